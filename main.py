@@ -5,22 +5,45 @@ warnings.filterwarnings("ignore", message=".*NotOpenSSLWarning.*")
 warnings.filterwarnings("ignore", category=UserWarning, module="urllib3")
 
 import os
+import sys
 import logging
 import requests
 import asyncio
 import re
+import html
 import time
 import json
 import pickle
+import multiprocessing
+import hmac
+import hashlib
+import inspect
+import bisect
+import random
+import threading
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
 
 load_dotenv()
 
 from datetime import datetime, timedelta
-from bs4 import BeautifulSoup
-from collections import defaultdict
+from bs4 import BeautifulSoup, UnicodeDammit
+from html.parser import HTMLParser
+import numpy as np
+from collections import OrderedDict, defaultdict, namedtuple
 from aiogram import Bot, Dispatcher, types
-from aiogram.utils.exceptions import MessageNotModified
+from aiogram.utils.exceptions import (
+    MessageNotModified,
+    RetryAfter,
+    NetworkError,
+    BotBlocked,
+    BotKicked,
+    ChatNotFound,
+    UserDeactivated,
+    CantInitiateConversation,
+)
 from aiogram.dispatcher.filters.state import StatesGroup, State
 from aiogram.types import (
     InlineKeyboardMarkup,
@@ -31,9 +54,19 @@ from aiogram.types import (
     CallbackQuery,
 )
 from aiogram.dispatcher import FSMContext
-from aiogram.dispatcher.filters import Text
+from aiogram.dispatcher.filters import (
+    StateFilter,
+    FilterNotPassed,
+    check_filters,
+    get_filters_spec,
+)
+from aiogram.dispatcher.handler import CancelHandler, SkipHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.utils import executor
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+import aiohttp
+from aiohttp import web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import csv
 from io import StringIO
@@ -77,6 +110,21 @@ try:
     ADMIN_ID = int(admin_id_raw)
 except ValueError as e:
     raise RuntimeError("ADMIN_ID must be an integer") from e
+# Режим приёма апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный https-адрес бота
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+# Альтернативный Bot API (локальный сервер или фейк для тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+# Google Sheets: google (по умолчанию) или fake — таблица в памяти для тестов
+SHEETS_BACKEND = os.getenv("SHEETS_BACKEND", "google").strip().lower()
+FAKE_SHEETS_LATENCY_MS = float(os.getenv("FAKE_SHEETS_LATENCY_MS", "0"))
+FAKE_SHEETS_ERROR_RATE = float(os.getenv("FAKE_SHEETS_ERROR_RATE", "0"))
+# Каталог для записи загруженных страниц цен/новостей (фикстуры для замеров)
+MARKET_FIXTURES_DIR = os.getenv("MARKET_FIXTURES_DIR", "")
 DB_PATH = "bot_data.db"
 CHANNEL_ID = "@your_channel"
 
@@ -92,6 +140,68 @@ CONFIG = {
     },
     "south_regions": ["Краснодар", "Ростов", "Астрахань", "Волгоград", "Ставрополь"],
     "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+    # Тяжёлые фоновые задачи (матчинг, отчёты) в пуле процессов
+    "cpu_jobs_workers": 2,
+    "cpu_job_timeout": 120,
+    # Подбор перевозчиков: логистов в первой волне, пауза между волнами (мин),
+    # число волн (последняя — всем оставшимся)
+    "carrier_wave_size": 5,
+    "carrier_wave_delay_min": 20,
+    "carrier_max_waves": 3,
+    # Исходящие сообщения: лимиты Telegram (~30 msg/s всего, ~1 msg/s в чат)
+    "outbound_rate": 30,
+    "outbound_chat_rate": 1.0,
+    "outbound_chat_burst": 3,
+    "outbound_workers": 8,
+    "outbound_max_retries": 3,
+    # Сводки уведомлений: окно накопления (сек, 0 — без сводок) и лимит событий
+    "notify_digest_window": 180,
+    "notify_digest_max_events": 15,
+    # Фоновые уведомления из обработчиков: одновременно не больше
+    "background_tasks_limit": 20,
+    # Апдейты: одновременно в обработке (разные пользователи) и окно повторов (сек)
+    "update_concurrency": 64,
+    "update_dedup_window": 2.0,
+    # Пользовательские кэши (BoundedCache): максимум записей в каждом
+    "user_cache_size": 10000,
+    # Google Sheets: отправка очереди изменений (сек), пауза после ошибок, повторы
+    "sheets_flush_interval": 5,
+    "sheets_backoff_max": 300,
+    "sheets_max_retries": 5,
+    # Предохранитель Google API: ошибок подряд до паузы, первая пауза (сек),
+    # таймаут одного запроса (сек)
+    "sheets_breaker_threshold": 3,
+    "sheets_breaker_cooldown": 30,
+    "sheets_request_timeout": 30,
+    # Индекс строк листов (ID -> строка): перечитывать не реже, сек
+    "sheets_index_ttl": 600,
+    # Кэш листов и сверка заголовков со схемой, сек
+    "sheets_worksheet_ttl": 3600,
+    # Сверка листов с локальными данными: период (ч) и лимит времени прохода (сек)
+    "sheets_reconcile_hours": 6,
+    "sheets_reconcile_budget": 120,
+    # Источники цен и новостей: таймаут запроса и дедлайн всего обновления (сек),
+    # соединений всего и на один хост
+    "market_fetch_timeout": 10,
+    "market_fetch_deadline": 25,
+    "market_fetch_connections": 20,
+    "market_fetch_per_host": 4,
+    # История цен: не чаще одной точки на ряд за столько сек
+    "price_history_min_interval": 600,
+    # Антифлуд: апдейтов в секунду на пользователя и запас
+    "flood_rate": 3.0,
+    "flood_burst": 20,
+    # Дорогие действия (@throttle): класс -> (вызовов в минуту, запас)
+    "throttle_classes": {
+        "search": (10, 3),
+        "deals": (20, 5),
+        "export": (4, 2),
+        "matching": (2, 1),
+    },
+    # Webhook: соединений от Telegram, апдейтов в обработке и ожидание при остановке
+    "webhook_max_connections": 40,
+    "webhook_queue_size": 1000,
+    "webhook_drain_timeout": 20,
 }
 
 # ════════════════════════════════════════════════════════════════════
@@ -109,6 +219,13 @@ BATCHES_JSON = os.path.join(DATA_DIR, "batches.json")
 PULLS_JSON = os.path.join(DATA_DIR, "pulls.json")
 PRICES_FILE = os.path.join(DATA_DIR, "prices.json")
 NEWS_FILE = os.path.join(DATA_DIR, "news.json")
+BROADCASTS_FILE = os.path.join(DATA_DIR, "broadcasts.json")
+SHEETS_OUTBOX_FILE = os.path.join(DATA_DIR, "sheets_outbox.pkl")
+# Апдейты webhook, прерванные при остановке (Telegram их уже не повторит)
+WEBHOOK_UNPROCESSED_FILE = os.path.join(DATA_DIR, "webhook_unprocessed.jsonl")
+# Справочные данные (в репозитории, не состояние)
+RESOURCES_DIR = "resources"
+REGION_PORT_DISTANCES_FILE = os.path.join(RESOURCES_DIR, "region_port_distances.json")
 GOOGLE_SHEETS_CREDENTIALS = "credentials.json"
 SPREADSHEET_ID = "1DywxtuWW4-1Q0O71ajVaBB5Ih15nZjA4rvlpV7P7NOA"
 # Алиасы для обратной совместимости: всегда указывают на DATA_DIR
@@ -117,11 +234,1586 @@ BATCHES_FILE = BATCHESFILE
 # ════════════════════════════════════════════════════════════════════
 # ИНИЦИАЛИЗАЦИЯ БОТА - ТОЛЬКО ОДИН РАЗ!
 # ════════════════════════════════════════════════════════════════════
-bot = Bot(token=API_TOKEN)
+class QueuedBot(Bot):
+    """
+    Bot, у которого send_message идёт через message_queue (общий лимит
+    Telegram и лимит на чат). Ответ в чат текущего апдейта (message.answer,
+    bot.send_message пользователю, нажавшему кнопку) получает приоритет
+    interactive, остальное — transactional. Явный priority передаётся как есть.
+    Документы и фото отправляются напрямую: поток файла нельзя повторить
+    после сетевой ошибки.
+    """
+
+    async def send_message(self, chat_id, text, *args, priority: int = None, **kwargs):
+        if args or message_queue.closed:
+            return await super().send_message(chat_id, text, *args, **kwargs)
+        if priority is None:
+            priority = current_chat_priority(chat_id)
+        return await message_queue.send_message(chat_id, text, priority=priority, **kwargs)
+
+
+def current_chat_priority(chat_id) -> int:
+    """interactive для чата/пользователя текущего апдейта, иначе transactional."""
+    current = {
+        str(obj.id)
+        for obj in (types.Chat.get_current(), types.User.get_current())
+        if obj is not None
+    }
+    if str(chat_id) in current:
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_TRANSACTIONAL
+
+
+bot = QueuedBot(
+    token=API_TOKEN,
+    server=(
+        TelegramAPIServer.from_base(TELEGRAM_API_URL)
+        if TELEGRAM_API_URL
+        else TELEGRAM_PRODUCTION
+    ),
+)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 scheduler = AsyncIOScheduler()
 
+# ════════════════════════════════════════════════════════════════════
+# ОГРАНИЧЕННЫЕ КЭШИ: TTL + РАЗМЕР ВМЕСТО ВЕЧНО РАСТУЩИХ СЛОВАРЕЙ
+# ════════════════════════════════════════════════════════════════════
+BOUNDED_CACHES = []  # все BoundedCache — для статистики и сохранения
+
+
+class BoundedCache:
+    """
+    Словарь с ограничением по размеру (LRU) и времени жизни записей (TTL).
+
+    Все операции O(1): записи лежат в OrderedDict в порядке последнего
+    обращения, при переполнении вытесняется самая давняя, просроченная
+    удаляется при чтении или когда оказывается в голове очереди.
+    persist — имя pickle-файла в DATA_DIR: содержимое загружается при
+    создании и сохраняется в on_shutdown (save_bounded_caches).
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float = None, persist: str = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl  # сек; None — без срока
+        self.path = os.path.join(DATA_DIR, persist) if persist else None
+        self._data = OrderedDict()  # ключ -> (срок по time.time() или None, значение)
+        self.metrics = {"hits": 0, "misses": 0, "evicted": 0, "expired": 0}
+        BOUNDED_CACHES.append(self)
+        if self.path:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return self._entry(key) is not None
+
+    def _entry(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[0] is not None and entry[0] <= time.time():
+            del self._data[key]
+            self.metrics["expired"] += 1
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._entry(key)
+        if entry is None:
+            self.metrics["misses"] += 1
+            return default
+        self._data.move_to_end(key)
+        self.metrics["hits"] += 1
+        return entry[1]
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (time.time() + ttl if ttl else None, value)
+        self._data.move_to_end(key)
+        self._trim()
+
+    __setitem__ = set
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def _trim(self):
+        now = time.time()
+        while self._data:
+            expires, _ = next(iter(self._data.values()))
+            if len(self._data) > self.maxsize:
+                self.metrics["evicted"] += 1
+            elif expires is not None and expires <= now:
+                self.metrics["expired"] += 1
+            else:
+                break
+            self._data.popitem(last=False)
+
+    def approx_bytes(self) -> int:
+        """Оценка занимаемой памяти (ключи и значения без вложенных объектов)."""
+        total = sys.getsizeof(self._data)
+        for key, (_, value) in self._data.items():
+            total += sys.getsizeof(key) + sys.getsizeof(value)
+        return total
+
+    def save(self):
+        try:
+            now = time.time()
+            items = [
+                (key, expires, value)
+                for key, (expires, value) in self._data.items()
+                if expires is None or expires > now
+            ]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(items, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.error(f"❌ Ошибка сохранения кэша {self.name}: {e}")
+
+    def load(self):
+        try:
+            if not os.path.exists(self.path):
+                return
+            with open(self.path, "rb") as f:
+                items = pickle.load(f)
+            now = time.time()
+            for key, expires, value in items:
+                if expires is None or expires > now:
+                    self._data[key] = (expires, value)
+            self._trim()
+            logging.info(f"✅ Кэш {self.name}: загружено {len(self._data)} записей")
+        except Exception as e:
+            logging.error(f"❌ Ошибка загрузки кэша {self.name}: {e}")
+
+
+def save_bounded_caches():
+    for cache in BOUNDED_CACHES:
+        if cache.path:
+            cache.save()
+
+
+def format_cache_metrics() -> str:
+    """Блок статистики ограниченных кэшей для админ-панели."""
+    if not BOUNDED_CACHES:
+        return ""
+    msg = "🧠 <b>Кэши в памяти:</b>\n"
+    total = 0
+    for cache in BOUNDED_CACHES:
+        m = cache.metrics
+        size = cache.approx_bytes()
+        total += size
+        lookups = m["hits"] + m["misses"]
+        hit_rate = f"{m['hits'] / lookups:.0%}" if lookups else "—"
+        msg += (
+            f"• {cache.name}: {len(cache)}/{cache.maxsize}, попаданий {hit_rate}, "
+            f"вытеснено {m['evicted']}, истекло {m['expired']}, ~{size / 1024:.0f} КБ\n"
+        )
+    msg += f"• Всего: ~{total / 1024:.0f} КБ\n"
+    return msg
+
+
+# ════════════════════════════════════════════════════════════════════
+# CALLBACK_DATA: ВЕРСИОНИРУЕМЫЙ КОДЕК ДЕЙСТВИЙ
+# ════════════════════════════════════════════════════════════════════
+CALLBACK_DATA_LIMIT = 64  # байт — ограничение Telegram на callback_data
+CALLBACK_STR_MARK = "~"  # строковое значение в поле "id" или вне списка вариантов
+BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+CALLBACK_ACTIONS = {}  # код -> CallbackAction
+CALLBACK_LEGACY_ACTIONS = {}  # legacy-префикс -> CallbackAction
+
+
+class CallbackDataError(ValueError):
+    """callback_data не подходит под текущую схему: устаревшая или битая кнопка."""
+
+
+def to_base36(value: int) -> str:
+    if value < 0:
+        return "-" + to_base36(-value)
+    digits = ""
+    while True:
+        value, rem = divmod(value, 36)
+        digits = BASE36_DIGITS[rem] + digits
+        if not value:
+            return digits
+
+
+def parse_legacy_value(raw: str):
+    """Значение из старого формата кнопок: число, если это цифры, иначе строка."""
+    return int(raw) if raw.isdigit() else raw
+
+
+class CallbackAction:
+    """
+    Схема callback-действия.
+
+    Формат: "<код>:<версия>:<поле>:<поле>...". Типы полей: int (base36),
+    "id" (int в base36 или строка с "~"), str (как есть, без ":") и кортеж
+    вариантов (индекс в base36). Пустые хвостовые поля опускаются, так что
+    кнопка укладывается в 64 байта даже для больших ID.
+
+    Кнопка с другой версией схемы считается устаревшей (CallbackDataError).
+    Кнопки старого формата (legacy_prefix) разбираются legacy_parse — по
+    умолчанию поля берутся по порядку через ":".
+
+    lock=(область, поле) — нажатия по одной сущности (пул, доставка)
+    обрабатываются по очереди, см. UpdateScheduler.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        code: str,
+        fields,
+        version: int = 1,
+        legacy_prefix: str = None,
+        legacy_parse=None,
+        lock=None,
+    ):
+        if code in CALLBACK_ACTIONS:
+            raise ValueError(f"Код callback-действия уже занят: {code!r}")
+        self.name = name
+        self.code = code
+        self.version = str(version)
+        self.fields = tuple(fields)  # ((имя, тип), ...)
+        self.payload = namedtuple(
+            name,
+            [field for field, _ in self.fields],
+            defaults=[None] * len(self.fields),
+        )
+        self.prefix = f"{code}:"
+        self.legacy_prefix = legacy_prefix
+        self.legacy_parse = legacy_parse
+        self.lock = lock  # (область, поле): нажатия по одной сущности идут по очереди
+        CALLBACK_ACTIONS[code] = self
+        if legacy_prefix:
+            CALLBACK_LEGACY_ACTIONS[legacy_prefix] = self
+
+    def pack(self, *args, **kwargs) -> str:
+        """callback_data для кнопки."""
+        values = self.payload(*args, **kwargs)
+        parts = [self.code, self.version]
+        parts += [
+            self._encode(field, kind, value)
+            for (field, kind), value in zip(self.fields, values)
+        ]
+        while len(parts) > 2 and parts[-1] == "":
+            parts.pop()
+        data = ":".join(parts)
+        if len(data.encode("utf-8")) > CALLBACK_DATA_LIMIT:
+            raise ValueError(
+                f"callback_data длиннее {CALLBACK_DATA_LIMIT} байт: {data!r}"
+            )
+        return data
+
+    def unpack(self, data: str):
+        """Payload из callback_data (новый или legacy-формат)."""
+        if self.legacy_prefix and data.startswith(self.legacy_prefix):
+            raw = data[len(self.legacy_prefix):]
+            try:
+                if self.legacy_parse:
+                    return self.legacy_parse(raw)
+                return self.payload(*[parse_legacy_value(v) for v in raw.split(":")])
+            except (TypeError, ValueError, IndexError) as e:
+                raise CallbackDataError(
+                    f"{self.name}: битая legacy-кнопка {data!r}"
+                ) from e
+
+        parts = data.split(":")
+        if parts[0] != self.code or len(parts) < 2:
+            raise CallbackDataError(f"{self.name}: чужая кнопка {data!r}")
+        if parts[1] != self.version:
+            raise CallbackDataError(
+                f"{self.name}: версия кнопки {parts[1]}, ожидается {self.version}"
+            )
+        raw_values = parts[2:]
+        if len(raw_values) > len(self.fields):
+            raise CallbackDataError(f"{self.name}: лишние поля в {data!r}")
+        try:
+            return self.payload(
+                *[
+                    self._decode(kind, raw)
+                    for (_, kind), raw in zip(self.fields, raw_values)
+                ]
+            )
+        except (ValueError, IndexError) as e:
+            raise CallbackDataError(f"{self.name}: битая кнопка {data!r}") from e
+
+    @staticmethod
+    def _encode(field: str, kind, value) -> str:
+        if value is None:
+            return ""
+        if kind is int:
+            return to_base36(int(value))
+        if kind == "id":
+            if isinstance(value, int) or str(value).isdigit():
+                return to_base36(int(value))
+            return CALLBACK_STR_MARK + str(value)
+        if isinstance(kind, tuple):
+            if value in kind:
+                return to_base36(kind.index(value))
+            value = CALLBACK_STR_MARK + str(value)
+        value = str(value)
+        if ":" in value:
+            raise ValueError(f"Поле {field!r} не может содержать ':': {value!r}")
+        return value
+
+    @staticmethod
+    def _decode(kind, raw: str):
+        if raw == "":
+            return None
+        if kind is str:
+            return raw
+        if raw.startswith(CALLBACK_STR_MARK):
+            if kind is int:
+                raise ValueError(f"ожидалось число: {raw!r}")
+            return raw[len(CALLBACK_STR_MARK):]
+        if isinstance(kind, tuple):
+            return kind[int(raw, 36)]
+        return int(raw, 36)
+
+
+def find_callback_action(data: str):
+    """CallbackAction по callback_data (новый или legacy-формат) или None."""
+    head = data.split(":", 1)[0]
+    return CALLBACK_ACTIONS.get(head) or CALLBACK_LEGACY_ACTIONS.get(head + ":")
+
+
+def parse_logist_status_legacy(raw: str):
+    """'delivery_12:completed' / '12:completed' -> LOGIST_STATUS_CB.payload."""
+    ref, status = raw.split(":")[:2]
+    source = ""
+    for candidate in ("delivery", "req"):
+        if ref.startswith(f"{candidate}_"):
+            source, ref = candidate, ref.split("_", 1)[1]
+            break
+    return LOGIST_STATUS_CB.payload(source, parse_legacy_value(ref), status)
+
+
+DEAL_FILTER_ROLES = ("farmer", "exporter", "logist", "expeditor")
+DEAL_FILTER_STATUSES = (
+    "active",
+    "reserved",
+    "sold",
+    "canceled",
+    "matches",
+    "filled",
+    "closed",
+    "cancelled",
+    "completed",
+    "pending",
+    "in_progress",
+)
+DELIVERY_TRANSITION_STATUSES = ("pending", "in_progress", "completed", "cancelled")
+
+VIEW_PULL_CB = CallbackAction(
+    "ViewPull", "vp", [("pull_id", "id")], legacy_prefix="view_pull:"
+)
+JOIN_PULL_CB = CallbackAction(
+    "JoinPull",
+    "jp",
+    [("pull_id", "id"), ("nonce", int)],  # nonce делает кнопки в списке уникальными
+    legacy_prefix="join_pull:",
+    lock=("pull", "pull_id"),
+)
+DEALS_FILTER_CB = CallbackAction(
+    "DealsFilter",
+    "ds",
+    [("role", DEAL_FILTER_ROLES), ("status", DEAL_FILTER_STATUSES)],
+    legacy_prefix="deals_status:",
+)
+LOGIST_STATUS_CB = CallbackAction(
+    "LogistStatus",
+    "ls",
+    [
+        ("source", ("", "delivery", "req")),  # где искать доставку; "" — legacy-поиск
+        ("delivery_id", "id"),
+        ("status", DELIVERY_TRANSITION_STATUSES),
+    ],
+    legacy_prefix="change_logist_status:",
+    legacy_parse=parse_logist_status_legacy,
+    lock=("delivery", "delivery_id"),
+)
+EXPEDITOR_STATUS_CB = CallbackAction(
+    "ExpeditorStatus",
+    "es",
+    [("freight_id", "id"), ("status", DELIVERY_TRANSITION_STATUSES)],
+    legacy_prefix="change_expeditor_status:",
+    lock=("freight", "freight_id"),
+)
+
+
+# ════════════════════════════════════════════════════════════════════
+# МАРШРУТИЗАЦИЯ АПДЕЙТОВ: ИНДЕКС ВМЕСТО ПЕРЕБОРА ФИЛЬТРОВ
+# ════════════════════════════════════════════════════════════════════
+ROUTE_SEPARATORS = ":_"
+ROUTE_SEGMENT_RE = re.compile(r"[^:_]*[:_]|[^:_]+")
+
+
+def split_route_key(key: str) -> list:
+    """'view_pull:12' -> ['view_', 'pull:', '12'] — разделитель остаётся в сегменте."""
+    return ROUTE_SEGMENT_RE.findall(key)
+
+
+def normalize_route_states(state):
+    """Состояния маршрута как в StateFilter aiogram. None в ответе = любое ("*")."""
+    items = state if isinstance(state, (list, set, tuple, frozenset)) else [state]
+    states = set()
+    for item in items:
+        if isinstance(item, State):
+            states.add(item.state)
+        elif inspect.isclass(item) and issubclass(item, StatesGroup):
+            states.update(item.all_states_names)
+        else:
+            states.add(item)
+    return None if "*" in states else frozenset(states)
+
+
+def route_keys(keys) -> list:
+    """Ключ маршрута: None, строка или список строк -> список."""
+    if keys is None:
+        return []
+    if isinstance(keys, str):
+        return [keys]
+    return list(keys)
+
+
+class Route:
+    """Обработчик, зарегистрированный в роутере."""
+
+    def __init__(self, order: int, handler, state, filters=None, text_only=False):
+        self.order = order  # порядок регистрации: из совпавших побеждает первый
+        self.handler = handler
+        self.spec = inspect.getfullargspec(inspect.unwrap(handler))
+        self.states = normalize_route_states(state)
+        self.filters = filters  # фильтры aiogram, которые нельзя проиндексировать
+        self.text_only = text_only  # маршрут без ключа ловит только текстовые сообщения
+        self.keys = []  # [(вид, ключ)] — для проверки перекрытий
+        self.action = None  # CallbackAction: роутер передаёт обработчику payload
+        self.throttle = getattr(handler, "throttle", None)  # см. @throttle
+
+    def accepts_state(self, raw_state) -> bool:
+        return self.states is None or raw_state in self.states
+
+    def covers_states_of(self, other: "Route") -> bool:
+        """Срабатывает ли этот маршрут во всех состояниях other."""
+        if self.states is None:
+            return True
+        return other.states is not None and other.states <= self.states
+
+    def describe(self) -> str:
+        keys = ", ".join(f"{kind}={key!r}" for kind, key in self.keys) or "без ключа"
+        return f"{self.handler.__name__} ({keys})"
+
+    def call_kwargs(self, data: dict) -> dict:
+        if self.spec.varkw:
+            return data
+        names = set(self.spec.args + self.spec.kwonlyargs)
+        return {k: v for k, v in data.items() if k in names}
+
+
+class RouteTable:
+    """
+    Индекс обработчиков одного типа апдейтов.
+
+    Точные ключи лежат в словаре, префиксы — в дереве по сегментам,
+    разделённым ":" / "_", маршруты без ключа — по состоянию FSM. Поиск
+    стоит O(1) для точного ключа и O(число сегментов) для префиксов и не
+    зависит от количества обработчиков. Перебором проверяются только
+    "generic"-маршруты с произвольными фильтрами (лямбды с исключениями,
+    команды, вложения) — их единицы.
+    """
+
+    def __init__(self, name: str, event_handler, key_name: str):
+        self.name = name
+        self.key_name = key_name  # "data" для callback, "text" для сообщений
+        self.event_handler = event_handler  # dp.message_handlers и т.п. — для фильтров
+        self.routes = []
+        self.exact = defaultdict(list)  # ключ -> [Route]
+        self.trie = {}  # сегмент -> узел; узел[None] = [Route]
+        self.by_state = defaultdict(list)  # маршруты без ключа: состояние -> [Route]
+        self.generic = []
+        self.metrics = {
+            "dispatched": 0,
+            "unmatched": 0,
+            "generic_checks": 0,
+            "stale": 0,
+        }
+
+    def add(self, route: Route, exact=None, prefixes=None):
+        self.routes.append(route)
+        for key in route_keys(exact):
+            self.exact[key].append(route)
+            route.keys.append((self.key_name, key))
+        for prefix in route_keys(prefixes):
+            if not prefix or prefix[-1] not in ROUTE_SEPARATORS:
+                raise ValueError(
+                    f"Префикс маршрута должен оканчиваться на ':' или '_': {prefix!r}"
+                )
+            node = self.trie
+            for segment in split_route_key(prefix):
+                node = node.setdefault(segment, {})
+            node.setdefault(None, []).append(route)
+            route.keys.append(("prefix", prefix))
+        if route.keys:
+            return
+        if route.filters is not None:
+            self.generic.append(route)
+        else:
+            for state in route.states if route.states is not None else ("*",):
+                self.by_state[state].append(route)
+
+    def prefix_routes(self, key: str) -> list:
+        found = []
+        node = self.trie
+        for segment in split_route_key(key):
+            node = node.get(segment)
+            if node is None:
+                break
+            found.extend(node.get(None, ()))
+        return found
+
+    def candidates(self, key, raw_state, is_text: bool = True) -> list:
+        """Подходящие по ключу и состоянию маршруты + generic, по порядку регистрации."""
+        found = set()
+        if key is not None:
+            found.update(self.exact.get(key, ()))
+            found.update(self.prefix_routes(key))
+        for route in self.by_state.get(raw_state, ()):
+            if is_text or not route.text_only:
+                found.add(route)
+        for route in self.by_state.get("*", ()):
+            if is_text or not route.text_only:
+                found.add(route)
+        found = [r for r in found if r.accepts_state(raw_state)]
+        found.extend(self.generic)
+        found.sort(key=lambda r: r.order)
+        return found
+
+    def check_conflicts(self) -> list:
+        """
+        Ключи маршрутов, которые никогда не сработают: раньше зарегистрирован
+        маршрут с тем же ключом (или охватывающим префиксом) во всех тех же
+        состояниях. Generic-маршруты не анализируются.
+        """
+        problems = []
+        for route in self.routes:
+            if route.filters is not None:
+                continue
+            keyless = []
+            for state in route.states or ():
+                keyless += self.by_state.get(state, [])
+            keyless += self.by_state.get("*", [])
+            for kind, key in route.keys or [(None, None)]:
+                earlier = list(keyless)
+                if kind == self.key_name:
+                    earlier += self.exact.get(key, [])
+                if kind is not None:
+                    earlier += self.prefix_routes(key)
+                for other in sorted(set(earlier), key=lambda r: r.order):
+                    if other.order >= route.order or other.handler is route.handler:
+                        continue
+                    if other.filters is not None or not other.covers_states_of(route):
+                        continue
+                    where = f"{kind}={key!r}" if kind else "без ключа"
+                    problems.append(
+                        f"{self.name}: {route.handler.__name__} ({where}) "
+                        f"не сработает — раньше зарегистрирован {other.describe()}"
+                    )
+                    break
+        return problems
+
+    def summary(self) -> str:
+        kinds = [kind for r in self.routes for kind, _ in r.keys]
+        keyed = sum(1 for r in self.routes if r.keys)
+        keyless = len(self.routes) - len(self.generic) - keyed
+        return (
+            f"{self.name}: {len(self.routes)} маршрутов "
+            f"(точных ключей {kinds.count(self.key_name)}, "
+            f"префиксов {kinds.count('prefix')}, по состоянию {keyless}, "
+            f"generic {len(self.generic)})"
+        )
+
+
+class UpdateRouter:
+    """
+    Единая точка входа для callback-ов и сообщений.
+
+    В aiogram регистрируются всего два обработчика (callback и message),
+    а они находят нужный маршрут по индексу RouteTable вместо
+    последовательной проверки сотен лямбда-фильтров. Семантика aiogram
+    сохраняется: из подходящих маршрутов вызывается зарегистрированный
+    раньше, SkipHandler передаёт апдейт следующему, аргументы обработчику
+    передаются по его сигнатуре (state, raw_state, данные middleware).
+    """
+
+    def __init__(self, dispatcher: Dispatcher):
+        self.dp = dispatcher
+        self._order = 0
+        self.callbacks = RouteTable(
+            "callback", dispatcher.callback_query_handlers, "data"
+        )
+        self.messages = RouteTable("message", dispatcher.message_handlers, "text")
+        dispatcher.register_callback_query_handler(self._dispatch_callback, state="*")
+        dispatcher.register_message_handler(
+            self._dispatch_message, content_types=types.ContentTypes.ANY, state="*"
+        )
+
+    def _next_order(self) -> int:
+        self._order += 1
+        return self._order
+
+    def _build_route(
+        self, table: RouteTable, handler, state, keyed: bool, custom_filters, config
+    ):
+        filters = None
+        if custom_filters or config:
+            # Нестандартные фильтры проверяет сам aiogram. У маршрута с ключом
+            # состояние проверяет роутер, у generic — фильтр состояния aiogram
+            filters = get_filters_spec(
+                self.dp,
+                self.dp.filters_factory.resolve(
+                    table.event_handler,
+                    *custom_filters,
+                    state="*" if keyed else state,
+                    **config,
+                ),
+            )
+            if not keyed:
+                state = "*"
+        return Route(self._next_order(), handler, state, filters)
+
+    def callback_query_handler(
+        self, *custom_filters, data=None, prefix=None, action=None, state=None, **kwargs
+    ):
+        """
+        Аналог dp.callback_query_handler.
+        data — точное значение callback_data (строка или список),
+        prefix — префикс, оканчивающийся на ":" или "_" (строка или список),
+        action — CallbackAction: обработчик получит разобранный payload.
+        """
+
+        def decorator(handler):
+            prefixes = route_keys(prefix)
+            if action is not None:
+                prefixes.append(action.prefix)
+                if action.legacy_prefix:
+                    prefixes.append(action.legacy_prefix)
+            keyed = data is not None or bool(prefixes)
+            route = self._build_route(
+                self.callbacks, handler, state, keyed, custom_filters, kwargs
+            )
+            route.action = action
+            self.callbacks.add(route, exact=data, prefixes=prefixes)
+            return handler
+
+        return decorator
+
+    def message_handler(
+        self, *custom_filters, text=None, content_types=None, state=None, **kwargs
+    ):
+        """
+        Аналог dp.message_handler.
+        text — точный текст сообщения/кнопки (строка или список).
+        """
+
+        def decorator(handler):
+            keyed = text is not None
+            config = dict(kwargs)
+            text_only = content_types in (None, "text", ["text"])
+            if not text_only:
+                config["content_types"] = content_types
+            route = self._build_route(
+                self.messages, handler, state, keyed, custom_filters, config
+            )
+            route.text_only = text_only
+            self.messages.add(route, exact=text)
+            return handler
+
+        return decorator
+
+    async def _dispatch(
+        self, table: RouteTable, obj, key, data: dict, is_text: bool = True
+    ):
+        state = data.get("state") or self.dp.current_state()
+        try:
+            raw_state = StateFilter.ctx_state.get()
+        except LookupError:
+            raw_state = await state.get_state()
+            StateFilter.ctx_state.set(raw_state)
+
+        for route in table.candidates(key, raw_state, is_text):
+            call_data = dict(data, state=state, raw_state=raw_state)
+            if route.action is not None:
+                try:
+                    call_data["payload"] = route.action.unpack(key)
+                except CallbackDataError as e:
+                    # Кнопка из старого сообщения — отвечаем, а не падаем в fallback
+                    logging.info(f"ℹ️ Устаревшая кнопка от {obj.from_user.id}: {e}")
+                    table.metrics["stale"] += 1
+                    await obj.answer(
+                        "ℹ️ Кнопка устарела. Откройте раздел заново.", show_alert=True
+                    )
+                    return None
+            if route.filters is not None:
+                table.metrics["generic_checks"] += 1
+                try:
+                    call_data.update(await check_filters(route.filters, (obj,)))
+                except FilterNotPassed:
+                    continue
+            if route.throttle:
+                if not await update_throttler.admit(obj, *route.throttle):
+                    return None
+            token = current_handler.set(route.handler)
+            try:
+                response = await route.handler(obj, **route.call_kwargs(call_data))
+            except SkipHandler:
+                continue
+            finally:
+                current_handler.reset(token)
+            table.metrics["dispatched"] += 1
+            return response
+
+        table.metrics["unmatched"] += 1
+        raise SkipHandler()
+
+    async def _dispatch_callback(self, callback: types.CallbackQuery, **data):
+        return await self._dispatch(self.callbacks, callback, callback.data, data)
+
+    async def _dispatch_message(self, message: types.Message, **data):
+        is_text = message.content_type == types.ContentType.TEXT
+        return await self._dispatch(self.messages, message, message.text, data, is_text)
+
+    def check_routes(self) -> list:
+        """Проверка при старте: конфликтующие и перекрытые маршруты."""
+        problems = self.callbacks.check_conflicts() + self.messages.check_conflicts()
+        for table in (self.callbacks, self.messages):
+            logging.info(f"🧭 Роутер: {table.summary()}")
+        for problem in problems:
+            logging.warning(f"⚠️ Роутер: {problem}")
+        return problems
+
+
+router = UpdateRouter(dp)
+
+
+def format_router_metrics() -> str:
+    """Блок статистики роутера апдейтов для админ-панели."""
+    lines = []
+    for table in (router.callbacks, router.messages):
+        m = table.metrics
+        if m["dispatched"] or m["unmatched"]:
+            lines.append(
+                f"• {table.name}: обработано {m['dispatched']}, "
+                f"без маршрута {m['unmatched']}, "
+                f"устаревших кнопок {m['stale']}, "
+                f"проверок generic-фильтров {m['generic_checks']}\n"
+            )
+    if not lines:
+        return ""
+    return "🧭 <b>Роутер апдейтов:</b>\n" + "".join(lines)
+
+
+# ════════════════════════════════════════════════════════════════════
+# ПЛАНИРОВЩИК АПДЕЙТОВ: ПОРЯДОК ПО ПОЛЬЗОВАТЕЛЮ, ПАРАЛЛЕЛЬНО МЕЖДУ НИМИ
+# ════════════════════════════════════════════════════════════════════
+class UpdateScheduler(BaseMiddleware):
+    """
+    Middleware, упорядочивающий обработку апдейтов.
+
+    Апдейты одного пользователя обрабатываются строго по очереди, разные
+    пользователи — параллельно, но не больше CONFIG["update_concurrency"]
+    одновременно. Callback-действия с lock (см. CallbackAction) вдобавок
+    сериализуются по сущности: два экспортёра/фермера, жмущие кнопки одного
+    пула, не гоняются за общие словари. Повтор той же кнопки (или команды)
+    в течение CONFIG["update_dedup_window"] схлопывается в одно нажатие.
+
+    Блокировки берутся в on_process_update и отпускаются в
+    on_post_process_update: aiogram вызывает его в finally, так что
+    CancelHandler или ошибка в обработчике ничего не подвешивают.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._locks = {}  # ключ -> [asyncio.Lock, число владельцев/ожидающих]
+        self._slots = None  # asyncio.Semaphore — создаётся в цикле событий
+        self._recent = BoundedCache(
+            "update_dedup",
+            CONFIG["user_cache_size"],
+            ttl=CONFIG["update_dedup_window"],
+        )  # ключ дубля -> последнее нажатие
+        self.metrics = {
+            "updates": 0,
+            "duplicates": 0,
+            "waited": 0,
+            "max_wait_ms": 0.0,
+        }
+
+    @staticmethod
+    def lock_keys(update: types.Update) -> list:
+        """Ключи сериализации: пользователь и (для callback с lock) сущность."""
+        if update.callback_query:
+            callback = update.callback_query
+            keys = [("user", callback.from_user.id)]
+            action = find_callback_action(callback.data or "")
+            if action is not None and action.lock:
+                scope, field = action.lock
+                try:
+                    value = getattr(action.unpack(callback.data), field)
+                except CallbackDataError:
+                    value = None
+                if value is not None:
+                    keys.append((scope, str(value)))
+            return keys
+        message = update.message or update.edited_message
+        if message and message.from_user:
+            return [("user", message.from_user.id)]
+        return []
+
+    @staticmethod
+    def duplicate_key(update: types.Update):
+        callback = update.callback_query
+        if callback:
+            message_id = callback.message.message_id if callback.message else None
+            return ("callback", callback.from_user.id, message_id, callback.data)
+        message = update.message
+        if message and message.from_user and (message.text or "").startswith("/"):
+            return ("command", message.from_user.id, message.text)
+        return None
+
+    def _is_duplicate(self, key) -> bool:
+        duplicate = key in self._recent
+        self._recent[key] = True  # каждое нажатие продлевает окно
+        return duplicate
+
+    async def _acquire(self, key):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._forget(key, entry)
+            raise
+
+    def _release(self, key):
+        entry = self._locks[key]
+        entry[0].release()
+        self._forget(key, entry)
+
+    def _forget(self, key, entry):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+    async def on_process_update(self, update: types.Update, data: dict):
+        self.metrics["updates"] += 1
+        dup_key = self.duplicate_key(update)
+        if dup_key is not None and self._is_duplicate(dup_key):
+            self.metrics["duplicates"] += 1
+            if update.callback_query:
+                try:
+                    await update.callback_query.answer()
+                except Exception as e:
+                    logging.debug(f"Не удалось ответить на повторный callback: {e}")
+            raise CancelHandler()
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(CONFIG["update_concurrency"])
+        started = time.monotonic()
+        held = []
+        try:
+            for key in self.lock_keys(update):
+                await self._acquire(key)
+                held.append(key)
+            await self._slots.acquire()
+        except BaseException:
+            for key in reversed(held):
+                self._release(key)
+            raise
+        data["_scheduler_keys"] = held
+
+        wait_ms = (time.monotonic() - started) * 1000
+        if wait_ms >= 1:
+            self.metrics["waited"] += 1
+            self.metrics["max_wait_ms"] = max(self.metrics["max_wait_ms"], wait_ms)
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        held = data.pop("_scheduler_keys", None)
+        if held is None:
+            return
+        self._slots.release()
+        for key in reversed(held):
+            self._release(key)
+
+
+update_scheduler = UpdateScheduler()
+dp.middleware.setup(update_scheduler)
+
+
+def format_update_scheduler_metrics() -> str:
+    """Блок статистики планировщика апдейтов для админ-панели."""
+    m = update_scheduler.metrics
+    if not m["updates"]:
+        return ""
+    msg = "🚦 <b>Апдейты:</b>\n"
+    msg += f"• Обработано: {m['updates']}, схлопнуто повторов: {m['duplicates']}\n"
+    msg += (
+        f"• Ждали очереди пользователя/сущности: {m['waited']} "
+        f"(макс. {m['max_wait_ms']:.0f} мс), активных блокировок: "
+        f"{len(update_scheduler._locks)}\n"
+    )
+    return msg
+
+
+# ════════════════════════════════════════════════════════════════════
+# АНТИФЛУД И ЛИМИТЫ НА ДОРОГИЕ ДЕЙСТВИЯ
+# ════════════════════════════════════════════════════════════════════
+def throttle(action_class: str, cost: float = 1):
+    """
+    Помечает обработчик как дорогой: вызов списывает cost токенов из
+    бакета (пользователь, action_class), бюджет класса —
+    CONFIG["throttle_classes"]. Ставится под декоратором роутера.
+    """
+
+    def decorator(handler):
+        handler.throttle = (action_class, cost)
+        return handler
+
+    return decorator
+
+
+class UpdateThrottler(BaseMiddleware):
+    """
+    Ограничение частоты запросов пользователя.
+
+    Антифлуд: на каждого пользователя общий токен-бакет на все апдейты
+    (CONFIG["flood_rate"] / CONFIG["flood_burst"]), проверяется в
+    on_pre_process_update — лишний апдейт отбрасывается до очереди
+    UpdateScheduler и не занимает блокировки. Дорогие обработчики (@throttle)
+    дополнительно списывают токены из бакета своего класса; его проверяет
+    роутер перед вызовом. При отказе пользователь получает «подождите»
+    (не чаще одного раза за период ожидания).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._buckets = BoundedCache("throttle_buckets", CONFIG["user_cache_size"])
+        self._warned = BoundedCache("throttle_warnings", CONFIG["user_cache_size"])
+        self.metrics = defaultdict(lambda: {"allowed": 0, "throttled": 0})
+
+    def _bucket(self, user_id, action_class: str):
+        key = (user_id, action_class)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if action_class == "flood":
+                rate, burst = CONFIG["flood_rate"], CONFIG["flood_burst"]
+            else:
+                per_minute, burst = CONFIG["throttle_classes"][action_class]
+                rate = per_minute / 60
+            bucket = TokenBucket(rate, burst)
+            self._buckets[key] = bucket
+        return bucket
+
+    async def admit(self, obj, action_class: str, cost: float = 1) -> bool:
+        """Списывает cost токенов; если не хватает — «подождите» и False."""
+        user_id = obj.from_user.id
+        wait = self._bucket(user_id, action_class).take(cost)
+        if not wait:
+            self.metrics[action_class]["allowed"] += 1
+            return True
+
+        self.metrics[action_class]["throttled"] += 1
+        warn_key = (user_id, action_class)
+        if warn_key in self._warned:
+            if isinstance(obj, types.CallbackQuery):
+                await obj.answer()
+            return False
+        self._warned.set(warn_key, True, ttl=wait)
+        logging.info(f"⏳ Лимит {action_class}: {user_id}, ждать {wait:.1f} с")
+        text = f"⏳ Слишком часто. Повторите через {max(1, round(wait))} с."
+        try:
+            await obj.answer(text)  # callback — всплывающее уведомление
+        except Exception as e:
+            logging.debug(f"Не удалось ответить о лимите: {e}")
+        return False
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        obj = update.message or update.callback_query or update.edited_message
+        if obj is None or obj.from_user is None:
+            return
+        if not await self.admit(obj, "flood"):
+            raise CancelHandler()
+
+
+update_throttler = UpdateThrottler()
+dp.middleware.setup(update_throttler)
+
+
+def format_throttle_metrics() -> str:
+    """Блок статистики лимитов для админ-панели."""
+    lines = [
+        f"• {name}: пропущено {m['allowed']}, отклонено {m['throttled']}\n"
+        for name, m in sorted(update_throttler.metrics.items())
+        if m["throttled"]
+    ]
+    if not lines:
+        return ""
+    return "⏳ <b>Лимиты запросов:</b>\n" + "".join(lines)
+
+
+# ════════════════════════════════════════════════════════════════════
+# ИСХОДЯЩИЕ СООБЩЕНИЯ: ОЧЕРЕДЬ С ЛИМИТАМИ TELEGRAM
+# ════════════════════════════════════════════════════════════════════
+PRIORITY_INTERACTIVE = 0  # ответы пользователю на его действие
+PRIORITY_TRANSACTIONAL = 1  # уведомления по сделкам, пулам, заявкам
+PRIORITY_BROADCAST = 2  # рассылки
+OUTBOUND_LANES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_TRANSACTIONAL: "transactional",
+    PRIORITY_BROADCAST: "broadcast",
+}
+# Получатель недоступен навсегда — повтор бессмысленен
+OUTBOUND_UNREACHABLE_ERRORS = (
+    BotBlocked,
+    BotKicked,
+    ChatNotFound,
+    UserDeactivated,
+    CantInitiateConversation,
+)
+
+
+class TokenBucket:
+    """Токен-бакет: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount: float = 1) -> float:
+        """Берёт amount токенов. Возвращает 0 или сколько секунд ждать (не взято)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def block(self, seconds: float):
+        """Запрет на seconds секунд (после RetryAfter)."""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+    def is_idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class OutboundMessageQueue:
+    """
+    Единая очередь исходящих сообщений.
+
+    Задания разбираются пулом воркеров в порядке приоритета
+    (interactive > transactional > broadcast). Отправка ограничена общим
+    токен-бакетом и бакетом на каждый чат: если чат исчерпал лимит, задание
+    откладывается, не занимая воркер. RetryAfter приостанавливает отправку
+    на указанное Telegram время, сетевые ошибки повторяются с экспоненциальной
+    задержкой. enqueue() возвращает future с результатом отправки; после
+    stop() future неотправленных заданий отменяются.
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._workers = []
+        self._seq = 0
+        self._global = TokenBucket(CONFIG["outbound_rate"], CONFIG["outbound_rate"])
+        self._chats = {}  # chat_id -> TokenBucket
+        self._delayed = {}  # seq -> (задание, TimerHandle): ждут повтора/лимита чата
+        self._lane_depth = defaultdict(int)  # приоритет -> заданий в очереди
+        self.closed = False
+        self.metrics = {
+            "queued": 0,
+            "sent": 0,
+            "failed": 0,
+            "unreachable": 0,
+            "retried": 0,
+            "retry_after": 0,
+            "sum_latency_ms": 0.0,
+            "max_latency_ms": 0.0,
+            "lanes": defaultdict(int),
+        }
+
+    def start(self):
+        """Запуск воркеров (нужен работающий event loop)."""
+        if self._workers or self.closed:
+            return
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        loop = asyncio.get_event_loop()
+        self._workers = [
+            loop.create_task(self._worker()) for _ in range(CONFIG["outbound_workers"])
+        ]
+        logging.info(f"📤 Очередь сообщений запущена: {len(self._workers)} воркеров")
+
+    async def stop(self, timeout: float = 10.0):
+        """Дожидается отправки очереди (не дольше timeout) и гасит воркеры."""
+        if not self._workers:
+            return
+        deadline = time.monotonic() + timeout
+        while (self._queue.qsize() or self._delayed) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        self.closed = True
+        # Отменённый воркер отменяет future задания, которое он отправлял
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        dropped = 0
+        for job, timer in list(self._delayed.values()):
+            timer.cancel()
+            dropped += self._drop(job)
+        self._delayed.clear()
+        while not self._queue.empty():
+            _, _, job = self._queue.get_nowait()
+            self._lane_depth[job["priority"]] -= 1
+            dropped += self._drop(job)
+        if dropped:
+            logging.warning(f"⚠️ Очередь сообщений остановлена, не отправлено: {dropped}")
+
+    @staticmethod
+    def _drop(job) -> int:
+        if job["future"].done():
+            return 0
+        job["future"].cancel()
+        return 1
+
+    def depth(self) -> dict:
+        """Глубина очереди по приоритетам (включая отложенные задания)."""
+        lanes = defaultdict(int)
+        for priority, count in self._lane_depth.items():
+            if count:
+                lanes[OUTBOUND_LANES.get(priority, str(priority))] += count
+        for job, _ in self._delayed.values():
+            lanes[OUTBOUND_LANES.get(job["priority"], str(job["priority"]))] += 1
+        return dict(lanes)
+
+    def enqueue(
+        self,
+        chat_id,
+        *args,
+        priority: int = PRIORITY_TRANSACTIONAL,
+        method: str = "send_message",
+        **kwargs,
+    ) -> asyncio.Future:
+        """Ставит вызов bot.<method>(chat_id, *args, **kwargs) в очередь."""
+        future = asyncio.get_event_loop().create_future()
+        if self.closed:
+            future.cancel()
+            return future
+        self.start()
+        job = {
+            "chat_id": chat_id,
+            "method": method,
+            "args": args,
+            "kwargs": kwargs,
+            "priority": priority,
+            "attempt": 0,
+            "future": future,
+            "queued_at": time.monotonic(),
+        }
+        self.metrics["queued"] += 1
+        self._put(job)
+        return future
+
+    async def send_message(
+        self, chat_id, text, priority: int = PRIORITY_TRANSACTIONAL, **kwargs
+    ):
+        """bot.send_message через очередь; исключения пробрасываются вызывающему."""
+        return await self.enqueue(chat_id, text, priority=priority, **kwargs)
+
+    def _put(self, job):
+        self._seq += 1
+        self._lane_depth[job["priority"]] += 1
+        self._queue.put_nowait((job["priority"], self._seq, job))
+
+    def _put_later(self, job, delay: float):
+        self._seq += 1
+        key = self._seq
+
+        def put():
+            self._delayed.pop(key, None)
+            self._put(job)
+
+        timer = asyncio.get_event_loop().call_later(delay, put)
+        self._delayed[key] = (job, timer)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        key = str(chat_id)
+        bucket = self._chats.get(key)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                for idle_key in [k for k, b in self._chats.items() if b.is_idle()]:
+                    self._chats.pop(idle_key, None)
+            bucket = self._chats[key] = TokenBucket(
+                CONFIG["outbound_chat_rate"], CONFIG["outbound_chat_burst"]
+            )
+        return bucket
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            self._lane_depth[job["priority"]] -= 1
+            try:
+                await self._deliver(job)
+            except asyncio.CancelledError:
+                if not job["future"].done():
+                    job["future"].cancel()
+                raise
+            except Exception as e:
+                logging.error(f"❌ Воркер очереди сообщений: {e}", exc_info=True)
+                if not job["future"].done():
+                    job["future"].set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, job):
+        future = job["future"]
+        if future.done():  # вызывающий отменил ожидание
+            return
+
+        chat_wait = self._chat_bucket(job["chat_id"]).take()
+        if chat_wait > 0:
+            self._put_later(job, chat_wait)
+            return
+        global_wait = self._global.take()
+        while global_wait > 0:
+            await asyncio.sleep(global_wait)
+            global_wait = self._global.take()
+
+        try:
+            # Метод базового Bot: QueuedBot.send_message снова поставил бы в очередь
+            result = await getattr(Bot, job["method"])(
+                bot, job["chat_id"], *job["args"], **job["kwargs"]
+            )
+        except RetryAfter as e:
+            self.metrics["retry_after"] += 1
+            self._global.block(e.timeout)
+            self._chat_bucket(job["chat_id"]).block(e.timeout)
+            logging.warning(f"⏳ Flood control: пауза {e.timeout} с (чат {job['chat_id']})")
+            self._retry(job, e.timeout, e)
+        except OUTBOUND_UNREACHABLE_ERRORS as e:
+            self.metrics["unreachable"] += 1
+            self._fail(job, e)
+        except (NetworkError, asyncio.TimeoutError) as e:
+            self._retry(job, min(2 ** job["attempt"], 30), e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            latency_ms = (time.monotonic() - job["queued_at"]) * 1000
+            self.metrics["sent"] += 1
+            self.metrics["lanes"][OUTBOUND_LANES.get(job["priority"])] += 1
+            self.metrics["sum_latency_ms"] += latency_ms
+            self.metrics["max_latency_ms"] = max(self.metrics["max_latency_ms"], latency_ms)
+            if not future.done():
+                future.set_result(result)
+
+    def _retry(self, job, delay: float, error: Exception):
+        job["attempt"] += 1
+        if job["attempt"] > CONFIG["outbound_max_retries"]:
+            self._fail(job, error)
+            return
+        self.metrics["retried"] += 1
+        self._put_later(job, delay)
+
+    def _fail(self, job, error: Exception):
+        self.metrics["failed"] += 1
+        if not job["future"].done():
+            job["future"].set_exception(error)
+
+
+message_queue = OutboundMessageQueue()
+
+
+async def notify_many(chat_ids, text, priority: int = PRIORITY_TRANSACTIONAL, **kwargs):
+    """
+    Рассылает одно сообщение списку чатов через очередь.
+    Повторы chat_id и заблокировавшие бота пропускаются, недоступные
+    получатели отмечаются. Возвращает (отправлено, [не доставлено]).
+    """
+    unique_ids = []
+    seen = set()
+    for chat_id in chat_ids:
+        if chat_id is None or str(chat_id) in seen or is_user_blocked(chat_id):
+            continue
+        seen.add(str(chat_id))
+        unique_ids.append(int(chat_id) if str(chat_id).isdigit() else chat_id)
+
+    results = await asyncio.gather(
+        *(
+            message_queue.send_message(chat_id, text, priority=priority, **kwargs)
+            for chat_id in unique_ids
+        ),
+        return_exceptions=True,
+    )
+    failed_ids = []
+    for chat_id, result in zip(unique_ids, results):
+        if isinstance(result, Exception):
+            logging.error(f"❌ Не доставлено {chat_id}: {result}")
+            failed_ids.append(chat_id)
+            if isinstance(result, OUTBOUND_UNREACHABLE_ERRORS):
+                mark_user_blocked(chat_id)
+    return len(unique_ids) - len(failed_ids), failed_ids
+
+
+def format_outbound_metrics() -> str:
+    """Блок статистики очереди сообщений для админ-панели."""
+    m = message_queue.metrics
+    if not m["queued"]:
+        return ""
+    avg_ms = m["sum_latency_ms"] / m["sent"] if m["sent"] else 0
+    depth = message_queue.depth()
+    lanes = ", ".join(f"{lane} {count}" for lane, count in sorted(m["lanes"].items()))
+    msg = "📤 <b>Исходящие сообщения:</b>\n"
+    msg += f"• Отправлено: {m['sent']} из {m['queued']} ({lanes or '—'})\n"
+    msg += (
+        f"• Ошибок: {m['failed']}, недоступны: {m['unreachable']}, "
+        f"повторов: {m['retried']}, flood: {m['retry_after']}\n"
+    )
+    msg += f"• Задержка: ср. {avg_ms:.0f} мс, макс. {m['max_latency_ms']:.0f} мс\n"
+    msg += f"• В очереди: {sum(depth.values())}\n"
+    d = notification_digest.metrics
+    if d["digests"]:
+        msg += f"• Сводок: {d['digests']} (объединено событий: {d['coalesced']})\n"
+    return msg
+
+
+# ════════════════════════════════════════════════════════════════════
+# УВЕДОМЛЕНИЯ: СВОДКИ (DIGEST) ПО ПОЛЬЗОВАТЕЛЮ
+# ════════════════════════════════════════════════════════════════════
+NOTIFY_MODE_INSTANT = "instant"
+NOTIFY_MODE_DIGEST = "digest"
+NOTIFY_URGENT_KINDS = {"offer_accepted"}  # всегда уходят сразу
+NOTIFY_KIND_TITLES = {
+    "match": "🎯 Подходящие пулы",
+    "new_request": "🚚 Новые заявки на перевозку",
+    "offer_accepted": "🎉 Принятые предложения",
+    "offer_rejected": "❌ Отклонённые предложения",
+}
+NOTIFY_DIGEST_MAX_LINES = 20
+NOTIFY_DIGEST_MAX_BUTTONS = 8
+
+
+def get_notify_mode(user_id) -> str:
+    user = get_user_by_id(user_id)
+    mode = user.get("notify_mode") if isinstance(user, dict) else None
+    # Сводки — по выбору пользователя в настройках, по умолчанию «сразу»
+    return mode if mode in (NOTIFY_MODE_INSTANT, NOTIFY_MODE_DIGEST) else NOTIFY_MODE_INSTANT
+
+
+class NotificationDigest:
+    """
+    Копит события для получателя в течение окна CONFIG["notify_digest_window"]
+    и отправляет их одним сообщением-сводкой с общей клавиатурой.
+    Срочные типы и пользователи в режиме «сразу» получают сообщение сразу;
+    если за окно пришло одно событие, уходит исходное сообщение.
+    """
+
+    def __init__(self):
+        self._buffers = {}  # str(user_id) -> {"user_id", "events": [...]}
+        self._timers = {}  # str(user_id) -> asyncio.TimerHandle
+        self.metrics = {"events": 0, "instant": 0, "digests": 0, "coalesced": 0}
+
+    async def notify(
+        self, user_id, kind: str, summary: str, text: str, keyboard=None, urgent: bool = False
+    ) -> bool:
+        """Событие для пользователя. True — отправлено или поставлено в сводку."""
+        self.metrics["events"] += 1
+        window = CONFIG["notify_digest_window"]
+        if (
+            urgent
+            or kind in NOTIFY_URGENT_KINDS
+            or window <= 0
+            or get_notify_mode(user_id) == NOTIFY_MODE_INSTANT
+        ):
+            self.metrics["instant"] += 1
+            return await self._send(user_id, text, keyboard)
+
+        key = str(user_id)
+        buffer = self._buffers.setdefault(key, {"user_id": user_id, "events": []})
+        buffer["events"].append(
+            {"kind": kind, "summary": summary, "text": text, "keyboard": keyboard}
+        )
+        if len(buffer["events"]) >= CONFIG["notify_digest_max_events"]:
+            background_tasks.spawn("notify_digest", self.flush(key))
+        elif key not in self._timers:
+            self._timers[key] = asyncio.get_event_loop().call_later(
+                window, lambda: background_tasks.spawn("notify_digest", self.flush(key))
+            )
+        return True
+
+    async def flush(self, key: str) -> bool:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        buffer = self._buffers.pop(key, None)
+        if not buffer or not buffer["events"]:
+            return False
+
+        events = buffer["events"]
+        if len(events) == 1:
+            return await self._send(buffer["user_id"], events[0]["text"], events[0]["keyboard"])
+
+        self.metrics["digests"] += 1
+        self.metrics["coalesced"] += len(events)
+        text, keyboard = self.render(events)
+        return await self._send(buffer["user_id"], text, keyboard)
+
+    async def flush_all(self):
+        """Остановка бота: отправляем все накопленные сводки."""
+        for key in list(self._buffers):
+            await self.flush(key)
+
+    @staticmethod
+    def render(events: list):
+        """Сводка: события сгруппированы по типу, кнопки — первые из каждого события."""
+        by_kind = defaultdict(list)
+        for event in events:
+            by_kind[event["kind"]].append(event["summary"])
+
+        text = f"🔔 <b>Сводка уведомлений ({len(events)})</b>\n"
+        lines = 0
+        for kind, summaries in by_kind.items():
+            text += f"\n<b>{NOTIFY_KIND_TITLES.get(kind, kind)}</b> ({len(summaries)})\n"
+            for summary in summaries:
+                if lines >= NOTIFY_DIGEST_MAX_LINES:
+                    break
+                # Краткое описание — свободный ввод (культура, маршрут)
+                text += f"• {html.escape(str(summary), quote=False)}\n"
+                lines += 1
+        if lines < len(events):
+            text += f"\n… и ещё {len(events) - lines}\n"
+
+        keyboard = InlineKeyboardMarkup(row_width=1)
+        seen = set()
+        for event in events:
+            rows = event["keyboard"].inline_keyboard if event["keyboard"] else []
+            button = rows[0][0] if rows and rows[0] else None
+            if button is None or button.callback_data in seen:
+                continue
+            seen.add(button.callback_data)
+            keyboard.add(button)
+            if len(seen) >= NOTIFY_DIGEST_MAX_BUTTONS:
+                break
+        return text, keyboard
+
+    async def _send(self, user_id, text: str, keyboard=None) -> bool:
+        try:
+            await message_queue.send_message(
+                user_id, text, parse_mode="HTML", reply_markup=keyboard
+            )
+            return True
+        except OUTBOUND_UNREACHABLE_ERRORS as e:
+            mark_user_blocked(user_id)
+            logging.error(f"❌ Уведомление {user_id} не доставлено: {e}")
+        except Exception as e:
+            logging.error(f"❌ Уведомление {user_id} не доставлено: {e}")
+        return False
+
+
+notification_digest = NotificationDigest()
+
+# ════════════════════════════════════════════════════════════════════
+# ФОНОВЫЕ ЗАДАЧИ ОБРАБОТЧИКОВ (уведомления после ответа пользователю)
+# ════════════════════════════════════════════════════════════════════
+class BackgroundTaskRunner:
+    """
+    Запуск корутин в фоне с ограничением параллельности.
+
+    Обработчик вызывает spawn(name, coro) и сразу отвечает пользователю.
+    Ошибки задач логируются и учитываются в метриках по имени задачи;
+    drain() при остановке даёт незавершённым задачам доработать.
+    """
+
+    def __init__(self):
+        self._semaphore = None
+        self._tasks = set()
+        self.metrics = defaultdict(
+            lambda: {"started": 0, "ok": 0, "failed": 0, "sum_ms": 0.0, "last_error": ""}
+        )
+
+    def spawn(self, name: str, coro) -> asyncio.Task:
+        """Ставит корутину в фон под именем name (для логов и метрик)."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(CONFIG["background_tasks_limit"])
+        self.metrics[name]["started"] += 1
+        task = asyncio.get_event_loop().create_task(self._run(name, coro))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, name: str, coro):
+        m = self.metrics[name]
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                result = await coro
+                m["ok"] += 1
+                return result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                m["failed"] += 1
+                m["last_error"] = f"{type(e).__name__}: {e}"[:200]
+                logging.error(f"❌ Фоновая задача {name}: {e}", exc_info=True)
+            finally:
+                m["sum_ms"] += (time.perf_counter() - started) * 1000
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    async def drain(self, timeout: float = 15.0) -> int:
+        """Ждёт завершения задач не дольше timeout, остальные отменяет."""
+        if not self._tasks:
+            return 0
+        done, still_running = await asyncio.wait(list(self._tasks), timeout=timeout)
+        for task in still_running:
+            task.cancel()
+        if still_running:
+            await asyncio.gather(*still_running, return_exceptions=True)
+            logging.warning(f"⚠️ Отменено фоновых задач при остановке: {len(still_running)}")
+        return len(still_running)
+
+
+background_tasks = BackgroundTaskRunner()
+
+
+def format_background_task_metrics() -> str:
+    """Блок статистики фоновых задач обработчиков для админ-панели."""
+    if not background_tasks.metrics:
+        return ""
+    msg = f"🧵 <b>Фоновые уведомления</b> (в работе: {background_tasks.pending}):\n"
+    for name, m in sorted(background_tasks.metrics.items()):
+        done = m["ok"] + m["failed"]
+        avg_ms = m["sum_ms"] / done if done else 0
+        msg += f"• {name}: {m['ok']}/{m['started']} ок, ошибок {m['failed']}, ср. {avg_ms:.0f} мс\n"
+        if m["last_error"]:
+            msg += f"  ↳ {m['last_error']}\n"
+    return msg
+
+
 # ════════════════════════════════════════════════════════════════════
 # ХРАНИЛИЩА ДАННЫХ - БЕЗ ДУБЛИРОВАНИЯ!
 # ════════════════════════════════════════════════════════════════════
@@ -151,9 +1843,14 @@ logistic_offers = {}
 
 # Рейтинги
 logistic_ratings = {}
-last_start_times = {}
-welcome_message_ids = {}
-last_back_click = {}
+
+# ID приветственных сообщений: бот может удалить своё сообщение в течение 48 ч
+welcome_message_ids = BoundedCache(
+    "welcome_message_ids",
+    CONFIG["user_cache_size"],
+    ttl=48 * 3600,
+    persist="welcome_message_ids.pkl",
+)
 # Счётчики
 batch_counter = 0
 pull_counter = 0
@@ -376,6 +2073,11 @@ def get_user_by_id(user_id):
     return users.get(user_id) or users.get(str(user_id)) or {}
 
 
+def is_admin_user(user_id) -> bool:
+    """Главный админ (ADMIN_ID) или пользователь с ролью admin."""
+    return user_id == ADMIN_ID or get_user_by_id(user_id).get("role") == "admin"
+
+
 def get_offer_logist_id(offer: dict):
     """ID логиста в оффере с учётом legacy-ключей."""
     if not isinstance(offer, dict):
@@ -1214,20 +2916,6 @@ def _batch_matches_pull(batch, pull_data):
     )
 
 
-def parse_join_pull_callback(callback_data: str) -> dict:
-    """Универсальный парсер callback для join_pull"""
-    try:
-        parts = callback_data.split(":")
-        pull_id = int(parts[1])
-        timestamp = parts[2] if len(parts) >= 3 else None
-
-        logging.info(f"🔗 Parsed callback: pull_id={pull_id}, timestamp={timestamp}")
-        return {"pull_id": pull_id, "timestamp": timestamp}
-    except (ValueError, IndexError) as e:
-        logging.error(f"❌ Ошибка парсинга '{callback_data}': {e}")
-        raise
-
-
 def validate_batch_volume(batch: dict, pull: dict) -> tuple:
     """Проверяет, поместится ли партия в пул"""
     batch_volume = batch.get("volume", 0)
@@ -1244,77 +2932,486 @@ def validate_batch_volume(batch: dict, pull: dict) -> tuple:
     return (True, "✅ Партия подходит")
 
 
+# ════════════════════════════════════════════════════════════════════
+# РЕЗЕРВИРОВАНИЕ ОБЪЁМА ПУЛА (reserve -> confirm -> release)
+# ════════════════════════════════════════════════════════════════════
+PULL_RESERVATION_TTL = 600  # секунд до автоматического снятия резерва
+VOLUME_EPSILON = 1e-6
+
+
+class PullReservationManager:
+    """
+    Сериализует изменения объёма пула через asyncio.Lock на каждый пул.
+
+    reserve() под локом проверяет свободный объём с учётом чужих резервов и
+    откладывает объём; confirm() под тем же локом применяет изменение к
+    пулу (apply_func) и снимает резерв; release() снимает резерв без
+    изменений. Просроченные резервы снимаются лениво и периодической задачей.
+    Операции над разными пулами не блокируют друг друга.
+    """
+
+    def __init__(self, ttl: int = PULL_RESERVATION_TTL):
+        self.ttl = ttl
+        self._locks = {}  # pull_key -> asyncio.Lock
+        self._reservations = {}  # reservation_id -> dict
+        self._reserved_by_pull = defaultdict(float)  # pull_key -> тонн в резерве
+        self._counter = 0
+
+    @staticmethod
+    def _key(pull_id) -> str:
+        return str(pull_id)
+
+    def lock(self, pull_id) -> asyncio.Lock:
+        """Лок пула для любых изменений current_volume/статуса."""
+        key = self._key(pull_id)
+        pull_lock = self._locks.get(key)
+        if pull_lock is None:
+            pull_lock = self._locks[key] = asyncio.Lock()
+        return pull_lock
+
+    def reserved_volume(self, pull_id) -> float:
+        """Объём пула в активных резервах."""
+        self._purge_expired(self._key(pull_id))
+        return self._reserved_by_pull.get(self._key(pull_id), 0.0)
+
+    def available_volume(self, pull_id, pull: dict = None) -> float:
+        """Свободный объём: цель - текущий объём - резервы."""
+        if pull is None:
+            _, pull = find_pull_by_id(pull_id)
+        if not isinstance(pull, dict):
+            return 0.0
+        target = safe_float(pull.get("target_volume"))
+        current = safe_float(pull.get("current_volume"))
+        return max(target - current - self.reserved_volume(pull_id), 0.0)
+
+    async def reserve(self, pull_id, volume: float, holder=None, ttl: int = None):
+        """Резервирует объём. Возвращает reservation_id или None, если места нет."""
+        volume = safe_float(volume)
+        if volume <= 0:
+            return None
+
+        async with self.lock(pull_id):
+            _, pull = find_pull_by_id(pull_id)
+            if not isinstance(pull, dict) or not is_pull_open_status(pull.get("status")):
+                return None
+            if volume > self.available_volume(pull_id, pull) + VOLUME_EPSILON:
+                return None
+
+            self._counter += 1
+            reservation_id = f"r{self._counter}"
+            key = self._key(pull_id)
+            self._reservations[reservation_id] = {
+                "pull_id": pull_id,
+                "pull_key": key,
+                "volume": volume,
+                "holder": holder,
+                "expires_at": time.monotonic() + (ttl or self.ttl),
+            }
+            self._reserved_by_pull[key] += volume
+            return reservation_id
+
+    async def confirm(self, reservation_id, apply_func):
+        """
+        Применяет резерв: apply_func(pull) вызывается под локом пула и
+        должна синхронно изменить пул. Возвращает (True, результат apply_func)
+        или (False, None), если резерв истёк или места больше нет.
+        """
+        reservation = self._reservations.get(reservation_id)
+        if reservation is None:
+            return False, None
+
+        async with self.lock(reservation["pull_key"]):
+            reservation = self._take(reservation_id)
+            if reservation is None or reservation["expires_at"] < time.monotonic():
+                return False, None
+
+            _, pull = find_pull_by_id(reservation["pull_id"])
+            if not isinstance(pull, dict):
+                return False, None
+
+            # Объём мог измениться в обход резервов (редактирование пула)
+            target = safe_float(pull.get("target_volume"))
+            current = safe_float(pull.get("current_volume"))
+            if target > 0 and current + reservation["volume"] > target + VOLUME_EPSILON:
+                return False, None
+
+            return True, apply_func(pull)
+
+    def release(self, reservation_id) -> bool:
+        """Снимает резерв без изменения пула."""
+        return self._take(reservation_id) is not None
+
+    def _take(self, reservation_id):
+        reservation = self._reservations.pop(reservation_id, None)
+        if reservation is not None:
+            key = reservation["pull_key"]
+            self._reserved_by_pull[key] = max(
+                self._reserved_by_pull[key] - reservation["volume"], 0.0
+            )
+            if self._reserved_by_pull[key] <= VOLUME_EPSILON:
+                self._reserved_by_pull.pop(key, None)
+        return reservation
+
+    def _purge_expired(self, pull_key=None) -> int:
+        now = time.monotonic()
+        expired = [
+            reservation_id
+            for reservation_id, reservation in self._reservations.items()
+            if reservation["expires_at"] < now
+            and (pull_key is None or reservation["pull_key"] == pull_key)
+        ]
+        for reservation_id in expired:
+            self._take(reservation_id)
+        return len(expired)
+
+    async def purge_expired(self) -> int:
+        """
+        Периодическая очистка: просроченные резервы и неиспользуемые локи.
+        Корутина, чтобы планировщик выполнял её в цикле событий, а не в
+        потоке: локи и резервы используются только из цикла.
+        """
+        purged = self._purge_expired()
+        for key, pull_lock in list(self._locks.items()):
+            if not pull_lock.locked() and key not in self._reserved_by_pull:
+                self._locks.pop(key, None)
+        if purged:
+            logging.info(f"🧹 Снято просроченных резервов пулов: {purged}")
+        return purged
+
+
+pull_reservations = PullReservationManager()
+
+
+# ════════════════════════════════════════════════════════════════════
+# УЧЁТ НАПОЛНЕНИЯ ПУЛОВ (объём, резервы, участники, пороги)
+# ════════════════════════════════════════════════════════════════════
+PULL_FILL_THRESHOLDS = (50, 90, 100)  # % заполнения, на которые есть события
+
+
+class PullFillTracker:
+    """
+    Единый учёт наполнения пулов.
+
+    Все изменения current_volume проходят через add_volume()/set_volume():
+    трекер пишет значение в сам пул (он остаётся источником для pickle и
+    для объёма — приращение считается от current_volume пула, так что
+    запись в обход трекера не теряется) и инкрементально обновляет
+    агрегаты — объём и число участников. После правки target_volume нужен
+    refresh(), чтобы пересчитать уровень заполнения. Резервы
+    берутся из pull_reservations. При пересечении порога заполнения вверх
+    синхронно вызываются подписчики subscribe(threshold, callback); при
+    падении объёма ниже порога событие может сработать снова.
+    reconcile() периодически сверяет агрегаты с pulls/pullparticipants.
+    """
+
+    def __init__(self, thresholds=PULL_FILL_THRESHOLDS):
+        self.thresholds = tuple(sorted(thresholds))
+        self._stats = {}  # pull_key -> {"current", "participants", "level"}
+        self._listeners = defaultdict(list)  # threshold -> [callback(pull_id, pull, threshold)]
+        self.events_fired = 0
+        self.drift_fixed = 0
+
+    @staticmethod
+    def _key(pull_id) -> str:
+        return str(pull_id)
+
+    @staticmethod
+    def _participants_of(pull_id) -> list:
+        participants = pullparticipants.get(pull_id)
+        if participants is None:
+            participants = pullparticipants.get(str(pull_id))
+        if participants is None and str(pull_id).isdigit():
+            participants = pullparticipants.get(int(pull_id))
+        return participants if isinstance(participants, list) else []
+
+    @staticmethod
+    def fill_percent_of(pull: dict, current: float = None) -> float:
+        target = safe_float(pull.get("target_volume"))
+        if target <= 0:
+            return 0.0
+        if current is None:
+            current = safe_float(pull.get("current_volume"))
+        return current / target * 100
+
+    def _level(self, percent: float) -> int:
+        level = 0
+        for threshold in self.thresholds:
+            if percent + VOLUME_EPSILON >= threshold:
+                level = threshold
+        return level
+
+    def subscribe(self, threshold: int, callback):
+        """Подписка на достижение порога заполнения (в процентах)."""
+        if threshold not in self.thresholds:
+            raise ValueError(f"Неизвестный порог заполнения: {threshold}")
+        self._listeners[threshold].append(callback)
+
+    def _entry(self, pull_id, pull: dict) -> dict:
+        key = self._key(pull_id)
+        entry = self._stats.get(key)
+        if entry is None:
+            current = safe_float(pull.get("current_volume"))
+            entry = self._stats[key] = {
+                "current": current,
+                "participants": len(self._participants_of(pull_id)),
+                "level": self._level(self.fill_percent_of(pull, current)),
+            }
+        return entry
+
+    def _update(self, pull_id, pull: dict, current: float, fire: bool = True):
+        entry = self._entry(pull_id, pull)
+        entry["current"] = current
+        new_level = self._level(self.fill_percent_of(pull, current))
+        old_level = entry["level"]
+        entry["level"] = new_level
+        if not fire or new_level <= old_level:
+            return
+
+        for threshold in self.thresholds:
+            if old_level < threshold <= new_level:
+                self.events_fired += 1
+                logging.info(f"📈 Пул #{pull_id} достиг {threshold}% заполнения")
+                for callback in self._listeners.get(threshold, []):
+                    try:
+                        callback(pull_id, pull, threshold)
+                    except Exception as e:
+                        logging.error(
+                            f"❌ Ошибка обработчика порога {threshold}% пула #{pull_id}: {e}",
+                            exc_info=True,
+                        )
+
+    def add_volume(self, pull_id, pull: dict, delta: float) -> float:
+        """Прибавляет объём к пулу и возвращает новый current_volume."""
+        entry = self._entry(pull_id, pull)
+        base = safe_float(pull.get("current_volume"))
+        if abs(entry["current"] - base) > VOLUME_EPSILON:
+            logging.info(
+                f"🔄 Пул #{pull_id}: объём изменён в обход учёта "
+                f"({entry['current']} -> {base} т)"
+            )
+            self.drift_fixed += 1
+        current = max(base + safe_float(delta), 0.0)
+        pull["current_volume"] = current
+        self._update(pull_id, pull, current)
+        return current
+
+    def set_volume(self, pull_id, pull: dict, volume: float) -> float:
+        """Устанавливает пересчитанный объём пула."""
+        current = max(safe_float(volume), 0.0)
+        pull["current_volume"] = current
+        self._update(pull_id, pull, current)
+        return current
+
+    def participant_added(self, pull_id, pull: dict, count: int = 1):
+        """Вызывается после добавления записи в pullparticipants."""
+        if self._key(pull_id) not in self._stats:
+            self._entry(pull_id, pull)  # новая запись уже учтена при подсчёте
+            return
+        self._stats[self._key(pull_id)]["participants"] += count
+
+    def refresh(self, pull_id, pull: dict = None):
+        """Пересчёт агрегатов одного пула после массовых правок."""
+        if pull is None:
+            _, pull = find_pull_by_id(pull_id)
+        if not isinstance(pull, dict):
+            self.forget(pull_id)
+            return
+        entry = self._entry(pull_id, pull)
+        entry["participants"] = len(self._participants_of(pull_id))
+        self._update(pull_id, pull, safe_float(pull.get("current_volume")))
+
+    def forget(self, pull_id):
+        self._stats.pop(self._key(pull_id), None)
+
+    def fill_percent(self, pull_id, pull: dict = None) -> float:
+        if pull is None:
+            _, pull = find_pull_by_id(pull_id)
+        if not isinstance(pull, dict):
+            return 0.0
+        return self.fill_percent_of(pull)
+
+    def stats(self, pull_id, pull: dict = None) -> dict:
+        """Текущие агрегаты пула: объём, резерв, участники, свободно, %."""
+        if pull is None:
+            _, pull = find_pull_by_id(pull_id)
+        if not isinstance(pull, dict):
+            return {}
+        entry = self._entry(pull_id, pull)
+        current = safe_float(pull.get("current_volume"))
+        reserved = pull_reservations.reserved_volume(pull_id)
+        target = safe_float(pull.get("target_volume"))
+        return {
+            "current_volume": current,
+            "reserved_volume": reserved,
+            "participants": entry["participants"],
+            "target_volume": target,
+            "available_volume": max(target - current - reserved, 0.0),
+            "fill_percent": self.fill_percent_of(pull, current),
+        }
+
+    def rebuild(self) -> int:
+        """Полная инициализация агрегатов при старте, без событий."""
+        self._stats.clear()
+        all_pulls = pulls.get("pulls", {}) if isinstance(pulls, dict) else {}
+        for pull_id, pull in all_pulls.items():
+            if isinstance(pull, dict):
+                self._entry(pull.get("id", pull_id), pull)
+        logging.info(f"📊 Учёт наполнения пулов: {len(self._stats)} пулов")
+        return len(self._stats)
+
+    def reconcile(self) -> int:
+        """
+        Сверка агрегатов с pulls/pullparticipants.
+
+        Расхождение с current_volume пула означает запись в обход трекера:
+        агрегат выравнивается по пулу (с событиями порогов). Расхождение
+        суммы объёмов участников с current_volume только логируется —
+        часть партий попадает в пул без записи в pullparticipants.
+        """
+        fixed = 0
+        all_pulls = pulls.get("pulls", {}) if isinstance(pulls, dict) else {}
+        seen = set()
+        for storage_id, pull in list(all_pulls.items()):
+            if not isinstance(pull, dict):
+                continue
+            pull_id = pull.get("id", storage_id)
+            seen.add(self._key(pull_id))
+            entry = self._entry(pull_id, pull)
+            participants = self._participants_of(pull_id)
+
+            if entry["participants"] != len(participants):
+                entry["participants"] = len(participants)
+                fixed += 1
+
+            current = safe_float(pull.get("current_volume"))
+            if abs(entry["current"] - current) > VOLUME_EPSILON:
+                logging.warning(
+                    f"⚠️ Пул #{pull_id}: учтено {entry['current']} т, в пуле {current} т — выравниваю"
+                )
+                self._update(pull_id, pull, current)
+                fixed += 1
+
+            participants_volume = sum(
+                safe_float(p.get("volume")) for p in participants if isinstance(p, dict)
+            )
+            if participants and abs(participants_volume - current) > VOLUME_EPSILON:
+                logging.warning(
+                    f"⚠️ Пул #{pull_id}: объём участников {participants_volume} т "
+                    f"≠ current_volume {current} т"
+                )
+
+        for key in set(self._stats) - seen:
+            self._stats.pop(key, None)
+            fixed += 1
+
+        self.drift_fixed += fixed
+        if fixed:
+            logging.info(f"🔄 Сверка наполнения пулов: исправлено {fixed} расхождений")
+        return fixed
+
+
+pull_fill = PullFillTracker()
+
+
+async def reconcile_pull_fill():
+    """
+    Плановая сверка наполнения в цикле событий: события порогов запускают
+    фоновые задачи (закрытие пула), которым нужен текущий цикл.
+    """
+    pull_fill.reconcile()
+
+
 async def check_and_close_pool_if_full(pull_id: int):
     """Автоматически закрывает пул если current_volume >= target_volume"""
-    resolved_pull_id, pull = find_pull_by_id(pull_id)
-    if not pull:
-        logging.error(f"❌ Пул #{pull_id} не найден")
-        return
-    pull_id = resolved_pull_id
-    current = pull.get("current_volume", 0)
-    target = pull.get("target_volume", 0)
+    # Проверка и закрытие под локом пула: повторный вызов не закроет дважды
+    async with pull_reservations.lock(pull_id):
+        resolved_pull_id, pull = find_pull_by_id(pull_id)
+        if not pull:
+            logging.error(f"❌ Пул #{pull_id} не найден")
+            return
+        pull_id = resolved_pull_id
+        current = pull.get("current_volume", 0)
+        target = pull.get("target_volume", 0)
+
+        logging.info(f"🔍 Проверка автозакрытия пула #{pull_id}: {current}/{target} т")
 
-    logging.info(f"🔍 Проверка автозакрытия пула #{pull_id}: {current}/{target} т")
+        if current < target or pull.get("closed_at"):
+            return
+        if normalize_transition_status(pull.get("status")) == "closed":
+            return
 
-    if current >= target:
         pull["status"] = "closed"  # Правильный формат статуса
         pull["closed_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if not pull.get("deal_id"):
+            pull["deal_id"] = create_deal_from_full_pull(pull)
         save_pulls_to_pickle()
 
-        logging.info(f"🔒 Пул #{pull_id} АВТОМАТИЧЕСКИ ЗАКРЫТ ({current}/{target} т)")
+    logging.info(f"🔒 Пул #{pull_id} АВТОМАТИЧЕСКИ ЗАКРЫТ ({current}/{target} т)")
 
-        notification_text = (
-            f"🎉 <b>Пул #{pull_id} закрыт!</b>\n\n"
-            f"📦 Культура: {pull.get('culture', 'Неизвестна')}\n"
-            f"📊 Объём: {current}/{target} т\n"
-            "✅ Пул заполнен и готов к отгрузке."
-        )
+    notification_text = (
+        f"🎉 <b>Пул #{pull_id} закрыт!</b>\n\n"
+        f"📦 Культура: {pull.get('culture', 'Неизвестна')}\n"
+        f"📊 Объём: {current}/{target} т\n"
+        f"🤝 Сделка #{pull.get('deal_id')} создана\n"
+        "✅ Пул заполнен и готов к отгрузке."
+    )
 
-        keyboard = InlineKeyboardMarkup()
-        keyboard.add(
-            InlineKeyboardButton(
-                "📋 Посмотреть пул", callback_data=f"view_pull:{pull_id}"
-            )
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(
+        InlineKeyboardButton(
+            "📋 Посмотреть пул", callback_data=VIEW_PULL_CB.pack(pull_id)
         )
+    )
 
-        # Уведомляем экспортёра
-        exporter_id = pull.get("exporter_id")
-        if exporter_id:
-            try:
-                await bot.send_message(
-                    exporter_id,
-                    notification_text,
-                    parse_mode="HTML",
-                    reply_markup=keyboard,
-                )
-            except Exception as e:
-                logging.error(f"❌ Ошибка уведомления экспортёра: {e}")
+    # Экспортёр, фермеры (включая участников без записи в farmer_ids) и логисты
+    recipient_ids = [pull.get("exporter_id")]
+    recipient_ids.extend(pull.get("farmer_ids", []))
+    for participant in PullFillTracker._participants_of(pull_id):
+        if isinstance(participant, dict):
+            recipient_ids.append(participant.get("farmer_id"))
+    recipient_ids.extend(pull.get("logist_ids", []))
 
-        # Уведомляем фермеров
-        farmer_ids = pull.get("farmer_ids", [])
-        for farmer_id in farmer_ids:
-            try:
-                await bot.send_message(
-                    farmer_id,
-                    notification_text,
-                    parse_mode="HTML",
-                    reply_markup=keyboard,
-                )
-            except Exception as e:
-                logging.error(f"❌ Ошибка уведомления фермера {farmer_id}: {e}")
+    sent_count, failed_ids = await notify_many(
+        recipient_ids, notification_text, parse_mode="HTML", reply_markup=keyboard
+    )
+    logging.info(
+        f"📨 Пул #{pull_id} закрыт: уведомлено {sent_count}, ошибок {len(failed_ids)}"
+    )
 
-        # Уведомляем логистов
-        logist_ids = pull.get("logist_ids", [])
-        for logist_id in logist_ids:
-            try:
-                await bot.send_message(
-                    logist_id,
-                    notification_text,
-                    parse_mode="HTML",
-                    reply_markup=keyboard,
-                )
-            except Exception as e:
-                logging.error(f"❌ Ошибка уведомления логиста {logist_id}: {e}")
+
+def on_pull_filled(pull_id, pull: dict, threshold: int):
+    """100%: пул помечается заполненным, закрытие и сделка — фоновой задачей."""
+    if not is_pull_open_status(pull.get("status")):
+        return
+    pull["status"] = "filled"
+    logging.info(f"🎉 Пул #{pull_id} заполнен на 100%!")
+    background_tasks.spawn("pull_auto_close", check_and_close_pool_if_full(pull_id))
+
+
+def on_pull_almost_filled(pull_id, pull: dict, threshold: int):
+    """90%: предупреждаем экспортёра, что пул почти собран."""
+    exporter_id = pull.get("exporter_id")
+    if not exporter_id or not is_pull_open_status(pull.get("status")):
+        return
+    stats = pull_fill.stats(pull_id, pull)
+    text = (
+        f"📈 <b>Пул #{pull_id} заполнен на {stats['fill_percent']:.0f}%</b>\n\n"
+        f"📊 {stats['current_volume']:,.0f}/{stats['target_volume']:,.0f} т, "
+        f"участников: {stats['participants']}\n"
+        f"Осталось: {stats['available_volume']:,.0f} т"
+    )
+
+    async def notify():
+        try:
+            await bot.send_message(exporter_id, text, parse_mode="HTML")
+        except Exception as e:
+            logging.error(f"❌ Ошибка уведомления экспортёра о пуле #{pull_id}: {e}")
+
+    background_tasks.spawn("pull_almost_filled", notify())
+
+
+pull_fill.subscribe(100, on_pull_filled)
+pull_fill.subscribe(90, on_pull_almost_filled)
 
 
 # ==================== КОНЕЦ НОВЫХ ФУНКЦИЙ ====================
@@ -1422,6 +3519,7 @@ def save_expeditor_data():
 
 def save_logistics_cards_data():
     """Сохранение карточек логистов"""
+    invalidate_freight_cards_cache()
     try:
         path = os.path.join(DATA_DIR, "logistics_cards.pkl")
         with open(path, "wb") as f:
@@ -2028,6 +4126,7 @@ def save_logistics_offers_to_pickle():
 
 def save_logistics_cards_to_pickle():
     """Сохранение карточек логистов"""
+    invalidate_freight_cards_cache()
     try:
         with open(os.path.join(DATA_DIR, "logistics_cards.pkl"), "wb") as f:
             pickle.dump(logistics_cards, f)
@@ -2326,6 +4425,7 @@ class LogisticOfferStates(StatesGroup):
     vehicle_type = State()
     price = State()
     delivery_date = State()
+    additional_info = State()
     confirm = State()
 
 
@@ -2640,9 +4740,7 @@ def expeditor_service_keyboard():
     return keyboard
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("expeditor_view_deal:"), state="*"
-)
+@router.callback_query_handler(prefix="expeditor_view_deal:", state="*")
 async def expeditor_view_deal_details(callback: types.CallbackQuery, state: FSMContext):
     """Просмотр деталей сделки"""
     await state.finish()
@@ -2682,7 +4780,7 @@ async def expeditor_view_deal_details(callback: types.CallbackQuery, state: FSMC
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("expeditor_take:"), state="*")
+@router.callback_query_handler(prefix="expeditor_take:", state="*")
 async def expeditor_take_deal(callback: types.CallbackQuery, state: FSMContext):
     """Взять сделку в работу"""
     await state.finish()
@@ -2813,10 +4911,46 @@ def format_admin_statistics():
     msg += f"• Всего: {total_requests}\n"
     msg += f"• Активные: {active_requests}"
 
+    jobs_block = format_cpu_job_metrics()
+    if jobs_block:
+        msg += "\n\n" + jobs_block
+
+    outbound_block = format_outbound_metrics()
+    if outbound_block:
+        msg += "\n\n" + outbound_block
+
+    background_block = format_background_task_metrics()
+    if background_block:
+        msg += "\n\n" + background_block
+
+    router_block = format_router_metrics()
+    if router_block:
+        msg += "\n\n" + router_block
+
+    scheduler_block = format_update_scheduler_metrics()
+    if scheduler_block:
+        msg += "\n\n" + scheduler_block
+
+    cache_block = format_cache_metrics()
+    if cache_block:
+        msg += "\n\n" + cache_block
+
+    throttle_block = format_throttle_metrics()
+    if throttle_block:
+        msg += "\n\n" + throttle_block
+
+    sheets_block = format_sheets_metrics()
+    if sheets_block:
+        msg += "\n\n" + sheets_block
+
+    market_block = format_market_metrics()
+    if market_block:
+        msg += "\n\n" + market_block
+
     return msg
 
 
-@dp.message_handler(commands=["reset"], state="*")
+@router.message_handler(commands=["reset"], state="*")
 async def reset_account(message: types.Message, state: FSMContext):
     """Удалить свой аккаунт для повторной регистрации"""
     user_id = message.from_user.id
@@ -2847,7 +4981,7 @@ async def reset_account(message: types.Message, state: FSMContext):
     )
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("confirm_reset:"), state="*")
+@router.callback_query_handler(prefix="confirm_reset:", state="*")
 async def confirm_reset_account(callback: CallbackQuery, state: FSMContext):
     """Подтверждение удаления аккаунта пользователя с КОРРЕКТНОЙ каскадной очисткой всех структур."""
     user_id = parse_callback_id(callback.data)
@@ -2901,10 +5035,10 @@ async def confirm_reset_account(callback: CallbackQuery, state: FSMContext):
                     if b.get("id") not in batch_ids_to_delete
                 ]
 
-                pull["current_volume"] = (
-                    sum(b.get("volume", 0) for b in pull.get("batches_data", []))
-                    if pull.get("batches_data")
-                    else 0
+                pull_fill.set_volume(
+                    pull.get("id"),
+                    pull,
+                    sum(b.get("volume", 0) for b in pull.get("batches_data", [])),
                 )
 
                 target_volume = pull.get("target_volume", 0) or 0
@@ -2921,6 +5055,7 @@ async def confirm_reset_account(callback: CallbackQuery, state: FSMContext):
                         if p.get("batch_id") not in batch_ids_to_delete
                         and not same_id(p.get("farmer_id"), user_id)
                     ]
+                    pull_fill.refresh(pull_id, pull)
 
         # 2.2. Чистим совпадения (matches) по удаляемым партиям/фермеру
         removed_matches = 0
@@ -3020,70 +5155,29 @@ async def confirm_reset_account(callback: CallbackQuery, state: FSMContext):
         deleted_items.append("карточка экспедитора")
         logging.info(f"✅ Удалена карточка экспедитора {user_id}")
 
-    # 3. Удаляем запись пользователя из Google Sheets (если настроено)
-    spreadsheet_ref = getattr(gs, "spreadsheet", None)
-    if spreadsheet_ref:
-        try:
-            worksheet = spreadsheet_ref.worksheet("Users")
-            cell = worksheet.find(str(user_id))
-            if cell:
-                worksheet.delete_rows(cell.row)
-                deleted_items.append("запись в Google Sheets (Users)")
-                logging.info(f"✅ Удалён аккаунт {user_id} из Google Sheets (Users)")
-        except Exception as e:
-            logging.error(f"❌ Ошибка удаления из Google Sheets (Users): {e}")
-    else:
-        logging.warning(
-            "⚠️ Google Sheets не настроен, пропускаем удаление из листа Users"
-        )
-
-    # 4. Удаляем партии пользователя из Google Sheets
-    if spreadsheet_ref:
-        try:
-            worksheet = spreadsheet_ref.worksheet("Batches")
-            all_values = worksheet.get_all_values()
-            rows_to_delete = []
-            for i, row in enumerate(all_values[1:], start=2):
-                if row and len(row) > 1 and same_id(row[1], user_id):
-                    rows_to_delete.append(i)
-            for row_num in reversed(rows_to_delete):
-                worksheet.delete_rows(row_num)
-            if rows_to_delete:
-                deleted_items.append(f"{len(rows_to_delete)} партий из Google Sheets")
-                logging.info(
-                    f"✅ Удалено {len(rows_to_delete)} партий из Google Sheets"
-                )
-        except Exception as e:
-            logging.error(f"❌ Ошибка удаления партий из Google Sheets: {e}")
-    else:
-        logging.warning(
-            "⚠️ Google Sheets не настроен, пропускаем удаление из листа Batches"
+    # 3. Удаляем пользователя, его партии и пулы из Google Sheets — через
+    # очередь: при недоступном Google удаление дождётся восстановления API
+    if sheets_outbox.enabled:
+        sheets_outbox.delete_user(user_id)
+        for batch_id in batch_ids_to_delete:
+            sheets_outbox.delete_batch(batch_id)
+        all_pulls = pulls.get("pulls", {}) if isinstance(pulls, dict) else {}
+        user_pull_ids = [
+            pull.get("id", pull_id)
+            for pull_id, pull in all_pulls.items()
+            if isinstance(pull, dict) and same_id(pull.get("exporter_id"), user_id)
+        ]
+        for pull_id in user_pull_ids:
+            sheets_outbox.delete_pull(pull_id)
+        deleted_items.append("записи в Google Sheets (Users, Batches, Pulls)")
+        logging.info(
+            f"✅ Удаление из Google Sheets поставлено в очередь: пользователь {user_id}, "
+            f"партий {len(batch_ids_to_delete)}, пулов {len(user_pull_ids)}"
         )
-
-    # 5. Удаляем пулы пользователя из Google Sheets
-    if spreadsheet_ref:
-        try:
-            worksheet = spreadsheet_ref.worksheet("Pulls")
-            all_values = worksheet.get_all_values()
-            rows_to_delete = []
-            for i, row in enumerate(all_values[1:], start=2):
-                if row and len(row) > 1 and same_id(row[1], user_id):
-                    rows_to_delete.append(i)
-            for row_num in reversed(rows_to_delete):
-                worksheet.delete_rows(row_num)
-            if rows_to_delete:
-                deleted_items.append(f"{len(rows_to_delete)} пуллов из Google Sheets")
-                logging.info(
-                    f"✅ Удалено {len(rows_to_delete)} пуллов из Google Sheets"
-                )
-        except Exception as e:
-            logging.error(f"❌ Ошибка удаления пуллов из Google Sheets: {e}")
     else:
-        logging.warning(
-            "⚠️ Google Sheets не настроен, пропускаем удаление из листа Pulls"
-        )
+        logging.warning("⚠️ Google Sheets не настроен, пропускаем удаление из листов")
 
-    # 6. Глобальная очистка "мертвых" партий и совпадений
+    # 4. Глобальная очистка "мертвых" партий и совпадений
     def global_cleanup_orphaned_batches_and_matches():
         all_active_batch_ids = {
             b["id"]
@@ -3101,10 +5195,10 @@ async def confirm_reset_account(callback: CallbackQuery, state: FSMContext):
             pull["batch_ids"] = [
                 bid for bid in pull.get("batch_ids", []) if bid in all_active_batch_ids
             ]
-            pull["current_volume"] = (
-                sum(b.get("volume", 0) for b in pull.get("batches_data", []))
-                if pull.get("batches_data")
-                else 0
+            pull_fill.set_volume(
+                pull.get("id"),
+                pull,
+                sum(b.get("volume", 0) for b in pull.get("batches_data", [])),
             )
             target_volume = pull.get("target_volume", 0) or 0
             if pull["current_volume"] < target_volume:
@@ -3118,6 +5212,7 @@ async def confirm_reset_account(callback: CallbackQuery, state: FSMContext):
                 for p in participants
                 if isinstance(p, dict) and p.get("batch_id") in all_active_batch_ids
             ]
+        pull_fill.reconcile()
 
         removed = 0
         if isinstance(globals().get("matches"), dict):
@@ -3140,7 +5235,7 @@ async def confirm_reset_account(callback: CallbackQuery, state: FSMContext):
 
     global_cleanup_orphaned_batches_and_matches()
 
-    # 7. Формируем сообщение о результатах удаления
+    # 5. Формируем сообщение о результатах удаления
     if deleted_items:
         items_text = "\n".join([f"• {item}" for item in deleted_items])
         result_msg = (
@@ -3155,7 +5250,7 @@ async def confirm_reset_account(callback: CallbackQuery, state: FSMContext):
     await callback.answer("✅ Аккаунт удалён")
 
 
-@dp.callback_query_handler(lambda c: c.data == "cancel_reset", state="*")
+@router.callback_query_handler(data="cancel_reset", state="*")
 async def cancel_reset_account(callback: CallbackQuery):
     """Отмена удаления аккаунта"""
     await callback.message.edit_text("❌ Удаление отменено")
@@ -3263,7 +5358,7 @@ def join_pull_keyboard(pull_id):
     """Клавиатура для присоединения к пулу"""
     keyboard = InlineKeyboardMarkup(row_width=2)
     keyboard.add(
-        InlineKeyboardButton("✅ Присоединиться", callback_data=f"join_pull:{pull_id}"),
+        InlineKeyboardButton("✅ Присоединиться", callback_data=JOIN_PULL_CB.pack(pull_id)),
         InlineKeyboardButton("◀️ Назад", callback_data="back_to_pools_list"),
     )
     return keyboard
@@ -3292,7 +5387,7 @@ def get_pull_details_keyboard(pull_id, user_id, pull):
     elif user_id in users and (get_user_by_id(user_id) or {}).get("role") == "farmer":
         keyboard.add(
             InlineKeyboardButton(
-                "✅ Присоединиться", callback_data=f"join_pull:{pull_id}"
+                "✅ Присоединиться", callback_data=JOIN_PULL_CB.pack(pull_id)
             )
         )
         keyboard.add(
@@ -3530,6 +5625,7 @@ def profile_edit_keyboard():
             "🏢 Реквизиты", callback_data="edit_profile:company_details"
         ),
     )
+    keyboard.add(InlineKeyboardButton("🔔 Уведомления", callback_data="notify_mode"))
     keyboard.add(InlineKeyboardButton("❌ Отмена", callback_data="edit_cancel"))
     return keyboard
 
@@ -3550,7 +5646,7 @@ def search_criteria_keyboard():
     return keyboard
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_main", state="*")
+@router.callback_query_handler(data="back_to_main", state="*")
 async def back_to_main_handler(callback: types.CallbackQuery, state: FSMContext):
     """Возврат в главное меню из расширенного поиска"""
     await state.finish()
@@ -3955,7 +6051,7 @@ async def notify_match(farmer_id, batch, matching_pulls, extra=None, *args, **kw
             kb.add(
                 InlineKeyboardButton(
                     f"🔗 Присоединиться к Пулу #{pull_id}",
-                    callback_data=f"join_pull:{pull_id}:{unique_id}",
+                    callback_data=JOIN_PULL_CB.pack(pull_id, unique_id),
                 )
             )
 
@@ -3977,111 +6073,135 @@ async def notify_match(farmer_id, batch, matching_pulls, extra=None, *args, **kw
         logging.info(f"📝 Текст сообщения ({len(text)} символов): {text[:200]}...")
         logging.info(f"🔘 Кнопок: {len(kb.inline_keyboard)}")
 
-        await bot.send_message(farmer_id, text, parse_mode="HTML", reply_markup=kb)
-        logging.info(f"✅ Уведомление фермеру {farmer_id} УСПЕШНО отправлено!")
+        summary = (
+            f"{batch_culture} {batch_volume} т — пулов: {len(matching_pulls)}"
+        )
+        await notification_digest.notify(farmer_id, "match", summary, text, kb)
+        logging.info(f"✅ Уведомление фермеру {farmer_id} передано на отправку")
 
     except Exception as e:
         logging.error(f"❌ Ошибка уведомления фермеру {farmer_id}: {e}", exc_info=True)
 
 
-async def auto_match_batches_and_pulls():
+def compute_auto_matches(pull_rows, batch_rows, user_roles):
     """
-    Ищет совпадения партий и пулов, обновляет статусы и отправляет уведомления.
-    ТОЛЬКО ФЕРМЕРЫ получают уведомления о совпадениях!
+    Подбор пар (пул, партия) по снимку — выполняется в пуле процессов.
+    Каждая партия совпадает не более одного раза (первый подходящий пул).
     """
-    try:
-        logging.info("🔄 Запуск автоматического поиска совпадений...")
-        if "pulls" not in pulls or not isinstance(pulls["pulls"], dict):
-            logging.warning(
-                "⚠️ Структура pulls некорректна или ключ 'pulls' отсутствует"
-            )
-            return 0
+    roles = dict(user_roles)
+    matched_rows = set()
+    result = []
 
-        matching_count = 0
+    for pull_id, pull_culture, pull_status in pull_rows:
+        if normalize_transition_status(pull_status) == "filled":
+            continue  # Пропускаем полностью заполненные пулы
+        pull_culture = pull_culture.lower().strip()
 
-        for pull_id, pull_data in pulls["pulls"].items():
-            if not isinstance(pull_data, dict):
+        for index, row in enumerate(batch_rows):
+            if index in matched_rows:
                 continue
+            batch_id, farmer_id, batch_culture, batch_status = row[:4]
 
-            # Проверяем статус пула и культуру
-            pull_status = normalize_transition_status(pull_data.get("status"))
-            pull_culture = pull_data.get("culture", "").lower().strip()
+            # ✅ ПРОВЕРКА РОЛИ: Только фермеры получают уведомления
+            if farmer_id not in roles or roles[farmer_id].lower() != "farmer":
+                continue
 
-            if pull_status == "filled":
-                continue  # Пропускаем полностью заполненные пулы
+            if batch_culture.lower().strip() == pull_culture and batch_status.lower() in [
+                "активна",
+                "active",
+                "available",
+            ]:
+                matched_rows.add(index)
+                result.append((pull_id, batch_id, farmer_id))
 
-            for batch_id, farmer_id, batch in iter_all_batches():
+    return result
 
-                # ✅ ПРОВЕРКА РОЛИ: Только фермеры получают уведомления
-                if farmer_id not in users:
-                    logging.debug(f"⚠️ Пользователь {farmer_id} не найден в базе")
-                    continue
 
-                user_role = (get_user_by_id(farmer_id) or {}).get("role", "").lower()
-                if user_role != "farmer":
-                    logging.debug(
-                        f"⚠️ Пользователь {farmer_id} (партия #{batch_id}) имеет роль '{user_role}', а не 'farmer'. Пропускаем."
-                    )
-                    continue
+async def apply_auto_matches(match_rows):
+    """Применяет найденные совпадения к живым данным и уведомляет фермеров."""
+    all_pulls = pulls.get("pulls", {}) if isinstance(pulls, dict) else {}
+    matching_count = 0
 
-                batch_culture = batch.get("culture", "").lower().strip()
-                batch_status = batch.get("status", "").lower()
+    # Один проход по партиям вместо полного поиска на каждое совпадение
+    batches_by_key = {}
+    for current_id, owner_id, item in iter_all_batches():
+        batches_by_key.setdefault((str(current_id), str(owner_id)), item)
 
-                # Логика совпадения по культуре и статусу партии
-                if batch_culture == pull_culture and batch_status in [
-                    "активна",
-                    "active",
-                    "available",
-                ]:
-                    logging.info(
-                        "✅ Совпадение:\n"
-                        f"  Фермер {farmer_id} (роль: {user_role}): Партия #{batch_id} ({batch_culture})\n"
-                        f"  Пул #{pull_id} ({pull_culture})"
-                    )
+    for pull_id, batch_id, farmer_id in match_rows:
+        pull_data = all_pulls.get(pull_id)
+        batch = batches_by_key.get((str(batch_id), str(farmer_id)))
+        if not isinstance(pull_data, dict) or batch is None:
+            continue
 
-                    try:
-                        # Отправляем уведомление только фермеру
-                        await notify_match(farmer_id, batch, [pull_data])
-                        logging.info(f"✅ Уведомление отправлено фермеру {farmer_id}")
-                    except Exception as e:
-                        logging.error(
-                            f"❌ Ошибка отправки уведомления фермеру {farmer_id}: {e}"
-                        )
+        # Пока шёл расчёт, данные могли измениться — перепроверяем
+        if normalize_transition_status(pull_data.get("status")) == "filled":
+            continue
+        if str(batch.get("status") or "").lower() not in ["активна", "active", "available"]:
+            continue
+        if (
+            str(batch.get("culture") or "").lower().strip()
+            != str(pull_data.get("culture") or "").lower().strip()
+        ):
+            continue
 
-                    # Обновляем статусы в партиях и пулах
-                    batch["status"] = "matched"
-                    pull_data["status"] = "processing"
-                    pulls["pulls"][pull_id] = pull_data
+        logging.info(
+            "✅ Совпадение:\n"
+            f"  Фермер {farmer_id}: Партия #{batch_id} ({batch.get('culture')})\n"
+            f"  Пул #{pull_id} ({pull_data.get('culture')})"
+        )
 
-                    matching_count += 1
+        try:
+            # Отправляем уведомление только фермеру
+            await notify_match(farmer_id, batch, [pull_data])
+            logging.info(f"✅ Уведомление отправлено фермеру {farmer_id}")
+        except Exception as e:
+            logging.error(f"❌ Ошибка отправки уведомления фермеру {farmer_id}: {e}")
 
-        if matching_count > 0:
-            try:
-                save_pulls_to_pickle()
-                save_batches_to_pickle()
-                logging.info(
-                    f"✅ Найдено {matching_count} совпадений, данные сохранены"
-                )
-            except Exception as e:
-                logging.error(f"❌ Ошибка сохранения данных: {e}")
-        else:
-            logging.info("ℹ️ Совпадений не найдено")
+        # Обновляем статусы в партиях и пулах
+        batch["status"] = "matched"
+        pull_data["status"] = "processing"
+        matching_count += 1
+
+    if matching_count > 0:
+        try:
+            save_pulls_to_pickle()
+            save_batches_to_pickle()
+            logging.info(f"✅ Найдено {matching_count} совпадений, данные сохранены")
+        except Exception as e:
+            logging.error(f"❌ Ошибка сохранения данных: {e}")
+    else:
+        logging.info("ℹ️ Совпадений не найдено")
 
-        return matching_count
+    return matching_count
 
-    except Exception as e:
-        logging.error(f"❌ Ошибка в auto_match_batches_and_pulls: {e}", exc_info=True)
+
+async def auto_match_batches_and_pulls():
+    """
+    Ищет совпадения партий и пулов, обновляет статусы и отправляет уведомления.
+    ТОЛЬКО ФЕРМЕРЫ получают уведомления о совпадениях!
+    Подбор пар считается в пуле процессов (см. run_cpu_job).
+    """
+    logging.info("🔄 Запуск автоматического поиска совпадений...")
+    if "pulls" not in pulls or not isinstance(pulls["pulls"], dict):
+        logging.warning("⚠️ Структура pulls некорректна или ключ 'pulls' отсутствует")
         return 0
 
+    def snapshot():
+        return snapshot_pull_rows(), snapshot_batch_rows(), snapshot_user_roles()
+
+    matching_count = await run_cpu_job(
+        "auto_match_batches_and_pulls",
+        snapshot,
+        compute_auto_matches,
+        apply_auto_matches,
+    )
+    return matching_count or 0
+
 
 # ============================================================================
 # ОБРАБОТЧИК КОМАНДЫ /start
 # ============================================================================
-# Глобальный словарь для защиты от дублирования
-last_start_times = {}
-
-
-@dp.message_handler(commands=["start"], state="*")
+@router.message_handler(commands=["start"], state="*")
 async def cmd_start(message: types.Message, state: FSMContext):
     """Обработчик команды /start"""
     user_id = message.from_user.id
@@ -4099,18 +6219,9 @@ async def cmd_start(message: types.Message, state: FSMContext):
 
     await state.finish()
 
-    # ✅ ПРОВЕРКА 2: Защита от дублирования
-    import time
-
-    current_time = time.time()
-
-    if user_id in last_start_times:
-        time_diff = current_time - last_start_times[user_id]
-        if time_diff < 3:
-            return
-
-    last_start_times[user_id] = current_time
+    # Повторный /start схлопывает UpdateScheduler
     logging.info(f"🚀 /start от пользователя {user_id}")
+    mark_user_blocked(user_id, blocked=False)  # снова пишет боту — доступен
 
     if user_id in users:
         # Зарегистрированный пользователь
@@ -4299,7 +6410,7 @@ def format_admin_users_legacy():
     return msg
 
 
-@dp.callback_query_handler(lambda c: c.data == "backtoadmin", state="*")
+@router.callback_query_handler(data="backtoadmin", state="*")
 async def back_to_admin_callback(callback: types.CallbackQuery, state: FSMContext):
     """Возврат в админ меню"""
 
@@ -4328,7 +6439,7 @@ async def back_to_admin_callback(callback: types.CallbackQuery, state: FSMContex
 # ============================================================================
 
 
-@dp.message_handler(commands=["admin"], state="*")
+@router.message_handler(commands=["admin"], state="*")
 async def cmd_admin(message: types.Message, state: FSMContext):
     """Вход в админ-панель"""
     await state.finish()
@@ -4349,7 +6460,7 @@ async def cmd_admin(message: types.Message, state: FSMContext):
 # ============================================================================
 
 
-@dp.callback_query_handler(lambda c: c.data == "adminstat", state="*")
+@router.callback_query_handler(data="adminstat", state="*")
 async def admin_statistics_callback(callback: types.CallbackQuery, state: FSMContext):
     """Статистика через callback"""
     await state.finish()
@@ -4374,7 +6485,7 @@ async def admin_statistics_callback(callback: types.CallbackQuery, state: FSMCon
         await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data == "adminanalytics", state="*")
+@router.callback_query_handler(data="adminanalytics", state="*")
 async def admin_analytics_callback(callback: types.CallbackQuery, state: FSMContext):
     """Аналитика через callback"""
     await state.finish()
@@ -4399,7 +6510,7 @@ async def admin_analytics_callback(callback: types.CallbackQuery, state: FSMCont
         await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data == "adminexport", state="*")
+@router.callback_query_handler(data="adminexport", state="*")
 async def admin_export_callback(callback: types.CallbackQuery, state: FSMContext):
     """Экспорт данных через callback"""
     await state.finish()
@@ -4432,7 +6543,7 @@ async def admin_export_callback(callback: types.CallbackQuery, state: FSMContext
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "adminusers", state="*")
+@router.callback_query_handler(data="adminusers", state="*")
 async def admin_users_callback(callback: types.CallbackQuery, state: FSMContext):
     """Список пользователей через callback"""
     await state.finish()
@@ -4457,7 +6568,7 @@ async def admin_users_callback(callback: types.CallbackQuery, state: FSMContext)
         await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data == "adminbroadcast", state="*")
+@router.callback_query_handler(data="adminbroadcast", state="*")
 async def admin_broadcast_callback(callback: types.CallbackQuery, state: FSMContext):
     """Рассылка через callback"""
     await state.finish()
@@ -4471,14 +6582,16 @@ async def admin_broadcast_callback(callback: types.CallbackQuery, state: FSMCont
 
     await callback.message.edit_text(
         "📧 <b>Рассылка сообщений</b>\n\n"
-        "Отправьте сообщение для рассылки всем пользователям.",
+        "Отправьте сообщение для рассылки. Затем выберите, кому его отправить: "
+        "всем, роли или региону.",
         reply_markup=keyboard,
         parse_mode="HTML",
     )
+    await Broadcast.message.set()
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "adminprices", state="*")
+@router.callback_query_handler(data="adminprices", state="*")
 async def admin_prices_callback(callback: types.CallbackQuery, state: FSMContext):
     """Обновление цен через callback"""
     await state.finish()
@@ -4526,7 +6639,8 @@ async def admin_prices_callback(callback: types.CallbackQuery, state: FSMContext
 # ============================================================================
 
 
-@dp.callback_query_handler(lambda c: c.data == "exportusers", state="*")
+@router.callback_query_handler(data="exportusers", state="*")
+@throttle("export")
 async def export_users_callback(callback: CallbackQuery, state: FSMContext):
     """Экспорт пользователей в CSV"""
     await state.finish()
@@ -4572,7 +6686,8 @@ async def export_users_callback(callback: CallbackQuery, state: FSMContext):
         await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data == "exportpulls", state="*")
+@router.callback_query_handler(data="exportpulls", state="*")
+@throttle("export")
 async def export_pools_callback(callback: CallbackQuery, state: FSMContext):
     """Экспорт пуллов в CSV"""
     await state.finish()
@@ -4623,7 +6738,8 @@ async def export_pools_callback(callback: CallbackQuery, state: FSMContext):
         await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data == "exportbatches", state="*")
+@router.callback_query_handler(data="exportbatches", state="*")
+@throttle("export")
 async def export_batches_callback(callback: CallbackQuery, state: FSMContext):
     """Экспорт партий в CSV"""
     await state.finish()
@@ -4673,7 +6789,8 @@ async def export_batches_callback(callback: CallbackQuery, state: FSMContext):
         await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data == "exportrequests", state="*")
+@router.callback_query_handler(data="exportrequests", state="*")
+@throttle("export")
 async def export_requests_callback(callback: CallbackQuery, state: FSMContext):
     """Экспорт фермерских заявок на логистику в CSV."""
     await state.finish()
@@ -4741,7 +6858,8 @@ async def export_requests_callback(callback: CallbackQuery, state: FSMContext):
         await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data == "exportfull", state="*")
+@router.callback_query_handler(data="exportfull", state="*")
+@throttle("export", cost=2)
 async def export_full_backup_callback(callback: CallbackQuery, state: FSMContext):
     """Полный бэкап всех данных"""
     await state.finish()
@@ -4791,9 +6909,7 @@ async def export_full_backup_callback(callback: CallbackQuery, state: FSMContext
         await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
 
 
-@dp.callback_query_handler(
-    lambda c: c.data == "__legacy_reload_data_disabled", state="*"
-)
+@router.callback_query_handler(data="__legacy_reload_data_disabled", state="*")
 async def reload_data_callback_legacy(callback: CallbackQuery, state: FSMContext):
     """Перезагрузка данных из файлов"""
     await state.finish()
@@ -4835,7 +6951,9 @@ def check_and_close_pull_if_full(pull_id):
         logging.info(f"✅ Pull {pull_id} auto-closed → Deal {deal_id}")
 
         # Запустить массовое уведомление всех логистов и участников
-        asyncio.create_task(notify_all_about_pull_closure(pull, deal_id))
+        background_tasks.spawn(
+            "pull_closure_notify", notify_all_about_pull_closure(pull, deal_id)
+        )
         return True
 
     return False
@@ -4845,12 +6963,19 @@ def create_deal_from_full_pull(pull):
     """Создаёт сделку из заполненного пула"""
     global deal_counter
 
-    deal_counter += 1
+    # Числовой ID, совместимый со сделками, созданными next_numeric_id
+    deal_id = next_numeric_id(deals)
+    deal_counter = max(deal_counter, int(deal_id))
 
     farmer_ids = []
     batch_details = []
 
-    for participant in pull.get("participants", []):
+    participants = pull.get("participants") or PullFillTracker._participants_of(
+        pull.get("id")
+    )
+    for participant in participants:
+        if not isinstance(participant, dict):
+            continue
         f_id = participant.get("farmer_id")
         b_id = participant.get("batch_id")
         volume = participant.get("volume", 0)
@@ -4867,21 +6992,23 @@ def create_deal_from_full_pull(pull):
             }
         )
 
+    volume = safe_float(pull.get("current_volume"))
+    price = safe_float(pull.get("price"))
     deal = {
-        "id": deal_counter,
-        "pull_id": pull["id"],
+        "id": deal_id,
+        "pull_id": pull.get("id"),
         "type": "pool_deal",
-        "exporter_id": pull["exporter_id"],
-        "exporter_name": pull["exporter_name"],
+        "exporter_id": pull.get("exporter_id"),
+        "exporter_name": pull.get("exporter_name", ""),
         "farmer_ids": farmer_ids,
         "batches": batch_details,
         "logistic_id": None,
         "expeditor_id": None,
-        "culture": pull["culture"],
-        "volume": pull["current_volume"],
-        "price": pull["price"],
-        "total_sum": pull["current_volume"] * pull["price"],
-        "port": pull["port"],
+        "culture": pull.get("culture"),
+        "volume": volume,
+        "price": price,
+        "total_sum": volume * price,
+        "port": pull.get("port"),
         "quality": {
             "moisture": pull.get("moisture", 0),
             "nature": pull.get("nature", 0),
@@ -4896,10 +7023,10 @@ def create_deal_from_full_pull(pull):
         "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
 
-    deals[deal_counter] = deal
+    deals[deal_id] = deal
     save_deals_to_pickle()
-    logging.info(f"✅ Deal {deal_counter} created from pull {pull['id']}")
-    return deal_counter
+    logging.info(f"✅ Deal {deal_id} created from pull {pull.get('id')}")
+    return deal_id
 
 
 async def notify_all_about_pull_closure(pull, deal_id):
@@ -4938,23 +7065,6 @@ async def notify_all_about_pull_closure(pull, deal_id):
         if isinstance(p, dict) and p.get("farmer_id")
     ]
 
-    all_notify_ids = set(farmer_ids) | set(logist_ids)
-    normalized_notify_ids = []
-    seen_notify_keys = set()
-    for notify_id_raw in all_notify_ids:
-        if notify_id_raw is None:
-            continue
-        notify_id = (
-            int(notify_id_raw)
-            if str(notify_id_raw).isdigit()
-            else notify_id_raw
-        )
-        notify_key = str(notify_id)
-        if notify_key in seen_notify_keys:
-            continue
-        seen_notify_keys.add(notify_key)
-        normalized_notify_ids.append(notify_id)
-
     notify_text = (
         f"🔒 <b>ПУЛ #{pull_id} СОБРАН/ЗАКРЫТ!</b>\n\n"
         f"🌾 Культура: {pull.get('culture')}\n"
@@ -4964,17 +7074,10 @@ async def notify_all_about_pull_closure(pull, deal_id):
         f"✅ Сделка #{deal_id} создана\n"
     )
 
-    sent_count = 0
-    failed_ids = []
-    for notify_id in normalized_notify_ids:
-        try:
-            await bot.send_message(notify_id, notify_text, parse_mode="HTML")
-            sent_count += 1
-        except Exception as e:
-            logging.error(
-                f"[NOTIFY ERROR] Ошибка при уведомлении user_id={notify_id}: {e}"
-            )
-            failed_ids.append(notify_id)
+    # notify_many убирает дубли (int/str) и отправляет в темпе лимитов Telegram
+    sent_count, failed_ids = await notify_many(
+        farmer_ids + logist_ids, notify_text, parse_mode="HTML"
+    )
 
     logging.info(
         f"[NOTIFY RESULT] Пул {pull_id}: {sent_count} уведомлений отправлено, "
@@ -4997,7 +7100,7 @@ async def notify_all_about_pull_closure(pull, deal_id):
     try:
         keyboard = InlineKeyboardMarkup(row_width=1)
         keyboard.add(
-            InlineKeyboardButton("📦 Открыть пул", callback_data=f"view_pull:{pull_id}")
+            InlineKeyboardButton("📦 Открыть пул", callback_data=VIEW_PULL_CB.pack(pull_id))
         )
         keyboard.add(
             InlineKeyboardButton(
@@ -5036,42 +7139,38 @@ async def notify_all_about_pull_closure(pull, deal_id):
             "откройте пул и оставьте своё предложение."
         )
 
-        for exp in expeditors:
-            uid = exp.get("user_id")
-            if not uid:
-                continue
-            try:
-                kb = InlineKeyboardMarkup(row_width=1)
-                kb.add(
-                    InlineKeyboardButton(
-                        "📦 Открыть пул", callback_data=f"view_pull:{pull_id}"
-                    )
-                )
-                kb.add(
-                    InlineKeyboardButton(
-                        "💼 Мои экспедиторские услуги",
-                        callback_data="expeditor_my_card",
-                    )
-                )
-                await bot.send_message(
-                    uid, exp_text, reply_markup=kb, parse_mode="HTML"
-                )
-            except Exception as e:
-                logging.error(
-                    f"[NOTIFY EXPEDITOR ERROR] user_id={uid} pull={pull_id}: {e}"
-                )
+        kb = InlineKeyboardMarkup(row_width=1)
+        kb.add(
+            InlineKeyboardButton("📦 Открыть пул", callback_data=VIEW_PULL_CB.pack(pull_id))
+        )
+        kb.add(
+            InlineKeyboardButton(
+                "💼 Мои экспедиторские услуги",
+                callback_data="expeditor_my_card",
+            )
+        )
+        _, failed_expeditors = await notify_many(
+            [exp.get("user_id") for exp in expeditors if exp.get("user_id")],
+            exp_text,
+            reply_markup=kb,
+            parse_mode="HTML",
+        )
+        if failed_expeditors:
+            logging.error(
+                f"[NOTIFY EXPEDITOR ERROR] pull={pull_id}: не доставлено {failed_expeditors}"
+            )
 
     logging.info(f"✅ Mass notifications sent for pull {pull_id}, deal {deal_id}")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data in {
+@router.callback_query_handler(
+    data=[
         "__router_exportusers_disabled__",
         "__router_exportpulls_disabled__",
         "__router_exportbatches_disabled__",
         "__router_exportrequests_disabled__",
         "__router_exportfull_disabled__",
-    },
+    ],
     state="*",
 )
 async def export_callbacks_router(callback: types.CallbackQuery, state: FSMContext):
@@ -5273,7 +7372,7 @@ async def export_callbacks_router(callback: types.CallbackQuery, state: FSMConte
         await callback.message.answer(f"❌ Ошибка: {e}")
 
 
-@dp.message_handler(lambda m: m.text == "📝 Зарегистрироваться", state="*")
+@router.message_handler(text="📝 Зарегистрироваться", state="*")
 async def registration_entry(message: types.Message, state: FSMContext):
     """Обработчик кнопки регистрации"""
     await state.finish()
@@ -5300,7 +7399,7 @@ async def registration_entry(message: types.Message, state: FSMContext):
     await RegistrationStatesGroup.name.set()
 
 
-@dp.callback_query_handler(lambda c: c.data == "start_registration", state="*")
+@router.callback_query_handler(data="start_registration", state="*")
 async def start_registration(callback: types.CallbackQuery, state: FSMContext):
     """Начало регистрации через callback"""
     await callback.message.edit_text(
@@ -5335,7 +7434,7 @@ async def delete_previous_messages(message: types.Message, state: FSMContext):
 
 
 # ========== ШАГ 1: ИМЯ ==========
-@dp.message_handler(state=RegistrationStatesGroup.name)
+@router.message_handler(state=RegistrationStatesGroup.name)
 async def registration_name(message: types.Message, state: FSMContext):
     """Получение имени при регистрации"""
     name = message.text.strip()
@@ -5362,7 +7461,7 @@ async def registration_name(message: types.Message, state: FSMContext):
 
 
 # ========== ШАГ 2: ТЕЛЕФОН ==========
-@dp.message_handler(state=RegistrationStatesGroup.phone)
+@router.message_handler(state=RegistrationStatesGroup.phone)
 async def registration_phone(message: types.Message, state: FSMContext):
     """Получение телефона при регистрации"""
     phone = message.text.strip()
@@ -5384,7 +7483,7 @@ async def registration_phone(message: types.Message, state: FSMContext):
 
 
 # ========== ШАГ 3: EMAIL ==========
-@dp.message_handler(state=RegistrationStatesGroup.email)
+@router.message_handler(state=RegistrationStatesGroup.email)
 async def registration_email(message: types.Message, state: FSMContext):
     """Получение email при регистрации"""
     email = message.text.strip()
@@ -5409,7 +7508,7 @@ async def registration_email(message: types.Message, state: FSMContext):
 
 
 # ========== ШАГ 4: ИНН ==========
-@dp.message_handler(state=RegistrationStatesGroup.inn)
+@router.message_handler(state=RegistrationStatesGroup.inn)
 async def registration_inn(message: types.Message, state: FSMContext):
     """Получение ИНН при регистрации"""
     inn = message.text.strip()
@@ -5441,7 +7540,7 @@ async def registration_inn(message: types.Message, state: FSMContext):
 
 
 # ========== ШАГ 5: ОГРН ==========
-@dp.message_handler(state=RegistrationStatesGroup.ogrn)
+@router.message_handler(state=RegistrationStatesGroup.ogrn)
 async def registration_ogrn(message: types.Message, state: FSMContext):
     """Получение ОГРН при регистрации"""
     ogrn = message.text.strip().replace(" ", "")
@@ -5465,9 +7564,7 @@ async def registration_ogrn(message: types.Message, state: FSMContext):
     await RegistrationStatesGroup.company_details.set()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data == "skip_ogrn", state=RegistrationStatesGroup.ogrn
-)
+@router.callback_query_handler(data="skip_ogrn", state=RegistrationStatesGroup.ogrn)
 async def skip_ogrn(callback: types.CallbackQuery, state: FSMContext):
     """Пропустить ОГРН"""
     await state.update_data(ogrn=None)
@@ -5492,7 +7589,7 @@ async def skip_ogrn(callback: types.CallbackQuery, state: FSMContext):
 
 
 # ========== ШАГ 6: ЮРИДИЧЕСКИЙ АДРЕС ==========
-@dp.message_handler(state=RegistrationStatesGroup.company_details)
+@router.message_handler(state=RegistrationStatesGroup.company_details)
 async def registration_company_details(message: types.Message, state: FSMContext):
     """Получение юридического адреса компании"""
     company_details = message.text.strip()
@@ -5527,9 +7624,7 @@ async def registration_company_details(message: types.Message, state: FSMContext
 
 
 # ========== ШАГ 7: РОЛЬ ==========
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("role:"), state=RegistrationStatesGroup.role
-)
+@router.callback_query_handler(prefix="role:", state=RegistrationStatesGroup.role)
 async def registration_role(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора роли"""
     role = callback.data.split(":", 1)[1]
@@ -5555,20 +7650,14 @@ async def registration_role(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("join_pull:"), state="*")
-async def join_pull_start(callback: types.CallbackQuery, state: FSMContext):
+@router.callback_query_handler(action=JOIN_PULL_CB, state="*")
+async def join_pull_start(callback: types.CallbackQuery, state: FSMContext, payload):
     """Начало процесса присоединения к пулу"""
-
-    try:
-        parsed = parse_join_pull_callback(callback.data)
-        pull_id = parsed["pull_id"]
-        logging.info(
-            f"🔗 join_pull callback: {callback.data}, извлечён pull_id: {pull_id}"
-        )
-    except (IndexError, ValueError) as e:
-        logging.error(f"❌ Ошибка парсинга callback: {callback.data}, ошибка: {e}")
+    pull_id = payload.pull_id
+    if pull_id is None:
         await callback.answer("❌ Ошибка обработки данных", show_alert=True)
         return
+    logging.info(f"🔗 join_pull callback: {callback.data}, pull_id: {pull_id}")
 
     # ✅ Получаем пулы с учетом разных типов ключей
     all_pulls = pulls.get("pulls", {})
@@ -5711,7 +7800,9 @@ async def join_pull_start(callback: types.CallbackQuery, state: FSMContext):
         )
         logging.info(f"   Добавлена партия: {button_text}")
 
-    keyboard.add(InlineKeyboardButton("◀️ Назад", callback_data=f"view_pull:{pull_id}"))
+    keyboard.add(
+        InlineKeyboardButton("◀️ Назад", callback_data=VIEW_PULL_CB.pack(pull_id))
+    )
 
     await JoinPullStatesGroup.select_batch.set()
 
@@ -5729,7 +7820,7 @@ async def join_pull_start(callback: types.CallbackQuery, state: FSMContext):
 
 
 # Быстрое создание партии для пулла
-@dp.callback_query_handler(lambda c: c.data.startswith("quickbatch:"), state="*")
+@router.callback_query_handler(prefix="quickbatch:", state="*")
 async def quick_batch_start(callback: types.CallbackQuery, state: FSMContext):
     """Начать создание партии для присоединения к пуллу"""
     await state.finish()
@@ -5778,7 +7869,7 @@ async def quick_batch_start(callback: types.CallbackQuery, state: FSMContext):
 
 
 # Обработка объёма
-@dp.message_handler(state=QuickBatchStatesGroup.volume)
+@router.message_handler(state=QuickBatchStatesGroup.volume)
 async def quick_batch_volume(message: types.Message, state: FSMContext):
     """Получение объёма партии"""
     try:
@@ -5825,7 +7916,7 @@ async def quick_batch_volume(message: types.Message, state: FSMContext):
 
 
 # Обработка цены
-@dp.message_handler(state=QuickBatchStatesGroup.price)
+@router.message_handler(state=QuickBatchStatesGroup.price)
 async def quick_batch_price(message: types.Message, state: FSMContext):
     """Получение цены"""
     try:
@@ -5853,8 +7944,8 @@ async def quick_batch_price(message: types.Message, state: FSMContext):
 
 
 # Выбор - указывать качество или нет
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("quickquality:"), state=QuickBatchStatesGroup.price
+@router.callback_query_handler(
+    prefix="quickquality:", state=QuickBatchStatesGroup.price
 )
 async def quick_batch_quality_choice(callback: types.CallbackQuery, state: FSMContext):
     """Выбор - указывать параметры качества"""
@@ -5876,7 +7967,7 @@ async def quick_batch_quality_choice(callback: types.CallbackQuery, state: FSMCo
 
 
 # Качество: натура
-@dp.message_handler(state=QuickBatchStatesGroup.quality)
+@router.message_handler(state=QuickBatchStatesGroup.quality)
 async def quick_batch_quality(message: types.Message, state: FSMContext):
     """Натура"""
     try:
@@ -5889,7 +7980,7 @@ async def quick_batch_quality(message: types.Message, state: FSMContext):
 
 
 # Влажность
-@dp.message_handler(state=QuickBatchStatesGroup.moisture)
+@router.message_handler(state=QuickBatchStatesGroup.moisture)
 async def quick_batch_moisture(message: types.Message, state: FSMContext):
     """Влажность"""
     try:
@@ -5902,7 +7993,7 @@ async def quick_batch_moisture(message: types.Message, state: FSMContext):
 
 
 # Сорность
-@dp.message_handler(state=QuickBatchStatesGroup.impurity)
+@router.message_handler(state=QuickBatchStatesGroup.impurity)
 async def quick_batch_impurity(message: types.Message, state: FSMContext):
     """Сорность"""
     try:
@@ -6017,6 +8108,8 @@ async def finish_quick_batch(message_or_callback, state: FSMContext, user_id: in
         }
     )
 
+    pull_fill.participant_added(pull_id, pull)
+
     # Диагностика
     logging.info(f"✅ Участник добавлен в pullparticipants[{pull_id_str}]")
     logging.info(f"   Всего участников в пуле: {len(pullparticipants[pull_id_str])}")
@@ -6047,8 +8140,8 @@ async def finish_quick_batch(message_or_callback, state: FSMContext, user_id: in
     if not any(same_id(existing_farmer_id, user_id) for existing_farmer_id in pull["farmer_ids"]):
         pull["farmer_ids"].append(user_id)
 
-    # ✅ ИСПРАВЛЕНО: Используем current_volume
-    pull["current_volume"] = pull.get("current_volume", 0) + batch_volume
+    # ✅ ИСПРАВЛЕНО: Используем current_volume (пороги заполнения — через pull_fill)
+    pull_fill.add_volume(pull_id, pull, batch_volume)
 
     # Создаём сделку с числовым ID (совместимо с parse_callback_id)
     deal_id = next_numeric_id(deals)
@@ -6095,16 +8188,10 @@ async def finish_quick_batch(message_or_callback, state: FSMContext, user_id: in
             parse_mode="HTML",
         )
 
-    # Проверяем заполнение пулла
-    if pull["current_volume"] >= target_volume:
-        pull["status"] = "filled"
-        save_pulls_to_pickle()
-        logging.info(f"🎉 Пул #{pull_id} заполнен!")
-
     # Возвращаемся к пуллу
     keyboard = InlineKeyboardMarkup()
     keyboard.add(
-        InlineKeyboardButton("📊 К пуллу", callback_data=f"view_pull:{pull_id}")
+        InlineKeyboardButton("📊 К пуллу", callback_data=VIEW_PULL_CB.pack(pull_id))
     )
 
     if isinstance(message_or_callback, types.Message):
@@ -6123,9 +8210,7 @@ async def finish_quick_batch(message_or_callback, state: FSMContext, user_id: in
             )
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("createbatchforpull:"), state="*"
-)
+@router.callback_query_handler(prefix="createbatchforpull:", state="*")
 async def create_batch_for_pull_callback(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -6172,9 +8257,8 @@ async def create_batch_for_pull_callback(
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("selectbatchjoin:"),
-    state=JoinPullStatesGroup.select_batch,
+@router.callback_query_handler(
+    prefix="selectbatchjoin:", state=JoinPullStatesGroup.select_batch
 )
 async def select_batch_for_join(callback: types.CallbackQuery, state: FSMContext):
     """Выбор партии для присоединения к пулу"""
@@ -6246,85 +8330,101 @@ async def select_batch_for_join(callback: types.CallbackQuery, state: FSMContext
         return
 
     target_volume = pull.get("target_volume", 0)
-    current_volume = pull.get("current_volume", 0)
-    available = target_volume - current_volume
-
-    if batch.get("volume", 0) > available:
-        await callback.answer(
-            "❌ Объем партии больше доступного в пуле!", show_alert=True
-        )
-        await state.finish()
-        return
 
     # ✅ ИСПРАВЛЕНО: Работа с pullparticipants через глобальную переменную
     # Нормализуем ключ к строке для единообразия
     pull_id_str = str(pull_id)
 
-    if pull_id_str not in pullparticipants:
-        pullparticipants[pull_id_str] = []
-
     if any(
         isinstance(p, dict) and same_id(p.get("batch_id"), batch_id)
-        for p in pullparticipants[pull_id_str]
+        for p in pullparticipants.get(pull_id_str, [])
     ):
         await callback.answer("❌ Эта партия уже присоединена к пулу", show_alert=True)
         await state.finish()
         return
 
-    participant = {
-        "farmer_id": user_id,
-        "farmer_name": (get_user_by_id(user_id) or {}).get("name", ""),
-        "batch_id": batch_id,
-        "volume": batch.get("volume", 0),
-        "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-    }
-    pullparticipants[pull_id_str].append(participant)
-
-    # ✅ ДИАГНОСТИКА - можно убрать после отладки
-    logging.info(f"✅ Участник добавлен в pullparticipants[{pull_id_str}]")
-    logging.info(f"   Участников в пуле: {len(pullparticipants[pull_id_str])}")
-
-    pull.setdefault("batch_ids", [])
-    if not any(same_id(existing_batch_id, batch_id) for existing_batch_id in pull["batch_ids"]):
-        pull["batch_ids"].append(batch.get("id", batch_id))
+    # Резервируем объём партии под локом пула
+    reservation_id = await pull_reservations.reserve(
+        pull_id, batch.get("volume", 0), holder=user_id
+    )
+    if reservation_id is None:
+        await callback.answer(
+            "❌ Объем партии больше доступного в пуле!", show_alert=True
+        )
+        await state.finish()
+        return
 
-    pull.setdefault("farmer_ids", [])
-    if not any(same_id(existing_farmer_id, user_id) for existing_farmer_id in pull["farmer_ids"]):
-        pull["farmer_ids"].append(user_id)
+    def apply_join(pull):
+        participants = pullparticipants.setdefault(pull_id_str, [])
+        if any(
+            isinstance(p, dict) and same_id(p.get("batch_id"), batch_id)
+            for p in participants
+        ):
+            return False
 
-    pull.setdefault("batches", [])
-    if not any(
-        (
-            isinstance(b, dict)
-            and same_id(b.get("id"), batch_id)
-        )
-        or (
-            not isinstance(b, dict)
-            and same_id(b, batch_id)
-        )
-        for b in pull["batches"]
-    ):
-        pull["batches"].append(
+        participants.append(
             {
-                "id": batch.get("id", batch_id),
                 "farmer_id": user_id,
-                "culture": batch.get("culture"),
-                "volume": batch.get("volume"),
-                "price": batch.get("price"),
-                "moisture": batch.get("moisture", 0),
-                "impurity": batch.get("impurity", batch.get("impurities", 0)),
-                "quality_class": batch.get("quality_class", ""),
+                "farmer_name": (get_user_by_id(user_id) or {}).get("name", ""),
+                "batch_id": batch_id,
+                "volume": batch.get("volume", 0),
                 "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             }
         )
 
-    pull["current_volume"] = current_volume + batch.get("volume", 0)
+        # ✅ ДИАГНОСТИКА - можно убрать после отладки
+        logging.info(f"✅ Участник добавлен в pullparticipants[{pull_id_str}]")
+        logging.info(f"   Участников в пуле: {len(participants)}")
 
-    # Закрытие пула при заполнении
-    if pull["current_volume"] >= target_volume:
-        pull["status"] = "filled"
-        save_pulls_to_pickle()
-        logging.info(f"🎉 Пул #{pull_id} заполнен на 100%!")
+        pull.setdefault("batch_ids", [])
+        if not any(same_id(existing_batch_id, batch_id) for existing_batch_id in pull["batch_ids"]):
+            pull["batch_ids"].append(batch.get("id", batch_id))
+
+        pull.setdefault("farmer_ids", [])
+        if not any(same_id(existing_farmer_id, user_id) for existing_farmer_id in pull["farmer_ids"]):
+            pull["farmer_ids"].append(user_id)
+
+        pull.setdefault("batches", [])
+        if not any(
+            (
+                isinstance(b, dict)
+                and same_id(b.get("id"), batch_id)
+            )
+            or (
+                not isinstance(b, dict)
+                and same_id(b, batch_id)
+            )
+            for b in pull["batches"]
+        ):
+            pull["batches"].append(
+                {
+                    "id": batch.get("id", batch_id),
+                    "farmer_id": user_id,
+                    "culture": batch.get("culture"),
+                    "volume": batch.get("volume"),
+                    "price": batch.get("price"),
+                    "moisture": batch.get("moisture", 0),
+                    "impurity": batch.get("impurity", batch.get("impurities", 0)),
+                    "quality_class": batch.get("quality_class", ""),
+                    "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                }
+            )
+
+        # Закрытие пула при заполнении — событие 100% в pull_fill
+        pull_fill.add_volume(pull_id, pull, batch.get("volume", 0))
+        batch["status"] = "reserved"
+        return True
+
+    confirmed, joined = await pull_reservations.confirm(reservation_id, apply_join)
+    if not confirmed or not joined:
+        await callback.answer(
+            "❌ Не удалось присоединиться: место занято или партия уже в пуле",
+            show_alert=True,
+        )
+        await state.finish()
+        return
+    save_pulls_to_pickle()
+    save_batches_to_pickle()
 
     # Уведомление экспортера с данными фермера
     exporter_id = pull.get("exporter_id")
@@ -6377,11 +8477,6 @@ async def select_batch_for_join(callback: types.CallbackQuery, state: FSMContext
         except Exception as e:
             logging.error(f"Ошибка уведомления фермеру: {e}")
 
-    batch["status"] = "reserved"
-
-    save_pulls_to_pickle()
-    save_batches_to_pickle()
-
     # ✅ ДИАГНОСТИКА - можно убрать после отладки
     logging.info("✅ Данные сохранены в файл")
 
@@ -6400,7 +8495,7 @@ async def select_batch_for_join(callback: types.CallbackQuery, state: FSMContext
     await state.finish()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("viewparticipants:"), state="*")
+@router.callback_query_handler(prefix="viewparticipants:", state="*")
 async def view_pullparticipants(callback: types.CallbackQuery, state: FSMContext):
     """Просмотр участников пула с полными контактами"""
     await state.finish()
@@ -6494,16 +8589,14 @@ async def view_pullparticipants(callback: types.CallbackQuery, state: FSMContext
 
     keyboard = InlineKeyboardMarkup(row_width=1)
     keyboard.add(
-        InlineKeyboardButton("◀️ Назад к пулу", callback_data=f"view_pull:{pull_id}")
+        InlineKeyboardButton("◀️ Назад к пулу", callback_data=VIEW_PULL_CB.pack(pull_id))
     )
 
     await callback.message.edit_text(msg, reply_markup=keyboard, parse_mode="HTML")
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("region:"), state=RegistrationStatesGroup.region
-)
+@router.callback_query_handler(prefix="region:", state=RegistrationStatesGroup.region)
 async def registration_region(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора региона"""
 
@@ -6538,11 +8631,7 @@ async def registration_region(callback: types.CallbackQuery, state: FSMContext):
     save_users_to_pickle()
 
     # Синхронизация с Google Sheets
-    if gs and gs.spreadsheet:
-        try:
-            gs.sync_user_to_sheets(users[user_id], user_id)
-        except Exception as e:
-            logging.error(f"Ошибка синхронизации с Google Sheets: {e}")
+    sheets_outbox.upsert_user(user_id, users[user_id])
 
     await state.finish()
 
@@ -6577,7 +8666,7 @@ async def registration_region(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("✅ Регистрация завершена!")
 
 
-@dp.message_handler(commands=["admin_legacy"], state="*")
+@router.message_handler(commands=["admin_legacy"], state="*")
 async def admin_menu(message: types.Message, state: FSMContext):
     """Админ меню"""
     await state.finish()
@@ -6598,7 +8687,7 @@ async def admin_menu(message: types.Message, state: FSMContext):
 # ✅ ТОЛЬКО ИСПРАВЛЯЕМ ЛОГИКУ ВНУТРИ!
 
 
-@dp.message_handler(lambda m: m.text == "📊 Статистика бота", state="*")
+@router.message_handler(text="📊 Статистика бота", state="*")
 async def admin_stats_button(message: types.Message, state: FSMContext):
     """Обработчик кнопки Статистика бота"""
     await state.finish()
@@ -6699,7 +8788,7 @@ async def admin_stats_button(message: types.Message, state: FSMContext):
         await message.answer(f"❌ Ошибка: {str(e)}")
 
 
-@dp.message_handler(lambda m: m.text == "📊 Аналитика", state="*")
+@router.message_handler(text="📊 Аналитика", state="*")
 async def admin_analytics_button(message: types.Message, state: FSMContext):
     """Обработчик кнопки Аналитика"""
     await state.finish()
@@ -6762,7 +8851,7 @@ async def admin_analytics_button(message: types.Message, state: FSMContext):
         await message.answer(f"❌ Ошибка: {str(e)}")
 
 
-@dp.message_handler(lambda m: m.text == "📂 Экспорт данных", state="*")
+@router.message_handler(text="📂 Экспорт данных", state="*")
 async def admin_export_button(message: types.Message, state: FSMContext):
     """Обработчик кнопки Экспорт данных"""
     await state.finish()
@@ -6810,7 +8899,7 @@ async def admin_export_button(message: types.Message, state: FSMContext):
         await message.answer(f"❌ Ошибка при экспорте: {str(e)}")
 
 
-@dp.message_handler(lambda m: m.text == "🔍 Найти совпадения", state="*")
+@router.message_handler(text="🔍 Найти совпадения", state="*")
 async def admin_manual_match(message: types.Message, state: FSMContext):
     """Ручной поиск совпадений"""
     await state.finish()
@@ -6831,7 +8920,7 @@ async def admin_manual_match(message: types.Message, state: FSMContext):
     )
 
 
-@dp.message_handler(lambda m: m.text == "◀️ Назад", state="*")
+@router.message_handler(text="◀️ Назад", state="*")
 async def admin_back(message: types.Message, state: FSMContext):
     """Возврат из админ панели"""
     await state.finish()
@@ -6847,7 +8936,7 @@ async def admin_back(message: types.Message, state: FSMContext):
         await message.answer("◀️ Возврат")
 
 
-@dp.message_handler(commands=["match"], state="*")
+@router.message_handler(commands=["match"], state="*")
 async def cmd_manual_match(message: types.Message, state: FSMContext):
     """Ручной запуск поиска совпадений"""
     await state.finish()
@@ -6868,7 +8957,7 @@ async def cmd_manual_match(message: types.Message, state: FSMContext):
     )
 
 
-@dp.message_handler(lambda m: m.text == "👤 Профиль", state="*")
+@router.message_handler(text="👤 Профиль", state="*")
 async def cmd_profile(message: types.Message, state: FSMContext):
     """Показать расширенный профиль пользователя"""
     await state.finish()
@@ -6900,7 +8989,7 @@ async def cmd_profile(message: types.Message, state: FSMContext):
     await message.answer(profile_text, parse_mode="HTML", reply_markup=keyboard)
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_profile:"), state="*")
+@router.callback_query_handler(prefix="edit_profile:", state="*")
 async def start_edit_profile(callback: types.CallbackQuery, state: FSMContext):
     """Начать редактирование профиля"""
     field = callback.data.split(":", 1)[1]
@@ -6927,9 +9016,7 @@ async def start_edit_profile(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("region:"), state=EditProfile.new_value
-)
+@router.callback_query_handler(prefix="region:", state=EditProfile.new_value)
 async def edit_profile_region(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора региона при редактировании профиля"""
     new_region = callback.data.split(":", 1)[1]
@@ -6951,8 +9038,7 @@ async def edit_profile_region(callback: types.CallbackQuery, state: FSMContext):
 
     save_users_to_json()
 
-    if gs and gs.spreadsheet:
-        gs.update_user_in_sheets(user_id, users[user_id])
+    sheets_outbox.upsert_user(user_id, users[user_id])
 
     await state.finish()
 
@@ -6969,7 +9055,7 @@ async def edit_profile_region(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("✅ Регион обновлён")
 
 
-@dp.message_handler(state=EditProfile.new_value)
+@router.message_handler(state=EditProfile.new_value)
 async def edit_profile_value(message: types.Message, state: FSMContext):
     """Сохранить новое значение профиля"""
     user_id = message.from_user.id
@@ -6994,8 +9080,7 @@ async def edit_profile_value(message: types.Message, state: FSMContext):
 
     save_users_to_json()
 
-    if gs and gs.spreadsheet:
-        gs.update_user_in_sheets(user_id, users[user_id])
+    sheets_outbox.upsert_user(user_id, users[user_id])
 
     await state.finish()
 
@@ -7014,12 +9099,16 @@ async def edit_profile_value(message: types.Message, state: FSMContext):
     )
 
 
-@dp.message_handler(lambda m: m.text == "📈 Цены на зерно", state="*")
+@router.message_handler(text="📈 Цены на зерно", state="*")
 async def show_prices_menu(message: types.Message, state: FSMContext):
     """Показать цены сразу без меню"""
     await state.finish()
 
+    await serve_market_cache("prices")
     prices_msg = format_prices_message()
+    trends = format_price_trends()
+    if trends:
+        prices_msg += "\n\n" + trends
 
     keyboard = InlineKeyboardMarkup(row_width=1)
     keyboard.add(
@@ -7029,10 +9118,11 @@ async def show_prices_menu(message: types.Message, state: FSMContext):
     await message.answer(prices_msg, parse_mode="HTML", reply_markup=keyboard)
 
 
-@dp.message_handler(lambda m: m.text == "📰 Новости рынка", state="*")
+@router.message_handler(text="📰 Новости рынка", state="*")
 async def show_news_menu(message: types.Message, state: FSMContext):
     """Показать новости сразу без меню"""
     await state.finish()
+    await serve_market_cache("news")
     news_msg = format_news_message()
     keyboard = InlineKeyboardMarkup(row_width=1)
     keyboard.add(
@@ -7047,9 +9137,10 @@ async def show_news_menu(message: types.Message, state: FSMContext):
     )
 
 
-@dp.callback_query_handler(lambda c: c.data == "view_news", state="*")
+@router.callback_query_handler(data="view_news", state="*")
 async def show_news(callback: types.CallbackQuery):
     """Показать новости"""
+    await serve_market_cache("news")
     news_msg = format_news_message()
     await callback.message.edit_text(
         news_msg, parse_mode="HTML", disable_web_page_preview=True
@@ -7057,443 +9148,762 @@ async def show_news(callback: types.CallbackQuery):
     await callback.answer()
 
 
-def parse_soy_from_zol():
-    """
-    Парсинг цен на сою с ZOL.RU (региональная аналитика)
+# ════════════════════════════════════════════════════════════════════
+# РЫНОЧНЫЕ ДАННЫЕ: ПАРАЛЛЕЛЬНАЯ ЗАГРУЗКА ИСТОЧНИКОВ ЦЕН И НОВОСТЕЙ
+# ════════════════════════════════════════════════════════════════════
+MARKET_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+ZERNO_WHEAT_URL = "https://www.zerno.ru/regional-prices-wheat-minimum-and-maximum"
+ZERNO_CEREALS_URL = "https://www.zerno.ru/cerealspricesdate/{date}/{crop}"
+ZERNO_CEREALS = {
+    "Ячмень": "barley",
+    "Кукуруза": "corn",
+    "Подсолнечник": "sunflower",
+}
+# ZOL.RU публикует аналитику еженедельно; зеркала опрашиваются наперегонки
+ZOL_SOY_URLS = [
+    "https://www.zol.ru/n/3fa47",  # 01.10.2025
+    "https://www.zol.ru/n/3faf3",  # резерв 1
+    "https://www.zol.ru/n/3f7b3",  # резерв 2
+    "https://www.zol.ru/soya.htm",  # общая страница
+]
+YAHOO_CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
+CBOT_SYMBOLS = {
+    "Пшеница (CBoT)": "ZW=F",
+    "Кукуруза (CBoT)": "ZC=F",
+    "Соя (CBoT)": "ZS=F",
+}
+CBOT_FALLBACK = {
+    "Пшеница (CBoT)": "₽5.50/bu",
+    "Кукуруза (CBoT)": "₽4.20/bu",
+    "Соя (CBoT)": "₽10.80/bu",
+}
+FOB_FALLBACK = 210.0
+MARKET_NOT_MODIFIED = object()  # ответ 304: страница не изменилась
+NEWS_URL = "https://www.zerno.ru"
+NEWS_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "ru-RU,ru;q=0.9",
+}
 
-    ZOL.RU публикует еженедельную аналитику цен по регионам России
-    Цены указаны в руб/кг, конвертируются в ₽/т
 
-    Returns:
-        int: Средняя цена в ₽/т или None при ошибке
+class MarketDataFetcher:
+    """
+    Загрузка страниц источников цен и новостей через общий aiohttp-пул.
+
+    Все запросы обновления идут одновременно: не больше
+    CONFIG["market_fetch_per_host"] соединений на хост, каждый запрос —
+    не дольше CONFIG["market_fetch_timeout"] сек и не позже общего
+    дедлайна обновления. Разбор страниц (потоковый HTML, JSON) — в потоке
+    executor-а, чтобы не держать event loop. Ошибка источника — это None,
+    вызывающий подставляет резервное значение.
     """
-    try:
-        logging.info("🌱 Парсинг сои с ZOL.RU...")
 
-        # ZOL.RU публикует аналитику еженедельно
-        base_urls = [
-            "https://www.zol.ru/n/3fa47",  # 01.10.2025
-            "https://www.zol.ru/n/3faf3",  # резерв 1
-            "https://www.zol.ru/n/3f7b3",  # резерв 2
-            "https://www.zol.ru/soya.htm",  # общая страница
-        ]
+    def __init__(self):
+        self._session = None
+        # URL -> {"etag", "last_modified", "result"}: условные запросы и
+        # результат разбора, который не надо повторять при 304
+        self.validators = BoundedCache(
+            "market_validators", 500, ttl=7 * 24 * 3600, persist="market_validators.pkl"
+        )
+        self.metrics = {
+            "requests": 0,
+            "not_modified": 0,
+            "failed": 0,
+            "timeouts": 0,
+            "last_update_ms": 0.0,
+        }
 
-        for url in base_urls:
-            try:
-                response = requests.get(
-                    url,
-                    timeout=10,
-                    headers={
-                        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-                    },
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=CONFIG["market_fetch_connections"],
+                    limit_per_host=CONFIG["market_fetch_per_host"],
+                    ttl_dns_cache=300,
+                ),
+                headers={"User-Agent": MARKET_USER_AGENT},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def fetch(self, url: str, deadline: float, headers=None):
+        """
+        (содержимое, кодировка, ETag, Last-Modified) страницы,
+        MARKET_NOT_MODIFIED на 304 или None (ошибка, другой код, дедлайн).
+        """
+        remaining = min(CONFIG["market_fetch_timeout"], deadline - time.monotonic())
+        if remaining <= 0:
+            self.metrics["timeouts"] += 1
+            logging.warning(f"⚠️ {url}: не хватило времени до дедлайна обновления")
+            return None
+        self.metrics["requests"] += 1
+        try:
+            async with self._get_session().get(
+                url, headers=headers, timeout=aiohttp.ClientTimeout(total=remaining)
+            ) as response:
+                if response.status == 304:
+                    self.metrics["not_modified"] += 1
+                    return MARKET_NOT_MODIFIED
+                if response.status != 200:
+                    self.metrics["failed"] += 1
+                    logging.warning(
+                        f"⚠️ {url}: страница недоступна (код {response.status})"
+                    )
+                    return None
+                content = await response.read()
+                return (
+                    content,
+                    response.get_encoding(),
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
                 )
+        except asyncio.TimeoutError:
+            self.metrics["timeouts"] += 1
+            logging.warning(f"⚠️ {url}: таймаут")
+        except aiohttp.ClientError as e:
+            self.metrics["failed"] += 1
+            logging.warning(f"⚠️ {url}: {e}")
+        return None
 
-                if response.status_code != 200:
-                    continue
+    async def fetch_parsed(
+        self, url: str, parse, deadline: float, *args, as_text=False, headers=None
+    ):
+        """
+        Загрузка url и разбор parse(содержимое, *args) в потоке; None при
+        ошибке. Если страница не изменилась (ETag / Last-Modified), берётся
+        прошлый результат разбора — без скачивания и парсинга.
+        """
+        cached = self.validators.get(url)
+        headers = dict(headers or {})
+        if cached:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        page = await self.fetch(url, deadline, headers=headers)
+        if page is MARKET_NOT_MODIFIED:
+            return cached["result"] if cached else None
+        if page is None:
+            return None
+        content, encoding, etag, last_modified = page
+        if MARKET_FIXTURES_DIR:
+            record_market_fixture(url, parse, args, content, encoding, as_text)
+        if as_text:
+            content = content.decode(encoding or "utf-8", errors="replace")
+        loop = asyncio.get_event_loop()
+        try:
+            result = await loop.run_in_executor(None, parse, content, *args)
+        except Exception as e:
+            logging.error(f"❌ Разбор {url}: {e}")
+            return None
+        if result is not None and (etag or last_modified):
+            self.validators[url] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "result": result,
+            }
+        return result
+
+    async def first_success(self, urls, parse, deadline: float, as_text=False):
+        """
+        Опрашивает зеркала одновременно; результат первого, у которого
+        parse вернул не None, остальные запросы отменяются.
+        """
+        tasks = [
+            asyncio.ensure_future(
+                self.fetch_parsed(url, parse, deadline, as_text=as_text)
+            )
+            for url in urls
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                if result is not None:
+                    return result
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
 
-                text = response.text.lower()
 
-                # Паттерны для парсинга
-                patterns = [
-                    r"соя\s*[=:]\s*(\d+\.?\d*)",
-                    r"soy\s*[=:]\s*(\d+\.?\d*)",
-                ]
+market_fetcher = MarketDataFetcher()
 
-                prices = []
-
-                for pattern in patterns:
-                    matches = re.findall(pattern, text)
-                    if matches:
-                        for match in matches:
-                            try:
-                                # Цена в руб/кг, переводим в ₽/т
-                                price_kg = float(match)
-                                price_ton = int(price_kg * 1000)
-
-                                # Валидация (18,000 - 60,000 ₽/т)
-                                if 18000 <= price_ton <= 60000:
-                                    prices.append(price_ton)
-                            except Exception:
-                                continue
 
-                # Убираем дубликаты
-                prices = list(set(prices))
+def format_market_metrics() -> str:
+    """Блок статистики загрузки рыночных данных для админ-панели."""
+    m = market_fetcher.metrics
+    if not m["requests"]:
+        return ""
+    return (
+        "🌾 <b>Источники цен и новостей:</b>\n"
+        f"• Запросов: {m['requests']}, без изменений (304) {m['not_modified']}, "
+        f"ошибок {m['failed']}, таймаутов {m['timeouts']}\n"
+        f"• Последнее обновление цен: {m['last_update_ms']:.0f} мс\n"
+    )
 
-                if prices and len(prices) >= 1:
-                    avg = int(sum(prices) / len(prices))
-                    logging.info(f"✅ Соя (ZOL.RU): найдено {len(prices)} регионов")
-                    for i, price in enumerate(sorted(prices), 1):
-                        logging.info(f"   Регион {i}: {price:,} ₽/т")
-                    logging.info(
-                        f"✅ Соя: средняя {avg:,} ₽/т ({len(prices)} регионов) [СПАРСЕНО]"
-                    )
-                    return avg
 
-            except Exception as e:
-                logging.debug(f"Попытка {url}: {e}")
-                continue
+SOY_PRICE_RE = re.compile(r"(?:соя|soy)\s*[=:]\s*(\d+\.?\d*)", re.IGNORECASE)
+NON_DIGITS_RE = re.compile(r"[^0-9]")
+NEWS_LINK_RE = re.compile(r"/node/\d+")
+HTML_FEED_CHUNK = 16384  # символов за один шаг потокового разбора
+CEREAL_HEADER_KEYWORDS = ("Класс", "Город", "цена", "изм.", "тренд", "Валюта")
+CEREAL_SKIP_VALUES = ("default_value", "-", "0", "", "руб/т")
 
-        logging.warning("⚠️ Соя (ZOL.RU): не удалось спарсить")
-        return None
 
-    except Exception as e:
-        logging.error(f"❌ Ошибка парсинга сои с ZOL.RU: {e}")
-        return None
+def decode_html(content) -> str:
+    """Текст страницы: кодировка из <meta>/BOM, как её определяет BeautifulSoup."""
+    if isinstance(content, str):
+        return content
+    return UnicodeDammit(content, is_html=True).unicode_markup or ""
 
 
-def parse_russia_regional_prices():
-    """Парсинг региональных цен на зерно в России с zerno.ru"""
+class StreamingHTMLParser(HTMLParser):
+    """
+    Потоковый разбор страницы без построения дерева.
 
-    logging.info("🌾 Парсинг РФ: начало...")
-    result = {}
+    Страница подаётся кусками по HTML_FEED_CHUNK символов; как только
+    нужный фрагмент разобран (done), остаток страницы не токенизируется.
+    """
 
-    # 1. ПШЕНИЦА (оставить как есть - работает отлично)
-    try:
-        url_wheat = "https://www.zerno.ru/regional-prices-wheat-minimum-and-maximum"
-        response = requests.get(url_wheat, timeout=10)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.content, "html.parser")
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.done = False
 
-        table = soup.find("table")
-        if table:
-            rows = table.find_all("tr")[1:]
-            logging.info(f"📋 Пшеница: найдено строк {len(rows)}")
+    def run(self, content):
+        text = decode_html(content)
+        for start in range(0, len(text), HTML_FEED_CHUNK):
+            self.feed(text[start:start + HTML_FEED_CHUNK])
+            if self.done:
+                break
+        else:
+            self.close()
+        self.finish()
+        return self
 
-            wheat_prices = []
-            for row in rows:
-                cells = row.find_all("td")
-                if len(cells) < 2:
-                    continue
+    def finish(self):
+        """Дописать незакрытые элементы, если страница оборвалась."""
 
-                region = cells[0].get_text(strip=True)
 
-                for i in range(1, min(4, len(cells))):
-                    price_text = cells[i].get_text(strip=True)
-                    if not price_text or price_text == "-":
-                        continue
+class TableRowsParser(StreamingHTMLParser):
+    """
+    Тексты ячеек <td> по строкам первой <table> страницы.
 
-                    if "-" in price_text and not price_text.startswith("-"):
-                        prices_range = price_text.split("-")
-                        for p in prices_range:
-                            try:
-                                price_clean = re.sub(r"[^0-9]", "", p)
-                                if price_clean:
-                                    price_value = int(price_clean)
-                                    if 8000 <= price_value <= 30000:
-                                        wheat_prices.append(price_value)
-                                        logging.info(
-                                            f"✅ Пшеница: {price_value} ₽/т из {region}"
-                                        )
-                            except Exception:
-                                continue
-                    else:
-                        try:
-                            price_clean = re.sub(r"[^0-9]", "", price_text)
-                            if price_clean:
-                                price_value = int(price_clean)
-                                if 8000 <= price_value <= 30000:
-                                    wheat_prices.append(price_value)
-                                    logging.info(
-                                        f"✅ Пшеница: {price_value} ₽/т из {region}"
-                                    )
-                        except Exception:
-                            continue
+    rows — список строк (строка без <td>, например заголовок из <th>, —
+    пустой список), None, если таблицы нет. Результат совпадает с
+    table.find_all("tr") / row.find_all("td") / get_text(strip=True)
+    BeautifulSoup, включая вложенные таблицы и незакрытые <td>, но дерево
+    не строится, а разбор останавливается на закрывающем </table>.
+    """
 
-            if wheat_prices:
-                result["Пшеница"] = int(sum(wheat_prices) / len(wheat_prices))
-                logging.info(
-                    f"✅ Пшеница: средняя {result['Пшеница']} ₽/т ({len(wheat_prices)} цен)"
-                )
-            else:
-                result["Пшеница"] = 15000
-                logging.warning("⚠️ Пшеница: используем резервное значение")
-        else:
-            result["Пшеница"] = 15000
-            logging.warning("⚠️ Пшеница: таблица не найдена")
+    def __init__(self):
+        super().__init__()
+        self.rows = None
+        self._open = []  # открытые table/tr/td первой таблицы: [тег, куски]
+        self._text = []  # текст с последнего тега
+        self._skip = False  # внутри <script>/<style>
+
+    def _flush_text(self):
+        if self._text:
+            piece = "".join(self._text).strip()
+            if piece:
+                for tag, pieces in self._open:
+                    if tag == "td":
+                        pieces.append(piece)
+            self._text = []
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        self._flush_text()
+        if tag in ("script", "style"):
+            self._skip = True
+        if tag == "table" and self.rows is None:
+            self.rows = []
+        elif not self._open or tag not in ("table", "tr", "td"):
+            return
+        if tag == "tr":
+            self.rows.append([])
+            self._open.append([tag, self.rows[-1]])
+            return
+        pieces = []
+        if tag == "td":
+            # Ячейка входит во все открытые строки, как в find_all("td")
+            for open_tag, cells in self._open:
+                if open_tag == "tr":
+                    cells.append(pieces)
+        self._open.append([tag, pieces])
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        self._flush_text()
+        if tag in ("script", "style"):
+            self._skip = False
+        if not any(open_tag == tag for open_tag, _ in self._open):
+            return
+        while self._open.pop()[0] != tag:
+            pass
+        if not self._open:
+            self.done = True
 
-    except Exception as e:
-        logging.error(f"❌ Ошибка парсинга пшеницы: {e}")
-        result["Пшеница"] = 15000
+    def handle_data(self, data):
+        if self._open and not self._skip and not self.done:
+            self._text.append(data)
 
-    # 2. УЛУЧШЕННЫЙ ПАРСИНГ ДРУГИХ КУЛЬТУР
-    today = datetime.now().strftime("%Y-%m-%d")
+    def handle_comment(self, data):
+        self._flush_text()
 
-    cereals_urls = {
-        "Ячмень": f"https://www.zerno.ru/cerealspricesdate/{today}/barley",
-        "Кукуруза": f"https://www.zerno.ru/cerealspricesdate/{today}/corn",
-        "Подсолнечник": f"https://www.zerno.ru/cerealspricesdate/{today}/sunflower",
-    }
+    def finish(self):
+        self._flush_text()
+        if self.rows is not None:
+            self.rows = [["".join(cell) for cell in row] for row in self.rows]
 
-    fallback_prices = {
-        "Ячмень": 14000,
-        "Кукуруза": 14000,
-        "Соя": 25000,
-        "Подсолнечник": 30000,
-    }
 
-    price_ranges = {
-        "Ячмень": (7000, 25000),
-        "Кукуруза": (10000, 30000),  # РАСШИРЕНО!
-        "Соя": (18000, 60000),  # РАСШИРЕНО!
-        "Подсолнечник": (15000, 50000),
-    }
+class LinkParser(StreamingHTMLParser):
+    """
+    Ссылки <a>, у которых href подходит под href_re: [(текст, href)].
+    Разбор останавливается после limit найденных ссылок.
+    """
+
+    def __init__(self, href_re, limit: int):
+        super().__init__()
+        self.href_re = href_re
+        self.limit = limit
+        self.links = []
+        self._href = None  # href открытой подходящей ссылки
+        self._text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a" or self.done:
+            return
+        href = dict(attrs).get("href") or ""
+        if self.href_re.search(href):
+            self._end_link()
+            self._href = href
+            self._text = []
+
+    def handle_endtag(self, tag):
+        if tag == "a":
+            self._end_link()
+
+    def handle_data(self, data):
+        if self._href is not None:
+            self._text.append(data)
+
+    def _end_link(self):
+        if self._href is None or self.done:
+            return
+        self.links.append(("".join(self._text).strip(), self._href))
+        self._href = None
+        if len(self.links) >= self.limit:
+            self.done = True
+
+    def finish(self):
+        self._end_link()
+
+
+def first_table_rows(content):
+    """Строки первой таблицы страницы (списки текстов <td>) или None."""
+    return TableRowsParser().run(content).rows
 
-    for culture, url in cereals_urls.items():
+
+def parse_soy_prices(text: str):
+    """
+    Цены на сою со страницы аналитики ZOL.RU.
+
+    Цены указаны в руб/кг, конвертируются в ₽/т
+
+    Returns:
+        int: Средняя цена в ₽/т или None, если цен на странице нет
+    """
+    prices = set()
+    for match in SOY_PRICE_RE.findall(text):
         try:
-            response = requests.get(url, timeout=10)
+            # Цена в руб/кг, переводим в ₽/т
+            price_ton = int(float(match) * 1000)
+        except ValueError:
+            continue
+        # Валидация (18,000 - 60,000 ₽/т)
+        if 18000 <= price_ton <= 60000:
+            prices.add(price_ton)
 
-            if response.status_code != 200:
-                logging.warning(
-                    f"⚠️ {culture}: страница недоступна (код {response.status_code})"
-                )
-                result[culture] = fallback_prices[culture]
-                continue
+    if not prices:
+        return None
+    avg = int(sum(prices) / len(prices))
+    logging.info(f"✅ Соя (ZOL.RU): найдено {len(prices)} регионов")
+    for i, price in enumerate(sorted(prices), 1):
+        logging.info(f"   Регион {i}: {price:,} ₽/т")
+    logging.info(f"✅ Соя: средняя {avg:,} ₽/т ({len(prices)} регионов) [СПАРСЕНО]")
+    return avg
+
+
+def parse_wheat_prices(content):
+    """Средняя цена пшеницы по регионам со страницы zerno.ru или None."""
+    rows = first_table_rows(content)
+    if rows is None:
+        logging.warning("⚠️ Пшеница: таблица не найдена")
+        return None
 
-            soup = BeautifulSoup(response.content, "html.parser")
-            table = soup.find("table")
+    rows = rows[1:]
+    logging.info(f"📋 Пшеница: найдено строк {len(rows)}")
 
-            if not table:
-                logging.warning(f"⚠️ {culture}: таблица не найдена")
-                result[culture] = fallback_prices[culture]
-                continue
+    wheat_prices = []
+    for cells in rows:
+        if len(cells) < 2:
+            continue
 
-            prices = []
-            rows = table.find_all("tr")
-            logging.info(f"📋 {culture}: найдено строк {len(rows)}")
+        region = cells[0]
 
-            for row in rows:
-                cells = row.find_all("td")
+        for price_text in cells[1:4]:
+            if not price_text or price_text == "-":
+                continue
 
-                # Пропускаем короткие строки
-                if len(cells) < 3:
-                    continue
+            if "-" in price_text and not price_text.startswith("-"):
+                parts = price_text.split("-")
+            else:
+                parts = [price_text]
+            for p in parts:
+                price_clean = NON_DIGITS_RE.sub("", p)
+                if price_clean:
+                    price_value = int(price_clean)
+                    if 8000 <= price_value <= 30000:
+                        wheat_prices.append(price_value)
+                        logging.info(f"✅ Пшеница: {price_value} ₽/т из {region}")
+
+    if not wheat_prices:
+        return None
+    avg = int(sum(wheat_prices) / len(wheat_prices))
+    logging.info(f"✅ Пшеница: средняя {avg} ₽/т ({len(wheat_prices)} цен)")
+    return avg
 
-                # КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: Пропускаем заголовки
-                first_cell = cells[0].get_text(strip=True)
-                if any(
-                    keyword in first_cell
-                    for keyword in ["Класс", "Город", "цена", "изм.", "тренд", "Валюта"]
-                ):
-                    continue
 
-                # Получаем город/источник для логирования
-                city = first_cell if first_cell else "Неизвестно"
+CEREAL_PRICE_RANGES = {
+    "Ячмень": (7000, 25000),
+    "Кукуруза": (10000, 30000),  # РАСШИРЕНО!
+    "Соя": (18000, 60000),  # РАСШИРЕНО!
+    "Подсолнечник": (15000, 50000),
+}
+RUSSIA_FALLBACK_PRICES = {
+    "Пшеница": 15000,
+    "Ячмень": 14000,
+    "Кукуруза": 14000,
+    "Соя": 28000,
+    "Подсолнечник": 30000,
+}
 
-                # Ищем цену в разных колонках (приоритет: 2, 1, 3, 4)
-                for col_idx in [2, 1, 3, 4]:
-                    if len(cells) <= col_idx:
-                        continue
 
-                    price_text = cells[col_idx].get_text(strip=True)
+def parse_cereal_prices(content, culture: str):
+    """Средняя цена культуры со страницы цен zerno.ru по дате или None."""
+    rows = first_table_rows(content)
+    if rows is None:
+        logging.warning(f"⚠️ {culture}: таблица не найдена")
+        return None
 
-                    # КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: Пропускаем служебные значения
-                    if not price_text or price_text in [
-                        "default_value",
-                        "-",
-                        "0",
-                        "",
-                        "руб/т",
-                    ]:
-                        continue
+    prices = []
+    logging.info(f"📋 {culture}: найдено строк {len(rows)}")
+    min_p, max_p = CEREAL_PRICE_RANGES[culture]
 
-                    try:
-                        # Извлекаем только цифры
-                        price_clean = re.sub(r"[^0-9]", "", price_text)
-                        if not price_clean:
-                            continue
+    for cells in rows:
+        # Пропускаем короткие строки
+        if len(cells) < 3:
+            continue
 
-                        price_value = int(price_clean)
+        # КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: Пропускаем заголовки
+        first_cell = cells[0]
+        if any(keyword in first_cell for keyword in CEREAL_HEADER_KEYWORDS):
+            continue
 
-                        # Валидация с расширенными диапазонами
-                        min_p, max_p = price_ranges[culture]
-                        if min_p <= price_value <= max_p:
-                            prices.append(price_value)
-                            logging.info(f"✅ {culture}: {price_value} ₽/т из {city}")
-                            break  # Нашли цену, переходим к следующей строке
-                    except Exception:
-                        continue
+        # Получаем город/источник для логирования
+        city = first_cell if first_cell else "Неизвестно"
 
-            # Результат
-            if prices:
-                avg = int(sum(prices) / len(prices))
-                result[culture] = avg
-                logging.info(f"✅ {culture}: средняя {avg} ₽/т ({len(prices)} цен)")
-            else:
-                result[culture] = fallback_prices[culture]
-                logging.warning(
-                    f"⚠️ {culture}: используем резервное значение {fallback_prices[culture]} ₽/т"
-                )
+        # Ищем цену в разных колонках (приоритет: 2, 1, 3, 4)
+        for col_idx in [2, 1, 3, 4]:
+            if len(cells) <= col_idx:
+                continue
 
-        except Exception as e:
-            result[culture] = fallback_prices[culture]
-            logging.error(f"❌ {culture}: {e}")
+            price_text = cells[col_idx]
 
-    try:
-        soy_price = parse_soy_from_zol()
+            # КЛЮЧЕВОЕ ИЗМЕНЕНИЕ: Пропускаем служебные значения
+            if price_text in CEREAL_SKIP_VALUES:
+                continue
 
-        if soy_price:
-            result["Соя"] = soy_price
-        else:
-            # Резервное значение на основе последних реальных данных
-            result["Соя"] = 28000
-            logging.warning("⚠️ Соя: используем резервное значение 28,000 ₽/т")
+            # Извлекаем только цифры
+            price_clean = NON_DIGITS_RE.sub("", price_text)
+            if not price_clean:
+                continue
 
-    except Exception as e:
-        result["Соя"] = 28000
-        logging.error(f"❌ Соя: {e}, используем резервное")
+            price_value = int(price_clean)
 
-    logging.info(f"📊 Парсинг завершён: {len(result)} культур")
-    return result
+            # Валидация с расширенными диапазонами
+            if min_p <= price_value <= max_p:
+                prices.append(price_value)
+                logging.info(f"✅ {culture}: {price_value} ₽/т из {city}")
+                break  # Нашли цену, переходим к следующей строке
 
+    if not prices:
+        return None
+    avg = int(sum(prices) / len(prices))
+    logging.info(f"✅ {culture}: средняя {avg} ₽/т ({len(prices)} цен)")
+    return avg
+
+
+def parse_yahoo_price(content):
+    """regularMarketPrice из ответа Yahoo Finance chart API или None."""
+    data = json.loads(content)
+    if "chart" in data and "result" in data["chart"] and data["chart"]["result"]:
+        result = data["chart"]["result"][0]
+        if "meta" in result and "regularMarketPrice" in result["meta"]:
+            return result["meta"]["regularMarketPrice"]
+    return None
 
-def parse_fob_black_sea():
-    """✅ Парсинг FOB (Черное море)"""
-    try:
-        url = "https://query1.finance.yahoo.com/v8/finance/chart/ZW=F"
-        response = requests.get(url, headers={"User-Agent": "Mozilla/5.0"}, timeout=10)
-        data = response.json()
 
-        if "chart" in data and "result" in data["chart"] and data["chart"]["result"]:
-            result = data["chart"]["result"][0]
-            if "meta" in result and "regularMarketPrice" in result["meta"]:
-                price_cents = result["meta"]["regularMarketPrice"]
-                price_dollars = price_cents / 100
-                fob_price = round(price_dollars * 36.74, 2)
-                logging.info(f"✅ FOB: ₽{fob_price}/т")
-                return fob_price
+async def fetch_russia_regional_prices(deadline: float):
+    """
+    Региональные цены на зерно в России (zerno.ru, ZOL.RU) — все страницы
+    сразу. Возвращает (цены с резервными значениями, только полученные цены).
+    """
+    logging.info("🌾 Парсинг РФ: начало...")
+    today = datetime.now().strftime("%Y-%m-%d")
+    cultures = ["Пшеница", *ZERNO_CEREALS, "Соя"]
+    found = await asyncio.gather(
+        market_fetcher.fetch_parsed(ZERNO_WHEAT_URL, parse_wheat_prices, deadline),
+        *[
+            market_fetcher.fetch_parsed(
+                ZERNO_CEREALS_URL.format(date=today, crop=crop),
+                parse_cereal_prices,
+                deadline,
+                culture,
+            )
+            for culture, crop in ZERNO_CEREALS.items()
+        ],
+        market_fetcher.first_success(
+            ZOL_SOY_URLS, parse_soy_prices, deadline, as_text=True
+        ),
+    )
 
-        logging.warning("⚠️ FOB: используем fallback")
-        return 210.0
+    result = {}
+    live = {}
+    for culture, price in zip(cultures, found):
+        if price:
+            result[culture] = live[culture] = price
+        else:
+            result[culture] = RUSSIA_FALLBACK_PRICES[culture]
+            logging.warning(
+                f"⚠️ {culture}: используем резервное значение "
+                f"{RUSSIA_FALLBACK_PRICES[culture]:,} ₽/т"
+            )
+    logging.info(f"📊 Парсинг завершён: {len(result)} культур")
+    return result, live
 
-    except Exception as e:
-        logging.error(f"❌ parse_fob_black_sea: {e}")
-        return 210.0
 
+async def fetch_cbot_futures(deadline: float) -> dict:
+    """Котировки фьючерсов CBoT (Yahoo Finance), в центах за бушель."""
+    quotes = await asyncio.gather(
+        *[
+            market_fetcher.fetch_parsed(
+                YAHOO_CHART_URL.format(symbol=symbol), parse_yahoo_price, deadline
+            )
+            for symbol in CBOT_SYMBOLS.values()
+        ]
+    )
+    return dict(zip(CBOT_SYMBOLS, quotes))
 
-def parse_cbot_futures():
-    """✅ Парсинг фьючерсов CBoT"""
+
+def format_cbot_prices(quotes: dict) -> dict:
+    """✅ Фьючерсы CBoT для экрана цен"""
     prices = {}
+    for name, price_cents in quotes.items():
+        if price_cents is None:
+            continue
+        price_dollars = price_cents / 100
+        prices[name] = f"₽{price_dollars:.2f}/bu"
+        logging.info(f"✅ {name}: ₽{price_dollars:.2f}/bu")
 
-    try:
-        symbols = {
-            "Пшеница (CBoT)": "ZW=F",
-            "Кукуруза (CBoT)": "ZC=F",
-            "Соя (CBoT)": "ZS=F",
-        }
+    if not prices:
+        prices = dict(CBOT_FALLBACK)
+        logging.warning("⚠️ CBoT: используем fallback")
+    return prices
 
-        for name, symbol in symbols.items():
-            try:
-                url = f"https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
-                response = requests.get(
-                    url, headers={"User-Agent": "Mozilla/5.0"}, timeout=10
-                )
-                data = response.json()
 
-                if (
-                    "chart" in data
-                    and "result" in data["chart"]
-                    and data["chart"]["result"]
-                ):
-                    result = data["chart"]["result"][0]
-                    if "meta" in result and "regularMarketPrice" in result["meta"]:
-                        price_cents = result["meta"]["regularMarketPrice"]
-                        price_dollars = price_cents / 100
-                        prices[name] = f"₽{price_dollars:.2f}/bu"
-                        logging.info(f"✅ {name}: ₽{price_dollars:.2f}/bu")
-            except Exception as e:
-                logging.error(f"❌ {name}: {e}")
-                continue
+def fob_black_sea_price(wheat_cents) -> float:
+    """✅ FOB (Черное море) по котировке пшеницы CBoT"""
+    if wheat_cents is None:
+        logging.warning("⚠️ FOB: используем fallback")
+        return FOB_FALLBACK
+    fob_price = round(wheat_cents / 100 * 36.74, 2)
+    logging.info(f"✅ FOB: ₽{fob_price}/т")
+    return fob_price
 
-        if not prices:
-            prices = {
-                "Пшеница (CBoT)": "₽5.50/bu",
-                "Кукуруза (CBoT)": "₽4.20/bu",
-                "Соя (CBoT)": "₽10.80/bu",
-            }
-            logging.warning("⚠️ CBoT: используем fallback")
 
-        return prices
+def parse_grain_news(content, limit=5):
+    """✅ Новости со страницы zerno.ru"""
+    newslist = []
+    links = LinkParser(NEWS_LINK_RE, 20).run(content).links
+    seen_titles = set()
+
+    keywords = [
+        "экспорт",
+        "россия",
+        "астрахань",
+        "зерно",
+        "пшениц",
+        "урожай",
+        "fob",
+        "черное море",
+        "цен",
+        "рынок",
+    ]
 
-    except Exception as e:
-        logging.error(f"❌ parse_cbot_futures: {e}")
-        return {
-            "Пшеница (CBoT)": "₽5.50/bu",
-            "Кукуруза (CBoT)": "₽4.20/bu",
-            "Соя (CBoT)": "₽10.80/bu",
-        }
+    for title, href in links:
+        title_lower = title.lower()
 
+        if title and len(title) > 30 and title not in seen_titles:
+            if any(kw in title_lower for kw in keywords):
+                seen_titles.add(title)
 
-def parse_grain_news(limit=5):
-    """✅ Парсинг новостей с zerno.ru"""
-    newslist = []
+                date = datetime.now().strftime("%d.%m.%Y")
+                full_link = (
+                    f"https://www.zerno.ru{href}" if href.startswith("/") else href
+                )
 
-    try:
-        url = "https://www.zerno.ru"
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-            "Accept-Language": "ru-RU,ru;q=0.9",
-        }
+                newslist.append({"title": title, "link": full_link, "date": date})
 
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
-
-        links = soup.find_all("a", href=re.compile(r"/node/\d+"))
-        seen_titles = set()
-
-        keywords = [
-            "экспорт",
-            "россия",
-            "астрахань",
-            "зерно",
-            "пшениц",
-            "урожай",
-            "fob",
-            "черное море",
-            "цен",
-            "рынок",
-        ]
+                if len(newslist) >= limit:
+                    break
 
-        for link in links[:20]:
-            title = link.text.strip()
-            href = link.get("href", "")
+    logging.info(f"✅ Спарсено новостей: {len(newslist)}")
+    return newslist
 
-            title_lower = title.lower()
 
-            if title and len(title) > 30 and title not in seen_titles:
-                if any(kw in title_lower for kw in keywords):
-                    seen_titles.add(title)
+# ====================================================================
+# ЗАМЕР РАЗБОРА СТРАНИЦ ЦЕН (python main.py --bench-parsers)
+# ====================================================================
+MARKET_HTML_PARSERS = {
+    parse.__name__: parse
+    for parse in (
+        parse_wheat_prices,
+        parse_cereal_prices,
+        parse_soy_prices,
+        parse_grain_news,
+    )
+}
+MARKET_FIXTURES_INDEX = "index.json"
+
+
+def record_market_fixture(url: str, parse, args, content: bytes, encoding, as_text):
+    """Сохранить загруженную страницу в MARKET_FIXTURES_DIR (для --bench-parsers)."""
+    if parse.__name__ not in MARKET_HTML_PARSERS:
+        return
+    try:
+        os.makedirs(MARKET_FIXTURES_DIR, exist_ok=True)
+        name = f"{parse.__name__}_{hashlib.md5(url.encode()).hexdigest()[:10]}.html"
+        with open(os.path.join(MARKET_FIXTURES_DIR, name), "wb") as f:
+            f.write(content)
+        index_path = os.path.join(MARKET_FIXTURES_DIR, MARKET_FIXTURES_INDEX)
+        index = {}
+        if os.path.exists(index_path):
+            with open(index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        index[name] = {
+            "url": url,
+            "parser": parse.__name__,
+            "args": list(args),
+            "encoding": encoding,
+            "as_text": as_text,
+        }
+        with open(index_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        logging.warning(f"⚠️ Фикстура {url} не записана: {e}")
 
-                    date = datetime.now().strftime("%d.%m.%Y")
-                    full_link = (
-                        f"https://www.zerno.ru{href}" if href.startswith("/") else href
-                    )
 
-                    newslist.append({"title": title, "link": full_link, "date": date})
+def measure_parse(parse, content, *args, repeat: int = 5) -> dict:
+    """Лучшее время из repeat прогонов и пик памяти (tracemalloc) одного прогона."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        parse(content, *args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        parse(content, *args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"ms": best * 1000, "peak_kb": peak / 1024}
 
-                    if len(newslist) >= limit:
-                        break
 
-        logging.info(f"✅ Спарсено новостей: {len(newslist)}")
-        return newslist
+def benchmark_market_parsers(directory: str, repeat: int = 5) -> list:
+    """
+    Замер разбора записанных страниц (см. MARKET_FIXTURES_DIR).
 
-    except Exception as e:
-        logging.error(f"❌ parse_grain_news: {e}")
-        return []
+    Для каждой страницы — время и пик памяти рабочего парсера и, для
+    сравнения, построения полного дерева BeautifulSoup, которым страницы
+    разбирались раньше.
+    """
+    index_path = os.path.join(directory, MARKET_FIXTURES_INDEX)
+    with open(index_path, "r", encoding="utf-8") as f:
+        index = json.load(f)
+    results = []
+    for name, meta in sorted(index.items()):
+        with open(os.path.join(directory, name), "rb") as f:
+            content = f.read()
+        size_kb = len(content) / 1024
+        if meta["as_text"]:
+            content = content.decode(meta["encoding"] or "utf-8", errors="replace")
+        parse = MARKET_HTML_PARSERS[meta["parser"]]
+        results.append(
+            {
+                "page": name,
+                "url": meta["url"],
+                "size_kb": size_kb,
+                "parser": measure_parse(parse, content, *meta["args"], repeat=repeat),
+                "full_tree": measure_parse(
+                    BeautifulSoup, content, "html.parser", repeat=repeat
+                ),
+            }
+        )
+    return results
 
 
-async def update_prices_cache():
-    """Обновление кэша цен"""
+def format_market_parsers_benchmark(results: list) -> str:
+    lines = []
+    for r in results:
+        parser, full = r["parser"], r["full_tree"]
+        lines.append(
+            f"{r['url']} ({r['size_kb']:.0f} КБ): парсер {parser['ms']:.1f} мс, "
+            f"пик {parser['peak_kb']:.0f} КБ; полное дерево {full['ms']:.1f} мс, "
+            f"пик {full['peak_kb']:.0f} КБ"
+        )
+    return "\n".join(lines)
+
+
+async def reload_prices_cache():
+    """Загрузка цен со всех источников в кэш (и в PRICES_FILE)"""
     global prices_cache, last_prices_update
 
     try:
         logging.info("🔄 Обновление цен...")
-        loop = asyncio.get_event_loop()
+        started = time.monotonic()
+        prices_cache["checked"] = datetime.now()
+        deadline = started + CONFIG["market_fetch_deadline"]
 
-        russia_prices = await loop.run_in_executor(None, parse_russia_regional_prices)
-        fob_price = await loop.run_in_executor(None, parse_fob_black_sea)
-        cbot_prices = await loop.run_in_executor(None, parse_cbot_futures)
+        (russia_prices, live_prices), cbot_quotes = await asyncio.gather(
+            fetch_russia_regional_prices(deadline), fetch_cbot_futures(deadline)
+        )
+        # FOB считается по той же котировке пшеницы ZW=F — второй запрос не нужен
+        wheat_cents = cbot_quotes.get("Пшеница (CBoT)")
+        fob_price = fob_black_sea_price(wheat_cents)
+        cbot_prices = format_cbot_prices(cbot_quotes)
+        record_price_history(
+            live_prices, cbot_quotes, fob_price if wheat_cents is not None else None
+        )
 
         prices_cache = {
             "data": {
@@ -7503,30 +9913,313 @@ async def update_prices_cache():
             },
             "updated": datetime.now(),
         }
+        save_market_cache(PRICES_FILE, prices_cache)
 
-        last_prices_update = datetime.now()
-        logging.info("✅ Цены обновлены")
+        last_prices_update = prices_cache["updated"]
+        market_fetcher.metrics["last_update_ms"] = (time.monotonic() - started) * 1000
+        logging.info(
+            f"✅ Цены обновлены за {market_fetcher.metrics['last_update_ms']:.0f} мс"
+        )
 
     except Exception as e:
         logging.error(f"❌ update_prices_cache: {e}")
 
 
-async def update_news_cache():
-    """Обновление кэша новостей - ИСПРАВЛЕННАЯ ВЕРСИЯ"""
+async def reload_news_cache():
+    """Загрузка новостей в кэш (и в NEWS_FILE)"""
     global news_cache
 
     try:
         logging.info("🔄 Обновление новостей...")
-        loop = asyncio.get_event_loop()
-        news = await loop.run_in_executor(None, parse_grain_news)
+        news_cache["checked"] = datetime.now()
+        deadline = time.monotonic() + CONFIG["market_fetch_deadline"]
+        news = await market_fetcher.fetch_parsed(
+            NEWS_URL, parse_grain_news, deadline, headers=NEWS_HEADERS
+        )
+        if news is None:
+            # Источник недоступен — остаются прежние новости
+            logging.warning("⚠️ Новости: источник недоступен, оставляем прежние")
+            return
 
         news_cache = {"data": news, "updated": datetime.now()}
+        save_market_cache(NEWS_FILE, news_cache)
 
         logging.info(f"✅ Новости обновлены: {len(news)} записей")
 
     except Exception as e:
         logging.error(f"❌ update_news_cache: {e}")
-        news_cache = {"data": [], "updated": datetime.now()}
+
+
+# ════════════════════════════════════════════════════════════════════
+# КЭШ ЦЕН И НОВОСТЕЙ: ФАЙЛЫ И STALE-WHILE-REVALIDATE
+# ════════════════════════════════════════════════════════════════════
+market_refresh_tasks = {}  # "prices" / "news" -> asyncio.Task идущего обновления
+
+
+def save_market_cache(path: str, cache: dict):
+    """Атомарно сохраняет кэш (данные + время обновления) в JSON."""
+    try:
+        payload = {
+            "data": cache.get("data"),
+            "updated": cache["updated"].isoformat() if cache.get("updated") else None,
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logging.error(f"❌ Ошибка сохранения {path}: {e}")
+
+
+def load_market_cache(path: str, empty) -> dict:
+    """Кэш из JSON-файла; без файла — пустой и устаревший."""
+    try:
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+            updated = payload.get("updated")
+            return {
+                "data": payload.get("data") or empty,
+                "updated": datetime.fromisoformat(updated) if updated else None,
+            }
+    except Exception as e:
+        logging.error(f"❌ Ошибка загрузки {path}: {e}")
+    return {"data": empty, "updated": None}
+
+
+def load_market_caches():
+    """Цены и новости прошлого запуска — сразу доступны пользователям."""
+    global prices_cache, news_cache, last_prices_update
+    prices_cache = load_market_cache(PRICES_FILE, {})
+    news_cache = load_market_cache(NEWS_FILE, [])
+    last_prices_update = prices_cache["updated"]
+    for name, cache in (("Цены", prices_cache), ("Новости", news_cache)):
+        if cache["updated"]:
+            logging.info(
+                f"✅ {name} из файла: от {cache['updated'].strftime('%d.%m.%Y %H:%M')}"
+            )
+
+
+def market_cache_is_stale(cache: dict) -> bool:
+    """Кэш старше CONFIG["cache_ttl"] (считая от последней попытки обновления)."""
+    moments = [t for t in (cache.get("updated"), cache.get("checked")) if t]
+    if not moments:
+        return True
+    return (datetime.now() - max(moments)).total_seconds() > CONFIG["cache_ttl"]
+
+
+async def run_market_refresh(name: str, reload):
+    """Одно обновление кэша за раз: повторный вызов ждёт уже идущее."""
+    task = market_refresh_tasks.get(name)
+    if task is None or task.done():
+        task = market_refresh_tasks[name] = asyncio.ensure_future(reload())
+    await asyncio.shield(task)
+
+
+async def update_prices_cache():
+    """Обновление кэша цен"""
+    await run_market_refresh("prices", reload_prices_cache)
+
+
+async def update_news_cache():
+    """Обновление кэша новостей"""
+    await run_market_refresh("news", reload_news_cache)
+
+
+async def serve_market_cache(name: str):
+    """
+    Stale-while-revalidate для экранов цен и новостей: устаревший кэш
+    отдаётся сразу, а обновляется в фоне. Ждём загрузки, только если
+    показывать ещё нечего.
+    """
+    if name == "prices":
+        cache, update = prices_cache, update_prices_cache
+    else:
+        cache, update = news_cache, update_news_cache
+    if not market_cache_is_stale(cache):
+        return
+    if not cache.get("data"):
+        await update()
+        return
+    task = market_refresh_tasks.get(name)
+    if task is None or task.done():
+        background_tasks.spawn(f"update_{name}_cache", update())
+
+
+def warm_market_caches():
+    """При запуске: кэш из файлов, устаревшее — обновить в фоне, не задерживая старт."""
+    load_market_caches()
+    if market_cache_is_stale(prices_cache):
+        background_tasks.spawn("update_prices_cache", update_prices_cache())
+    if market_cache_is_stale(news_cache):
+        background_tasks.spawn("update_news_cache", update_news_cache())
+
+
+# ════════════════════════════════════════════════════════════════════
+# ИСТОРИЯ ЦЕН: ВРЕМЕННЫЕ РЯДЫ И СТАТИСТИКА (NumPy)
+# ════════════════════════════════════════════════════════════════════
+PRICE_HISTORY_DIR = os.path.join(DATA_DIR, "price_history")
+PRICE_HISTORY_DTYPE = np.dtype([("ts", "<f8"), ("price", "<f8")])
+DAY_SECONDS = 24 * 3600
+
+
+class PriceHistory:
+    """
+    Append-only хранилище цен: на каждый ряд ("russia:Пшеница", "fob",
+    "cbot:Соя (CBoT)") — файл записей (время, цена) фиксированной длины.
+
+    Запись — дописывание 16 байт в конец файла, чтение — np.memmap без
+    загрузки файла в память: столбцы ts/price сразу доступны как массивы
+    NumPy. Недописанный хвост (оборванная запись) при чтении отбрасывается.
+    Точки чаще CONFIG["price_history_min_interval"] сек не пишутся.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._mapped = {}  # ряд -> np.memmap (сбрасывается после записи)
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, re.sub(r"[^\w]+", "_", name) + ".bin")
+
+    def series(self, name: str) -> np.ndarray:
+        """Все точки ряда по возрастанию времени (только чтение)."""
+        mapped = self._mapped.get(name)
+        if mapped is not None:
+            return mapped
+        path = self.path(name)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        count = size // PRICE_HISTORY_DTYPE.itemsize
+        if count == 0:
+            return np.zeros(0, dtype=PRICE_HISTORY_DTYPE)
+        mapped = np.memmap(path, dtype=PRICE_HISTORY_DTYPE, mode="r", shape=(count,))
+        self._mapped[name] = mapped
+        return mapped
+
+    def append(self, name: str, price: float, ts: float = None) -> bool:
+        ts = time.time() if ts is None else ts
+        points = self.series(name)
+        min_interval = CONFIG["price_history_min_interval"]
+        if len(points) and ts - points["ts"][-1] < min_interval:
+            return False
+        record = np.array([(ts, float(price))], dtype=PRICE_HISTORY_DTYPE)
+        path = self.path(name)
+        with open(path, "ab") as f:
+            # Хвост оборванной записи затираем, чтобы не сбить выравнивание
+            f.truncate(len(points) * PRICE_HISTORY_DTYPE.itemsize)
+            f.write(record.tobytes())
+        self._mapped.pop(name, None)
+        return True
+
+
+price_history = PriceHistory(PRICE_HISTORY_DIR)
+
+
+def record_price_history(russia_prices: dict, cbot_quotes: dict, fob_price):
+    """Пишет в историю только реально полученные цены (не резервные)."""
+    try:
+        for culture, price in russia_prices.items():
+            price_history.append(f"russia:{culture}", price)
+        for name, price_cents in cbot_quotes.items():
+            if price_cents is not None:
+                price_history.append(f"cbot:{name}", price_cents / 100)
+        if fob_price is not None:
+            price_history.append("fob", fob_price)
+    except Exception as e:
+        logging.error(f"❌ Ошибка записи истории цен: {e}")
+
+
+def price_trend_stats(name: str, now: float = None):
+    """
+    Статистика ряда: последняя цена, среднее за 7 дней, мин/макс и
+    волатильность (ст. отклонение лог-доходностей, %) за 30 дней,
+    изменение к цене неделю назад (%). None, если точек нет.
+
+    Окна отсчитываются от now, а не от последней точки: если за 7 дней
+    цен не было (парсер молчит), avg_7d и wow_change — None, stale — True.
+    """
+    points = price_history.series(name)
+    if not len(points):
+        return None
+    now = time.time() if now is None else now
+    ts = np.asarray(points["ts"])
+    prices = np.asarray(points["price"])
+    week_start = now - 7 * DAY_SECONDS
+    week = prices[ts >= week_start]
+    month = prices[ts >= now - 30 * DAY_SECONDS]
+    if not len(month):
+        month = prices[-1:]
+
+    stats = {
+        "last": float(prices[-1]),
+        "updated": float(ts[-1]),
+        "stale": not len(week),
+        "avg_7d": float(week.mean()) if len(week) else None,
+        "min_30d": float(month.min()),
+        "max_30d": float(month.max()),
+        "volatility_30d": None,
+        "wow_change": None,
+        "points": len(prices),
+    }
+    positive = month[month > 0]
+    if len(positive) > 2:
+        stats["volatility_30d"] = float(np.std(np.diff(np.log(positive))) * 100)
+    week_ago = np.searchsorted(ts, week_start, side="right") - 1
+    if len(week) and week_ago >= 0 and prices[week_ago] > 0:
+        stats["wow_change"] = float((prices[-1] / prices[week_ago] - 1) * 100)
+    return stats
+
+
+def format_price_trends() -> str:
+    """Раздел "Динамика цен" для экрана цен (по культурам РФ)."""
+    lines = []
+    for culture in CULTURES:
+        stats = price_trend_stats(f"russia:{culture}")
+        if not stats or stats["points"] < 2:
+            continue
+        if stats["stale"]:
+            updated = datetime.fromtimestamp(stats["updated"]).strftime("%d.%m")
+            lines.append(
+                f"• {culture}: нет данных за 7 дн., последняя цена "
+                f"{stats['last']:,.0f} ₽/т от {updated}\n"
+            )
+            continue
+        line = (
+            f"• {culture}: ср. 7 дн. {stats['avg_7d']:,.0f} ₽/т, "
+            f"30 дн. {stats['min_30d']:,.0f}–{stats['max_30d']:,.0f}"
+        )
+        if stats["wow_change"] is not None:
+            change = stats["wow_change"]
+            arrow = "📈" if change > 0 else "📉" if change < 0 else "➖"
+            line += f", за неделю {arrow} {stats['wow_change']:+.1f}%"
+        if stats["volatility_30d"] is not None:
+            line += f", волатильность {stats['volatility_30d']:.1f}%"
+        lines.append(line + "\n")
+    if not lines:
+        return ""
+    return "📊 <b>Динамика цен:</b>\n" + "".join(lines)
+
+
+def batch_price_hint(culture: str, price: float) -> str:
+    """Подсказка фермеру: цена партии относительно рынка за неделю."""
+    stats = price_trend_stats(f"russia:{culture}") if culture else None
+    if not stats or stats["stale"]:
+        return ""
+    market = stats["avg_7d"]
+    diff = (price / market - 1) * 100 if market else 0
+    if abs(diff) < 3:
+        verdict = "на уровне рынка"
+    elif diff > 0:
+        verdict = f"на {diff:.0f}% выше рынка"
+    else:
+        verdict = f"на {-diff:.0f}% ниже рынка"
+    hint = (
+        f"💡 Рынок ({culture}, среднее за 7 дней): {market:,.0f} ₽/т — "
+        f"ваша цена {verdict}"
+    )
+    if stats["wow_change"] is not None:
+        hint += f", за неделю рынок {stats['wow_change']:+.1f}%"
+    return hint + "\n\n"
 
 
 def load_users_from_json():
@@ -7957,13 +10650,423 @@ def load_users_from_pickle():
         return False
 
 
+SHEETS_HEADERS = {
+    "Users": [
+        "User ID",
+        "Имя",
+        "Роль",
+        "Телефон",
+        "Email",
+        "ИНН",
+        "Регион",
+        "Реквизиты",
+        "Дата регистрации",
+        "Обновлено",
+    ],
+    "Batches": [
+        "ID",
+        "Фермер ID",
+        "Культура",
+        "Объём (т)",
+        "Цена (₽/т)",
+        "Регион",
+        "Влажность (%)",
+        "Протеин (%)",
+        "Клейковина (%)",
+        "Сорность (%)",
+        "Дата готовности",
+        "Статус",
+        "Создано",
+        "Обновлено",
+    ],
+    "Pulls": [
+        "ID",
+        "Экспортер ID",
+        "Культура",
+        "Целевой объём (т)",
+        "Текущий объём (т)",
+        "Цена (₽/т)",
+        "Влажность (%)",
+        "Сорность (%)",
+        "Статус",
+        "Создано",
+        "Обновлено",
+    ],
+    "Deals": [
+        "ID",
+        "Пул ID",
+        "Партия ID",
+        "Фермер ID",
+        "Экспортер ID",
+        "Объём (т)",
+        "Цена (₽/т)",
+        "Статус",
+        "Создано",
+    ],
+}
+SHEETS_VOLATILE_HEADERS = {"Создано", "Обновлено", "Дата регистрации"}  # не сверяются
+COMPLETED_DEALS_SHEET = "Завершенные сделки"
+
+
+def sheets_user_row(user_id, user_data) -> list:
+    """Строка листа Users."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return [
+        str(user_id),
+        str(user_data.get("name", "")),
+        str(user_data.get("role", "")),
+        str(user_data.get("phone", "")),
+        str(user_data.get("email", "")),
+        str(user_data.get("inn", "")),
+        str(user_data.get("region", "")),
+        str(user_data.get("company_requisites", "")),
+        str(user_data.get("registration_date", now)),
+        now,
+    ]
+
+
+def sheets_batch_row(batch) -> list:
+    """Строка листа Batches."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return [
+        str(batch.get("id", "")),
+        str(batch.get("farmer_id", "")),
+        str(batch.get("culture", "")),
+        str(batch.get("volume", 0)),
+        str(batch.get("price", 0)),
+        str(batch.get("region", "")),
+        str(batch.get("moisture", "")),
+        str(batch.get("protein", "")),
+        str(batch.get("gluten", "")),
+        str(batch.get("weediness", "")),
+        str(batch.get("readiness_date", "")),
+        str(batch.get("status", "active")),
+        now,
+        now,
+    ]
+
+
+def sheets_pull_row(pull) -> list:
+    """Строка листа Pulls."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return [
+        str(pull.get("id", "")),
+        str(pull.get("exporter_id", "")),
+        str(pull.get("culture", "")),
+        str(pull.get("target_volume", 0)),
+        str(pull.get("current_volume", 0)),
+        str(pull.get("price", 0)),
+        str(pull.get("moisture", "")),
+        str(pull.get("impurity", "")),
+        str(pull.get("status", "active")),
+        now,
+        now,
+    ]
+
+
+SHEETS_UPDATED_RANGE_RE = re.compile(r"![A-Z]+(\d+)")
+
+
+def sheets_deal_row(deal) -> list:
+    """Строка листа Deals."""
+    return [
+        str(deal.get("id", "")),
+        str(deal.get("pull_id", "")),
+        str(deal.get("batch_id", "")),
+        str(deal.get("farmer_id", "")),
+        str(deal.get("exporter_id", "")),
+        str(deal.get("volume", 0)),
+        str(deal.get("price", 0)),
+        str(deal.get("status", "pending")),
+        str(deal.get("created_at") or datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+    ]
+
+
+def sheets_row_hash(title, row) -> str:
+    """Хэш строки листа без колонок-отметок времени."""
+    cells = [
+        str(row[i]) if i < len(row) else ""
+        for i, header in enumerate(SHEETS_HEADERS[title])
+        if header not in SHEETS_VOLATILE_HEADERS
+    ]
+    return hashlib.sha1("\x1f".join(cells).encode("utf-8")).hexdigest()
+
+
+def sheets_local_rows(title) -> dict:
+    """Строки листа по локальным данным: ID -> строка."""
+    if title == "Users":
+        return {
+            str(user_id): sheets_user_row(user_id, user)
+            for user_id, user in users.items()
+            if isinstance(user, dict)
+        }
+    if title == "Batches":
+        return {
+            str(batch["id"]): sheets_batch_row(batch)
+            for _, _, batch in iter_all_batches()
+            if str(batch.get("id", ""))
+        }
+    if title == "Pulls":
+        all_pulls = pulls.get("pulls", {}) if isinstance(pulls, dict) else {}
+        return {
+            str(pull.get("id", key)): sheets_pull_row(pull)
+            for key, pull in all_pulls.items()
+            if isinstance(pull, dict)
+        }
+    if title == "Deals":
+        return {
+            str(deal.get("id", key)): sheets_deal_row(dict(deal, id=deal.get("id", key)))
+            for key, deal in deals.items()
+            if isinstance(deal, dict)
+        }
+    return {}
+
+
+class SheetRowIndex:
+    """
+    Индекс листа: ID из колонки A -> номера строк.
+
+    Строится одним чтением колонки, дальше поддерживается при добавлении
+    (номера строк берутся из ответа append) и удалении строк (строки ниже
+    сдвигаются вверх). Через CONFIG["sheets_index_ttl"] сек или после ошибки
+    записи перечитывается заново — на случай ручных правок таблицы.
+    """
+
+    def __init__(self, column_values):
+        self.rows = defaultdict(list)  # ID -> [номер строки]
+        for row_num, value in enumerate(column_values[1:], start=2):
+            if value:
+                self.rows[value].append(row_num)
+        self.built = time.monotonic()
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self.built > CONFIG["sheets_index_ttl"]
+
+    def find(self, key) -> list:
+        return self.rows.get(key, [])
+
+    def appended(self, keys, first_row: int):
+        for offset, key in enumerate(keys):
+            self.rows[key].append(first_row + offset)
+
+    def deleted(self, row_nums):
+        removed = sorted(row_nums)
+        removed_set = set(removed)
+        for key in list(self.rows):
+            kept = [
+                row_num - bisect.bisect_left(removed, row_num)
+                for row_num in self.rows[key]
+                if row_num not in removed_set
+            ]
+            if kept:
+                self.rows[key] = kept
+            else:
+                del self.rows[key]
+
+
+# ════════════════════════════════════════════════════════════════════
+# ЛОКАЛЬНЫЙ GOOGLE SHEETS (SHEETS_BACKEND=fake): ТЕСТЫ И ЗАМЕРЫ
+# ════════════════════════════════════════════════════════════════════
+FakeSheetsResponse = namedtuple("FakeSheetsResponse", ["status_code"])
+FakeSheetsCell = namedtuple("FakeSheetsCell", ["row", "col", "value"])
+SHEETS_CELL_RE = re.compile(r"([A-Z]+)(\d+)")
+
+
+class FakeSheetsAPIError(Exception):
+    """Ошибка фейкового API; response.status_code как у gspread.APIError."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.response = FakeSheetsResponse(status_code)
+
+
+def sheets_column_number(letters: str) -> int:
+    """'A' -> 1, 'N' -> 14, 'AA' -> 27."""
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - ord("A") + 1
+    return number
+
+
+class FakeWorksheet:
+    """Лист в памяти: подмножество gspread.Worksheet, которое использует бот."""
+
+    def __init__(self, spreadsheet, sheet_id: int, title: str, rows: int, cols: int):
+        self.spreadsheet = spreadsheet
+        self.id = sheet_id
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self.cells = []  # строки листа, значения — строки
+
+    def _last_row(self) -> int:
+        """Номер последней непустой строки (append пишет после неё)."""
+        for row_num in range(len(self.cells), 0, -1):
+            if any(self.cells[row_num - 1]):
+                return row_num
+        return 0
+
+    def _write(self, row_num: int, col_num: int, values):
+        for offset, row in enumerate(values):
+            while len(self.cells) < row_num + offset:
+                self.cells.append([])
+            target = self.cells[row_num + offset - 1]
+            end = col_num - 1 + len(row)
+            if len(target) < end:
+                target.extend([""] * (end - len(target)))
+            target[col_num - 1 : end] = ["" if v is None else str(v) for v in row]
+        self.row_count = max(self.row_count, len(self.cells))
+
+    def _write_range(self, range_name: str, values):
+        match = SHEETS_CELL_RE.match(range_name.split("!")[-1])
+        if not match:
+            raise FakeSheetsAPIError(400, f"Неверный диапазон: {range_name!r}")
+        self._write(int(match.group(2)), sheets_column_number(match.group(1)), values)
+
+    def row_values(self, row: int) -> list:
+        self.spreadsheet.request("values.get")
+        values = list(self.cells[row - 1]) if row <= len(self.cells) else []
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def col_values(self, col: int) -> list:
+        self.spreadsheet.request("values.get")
+        values = [row[col - 1] if len(row) >= col else "" for row in self.cells]
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def get_all_values(self) -> list:
+        self.spreadsheet.request("values.get")
+        rows = self.cells[: self._last_row()]
+        width = max((len(row) for row in rows), default=0)
+        return [row + [""] * (width - len(row)) for row in rows]
+
+    def find(self, query, in_column=None):
+        self.spreadsheet.request("values.get")
+        for row_num, row in enumerate(self.cells, start=1):
+            for col_num, value in enumerate(row, start=1):
+                if in_column is not None and col_num != in_column:
+                    continue
+                if value == str(query):
+                    return FakeSheetsCell(row_num, col_num, value)
+        return None
+
+    def update(self, range_name, values=None, **kwargs):
+        self.spreadsheet.request("values.update")
+        self._write_range(range_name, values)
+        return {"updatedRange": f"{self.title}!{range_name}"}
+
+    def batch_update(self, data, **kwargs):
+        self.spreadsheet.request("values.batchUpdate")
+        for item in data:
+            self._write_range(item["range"], item["values"])
+        return {"totalUpdatedRows": len(data)}
+
+    def append_row(self, values, value_input_option="RAW", **kwargs):
+        return self.append_rows([values], value_input_option=value_input_option)
+
+    def append_rows(self, values, value_input_option="RAW", **kwargs):
+        self.spreadsheet.request("values.append")
+        first = self._last_row() + 1
+        self._write(first, 1, values)
+        last = first + len(values) - 1
+        return {
+            "updates": {
+                "updatedRange": f"{self.title}!A{first}:A{last}",
+                "updatedRows": len(values),
+            }
+        }
+
+    def delete_rows(self, start_index: int, end_index: int = None):
+        self.spreadsheet.request("batchUpdate")
+        del self.cells[start_index - 1 : end_index or start_index]
+
+    def add_cols(self, cols: int):
+        self.spreadsheet.request("batchUpdate")
+        self.col_count += cols
+
+
+class FakeSpreadsheet:
+    """
+    Таблица в памяти вместо Google Sheets — то подмножество gspread.Spreadsheet
+    и Worksheet, которым пользуется GoogleSheetsManager.
+
+    Каждый вызов — один "запрос": считается в calls по методу API, ждёт
+    latency сек и с вероятностью error_rate отвечает 429 (квота), как
+    настоящий API. Ошибка возникает до изменения данных.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, sheets=(), seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = defaultdict(int)  # метод API -> число запросов
+        self.errors = 0
+        self._sheets = OrderedDict()  # название -> FakeWorksheet
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()  # запросы идут из потоков executor-а
+        for title in sheets:
+            self._add(title, 1000, 26)
+
+    def request(self, method: str):
+        with self._lock:
+            self.calls[method] += 1
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise FakeSheetsAPIError(429, f"Quota exceeded: {method}")
+
+    def api_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def _add(self, title: str, rows: int, cols: int) -> FakeWorksheet:
+        worksheet = FakeWorksheet(self, len(self._sheets) + 1, title, rows, cols)
+        self._sheets[title] = worksheet
+        return worksheet
+
+    def worksheets(self) -> list:
+        self.request("get")
+        return list(self._sheets.values())
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        self.request("get")
+        if title not in self._sheets:
+            raise FakeSheetsAPIError(404, f"Лист не найден: {title}")
+        return self._sheets[title]
+
+    def add_worksheet(self, title: str, rows: int, cols: int) -> FakeWorksheet:
+        self.request("batchUpdate")
+        if title in self._sheets:
+            raise FakeSheetsAPIError(400, f"Лист уже существует: {title}")
+        return self._add(title, rows, cols)
+
+    def batch_update(self, body: dict):
+        self.request("batchUpdate")
+        by_id = {worksheet.id: worksheet for worksheet in self._sheets.values()}
+        for request in body.get("requests", []):
+            if "deleteDimension" not in request:
+                raise FakeSheetsAPIError(400, f"Не поддерживается: {list(request)}")
+            target = request["deleteDimension"]["range"]
+            worksheet = by_id[target["sheetId"]]
+            del worksheet.cells[target["startIndex"] : target["endIndex"]]
+        return {"replies": []}
+
+
 class GoogleSheetsManager:
     """Менеджер для работы с Google Sheets"""
 
-    def __init__(self, credentials_file, spreadsheet_id):
+    def __init__(self, credentials_file, spreadsheet_id, spreadsheet=None):
         self.spreadsheet_id = spreadsheet_id
         self.client = None
-        self.spreadsheet = None
+        self.spreadsheet = spreadsheet  # готовая таблица (FakeSpreadsheet) — без Google
+        self.worksheets = {}  # название листа -> (Worksheet, когда сверен)
+        self.row_indexes = {}  # название листа -> SheetRowIndex
+        if spreadsheet is not None:
+            return
 
         try:
             if not os.path.exists(credentials_file):
@@ -7981,6 +11084,8 @@ class GoogleSheetsManager:
                 credentials_file, scopes=scope
             )
             self.client = gspread.authorize(creds)
+            # Без таймаута поток очереди может висеть на медленном Google вечно
+            self.client.set_timeout(CONFIG["sheets_request_timeout"])
             self.spreadsheet = self.client.open_by_key(spreadsheet_id)
             logging.info("✅ Google Sheets подключен успешно")
 
@@ -7988,136 +11093,163 @@ class GoogleSheetsManager:
             logging.error(f"❌ Ошибка подключения к Google Sheets: {e}")
 
     def get_or_create_worksheet(self, title, headers):
-        """Получить или создать worksheet"""
+        """
+        Worksheet из кэша; раз в CONFIG["sheets_worksheet_ttl"] сек список
+        листов перечитывается одним запросом, а заголовок сверяется со схемой.
+        Лист создаётся, только если его точно нет в списке: ошибка запроса
+        пробрасывается, а не превращается в дубль листа.
+        """
         if not self.spreadsheet:
             return None
 
-        try:
-            worksheet = self.spreadsheet.worksheet(title)
-        except Exception:
+        cached = self.worksheets.get(title)
+        if cached and time.monotonic() - cached[1] < CONFIG["sheets_worksheet_ttl"]:
+            return cached[0]
+
+        existing = {ws.title: ws for ws in self.spreadsheet.worksheets()}
+        worksheet = existing.get(title)
+        if worksheet is None:
             worksheet = self.spreadsheet.add_worksheet(
                 title=title, rows=1000, cols=len(headers)
             )
-            worksheet.append_row(headers)
+            worksheet.update("A1", [headers])
             logging.info(f"✅ Создан worksheet: {title}")
+        else:
+            self.check_headers(worksheet, headers)
 
+        self.worksheets[title] = (worksheet, time.monotonic())
         return worksheet
 
+    def check_headers(self, worksheet, headers):
+        """Сверяет заголовок листа со схемой и дописывает недостающие колонки."""
+        current = worksheet.row_values(1)
+        if current == list(headers):
+            return
+        if current != list(headers[: len(current)]):
+            logging.warning(
+                f"⚠️ Google Sheets / {worksheet.title}: заголовок не совпадает "
+                f"со схемой ({current}), перезаписываем"
+            )
+        missing_cols = len(headers) - worksheet.col_count
+        if missing_cols > 0:
+            worksheet.add_cols(missing_cols)
+        worksheet.update("A1", [headers])
+        logging.info(f"✅ Google Sheets / {worksheet.title}: заголовок обновлён")
+
+    def forget_worksheet(self, title):
+        """Сбрасывает кэш листа (после ошибки записи)."""
+        self.worksheets.pop(title, None)
+        self.row_indexes.pop(title, None)
+
+    def row_index(self, title, worksheet) -> SheetRowIndex:
+        """Индекс строк листа; строится (одно чтение колонки A), если устарел."""
+        index = self.row_indexes.get(title)
+        if index is None or index.is_stale():
+            index = self.row_indexes[title] = SheetRowIndex(worksheet.col_values(1))
+        return index
+
+    def invalidate_row_index(self, *titles):
+        for title in titles:
+            self.row_indexes.pop(title, None)
+
+    def find_row(self, title, key):
+        """Номер строки с ID key в колонке A листа title или None."""
+        worksheet = self.get_or_create_worksheet(title, SHEETS_HEADERS[title])
+        found = self.row_index(title, worksheet).find(str(key))
+        return found[0] if found else None
+
+    def apply_ops(self, title, ops) -> int:
+        """
+        Применяет к листу пачку изменений {ключ: строка или None — удалить}.
+
+        Строки ищутся по индексу ID из колонки A (SheetRowIndex). Изменения
+        уходят тремя запросами: значения найденных строк (batch_update),
+        новые строки (append_rows) и удаление (batch_update таблицы).
+        Возвращает число API-вызовов.
+        """
+        if not self.spreadsheet:
+            raise RuntimeError("Нет подключения к Google Sheets")
+
+        headers = SHEETS_HEADERS[title]
+        worksheet = self.get_or_create_worksheet(title, headers)
+        last_col = chr(ord("A") + len(headers) - 1)
+        cached = self.row_indexes.get(title)
+        index = self.row_index(title, worksheet)
+        calls = 0 if index is cached else 1
+        try:
+            return calls + self._write_ops(title, worksheet, index, ops, last_col)
+        except Exception:
+            # Неизвестно, что успело записаться (или лист удалили) — перечитаем
+            self.forget_worksheet(title)
+            raise
+
+    def _write_ops(self, title, worksheet, index, ops, last_col) -> int:
+        updates, appends, append_keys, deletions = [], [], [], set()
+        for key, row in ops.items():
+            found = index.find(key)
+            if row is None:
+                deletions.update(found)
+            elif found:
+                updates.append(
+                    {"range": f"A{found[0]}:{last_col}{found[0]}", "values": [row]}
+                )
+            else:
+                appends.append(row)
+                append_keys.append(key)
+
+        calls = 0
+        if updates:
+            worksheet.batch_update(updates)
+            calls += 1
+        if appends:
+            response = worksheet.append_rows(appends)
+            calls += 1
+            # Номер первой добавленной строки — из ответа API ("Batches!A12:N13")
+            updates_info = (response or {}).get("updates", {})
+            match = SHEETS_UPDATED_RANGE_RE.search(updates_info.get("updatedRange", ""))
+            if match:
+                index.appended(append_keys, int(match.group(1)))
+            else:
+                self.row_indexes.pop(title, None)
+        if deletions:
+            # Снизу вверх, чтобы номера оставшихся строк не сдвигались
+            self.spreadsheet.batch_update(
+                {
+                    "requests": [
+                        {
+                            "deleteDimension": {
+                                "range": {
+                                    "sheetId": worksheet.id,
+                                    "dimension": "ROWS",
+                                    "startIndex": row_num - 1,
+                                    "endIndex": row_num,
+                                }
+                            }
+                        }
+                        for row_num in sorted(deletions, reverse=True)
+                    ]
+                }
+            )
+            calls += 1
+            index.deleted(deletions)
+        logging.info(
+            f"✅ Google Sheets / {title}: обновлено {len(updates)}, "
+            f"добавлено {len(appends)}, удалено {len(deletions)}"
+        )
+        return calls
+
     def update_user_in_sheets(self, user_id, user_data):
         """Обновление или добавление пользователя в Google Sheets"""
         try:
-            if not self.spreadsheet:
-                logging.error("❌ Нет подключения к Google Sheets")
-                return
-
-            headers = [
-                "User ID",
-                "Имя",
-                "Роль",
-                "Телефон",
-                "Email",
-                "ИНН",
-                "Регион",
-                "Реквизиты",
-                "Дата регистрации",
-                "Обновлено",
-            ]
-            worksheet = self.get_or_create_worksheet("Users", headers)
-
-            if not worksheet:
-                return
-
-            row_data = [
-                str(user_id),
-                str(user_data.get("name", "")),
-                str(user_data.get("role", "")),
-                str(user_data.get("phone", "")),
-                str(user_data.get("email", "")),
-                str(user_data.get("inn", "")),
-                str(user_data.get("region", "")),
-                str(user_data.get("company_requisites", "")),
-                str(
-                    user_data.get(
-                        "registration_date",
-                        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    )
-                ),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            ]
-
-            try:
-                cell = worksheet.find(str(user_id))
-                if cell:
-                    worksheet.update(f"A{cell.row}:J{cell.row}", [row_data])
-                    logging.info(f"✅ Пользователь {user_id} обновлен в Google Sheets")
-                else:
-                    worksheet.append_row(row_data)
-                    logging.info(f"✅ Пользователь {user_id} добавлен в Google Sheets")
-            except Exception:
-                worksheet.append_row(row_data)
-                logging.info(f"✅ Пользователь {user_id} добавлен в Google Sheets")
-
+            self.apply_ops("Users", {str(user_id): sheets_user_row(user_id, user_data)})
         except Exception as e:
             logging.error(f"❌ Ошибка обновления пользователя в Google Sheets: {e}")
 
     def sync_batch_to_sheets(self, batch):
         """Синхронизация партии фермера в Google Sheets"""
         try:
-            if not self.spreadsheet:
-                logging.error("❌ Нет подключения к Google Sheets")
-                return
-
-            headers = [
-                "ID",
-                "Фермер ID",
-                "Культура",
-                "Объём (т)",
-                "Цена (₽/т)",
-                "Регион",
-                "Влажность (%)",
-                "Протеин (%)",
-                "Клейковина (%)",
-                "Сорность (%)",
-                "Дата готовности",
-                "Статус",
-                "Создано",
-                "Обновлено",
-            ]
-            worksheet = self.get_or_create_worksheet("Batches", headers)
-
-            if not worksheet:
-                return
-
-            row_data = [
-                str(batch.get("id", "")),
-                str(batch.get("farmer_id", "")),
-                str(batch.get("culture", "")),
-                str(batch.get("volume", 0)),
-                str(batch.get("price", 0)),
-                str(batch.get("region", "")),
-                str(batch.get("moisture", "")),
-                str(batch.get("protein", "")),
-                str(batch.get("gluten", "")),
-                str(batch.get("weediness", "")),
-                str(batch.get("readiness_date", "")),
-                str(batch.get("status", "active")),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            ]
-
             batch_id = str(batch.get("id", ""))
-            try:
-                cell = worksheet.find(batch_id)
-                if cell:
-                    worksheet.update(f"A{cell.row}:N{cell.row}", [row_data])
-                    logging.info(f"✅ Партия {batch_id} обновлена в Google Sheets")
-                else:
-                    worksheet.append_row(row_data)
-                    logging.info(f"✅ Партия {batch_id} добавлена в Google Sheets")
-            except Exception:
-                worksheet.append_row(row_data)
-                logging.info(f"✅ Партия {batch_id} добавлена в Google Sheets")
-
+            self.apply_ops("Batches", {batch_id: sheets_batch_row(batch)})
         except Exception as e:
             logging.error(f"❌ Ошибка синхронизации партии в Google Sheets: {e}")
 
@@ -8128,71 +11260,14 @@ class GoogleSheetsManager:
     def delete_batch_from_sheets(self, batch_id):
         """Удаление партии из Google Sheets"""
         try:
-            if not self.spreadsheet:
-                logging.error("❌ Нет подключения к Google Sheets")
-                return
-
-            worksheet = self.spreadsheet.worksheet("Batches")
-            cell = worksheet.find(str(batch_id))
-            if cell:
-                worksheet.delete_rows(cell.row)
-                logging.info(f"✅ Партия {batch_id} удалена из Google Sheets")
-
+            self.apply_ops("Batches", {str(batch_id): None})
         except Exception as e:
             logging.error(f"❌ Ошибка удаления партии из Google Sheets: {e}")
 
     def sync_pull_to_sheets(self, pull):
         """Синхронизация пула в Google Sheets"""
         try:
-            if not self.spreadsheet:
-                logging.error("❌ Нет подключения к Google Sheets")
-                return
-
-            headers = [
-                "ID",
-                "Экспортер ID",
-                "Культура",
-                "Целевой объём (т)",
-                "Текущий объём (т)",
-                "Цена (₽/т)",
-                "Влажность (%)",
-                "Сорность (%)",
-                "Статус",
-                "Создано",
-                "Обновлено",
-            ]
-            worksheet = self.get_or_create_worksheet("Pulls", headers)
-
-            if not worksheet:
-                return
-
-            row_data = [
-                str(pull.get("id", "")),
-                str(pull.get("exporter_id", "")),
-                str(pull.get("culture", "")),
-                str(pull.get("target_volume", 0)),
-                str(pull.get("current_volume", 0)),
-                str(pull.get("price", 0)),
-                str(pull.get("moisture", "")),
-                str(pull.get("impurity", "")),
-                str(pull.get("status", "active")),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            ]
-
-            pull_id = str(pull.get("id", ""))
-            try:
-                cell = worksheet.find(pull_id)
-                if cell:
-                    worksheet.update(f"A{cell.row}:K{cell.row}", [row_data])
-                    logging.info(f"✅ Пул {pull_id} обновлен в Google Sheets")
-                else:
-                    worksheet.append_row(row_data)
-                    logging.info(f"✅ Пул {pull_id} добавлен в Google Sheets")
-            except Exception:
-                worksheet.append_row(row_data)
-                logging.info(f"✅ Пул {pull_id} добавлен в Google Sheets")
-
+            self.apply_ops("Pulls", {str(pull.get("id", "")): sheets_pull_row(pull)})
         except Exception as e:
             logging.error(f"❌ Ошибка синхронизации пула в Google Sheets: {e}")
 
@@ -8203,43 +11278,40 @@ class GoogleSheetsManager:
     def sync_deal_to_sheets(self, deal):
         """Синхронизация сделки в Google Sheets"""
         try:
-            if not self.spreadsheet:
-                logging.error("❌ Нет подключения к Google Sheets")
-                return
-
-            headers = [
-                "ID",
-                "Пул ID",
-                "Партия ID",
-                "Фермер ID",
-                "Экспортер ID",
-                "Объём (т)",
-                "Цена (₽/т)",
-                "Статус",
-                "Создано",
-            ]
-            worksheet = self.get_or_create_worksheet("Deals", headers)
-
-            if not worksheet:
-                return
+            self.apply_ops("Deals", {str(deal.get("id", "")): sheets_deal_row(deal)})
+        except Exception as e:
+            logging.error(f"❌ Ошибка синхронизации сделки в Google Sheets: {e}")
 
-            row_data = [
-                str(deal.get("id", "")),
-                str(deal.get("pull_id", "")),
-                str(deal.get("batch_id", "")),
-                str(deal.get("farmer_id", "")),
-                str(deal.get("exporter_id", "")),
-                str(deal.get("volume", 0)),
-                str(deal.get("price", 0)),
-                str(deal.get("status", "pending")),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            ]
+    def diff_rows(self, title, local_hashes: dict):
+        """
+        Сверка листа с локальными данными (одно чтение всего листа).
+        Возвращает (ID к записи, ID к удалению, строк на листе). Индекс
+        строк не трогает: его ведёт apply_ops.
+        """
+        worksheet = self.get_or_create_worksheet(title, SHEETS_HEADERS[title])
+        values = worksheet.get_all_values()
+        sheet_hashes = {
+            row[0]: sheets_row_hash(title, row) for row in values[1:] if row and row[0]
+        }
+        to_upsert = [
+            key for key, digest in local_hashes.items() if sheet_hashes.get(key) != digest
+        ]
+        to_delete = [key for key in sheet_hashes if key not in local_hashes]
+        return to_upsert, to_delete, len(sheet_hashes)
 
-            worksheet.append_row(row_data)
-            logging.info("✅ Сделка добавлена в Google Sheets")
+    def append_completed_deal(self, row):
+        """Дописывает строку на лист завершённых сделок."""
+        worksheet = self.spreadsheet.worksheet(COMPLETED_DEALS_SHEET)
+        worksheet.append_row(row, value_input_option="USER_ENTERED")
 
-        except Exception as e:
-            logging.error(f"❌ Ошибка синхронизации сделки в Google Sheets: {e}")
+    def append_missing_completed_deals(self, rows_by_key: dict) -> int:
+        """Дописывает на лист завершённых сделок строки, которых там нет."""
+        worksheet = self.spreadsheet.worksheet(COMPLETED_DEALS_SHEET)
+        present = {(row[1], row[2]) for row in worksheet.get_all_values() if len(row) > 2}
+        missing = [row for key, row in rows_by_key.items() if key not in present]
+        if missing:
+            worksheet.append_rows(missing, value_input_option="USER_ENTERED")
+        return len(missing)
 
 
 # ====================================================================
@@ -8252,6 +11324,19 @@ async def init_google_sheets():
     """Асинхронная инициализация Google Sheets"""
     global gs
     try:
+        if SHEETS_BACKEND == "fake":
+            gs = GoogleSheetsManager(
+                None,
+                SPREADSHEET_ID,
+                spreadsheet=FakeSpreadsheet(
+                    latency=FAKE_SHEETS_LATENCY_MS / 1000,
+                    error_rate=FAKE_SHEETS_ERROR_RATE,
+                    sheets=[COMPLETED_DEALS_SHEET],
+                ),
+            )
+            logging.warning("⚠️ Google Sheets: локальная таблица в памяти (SHEETS_BACKEND=fake)")
+            return
+
         if not GOOGLE_SHEETS_AVAILABLE:
             logging.warning("⚠️ Google Sheets отключён (GOOGLE_SHEETS_AVAILABLE=False)")
             return
@@ -8281,13 +11366,632 @@ async def init_google_sheets():
         gs = None
 
 
+# ====================================================================
+# ОЧЕРЕДЬ ИЗМЕНЕНИЙ GOOGLE SHEETS
+# ====================================================================
+def is_sheets_transient_error(error) -> bool:
+    """Квота (429), сбой на стороне Google (5xx) или сеть — стоит повторить."""
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if status == 429 or (status is not None and status >= 500):
+        return True
+    return isinstance(
+        error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    )
+
+
+class CircuitBreaker:
+    """
+    Предохранитель внешнего API.
+
+    closed — запросы идут; после threshold подряд неудачных — open: запросы
+    не отправляются cooldown сек. Затем half_open — пропускается одна проба:
+    удача закрывает предохранитель, неудача снова размыкает его, а пауза
+    удваивается (не больше max_cooldown).
+    """
+
+    def __init__(self, name: str, threshold: int, cooldown: float, max_cooldown: float):
+        self.name = name
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0  # неудач подряд
+        self.opened_at = 0.0  # time.monotonic() размыкания
+        self.opens = 0
+
+    @property
+    def is_open(self) -> bool:
+        """Разомкнут или ждёт пробы — синхронные вызовы API лучше пропустить."""
+        return self.state != "closed"
+
+    def retry_in(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def allow(self) -> bool:
+        """Можно ли сейчас обращаться к API (по истечении паузы — проба)."""
+        if self.state == "open" and not self.retry_in():
+            self.state = "half_open"
+            logging.info(f"🔌 {self.name}: пробный запрос")
+        return self.state != "open"
+
+    def success(self):
+        if self.state != "closed":
+            logging.info(f"✅ {self.name}: API снова доступен")
+        self.state = "closed"
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+
+    def failure(self):
+        self.failures += 1
+        if self.state == "half_open":
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+        elif self.failures < self.threshold:
+            return
+        if self.state != "open":
+            self.opens += 1
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        logging.warning(
+            f"⚠️ {self.name}: API недоступен, пауза {self.cooldown:.0f} с "
+            f"(ошибок подряд: {self.failures})"
+        )
+
+    def describe(self) -> str:
+        if self.state == "closed":
+            return "работает"
+        if self.state == "half_open":
+            return "проба"
+        return f"разомкнут, проба через {self.retry_in():.0f} с"
+
+
+class SheetsOutbox:
+    """
+    Очередь изменений Google Sheets.
+
+    Обработчики только ставят upsert/delete строки — без сети, O(1);
+    повторные изменения одной строки схлопываются, уходит последнее.
+    Фоновая задача раз в CONFIG["sheets_flush_interval"] сек отправляет
+    накопленное по листам через GoogleSheetsManager.apply_ops в потоке
+    (несколько batch-запросов на лист) и сохраняет очередь в
+    SHEETS_OUTBOX_FILE — после перезапуска неотправленное досылается.
+
+    Квота, 5xx и сетевые сбои считает CircuitBreaker: после
+    CONFIG["sheets_breaker_threshold"] ошибок подряд Google не трогаем,
+    пока не пройдёт пробный запрос. Неотправленное возвращается в начало
+    очереди (если строку не успели изменить снова), так что порядок
+    изменений сохраняется. Прочие ошибки повторяются не больше
+    CONFIG["sheets_max_retries"] раз.
+
+    Запросы, которые читают лист и сдвигают его строки (отправка очереди,
+    сверка, журнал сделок), идут под io_lock: индекс строк gs, посчитанный
+    до чужого append/deleteDimension, указывал бы не на те строки.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._pending = OrderedDict()  # (лист, ключ) -> строка или None (удалить)
+        self._attempts = defaultdict(int)  # (лист, ключ) -> неудачных отправок
+        self._dirty = False  # очередь изменилась после последнего сохранения
+        self._task = None
+        self._wakeup = None  # asyncio.Event: досрочная отправка при остановке
+        self._closing = False
+        self._io_lock = None  # asyncio.Lock — создаётся в цикле событий
+        self.breaker = CircuitBreaker(
+            "Google Sheets",
+            CONFIG["sheets_breaker_threshold"],
+            CONFIG["sheets_breaker_cooldown"],
+            CONFIG["sheets_backoff_max"],
+        )
+        self.last_reconcile = None  # (время, исправлено строк, мс)
+        self.metrics = {
+            "queued": 0,
+            "coalesced": 0,
+            "flushed": 0,
+            "api_calls": 0,
+            "failures": 0,
+            "transient_errors": 0,
+            "skipped": 0,
+            "dropped": 0,
+            "restored": 0,
+            "last_flush_ms": 0.0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return gs is not None and gs.spreadsheet is not None
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def io_lock(self) -> asyncio.Lock:
+        if self._io_lock is None:
+            self._io_lock = asyncio.Lock()
+        return self._io_lock
+
+    def _put(self, title: str, key, row):
+        if not self.enabled:
+            return
+        item = (title, str(key))
+        if item in self._pending:
+            self.metrics["coalesced"] += 1
+            del self._pending[item]  # новая версия встаёт в конец очереди
+        self._pending[item] = row
+        self._dirty = True
+        self.metrics["queued"] += 1
+
+    def upsert_user(self, user_id, user_data):
+        self._put("Users", user_id, sheets_user_row(user_id, user_data))
+
+    def delete_user(self, user_id):
+        self._put("Users", user_id, None)
+
+    def upsert_batch(self, batch):
+        self._put("Batches", batch.get("id", ""), sheets_batch_row(batch))
+
+    def delete_batch(self, batch_id):
+        self._put("Batches", batch_id, None)
+
+    def upsert_pull(self, pull):
+        self._put("Pulls", pull.get("id", ""), sheets_pull_row(pull))
+
+    def delete_pull(self, pull_id):
+        self._put("Pulls", pull_id, None)
+
+    def enqueue_fixes(self, title: str, rows: dict, deletes) -> int:
+        """Исправления сверки; строки, уже стоящие в очереди, не трогаем."""
+        fixed = 0
+        for key, row in list(rows.items()) + [(key, None) for key in deletes]:
+            if (title, str(key)) in self._pending:
+                continue
+            self._put(title, key, row)
+            fixed += 1
+        return fixed
+
+    def save(self):
+        """Атомарно сохраняет очередь в файл."""
+        if not self.path:
+            return
+        try:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(list(self._pending.items()), f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except Exception as e:
+            logging.error(f"❌ Ошибка сохранения очереди Google Sheets: {e}")
+
+    def load(self):
+        """Неотправленные изменения прошлого запуска — впереди новых."""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                items = pickle.load(f)
+        except Exception as e:
+            logging.error(f"❌ Ошибка загрузки очереди Google Sheets: {e}")
+            return
+        restored = OrderedDict(
+            (item, row) for item, row in items if item not in self._pending
+        )
+        self.metrics["restored"] += len(restored)
+        restored.update(self._pending)
+        self._pending = restored
+        if items:
+            logging.info(f"📊 Google Sheets: восстановлено изменений: {len(items)}")
+
+    def start(self):
+        """Запуск фоновой отправки (нужен работающий event loop)."""
+        if self._task is not None or not self.enabled:
+            return
+        self.load()
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_event_loop().create_task(self._run())
+        logging.info("📊 Очередь Google Sheets запущена")
+
+    async def stop(self, timeout: float = 15.0):
+        """Отправляет накопленное (не дольше timeout) и останавливает задачу."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.warning("⚠️ Google Sheets: отправка при остановке не успела")
+        except Exception as e:
+            logging.error(f"❌ Google Sheets: ошибка остановки очереди: {e}")
+        self._task = None
+        self.save()
+        if self._pending:
+            logging.warning(
+                f"⚠️ Google Sheets: не отправлено изменений: {self.pending()} "
+                "(сохранены до следующего запуска)"
+            )
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), timeout=CONFIG["sheets_flush_interval"]
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"❌ Google Sheets: ошибка отправки очереди: {e}")
+            if self._dirty:
+                self.save()
+            if self._closing:
+                return
+
+    async def flush(self):
+        """
+        Отправляет накопленное по одному apply_ops на лист, в порядке
+        очереди. Пока предохранитель разомкнут, ничего не отправляет; в
+        режиме пробы сначала уходит одно изменение.
+        """
+        if not self._pending or not self.enabled or not self.breaker.allow():
+            return
+        async with self.io_lock:
+            if self.breaker.state == "half_open":
+                item = next(iter(self._pending))
+                probe = OrderedDict([(item, self._pending.pop(item))])
+                if not await self._send(probe) or not self._pending:
+                    return
+            taken, self._pending = self._pending, OrderedDict()
+            await self._send(taken)
+
+    async def _send(self, taken: OrderedDict) -> bool:
+        self._dirty = True
+        by_sheet = OrderedDict()
+        for (title, key), row in taken.items():
+            by_sheet.setdefault(title, {})[key] = row
+
+        loop = asyncio.get_event_loop()
+        started = time.monotonic()
+        returned = OrderedDict()
+        ok = True
+        for title, ops in by_sheet.items():
+            if not ok:
+                # Google недоступен — остальные листы даже не пробуем
+                self.metrics["skipped"] += len(ops)
+                returned.update(((title, key), row) for key, row in ops.items())
+                continue
+            try:
+                calls = await loop.run_in_executor(None, gs.apply_ops, title, ops)
+            except Exception as e:
+                if is_sheets_transient_error(e):
+                    ok = False
+                    self.breaker.failure()
+                returned.update(self._failed(title, ops, e))
+                continue
+            self.breaker.success()
+            self.metrics["api_calls"] += calls
+            self.metrics["flushed"] += len(ops)
+            for key in ops:
+                self._attempts.pop((title, key), None)
+        self.metrics["last_flush_ms"] = (time.monotonic() - started) * 1000
+        self._restore(returned)
+        return ok
+
+    def _failed(self, title: str, ops: dict, error) -> OrderedDict:
+        """Изменения листа, которые стоит повторить."""
+        transient = is_sheets_transient_error(error)
+        self.metrics["failures"] += 1
+        if transient:
+            self.metrics["transient_errors"] += 1
+        logging.warning(
+            f"⚠️ Google Sheets / {title}: не отправлено {len(ops)} изменений "
+            f"({'повторим' if transient else 'ошибка'}): {error}"
+        )
+        retry = OrderedDict()
+        for key, row in ops.items():
+            item = (title, key)
+            if not transient:
+                self._attempts[item] += 1
+                if self._attempts[item] > CONFIG["sheets_max_retries"]:
+                    self._attempts.pop(item, None)
+                    self.metrics["dropped"] += 1
+                    logging.error(
+                        f"❌ Google Sheets / {title}: изменение {key} отброшено"
+                    )
+                    continue
+            retry[item] = row
+        return retry
+
+    def _restore(self, returned: OrderedDict):
+        """Возвращает неотправленное в начало очереди."""
+        if not returned:
+            return
+        restored = OrderedDict(
+            # строку уже изменили заново — отправится новая версия
+            (item, row) for item, row in returned.items() if item not in self._pending
+        )
+        restored.update(self._pending)
+        self._pending = restored
+
+
+sheets_outbox = SheetsOutbox(SHEETS_OUTBOX_FILE)
+
+
+def format_sheets_metrics() -> str:
+    """Блок статистики очереди Google Sheets для админ-панели."""
+    m = sheets_outbox.metrics
+    if not m["queued"] and not sheets_outbox.pending():
+        return ""
+    msg = f"📊 <b>Google Sheets</b> (в очереди: {sheets_outbox.pending()}):\n"
+    msg += (
+        f"• Изменений: {m['queued']}, схлопнуто {m['coalesced']}, "
+        f"отправлено {m['flushed']} за {m['api_calls']} запросов\n"
+    )
+    msg += (
+        f"• Ошибок: {m['failures']} (квота/сеть {m['transient_errors']}), "
+        f"отброшено {m['dropped']}, последняя отправка {m['last_flush_ms']:.0f} мс\n"
+    )
+    breaker = sheets_outbox.breaker
+    msg += f"• Предохранитель: {breaker.describe()}, срабатываний {breaker.opens}\n"
+    if m["restored"]:
+        msg += f"• Восстановлено после перезапуска: {m['restored']}\n"
+    if sheets_outbox.last_reconcile:
+        at, fixed, ms = sheets_outbox.last_reconcile
+        msg += (
+            f"• Сверка {at.strftime('%d.%m %H:%M')}: исправлено {fixed} строк "
+            f"за {ms:.0f} мс\n"
+        )
+    return msg
+
+
+# Удалять строки с листа, только если лишних не больше этой доли
+SHEETS_RECONCILE_MAX_DELETE_SHARE = 0.2
+
+
+async def find_sheet_row(title, key):
+    """
+    gs.find_row из асинхронного кода: запросы к API — в потоке, индекс
+    строк — под io_lock, чтобы не пересобирать его во время apply_ops.
+    """
+    loop = asyncio.get_event_loop()
+    async with sheets_outbox.io_lock:
+        return await loop.run_in_executor(None, gs.find_row, title, key)
+
+
+async def reconcile_google_sheets():
+    """
+    Сверка листов Google Sheets с локальными данными.
+
+    Каждый лист читается одним запросом, строки сравниваются по хэшу (без
+    колонок-отметок времени), а расхождения уходят через sheets_outbox
+    обычными batch-запросами. Лишние строки удаляются, только если их
+    немного — пустые локальные данные не должны стирать таблицу.
+    'Завершенные сделки' — журнал: на него только дописываются пропущенные
+    сделки. Проход ограничен CONFIG["sheets_reconcile_budget"] сек.
+    """
+    if not sheets_outbox.enabled:
+        return 0
+    if sheets_outbox.breaker.is_open:
+        logging.info("📊 Сверка Google Sheets отложена: Google API недоступен")
+        return 0
+    loop = asyncio.get_event_loop()
+    started = time.monotonic()
+    deadline = started + CONFIG["sheets_reconcile_budget"]
+    fixed = 0
+
+    for title in SHEETS_HEADERS:
+        if time.monotonic() > deadline:
+            logging.warning(f"⚠️ Сверка Google Sheets: нет времени на лист {title}")
+            break
+        local_rows = sheets_local_rows(title)
+        local_hashes = {
+            key: sheets_row_hash(title, row) for key, row in local_rows.items()
+        }
+        try:
+            # Под io_lock: очередь не сдвигает строки листа, пока он читается
+            async with sheets_outbox.io_lock:
+                to_upsert, to_delete, sheet_rows = await loop.run_in_executor(
+                    None, gs.diff_rows, title, local_hashes
+                )
+        except Exception as e:
+            logging.error(f"❌ Сверка Google Sheets / {title}: {e}")
+            continue
+        if to_delete and (
+            not local_rows
+            or len(to_delete) > sheet_rows * SHEETS_RECONCILE_MAX_DELETE_SHARE
+        ):
+            logging.warning(
+                f"⚠️ Сверка Google Sheets / {title}: {len(to_delete)} лишних строк "
+                f"из {sheet_rows} — удаление пропущено"
+            )
+            to_delete = []
+        # Строки берём заново: данные могли измениться, пока лист читался —
+        # созданное за это время не удаляем, удалённое не дописываем
+        rows = sheets_local_rows(title)
+        to_delete = [key for key in to_delete if key not in rows]
+        fixed += sheets_outbox.enqueue_fixes(
+            title, {key: rows[key] for key in to_upsert if key in rows}, to_delete
+        )
+
+    if time.monotonic() <= deadline:
+        completed = {}
+        for request_id, request in shipping_requests.items():
+            if not isinstance(request, dict) or request.get("pull_id") is None:
+                continue
+            if normalize_transition_status(request.get("status")) != "completed":
+                continue
+            try:
+                pull_id = int(request["pull_id"])
+                request_id = int(request.get("id", request_id))
+            except (TypeError, ValueError):
+                continue
+            if find_pull_by_id(pull_id)[1] is None:
+                continue
+            row = completed_deal_row(pull_id, request_id)
+            if row is not None:
+                completed[(str(pull_id), str(request_id))] = row
+        if completed:
+            try:
+                async with sheets_outbox.io_lock:
+                    fixed += await loop.run_in_executor(
+                        None, gs.append_missing_completed_deals, completed
+                    )
+            except Exception as e:
+                logging.error(f"❌ Сверка Google Sheets / {COMPLETED_DEALS_SHEET}: {e}")
+
+    elapsed_ms = (time.monotonic() - started) * 1000
+    sheets_outbox.last_reconcile = (datetime.now(), fixed, elapsed_ms)
+    logging.info(
+        f"📊 Сверка Google Sheets: исправлено {fixed} строк за {elapsed_ms:.0f} мс"
+    )
+    return fixed
+
+
+# ====================================================================
+# ЗАМЕР СИНХРОНИЗАЦИИ GOOGLE SHEETS (python main.py --bench-sheets)
+# ====================================================================
+def sheets_bench_workload(edits: int, seed: int) -> list:
+    """Типичные правки: партии, профили, пулы, изредка удаление партии."""
+    rnd = random.Random(seed)
+    workload = []
+    for _ in range(edits):
+        roll = rnd.random()
+        if roll < 0.6:
+            batch = {"id": rnd.randint(1, 200), "farmer_id": rnd.randint(1, 100)}
+            batch.update(culture="Пшеница", volume=rnd.randint(10, 500))
+            workload.append(("Batches", batch["id"], sheets_batch_row(batch)))
+        elif roll < 0.85:
+            user_id = rnd.randint(1, 100)
+            user = {"name": f"Пользователь {user_id}", "phone": rnd.randint(1, 10**6)}
+            workload.append(("Users", user_id, sheets_user_row(user_id, user)))
+        elif roll < 0.95:
+            pull = {"id": rnd.randint(1, 30), "current_volume": rnd.randint(0, 5000)}
+            workload.append(("Pulls", pull["id"], sheets_pull_row(pull)))
+        else:
+            workload.append(("Batches", rnd.randint(1, 200), None))
+    return workload
+
+
+def sheets_bench_mismatches(spreadsheet, expected: dict) -> int:
+    """Строк таблицы, не совпадающих с ожидаемыми (лишние, пропущенные, дубли)."""
+    mismatched = 0
+    for title, rows in expected.items():
+        try:
+            values = spreadsheet.worksheet(title).get_all_values()[1:]
+        except FakeSheetsAPIError:
+            values = []
+        on_sheet = defaultdict(list)
+        for row in values:
+            on_sheet[row[0]].append(sheets_row_hash(title, row))
+        for key, row in rows.items():
+            if on_sheet.get(key) != [sheets_row_hash(title, row)]:
+                mismatched += 1
+        mismatched += sum(1 for key in on_sheet if key not in rows)
+    return mismatched
+
+
+async def benchmark_sheets_sync(
+    edits: int = 300,
+    latency: float = 0.02,
+    error_rate: float = 0.0,
+    rate: float = 100.0,
+    seed: int = 1,
+) -> dict:
+    """
+    Замер синхронизации с Google Sheets на FakeSpreadsheet.
+
+    Одна и та же нагрузка (edits правок, rate правок в секунду) прогоняется
+    двумя способами: запись в таблицу прямо из обработчика, как до
+    SheetsOutbox, и через очередь. Для каждого — время "обработчика"
+    (p50/p95/max), число API-запросов, ошибок квоты и строк, разошедшихся
+    с ожидаемым состоянием. Глобальный gs на время замера подменяется.
+    """
+    global gs
+    workload = sheets_bench_workload(edits, seed)
+    saved_gs = gs
+    results = {}
+    try:
+        for mode in ("direct", "outbox"):
+            spreadsheet = FakeSpreadsheet(latency=latency, error_rate=error_rate, seed=seed)
+            gs = GoogleSheetsManager(None, "benchmark", spreadsheet=spreadsheet)
+            outbox = SheetsOutbox()
+            outbox.breaker = CircuitBreaker(
+                "Google Sheets (замер)", CONFIG["sheets_breaker_threshold"], 0.05, 1.0
+            )
+            expected = defaultdict(dict)
+            timings = []
+            started = time.perf_counter()
+
+            async def pump():
+                while True:
+                    await asyncio.sleep(0.5)
+                    await outbox.flush()
+
+            pump_task = asyncio.ensure_future(pump()) if mode == "outbox" else None
+            for title, key, row in workload:
+                if row is None:
+                    expected[title].pop(str(key), None)
+                else:
+                    expected[title][str(key)] = row
+                handler_started = time.perf_counter()
+                if mode == "outbox":
+                    outbox._put(title, key, row)
+                else:
+                    try:
+                        gs.apply_ops(title, {str(key): row})
+                    except FakeSheetsAPIError:
+                        pass  # до очереди ошибка только логировалась
+                timings.append((time.perf_counter() - handler_started) * 1000)
+                await asyncio.sleep(1 / rate)
+
+            if pump_task is not None:
+                pump_task.cancel()
+                for _ in range(1000):
+                    if not outbox.pending():
+                        break
+                    await asyncio.sleep(outbox.breaker.retry_in())
+                    await outbox.flush()
+            elapsed = time.perf_counter() - started
+
+            timings.sort()
+            api_calls = spreadsheet.api_calls()
+            spreadsheet.error_rate = 0.0
+            results[mode] = {
+                "p50_ms": timings[len(timings) // 2],
+                "p95_ms": timings[int(len(timings) * 0.95) - 1],
+                "max_ms": timings[-1],
+                "api_calls": api_calls,
+                "errors": spreadsheet.errors,
+                "mismatched": sheets_bench_mismatches(spreadsheet, expected),
+                "seconds": elapsed,
+            }
+    finally:
+        gs = saved_gs
+    return results
+
+
+def format_sheets_benchmark(results: dict) -> str:
+    titles = {"direct": "Запись из обработчика", "outbox": "Через SheetsOutbox"}
+    lines = []
+    for mode, r in results.items():
+        lines.append(
+            f"{titles.get(mode, mode)}: обработчик p50 {r['p50_ms']:.2f} мс, "
+            f"p95 {r['p95_ms']:.2f} мс, макс. {r['max_ms']:.2f} мс; "
+            f"API-запросов {r['api_calls']}, ошибок квоты {r['errors']}, "
+            f"расхождений {r['mismatched']}, всего {r['seconds']:.1f} с"
+        )
+    return "\n".join(lines)
+
+
 # ============================================================================
 # ОБРАБОТЧИКИ ДЛЯ ПРЕДЛОЖЕНИЙ ЛОГИСТОВ (ФЕРМЕР)
 # ============================================================================
 # 🚚 ФЕРМЕР: СПИСОК ПРЕДЛОЖЕНИЙ ЛОГИСТОВ
-@dp.message_handler(
-    lambda message: message.text == "🚚 Предложения логистов", state="*"
-)
+@router.message_handler(text="🚚 Предложения логистов", state="*")
 async def farmer_view_logistics_offers(message: types.Message, state: FSMContext):
     """Просмотр предложений логистов для фермера (через logistic_offers + farmer_logistics_requests)"""
     await state.finish()
@@ -8389,7 +12093,7 @@ async def farmer_view_logistics_offers(message: types.Message, state: FSMContext
     await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("farmer_view_offer:"), state="*")
+@router.callback_query_handler(prefix="farmer_view_offer:", state="*")
 async def farmer_view_offer_details(callback: types.CallbackQuery, state: FSMContext):
     """Детали предложения логиста для фермера (через logistic_offers)"""
     await state.finish()
@@ -8500,9 +12204,7 @@ async def farmer_view_offer_details(callback: types.CallbackQuery, state: FSMCon
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("farmer_accept_offer:"), state="*"
-)
+@router.callback_query_handler(prefix="farmer_accept_offer:", state="*")
 async def farmer_accept_logistics_offer(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -8765,9 +12467,7 @@ async def farmer_accept_logistics_offer(
     )
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("farmer_reject_offer:"), state="*"
-)
+@router.callback_query_handler(prefix="farmer_reject_offer:", state="*")
 async def farmer_reject_logistics_offer(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -8861,7 +12561,7 @@ async def farmer_reject_logistics_offer(
 
 
 # ✅ ИСТОРИЯ ПРЕДЛОЖЕНИЙ ФЕРМЕРА (по logistic_offers/source=farmer)
-@dp.message_handler(lambda message: message.text == "📋 История предложений", state="*")
+@router.message_handler(text="📋 История предложений", state="*")
 async def view_farmer_offers_history(message: types.Message, state: FSMContext):
     """Просмотр истории всех предложений логистов по заявкам фермера"""
     await state.finish()
@@ -8937,7 +12637,7 @@ async def view_farmer_offers_history(message: types.Message, state: FSMContext):
     await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
 
 
-@dp.callback_query_handler(lambda c: c.data == "farmer_back_to_offers", state="*")
+@router.callback_query_handler(data="farmer_back_to_offers", state="*")
 async def farmer_back_to_offers_list(callback: types.CallbackQuery, state: FSMContext):
     """Возврат к списку предложений"""
     await state.finish()
@@ -8950,7 +12650,7 @@ async def farmer_back_to_offers_list(callback: types.CallbackQuery, state: FSMCo
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("view_deal:"), state="*")
+@router.callback_query_handler(prefix="view_deal:", state="*")
 async def view_deal_details(callback: types.CallbackQuery):
     """Просмотр деталей сделки"""
     user_id = callback.from_user.id
@@ -9026,7 +12726,7 @@ async def view_deal_details(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.message_handler(lambda m: m.text == "🔍 Поиск экспортёров", state="*")
+@router.message_handler(text="🔍 Поиск экспортёров", state="*")
 async def search_exporters(message: types.Message, state: FSMContext):
     """Поиск экспортёров для фермера — универсальная версия"""
     await state.finish()
@@ -9092,7 +12792,8 @@ async def search_exporters(message: types.Message, state: FSMContext):
     )
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("findexporters:"), state="*")
+@router.callback_query_handler(prefix="findexporters:", state="*")
+@throttle("matching")
 async def process_find_exporters(callback: types.CallbackQuery):
     """Обработка выбора партии для поиска экспортёров — финальная версия"""
     try:
@@ -9259,7 +12960,7 @@ async def process_find_exporters(callback: types.CallbackQuery):
     await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
 
 
-@dp.message_handler(lambda m: m.text == "➕ Добавить партию", state="*")
+@router.message_handler(text="➕ Добавить партию", state="*")
 async def add_batch_start(message: types.Message, state: FSMContext):
     """Начало добавления партии фермером — исправленная версия"""
     await state.finish()
@@ -9278,9 +12979,7 @@ async def add_batch_start(message: types.Message, state: FSMContext):
     await AddBatch.culture.set()  # Переход FSM ПОСЛЕ отправки сообщения
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("culture:"), state=SearchByCulture.waiting_culture
-)
+@router.callback_query_handler(prefix="culture:", state=SearchByCulture.waiting_culture)
 async def search_by_culture_selected(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик выбора культуры для поиска — исправленная версия с полным функционалом"""
     try:
@@ -9424,7 +13123,7 @@ async def search_by_culture_selected(callback: types.CallbackQuery, state: FSMCo
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("contact_farmer:"))
+@router.callback_query_handler(prefix="contact_farmer:")
 async def contact_farmer_callback(callback: types.CallbackQuery):
     """Обработчик кнопки Связаться с фермером - показывает полные контакты"""
     try:
@@ -9543,9 +13242,7 @@ async def contact_farmer_callback(callback: types.CallbackQuery):
 
 
 # Глобальные переменные (если ещё не определены)
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("culture:"), state=AddBatch.culture
-)
+@router.callback_query_handler(prefix="culture:", state=AddBatch.culture)
 async def add_batch_culture(callback: types.CallbackQuery, state: FSMContext):
     """Выбор культуры для партии"""
     try:
@@ -9566,9 +13263,7 @@ async def add_batch_culture(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("region:"), state=AddBatch.region
-)
+@router.callback_query_handler(prefix="region:", state=AddBatch.region)
 async def add_batch_region(callback: types.CallbackQuery, state: FSMContext):
     """Выбор региона для партии"""
     region = callback.data.split(":", 1)[1]
@@ -9584,7 +13279,7 @@ async def add_batch_region(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.message_handler(state=AddBatch.volume)
+@router.message_handler(state=AddBatch.volume)
 async def add_batch_volume(message: types.Message, state: FSMContext):
     """Ввод объёма партии"""
     try:
@@ -9606,7 +13301,7 @@ async def add_batch_volume(message: types.Message, state: FSMContext):
         await message.answer("❌ Некорректное значение. Введите число больше 0:")
 
 
-@dp.message_handler(state=AddBatch.price)
+@router.message_handler(state=AddBatch.price)
 async def add_batch_price(message: types.Message, state: FSMContext):
     """Ввод цены партии"""
     try:
@@ -9615,8 +13310,11 @@ async def add_batch_price(message: types.Message, state: FSMContext):
             raise ValueError
 
         await state.update_data(price=price)
+        data = await state.get_data()
+        hint = batch_price_hint(data.get("culture"), price)
 
         await message.answer(
+            f"{hint}"
             "📦 <b>Добавление партии</b>\n\n" "Шаг 5 из 9\n\n" "Введите влажность (%):",
             parse_mode="HTML",
         )
@@ -9626,7 +13324,7 @@ async def add_batch_price(message: types.Message, state: FSMContext):
         await message.answer("❌ Некорректное значение. Введите число больше 0:")
 
 
-@dp.message_handler(state=AddBatch.humidity)
+@router.message_handler(state=AddBatch.humidity)
 async def add_batch_humidity(message: types.Message, state: FSMContext):
     """Ввод влажности партии"""
     try:
@@ -9646,7 +13344,7 @@ async def add_batch_humidity(message: types.Message, state: FSMContext):
         await message.answer("❌ Некорректное значение. Введите число от 0 до 100:")
 
 
-@dp.message_handler(state=AddBatch.impurity)
+@router.message_handler(state=AddBatch.impurity)
 async def add_batch_impurity(message: types.Message, state: FSMContext):
     """Ввод сорности партии"""
     try:
@@ -9673,9 +13371,7 @@ async def add_batch_impurity(message: types.Message, state: FSMContext):
         await message.answer("❌ Некорректное значение. Введите число от 0 до 100:")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("storage:"), state=AddBatch.storage_type
-)
+@router.callback_query_handler(prefix="storage:", state=AddBatch.storage_type)
 async def add_batch_storage_type(callback: types.CallbackQuery, state: FSMContext):
     """Выбор типа хранения"""
     storage_type = callback.data.split(":", 1)[1]
@@ -9691,7 +13387,7 @@ async def add_batch_storage_type(callback: types.CallbackQuery, state: FSMContex
     await callback.answer()
 
 
-@dp.message_handler(state=AddBatch.readiness_date)
+@router.message_handler(state=AddBatch.readiness_date)
 async def add_batch_readiness_date(message: types.Message, state: FSMContext):
     """Завершение добавления расширенной партии"""
     global batch_counter
@@ -9782,7 +13478,8 @@ async def add_batch_readiness_date(message: types.Message, state: FSMContext):
                         "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                     }
                     pullparticipants[participant_key].append(participant)
-                    pull["current_volume"] += batch["volume"]
+                    pull_fill.participant_added(pull_storage_id, pull)
+                    pull_fill.add_volume(pull_storage_id, pull, batch["volume"])
 
                     batch["status"] = "reserved"
 
@@ -9831,7 +13528,7 @@ async def add_batch_readiness_date(message: types.Message, state: FSMContext):
     # Синхронизация с Google Sheets
     if gs and gs.spreadsheet:
         try:
-            gs.sync_batch_to_sheets(batch)
+            sheets_outbox.upsert_batch(batch)
             farmer_name = user_info.get("name", "Неизвестно")
             await publish_batch_to_channel(batch, farmer_name)
         except Exception as e:
@@ -9892,7 +13589,7 @@ async def add_batch_readiness_date(message: types.Message, state: FSMContext):
     await state.finish()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("view_matches:"), state="*")
+@router.callback_query_handler(prefix="view_matches:", state="*")
 async def view_batch_matches(callback: types.CallbackQuery):
     """Просмотр совпадений для партии"""
     try:
@@ -9971,7 +13668,7 @@ async def view_batch_matches(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.message_handler(lambda m: m.text == "🔧 Мои партии", state="*")
+@router.message_handler(text="🔧 Мои партии", state="*")
 async def view_my_batches(message: types.Message, state: FSMContext):
     """Просмотр всех партий фермера с правильными статусами через статус мап"""
 
@@ -10076,7 +13773,7 @@ async def view_my_batches(message: types.Message, state: FSMContext):
     )
 
 
-@dp.message_handler(lambda m: m.text == "🎯 Пулы", state="*")
+@router.message_handler(text="🎯 Пулы", state="*")
 async def view_pools_menu(message: types.Message, state: FSMContext):
     """✅ Просмотр пулов для фермера"""
     await state.finish()
@@ -10143,7 +13840,7 @@ async def view_pools_menu(message: types.Message, state: FSMContext):
         )
 
         # ✅ ИЗМЕНЕНО: с подчёркиванием
-        callback_data = f"view_pull:{pull_id}"
+        callback_data = VIEW_PULL_CB.pack(pull_id)
 
         keyboard.add(InlineKeyboardButton(button_text, callback_data=callback_data))
 
@@ -10155,7 +13852,7 @@ async def view_pools_menu(message: types.Message, state: FSMContext):
     )
 
 
-@dp.message_handler(state=JoinPullStatesGroup.volume)
+@router.message_handler(state=JoinPullStatesGroup.volume)
 async def join_pull_volume(message: types.Message, state: FSMContext):
     """Ввод объёма для присоединения к пулу"""
     try:
@@ -10178,12 +13875,11 @@ async def join_pull_volume(message: types.Message, state: FSMContext):
             await state.finish()
             return
 
-        # Проверка доступного места
-        target_volume = pull.get("target_volume", 0)
-        current_volume = pull.get("current_volume", 0)
-        available = target_volume - current_volume
-
-        if volume > available:
+        # Резервируем объём под локом пула: параллельные присоединения
+        # не смогут переполнить пул
+        reservation_id = await pull_reservations.reserve(pull_id, volume, holder=user_id)
+        if reservation_id is None:
+            available = pull_reservations.available_volume(pull_id, pull)
             await message.answer(
                 "❌ Превышен доступный объём!\n"
                 f"Доступно: {available:,.0f} т\n"
@@ -10191,41 +13887,38 @@ async def join_pull_volume(message: types.Message, state: FSMContext):
             )
             return
 
-        # ✅ ИСПРАВЛЕНО: Работа с глобальной переменной pullparticipants
-        pull_id_str = str(pull_id)
+        def apply_join(pull):
+            # ✅ ИСПРАВЛЕНО: Работа с глобальной переменной pullparticipants
+            pull_id_str = str(pull_id)
+            pullparticipants.setdefault(pull_id_str, []).append(
+                {
+                    "farmer_id": user_id,
+                    "farmer_name": user_info.get("name", "?"),
+                    "batch_id": batch_id,
+                    "volume": volume,
+                    "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                }
+            )
+            logging.info(f"✅ Участник добавлен в pullparticipants[{pull_id_str}]")
+            logging.info(
+                f"   Всего участников в пуле: {len(pullparticipants[pull_id_str])}"
+            )
 
-        if pull_id_str not in pullparticipants:
-            pullparticipants[pull_id_str] = []
+            pull_fill.participant_added(pull_id, pull)
 
-        pullparticipants[pull_id_str].append(
-            {
-                "farmer_id": user_id,
-                "farmer_name": user_info.get("name", "?"),
-                "batch_id": batch_id,
-                "volume": volume,
-                "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            }
-        )
+            # Обновляем текущий объём пула; при 100% pull_fill закроет пул
+            pull_fill.add_volume(pull_id, pull, volume)
 
-        # Диагностика
-        logging.info(f"✅ Участник добавлен в pullparticipants[{pull_id_str}]")
-        logging.info(
-            f"   Всего участников в пуле: {len(pullparticipants[pull_id_str])}"
-        )
+            # ✅ КЛЮЧЕВАЯ ПРОВЕРКА - заполненность
+            return pull_fill.fill_percent(pull_id, pull) >= 100
 
-        # Обновляем текущий объём пула
-        pull["current_volume"] = current_volume + volume
+        confirmed, is_full = await pull_reservations.confirm(reservation_id, apply_join)
+        if not confirmed:
+            await message.answer("❌ Не удалось присоединиться: место в пуле уже занято.")
+            return
 
         save_pulls_to_pickle()
 
-        # ✅ КЛЮЧЕВАЯ ПРОВЕРКА - заполненность
-        is_full = False
-        if pull["current_volume"] >= pull.get("target_volume", 0):
-            pull["status"] = "filled"
-            save_pulls_to_pickle()
-            is_full = True
-            logging.info(f"🎉 Пул #{pull_id} заполнен на 100%!")
-
         await state.finish()
 
         if is_full:
@@ -10265,7 +13958,7 @@ async def join_pull_volume(message: types.Message, state: FSMContext):
         await message.answer("❌ Некорректный объём. Введите положительное число.")
 
 
-@dp.callback_query_handler(lambda c: c.data == "refresh_prices", state="*")
+@router.callback_query_handler(data="refresh_prices", state="*")
 async def refresh_prices(callback: types.CallbackQuery, state: FSMContext):
     """Обновление цен и отображения"""
     await state.finish()
@@ -10283,7 +13976,7 @@ async def refresh_prices(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("❌ Не удалось обновить цены", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data == "refresh_news", state="*")
+@router.callback_query_handler(data="refresh_news", state="*")
 async def refresh_news(callback: types.CallbackQuery):
     """Обновление новостей"""
     await callback.answer("🔄 Обновляем новости...")
@@ -10295,7 +13988,8 @@ async def refresh_news(callback: types.CallbackQuery):
     )
 
 
-@dp.callback_query_handler(lambda c: c.data == "auto_match_all", state="*")
+@router.callback_query_handler(data="auto_match_all", state="*")
+@throttle("matching")
 async def auto_match_all_batches(callback: types.CallbackQuery):
     """Автопоиск экспортёров для всех активных партий"""
     user_id = callback.from_user.id
@@ -10345,9 +14039,8 @@ async def auto_match_all_batches(callback: types.CallbackQuery):
         )
 
 
-@dp.callback_query_handler(
-    lambda c: c.data in ["view_analytics", "view_grain_news", "view_export_news"],
-    state="*",
+@router.callback_query_handler(
+    data=["view_analytics", "view_grain_news", "view_export_news"], state="*"
 )
 async def legacy_news_analytics_alias(callback: types.CallbackQuery, state: FSMContext):
     """Совместимость со старыми кнопками новостей/аналитики."""
@@ -10371,7 +14064,7 @@ async def legacy_news_analytics_alias(callback: types.CallbackQuery, state: FSMC
     await refresh_news(callback)
 
 
-@dp.message_handler(lambda m: m.text == "➕ Создать пул", state="*")
+@router.message_handler(text="➕ Создать пул", state="*")
 async def create_pull_start(message: types.Message, state: FSMContext):
     await state.finish()
     userid = message.from_user.id
@@ -10392,9 +14085,7 @@ async def create_pull_start(message: types.Message, state: FSMContext):
 
 
 # ✅ ИСПРАВЛЕНО: Обработчик выбора культуры
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("culture:"), state=CreatePullStatesGroup.culture
-)
+@router.callback_query_handler(prefix="culture:", state=CreatePullStatesGroup.culture)
 async def create_pull_culture_callback(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -10436,7 +14127,7 @@ async def create_pull_culture_callback(
 
 
 # Обработка объема
-@dp.message_handler(state=CreatePullStatesGroup.volume)
+@router.message_handler(state=CreatePullStatesGroup.volume)
 async def create_pull_volume(message: types.Message, state: FSMContext):
     try:
         volume = float(message.text.strip().replace(",", "."))
@@ -10456,7 +14147,7 @@ async def create_pull_volume(message: types.Message, state: FSMContext):
 
 
 # Обработка цены
-@dp.message_handler(state=CreatePullStatesGroup.price)
+@router.message_handler(state=CreatePullStatesGroup.price)
 async def create_pull_price(message: types.Message, state: FSMContext):
     try:
         price = float(message.text.strip().replace(",", "."))
@@ -10478,9 +14169,7 @@ async def create_pull_price(message: types.Message, state: FSMContext):
 
 # Обработка порта
 # Обработка порта
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("selectport_"), state=CreatePullStatesGroup.port
-)
+@router.callback_query_handler(prefix="selectport_", state=CreatePullStatesGroup.port)
 async def create_pull_port_callback(callback: types.CallbackQuery, state: FSMContext):
     logging.info(
         f"Received port callback: {callback.data}, state: {await state.get_state()}"
@@ -10520,7 +14209,7 @@ async def create_pull_port_callback(callback: types.CallbackQuery, state: FSMCon
 
 
 # Обработка влажности
-@dp.message_handler(state=CreatePullStatesGroup.moisture)
+@router.message_handler(state=CreatePullStatesGroup.moisture)
 async def create_pull_moisture(message: types.Message, state: FSMContext):
     try:
         moisture = float(message.text.strip().replace(",", "."))
@@ -10540,7 +14229,7 @@ async def create_pull_moisture(message: types.Message, state: FSMContext):
 
 
 # Обработка натуры
-@dp.message_handler(state=CreatePullStatesGroup.nature)
+@router.message_handler(state=CreatePullStatesGroup.nature)
 async def create_pull_nature(message: types.Message, state: FSMContext):
     try:
         nature = float(message.text.strip().replace(",", "."))
@@ -10560,7 +14249,7 @@ async def create_pull_nature(message: types.Message, state: FSMContext):
 
 
 # Обработка сорной примеси
-@dp.message_handler(state=CreatePullStatesGroup.impurity)
+@router.message_handler(state=CreatePullStatesGroup.impurity)
 async def create_pull_impurity(message: types.Message, state: FSMContext):
     try:
         impurity = float(message.text.strip().replace(",", "."))
@@ -10580,7 +14269,7 @@ async def create_pull_impurity(message: types.Message, state: FSMContext):
 
 
 # Обработка зерновой примеси
-@dp.message_handler(state=CreatePullStatesGroup.weed)
+@router.message_handler(state=CreatePullStatesGroup.weed)
 async def create_pull_weed(message: types.Message, state: FSMContext):
     try:
         weed = float(message.text.strip().replace(",", "."))
@@ -10599,7 +14288,7 @@ async def create_pull_weed(message: types.Message, state: FSMContext):
         await message.answer("❌ Некорректная примесь. Введите число от 0 до 100.")
 
 
-@dp.message_handler(state=CreatePullStatesGroup.documents)
+@router.message_handler(state=CreatePullStatesGroup.documents)
 async def create_pull_documents(message: types.Message, state: FSMContext):
     documents = message.text.strip()
     await state.update_data(documents=documents)
@@ -10629,9 +14318,7 @@ async def create_pull_documents(message: types.Message, state: FSMContext):
     )
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("doctype_"), state=CreatePullStatesGroup.doctype
-)
+@router.callback_query_handler(prefix="doctype_", state=CreatePullStatesGroup.doctype)
 async def create_pull_finish(callback: types.CallbackQuery, state: FSMContext):
     global pull_counter, pulls
 
@@ -10714,11 +14401,7 @@ async def create_pull_finish(callback: types.CallbackQuery, state: FSMContext):
     except Exception as e:
         logging.error(f"❌ save_pulls_to_pickle() error: {e}", exc_info=True)
 
-    try:
-        if gs and gs.spreadsheet:
-            gs.sync_pull_to_sheets(pull)
-    except Exception as e:
-        logging.error(f"Error syncing to Google Sheets: {e}")
+    sheets_outbox.upsert_pull(pull)
 
     logging.info(f"✅ Pull {pull_counter} created by user {userid}")
 
@@ -10747,7 +14430,7 @@ async def create_pull_finish(callback: types.CallbackQuery, state: FSMContext):
     logging.info(f"✅ Pull {pull_counter} created by user {userid}")
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_pools_list", state="*")
+@router.callback_query_handler(data="back_to_pools_list", state="*")
 async def back_to_pools_list(callback: types.CallbackQuery, state: FSMContext):
     """Возврат к списку пулов"""
     await state.finish()
@@ -10810,7 +14493,9 @@ async def back_to_pools_list(callback: types.CallbackQuery, state: FSMContext):
             f"₽{safe_float(pull.get('price', 0), 0.0):,.0f}/т ({progress:.0f}%)"
         )
         keyboard.add(
-            InlineKeyboardButton(button_text, callback_data=f"view_pull:{pull_id_value}")
+            InlineKeyboardButton(
+                button_text, callback_data=VIEW_PULL_CB.pack(pull_id_value)
+            )
         )
 
     await callback.message.edit_text(
@@ -10822,7 +14507,7 @@ async def back_to_pools_list(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("view_pull_matches:"), state="*")
+@router.callback_query_handler(prefix="view_pull_matches:", state="*")
 async def view_pull_matches(callback: types.CallbackQuery):
     """Просмотр совпадений для пула с контактами фермеров"""
     try:
@@ -10898,7 +14583,7 @@ async def view_pull_matches(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_my_pulls", state="*")
+@router.callback_query_handler(data="back_to_my_pulls", state="*")
 async def back_to_my_pulls(callback: types.CallbackQuery, state: FSMContext):
     """✅ Возврат к списку пулов экспортёра"""
     await state.finish()
@@ -10961,7 +14646,7 @@ async def back_to_my_pulls(callback: types.CallbackQuery, state: FSMContext):
             f"{status_icon} {culture_icon} {pull.get('culture', '?')} ({progress:.0f}%)"
         )
         keyboard.add(
-            InlineKeyboardButton(button_text, callback_data=f"view_pull:{pull_id}")
+            InlineKeyboardButton(button_text, callback_data=VIEW_PULL_CB.pack(pull_id))
         )
 
     keyboard.add(InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main"))
@@ -10978,7 +14663,7 @@ async def back_to_my_pulls(callback: types.CallbackQuery, state: FSMContext):
     logging.info(f"✅ Показано {len(my_pulls)} пулов")
 
 
-@dp.message_handler(lambda m: m.text == "📋 Мои пулы", state="*")
+@router.message_handler(text="📋 Мои пулы", state="*")
 async def view_my_pulls(message: types.Message, state: FSMContext):
     """✅ Показывает пулы экспортёра - ЕДИНСТВЕННАЯ ВЕРСИЯ"""
     userid = message.from_user.id
@@ -11028,7 +14713,7 @@ async def view_my_pulls(message: types.Message, state: FSMContext):
             f"{status_icon} {culture_icon} {pull.get('culture', '?')} ({progress:.0f}%)"
         )
         keyboard.add(
-            InlineKeyboardButton(button_text, callback_data=f"view_pull:{pull_id}")
+            InlineKeyboardButton(button_text, callback_data=VIEW_PULL_CB.pack(pull_id))
         )
 
     await message.answer(
@@ -11039,11 +14724,11 @@ async def view_my_pulls(message: types.Message, state: FSMContext):
     )
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("view_pull:"), state="*")
-async def view_pull_details(callback: types.CallbackQuery):
+@router.callback_query_handler(action=VIEW_PULL_CB, state="*")
+async def view_pull_details(callback: types.CallbackQuery, payload):
     """✅ Просмотр деталей пула с учетом роли пользователя и правильной клавиатурой."""
     try:
-        pull_id = parse_callback_id(callback.data)
+        pull_id = payload.pull_id
         if pull_id is None:
             await callback.answer("❌ Ошибка обработки данных", show_alert=True)
             return
@@ -11332,7 +15017,7 @@ async def view_pull_details(callback: types.CallbackQuery):
             if is_pull_open_status(pull_status):
                 keyboard.add(
                     InlineKeyboardButton(
-                        "✅ Присоединиться", callback_data=f"join_pull:{pull_id}"
+                        "✅ Присоединиться", callback_data=JOIN_PULL_CB.pack(pull_id)
                     )
                 )
             else:
@@ -11354,7 +15039,7 @@ async def view_pull_details(callback: types.CallbackQuery):
         await callback.message.reply("❌ <b>Ошибка системы</b>", parse_mode="HTML")
 
 
-@dp.message_handler(lambda m: m.text == "🔍 Найти партии", state="*")
+@router.message_handler(text="🔍 Найти партии", state="*")
 async def search_batches_for_exporter(message: types.Message, state: FSMContext):
     """Расширенный поиск партий для экспортёра"""
     await state.finish()
@@ -11371,7 +15056,7 @@ async def search_batches_for_exporter(message: types.Message, state: FSMContext)
     )
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("search_by:"), state="*")
+@router.callback_query_handler(prefix="search_by:", state="*")
 async def handle_search_criteria(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора критерия поиска партий"""
     await state.finish()
@@ -11515,7 +15200,7 @@ async def handle_search_criteria(callback: types.CallbackQuery, state: FSMContex
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("view_batch:"), state="*")
+@router.callback_query_handler(prefix="view_batch:", state="*")
 async def view_batch_details(callback: types.CallbackQuery, state: FSMContext):
     """Просмотр детальной информации о партии"""
     logging.info(f"📦 Просмотр партии {callback.data}")
@@ -11690,7 +15375,7 @@ async def view_batch_details(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("offer_delivery:"), state="*")
+@router.callback_query_handler(prefix="offer_delivery:", state="*")
 async def offer_delivery_from_batch(callback: types.CallbackQuery, state: FSMContext):
     """Запасной обработчик отклика логиста из карточки партии."""
     await state.finish()
@@ -11714,7 +15399,7 @@ async def offer_delivery_from_batch(callback: types.CallbackQuery, state: FSMCon
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_search", state="*")
+@router.callback_query_handler(data="back_to_search", state="*")
 async def back_to_search_menu(callback: types.CallbackQuery, state: FSMContext):
     """Возврат в меню поиска"""
     await state.finish()
@@ -11731,11 +15416,10 @@ async def back_to_search_menu(callback: types.CallbackQuery, state: FSMContext):
 
 
 # Обработчик выбора региона
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("searchregion:"),
-    state=SearchBatchesStatesGroup.enter_region,
+@router.callback_query_handler(
+    prefix="searchregion:", state=SearchBatchesStatesGroup.enter_region
 )
-@dp.callback_query_handler(lambda c: c.data.startswith("searchregion:"), state="*")
+@router.callback_query_handler(prefix="searchregion:", state="*")
 async def search_by_region_selected(callback: types.CallbackQuery, state: FSMContext):
     if ":" in callback.data:
         region = callback.data.split(":", 1)[1]
@@ -11793,7 +15477,7 @@ async def search_by_region_selected(callback: types.CallbackQuery, state: FSMCon
 # ═══════════════════════════════════════════════════════════════════════════
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("add_batch_to_pull:"), state="*")
+@router.callback_query_handler(prefix="add_batch_to_pull:", state="*")
 async def add_batch_to_pull_select(callback: types.CallbackQuery):
     """Выбор пулла для добавления партии"""
     try:
@@ -11871,7 +15555,7 @@ async def add_batch_to_pull_select(callback: types.CallbackQuery):
 # ════════════════════════════════════════════════════════════════════════════════════
 # ИСПРАВЛЕННАЯ ВЕРСИЯ
 # ════════════════════════════════════════════════════════════════════════════════════
-@dp.callback_query_handler(lambda c: c.data.startswith("confirm_add_batch:"), state="*")
+@router.callback_query_handler(prefix="confirm_add_batch:", state="*")
 async def confirm_add_batch_to_pull(callback: types.CallbackQuery):
     """✅ Подтверждение добавления партии в пулл - ПОЛНОСТЬЮ ИСПРАВЛЕННАЯ ВЕРСИЯ"""
     try:
@@ -11923,28 +15607,111 @@ async def confirm_add_batch_to_pull(callback: types.CallbackQuery):
             return
 
         batch_volume = safe_float(batch.get("volume", 0), 0.0)
-        target_volume = safe_float(pull.get("target_volume", 0), 0.0)
-        current_volume = safe_float(pull.get("current_volume", 0), 0.0)
-        available_volume = max(target_volume - current_volume, 0.0)
-        if target_volume > 0 and batch_volume > available_volume:
-            await callback.answer(
-                f"❌ Недостаточно места в пулле. Доступно: {available_volume:.1f} т",
-                show_alert=True,
-            )
-            return
         batch_culture = normalize_status_key(batch.get("culture"))
         pull_culture = normalize_status_key(pull.get("culture"))
         if batch_culture != pull_culture:
             await callback.answer("❌ Культура партии не совпадает с пуллом", show_alert=True)
             return
 
-        # 4️⃣ ИНИЦИАЛИЗИРУЕМ ПОЛЯ ПУЛЛА
-        if "batches" not in pull:
-            pull["batches"] = []
-        if "batch_ids" not in pull:
-            pull["batch_ids"] = []
-        if "farmer_ids" not in pull:
-            pull["farmer_ids"] = []
+        # 5️⃣ ПРОВЕРЯЕМ ЧТО ПАРТИЯ НЕ ДОБАВЛЕНА
+        if any(
+            same_id(existing_batch_id, batch_id)
+            for existing_batch_id in pull.get("batch_ids", [])
+        ):
+            await callback.answer("⚠️ Партия уже в пуле", show_alert=True)
+            return
+
+        # Резервируем объём партии под локом пулла
+        reservation_id = await pull_reservations.reserve(
+            pull_id, batch_volume, holder=callback.from_user.id
+        )
+        if reservation_id is None:
+            available_volume = pull_reservations.available_volume(pull_id, pull)
+            await callback.answer(
+                f"❌ Недостаточно места в пулле. Доступно: {available_volume:.1f} т",
+                show_alert=True,
+            )
+            return
+
+        def apply_add_batch(pull):
+            # 4️⃣ ИНИЦИАЛИЗИРУЕМ ПОЛЯ ПУЛЛА
+            if "batches" not in pull:
+                pull["batches"] = []
+            if "batch_ids" not in pull:
+                pull["batch_ids"] = []
+            if "farmer_ids" not in pull:
+                pull["farmer_ids"] = []
+
+            if any(same_id(existing_batch_id, batch_id) for existing_batch_id in pull["batch_ids"]):
+                return None
+
+            # 6️⃣ ДОБАВЛЯЕМ ПАРТИЮ В ПУЛ
+            if not any(
+                (
+                    (
+                        isinstance(b, dict)
+                        and same_id(b.get("id"), batch_id)
+                    )
+                    or (
+                        not isinstance(b, dict)
+                        and same_id(b, batch_id)
+                    )
+                )
+                for b in pull.get("batches", [])
+            ):
+                pull["batches"].append(
+                    {
+                        "id": batch_id,
+                        "farmer_id": farmer_id,
+                        "culture": batch.get("culture"),
+                        "volume": batch.get("volume"),
+                        "price": batch.get("price"),
+                        "moisture": batch.get("moisture", batch.get("humidity", 0)),
+                        "impurity": batch.get("impurity", batch.get("impurities", 0)),
+                        "quality_class": batch.get("quality_class", ""),
+                        "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    }
+                )
+            pull["batch_ids"].append(batch_id)
+            batch["status"] = "reserved"
+            batch["pull_id"] = pull_id
+
+            # 7️⃣ ДОБАВЛЯЕМ ФЕРМЕРА
+            if not any(same_id(existing_farmer_id, farmer_id) for existing_farmer_id in pull["farmer_ids"]):
+                pull["farmer_ids"].append(farmer_id)
+                logging.info(f"✅ Фермер {farmer_id} добавлен в пулл {pull_id}")
+
+            # 8️⃣ ДОБАВЛЯЕМ В pullparticipants
+            farmer_info = get_user_by_id(farmer_id) or {}
+            participant_record = {
+                "batch_id": batch_id,
+                "farmer_id": farmer_id,
+                "farmer_name": farmer_info.get("name", "Unknown"),
+                "volume": batch.get("volume", 0),
+                "quality_class": batch.get("quality_class", ""),
+                "culture": batch.get("culture", ""),
+                "price_per_ton": batch.get("price", 0),
+            }
+
+            if not any(
+                same_id(p.get("batch_id"), batch_id)
+                for p in pullparticipants.get(participants_key, [])
+                if isinstance(p, dict)
+            ):
+                pullparticipants[participants_key].append(participant_record)
+                pull_fill.participant_added(pull_id, pull)
+                logging.info(
+                    f"✅ Участник добавлен: farmer_id={farmer_id}, batch_id={batch_id}"
+                )
+
+            # 9️⃣ СЧИТАЕМ ОБЪЁМ
+            current_volume = 0
+            for b_id in pull["batch_ids"]:
+                _, existing_batch = find_batch_by_id(b_id)
+                if existing_batch:
+                    current_volume += existing_batch.get("volume", 0)
+            # 🔟 ЗАПОЛНЕНИЕ ПРОВЕРЯЕТ pull_fill (событие 100%)
+            return pull_fill.set_volume(pull_id, pull, current_volume)
 
         # ИНИЦИАЛИЗИРУЕМ pullparticipants
         participants_key = (
@@ -11957,83 +15724,18 @@ async def confirm_add_batch_to_pull(callback: types.CallbackQuery):
         if participants_key not in pullparticipants:
             pullparticipants[participants_key] = []
 
-        # 5️⃣ ПРОВЕРЯЕМ ЧТО ПАРТИЯ НЕ ДОБАВЛЕНА
-        if any(same_id(existing_batch_id, batch_id) for existing_batch_id in pull["batch_ids"]):
-            await callback.answer("⚠️ Партия уже в пуле", show_alert=True)
-            return
-
-        # 6️⃣ ДОБАВЛЯЕМ ПАРТИЮ В ПУЛ
-        if not any(
-            (
-                (
-                    isinstance(b, dict)
-                    and same_id(b.get("id"), batch_id)
-                )
-                or (
-                    not isinstance(b, dict)
-                    and same_id(b, batch_id)
-                )
-            )
-            for b in pull.get("batches", [])
-        ):
-            pull["batches"].append(
-                {
-                    "id": batch_id,
-                    "farmer_id": farmer_id,
-                    "culture": batch.get("culture"),
-                    "volume": batch.get("volume"),
-                    "price": batch.get("price"),
-                    "moisture": batch.get("moisture", batch.get("humidity", 0)),
-                    "impurity": batch.get("impurity", batch.get("impurities", 0)),
-                    "quality_class": batch.get("quality_class", ""),
-                    "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                }
-            )
-        pull["batch_ids"].append(batch_id)
-        batch["status"] = "reserved"
-        batch["pull_id"] = pull_id
-
-        # 7️⃣ ДОБАВЛЯЕМ ФЕРМЕРА
-        if not any(same_id(existing_farmer_id, farmer_id) for existing_farmer_id in pull["farmer_ids"]):
-            pull["farmer_ids"].append(farmer_id)
-            logging.info(f"✅ Фермер {farmer_id} добавлен в пулл {pull_id}")
-
-        # 8️⃣ ДОБАВЛЯЕМ В pullparticipants
-        farmer_info = get_user_by_id(farmer_id) or {}
-        participant_record = {
-            "batch_id": batch_id,
-            "farmer_id": farmer_id,
-            "farmer_name": farmer_info.get("name", "Unknown"),
-            "volume": batch.get("volume", 0),
-            "quality_class": batch.get("quality_class", ""),
-            "culture": batch.get("culture", ""),
-            "price_per_ton": batch.get("price", 0),
-        }
-
-        if not any(
-            same_id(p.get("batch_id"), batch_id)
-            for p in pullparticipants.get(participants_key, [])
-            if isinstance(p, dict)
-        ):
-            pullparticipants[participants_key].append(participant_record)
-            logging.info(
-                f"✅ Участник добавлен: farmer_id={farmer_id}, batch_id={batch_id}"
+        confirmed, current_volume = await pull_reservations.confirm(
+            reservation_id, apply_add_batch
+        )
+        if not confirmed or current_volume is None:
+            await callback.answer(
+                "⚠️ Партия уже в пуле или место в пулле занято", show_alert=True
             )
-
-        # 9️⃣ СЧИТАЕМ ОБЪЁМ
-        current_volume = 0
-        for b_id in pull["batch_ids"]:
-            _, existing_batch = find_batch_by_id(b_id)
-            if existing_batch:
-                current_volume += existing_batch.get("volume", 0)
+            return
 
         target_volume = pull.get("target_volume", 0)
-        pull["current_volume"] = current_volume
-
-        # 🔟 ПРОВЕРЯЕМ ЗАПОЛНЕНИЕ
         status_msg = ""
-        if target_volume > 0 and current_volume >= target_volume:
-            pull["status"] = "filled"
+        if normalize_transition_status(pull.get("status")) == "filled":
             status_msg = "🎉 Пулл собран!"
             logging.info(f"🎉 Пулл #{pull_id} СОБРАН!")
 
@@ -12105,7 +15807,7 @@ async def confirm_add_batch_to_pull(callback: types.CallbackQuery):
 # ═══════════════════════════════════════════════════════════════════════════
 # 🚚 ФЕРМЕР СОЗДАЕТ ЗАЯВКУ НА ДОСТАВКУ (копия логики экспортера)
 # ═══════════════════════════════════════════════════════════════════════════
-@dp.message_handler(lambda m: m.text == "🚚 Создать заявку на доставку", state="*")
+@router.message_handler(text="🚚 Создать заявку на доставку", state="*")
 async def create_logistics_from_menu(message: types.Message, state: FSMContext):
     """Показывает список партий для выбора"""
     await state.finish()
@@ -12142,9 +15844,7 @@ async def create_logistics_from_menu(message: types.Message, state: FSMContext):
     await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("create_logistics_from_batch:"), state="*"
-)
+@router.callback_query_handler(prefix="create_logistics_from_batch:", state="*")
 async def create_logistics_from_batch_handler(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -12206,7 +15906,7 @@ async def create_logistics_from_batch_handler(
     await callback.answer()
 
 
-@dp.message_handler(state=FarmerShippingRequestStates.route_to_region)
+@router.message_handler(state=FarmerShippingRequestStates.route_to_region)
 async def farmer_enter_destination_region(message: types.Message, state: FSMContext):
     """ШАГ 2: фермер вводит регион/город назначения, затем выбирает порт."""
     to_region = message.text.strip()
@@ -12258,8 +15958,8 @@ async def farmer_enter_destination_region(message: types.Message, state: FSMCont
     await FarmerShippingRequestStates.route_to_port.set()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("__legacy_create_logistic_req_disabled:"), state="*"
+@router.callback_query_handler(
+    prefix="__legacy_create_logistic_req_disabled:", state="*"
 )
 async def select_pull_for_logistics_legacy(
     callback: types.CallbackQuery, state: FSMContext
@@ -12299,9 +15999,8 @@ async def select_pull_for_logistics_legacy(
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("farmer_select_port:"),
-    state=FarmerShippingRequestStates.route_to_port,
+@router.callback_query_handler(
+    prefix="farmer_select_port:", state=FarmerShippingRequestStates.route_to_port
 )
 async def farmer_select_port(callback: types.CallbackQuery, state: FSMContext):
     """ШАГ 3: фермер выбрал порт, теперь выбирает транспорт."""
@@ -12338,8 +16037,8 @@ async def farmer_select_port(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("farmer_select_transport:"),
+@router.callback_query_handler(
+    prefix="farmer_select_transport:",
     state=FarmerShippingRequestStates.select_transport,
 )
 async def farmer_select_transport(callback: types.CallbackQuery, state: FSMContext):
@@ -12366,7 +16065,7 @@ async def farmer_select_transport(callback: types.CallbackQuery, state: FSMConte
     await callback.answer()
 
 
-@dp.message_handler(state=FarmerShippingRequestStates.entering_price)
+@router.message_handler(state=FarmerShippingRequestStates.entering_price)
 async def farmer_enter_price(message: types.Message, state: FSMContext):
     """ШАГ 5: Подтверждение."""
     try:
@@ -12439,7 +16138,7 @@ async def farmer_enter_price(message: types.Message, state: FSMContext):
     await state.update_data(desired_price=price)
 
 
-@dp.callback_query_handler(text="farmer_confirm_logistics_request", state="*")
+@router.callback_query_handler(data="farmer_confirm_logistics_request", state="*")
 async def farmer_confirm_logistics_request(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -12528,45 +16227,12 @@ async def farmer_confirm_logistics_request(
         f"{transport_name}, {data['desired_price']}₽/т"
     )
 
-    # Уведомления логистам и экспедиторам — меняем только текст маршрута
-
-    logists_count = 0
-    for logist_id, user_data in users.items():
-        if not isinstance(user_data, dict):
-            continue
-        if is_logistic_role(user_data.get("role")):
-            try:
-                msg = (
-                    "📬 <b>НОВАЯ ЗАЯВКА НА ДОСТАВКУ!</b>\n\n"
-                    f"🌾 {batch['culture']} • {batch['volume']} т\n"
-                    f"💰 Цена партии: {batch['price']:,} ₽/т\n"
-                    f"💳 Ожидаемая цена доставки: {data['desired_price']:,} ₽/т\n\n"
-                    f"📍 От: {farmer_region}\n"
-                    f"📍 Куда: {to_region} ({port_name})\n"
-                    f"🚚 Транспорт: {transport_name}\n"
-                    f"👤 Фермер: {farmer_user.get('name', '')}\n"
-                    f"☎️ {farmer_user.get('phone', '')}\n\n"
-                    "Нажмите «ОТКЛИКНУТЬСЯ», если готовы везти."
-                )
-
-                keyboard = InlineKeyboardMarkup()
-                keyboard.add(
-                    InlineKeyboardButton(
-                        "✅ ОТКЛИКНУТЬСЯ",
-                        callback_data=f"logist_respond_farmer_request:{request_id}",
-                    ),
-                    InlineKeyboardButton(
-                        "📋 ДЕТАЛИ",
-                        callback_data=f"view_request:farmer:{request_id}",
-                    ),
-                )
-
-                await bot.send_message(
-                    logist_id, msg, reply_markup=keyboard, parse_mode="HTML"
-                )
-                logists_count += 1
-            except Exception as e:
-                logging.error(f"❌ Ошибка уведомления логиста {logist_id}: {e}")
+    # Уведомления логистам — волнами, начиная с наиболее подходящих
+    try:
+        logists_count = await send_carrier_wave("farmer", request_id)
+    except Exception as e:
+        logists_count = 0
+        logging.error(f"❌ Ошибка уведомления логистов по заявке #{request_id}: {e}")
 
     success_text = (
         "✅ <b>ЗАЯВКА НА ДОСТАВКУ СОЗДАНА!</b>\n\n"
@@ -12602,9 +16268,7 @@ async def farmer_confirm_logistics_request(
 # ═══════════════════════════════════════════════════════════════════════════
 # ЭКСПЕДИТОР: ОТКЛИК НА ЗАЯВКУ ФЕРМЕРА
 # ═══════════════════════════════════════════════════════════════════════════
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("expeditor_respond_farmer_request:"), state="*"
-)
+@router.callback_query_handler(prefix="expeditor_respond_farmer_request:", state="*")
 async def expeditor_respond_farmer_request(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -12702,9 +16366,7 @@ async def expeditor_respond_farmer_request(
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("expeditor_respond_transport:"), state="*"
-)
+@router.callback_query_handler(prefix="expeditor_respond_transport:", state="*")
 async def expeditor_respond_transport(callback: types.CallbackQuery, state: FSMContext):
     """
     Экспедитор выбрал транспорт: сохраняем отклик в заявке и уведомляем фермера.
@@ -12883,9 +16545,7 @@ async def expeditor_respond_transport(callback: types.CallbackQuery, state: FSMC
     )
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("farmer_view_expeditor_offers:"), state="*"
-)
+@router.callback_query_handler(prefix="farmer_view_expeditor_offers:", state="*")
 async def farmer_view_expeditor_offers(callback: types.CallbackQuery):
     """Фермер смотрит все отклики экспедиторов по своей заявке."""
     try:
@@ -12963,9 +16623,7 @@ async def farmer_view_expeditor_offers(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("farmer_view_expeditor_offer:"), state="*"
-)
+@router.callback_query_handler(prefix="farmer_view_expeditor_offer:", state="*")
 async def farmer_view_expeditor_offer(callback: types.CallbackQuery):
     """Фермер смотрит конкретное предложение экспедитора и может его выбрать."""
     try:
@@ -13081,9 +16739,7 @@ async def farmer_view_expeditor_offer(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("farmer_choose_expeditor:"), state="*"
-)
+@router.callback_query_handler(prefix="farmer_choose_expeditor:", state="*")
 async def farmer_choose_expeditor(callback: types.CallbackQuery):
     """Фермер подтверждает выбор экспедитора по своей заявке."""
     try:
@@ -13267,7 +16923,7 @@ async def farmer_choose_expeditor(callback: types.CallbackQuery):
 # ═══════════════════════════════════════════════════════════════════════════
 # ФЕРМЕР: МОИ ЗАЯВКИ - просмотр списка заявок
 # ═══════════════════════════════════════════════════════════════════════════
-@dp.callback_query_handler(text="farmer_my_requests_menu", state="*")
+@router.callback_query_handler(data="farmer_my_requests_menu", state="*")
 async def farmer_my_requests_menu(callback: types.CallbackQuery, state: FSMContext):
     """МОИ ЗАЯВКИ - просмотр списка"""
     try:
@@ -13360,7 +17016,7 @@ async def farmer_my_requests_menu(callback: types.CallbackQuery, state: FSMConte
 
 
 # ✅ ДОБАВИТЬ второй обработчик с той же логикой:
-@dp.message_handler(text="📬 МОИ ЗАЯВКИ", state="*")
+@router.message_handler(text="📬 МОИ ЗАЯВКИ", state="*")
 async def farmer_my_requests_text(message: types.Message, state: FSMContext):
     """МОИ ЗАЯВКИ - текстовая кнопка"""
     await state.finish()
@@ -13436,9 +17092,7 @@ async def farmer_my_requests_text(message: types.Message, state: FSMContext):
     await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("farmer_request_view:"), state="*"
-)
+@router.callback_query_handler(prefix="farmer_request_view:", state="*")
 async def farmer_request_view(callback: types.CallbackQuery, state: FSMContext):
     """Просмотр деталей заявки"""
     await state.finish()
@@ -13575,7 +17229,7 @@ def get_choice_keyboard(field, request_id):
     return keyboard
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_request:"), state="*")
+@router.callback_query_handler(prefix="edit_request:", state="*")
 async def edit_request_start(callback: types.CallbackQuery, state: FSMContext):
     request_ref = callback.data.split(":")[-1]
     request_id = int(request_ref) if str(request_ref).isdigit() else request_ref
@@ -13612,7 +17266,7 @@ async def edit_request_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_req_field:"), state="*")
+@router.callback_query_handler(prefix="edit_req_field:", state="*")
 async def edit_req_field_handler(callback: types.CallbackQuery, state: FSMContext):
     _, field, request_id = callback.data.split(":")
     request_id = int(request_id) if str(request_id).isdigit() else request_id
@@ -13633,9 +17287,8 @@ async def edit_req_field_handler(callback: types.CallbackQuery, state: FSMContex
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("edit_field_val:"),
-    state=EditRequestStates.waiting_for_choice,
+@router.callback_query_handler(
+    prefix="edit_field_val:", state=EditRequestStates.waiting_for_choice
 )
 async def edit_field_value_choice(callback: types.CallbackQuery, state: FSMContext):
     _, field, value, request_id = callback.data.split(":")
@@ -13662,9 +17315,8 @@ async def edit_field_value_choice(callback: types.CallbackQuery, state: FSMConte
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("edit_field_custom:"),
-    state=EditRequestStates.waiting_for_choice,
+@router.callback_query_handler(
+    prefix="edit_field_custom:", state=EditRequestStates.waiting_for_choice
 )
 async def edit_field_custom_choice(callback: types.CallbackQuery, state: FSMContext):
     _, field, request_id = callback.data.split(":")
@@ -13677,7 +17329,7 @@ async def edit_field_custom_choice(callback: types.CallbackQuery, state: FSMCont
     await callback.answer()
 
 
-@dp.message_handler(state=EditRequestStates.waiting_for_custom_value)
+@router.message_handler(state=EditRequestStates.waiting_for_custom_value)
 async def process_custom_value(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
     field = user_data.get("edit_field")
@@ -13704,7 +17356,7 @@ async def process_custom_value(message: types.Message, state: FSMContext):
     await state.finish()
 
 
-@dp.message_handler(state=EditRequestStates.waiting_for_number)
+@router.message_handler(state=EditRequestStates.waiting_for_number)
 async def process_number_field(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
     field = user_data.get("edit_field")
@@ -13742,8 +17394,8 @@ async def process_number_field(message: types.Message, state: FSMContext):
     await state.finish()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data == "__legacy_farmer_request_view_disabled__", state="*"
+@router.callback_query_handler(
+    data="__legacy_farmer_request_view_disabled__", state="*"
 )
 async def show_request_view_legacy(callback: types.CallbackQuery, state: FSMContext):
     await state.finish()
@@ -13758,7 +17410,7 @@ async def show_request_view_legacy(callback: types.CallbackQuery, state: FSMCont
 # ============================================================================
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("delete_request:"), state="*")
+@router.callback_query_handler(prefix="delete_request:", state="*")
 async def confirm_delete_request(callback: types.CallbackQuery, state: FSMContext):
     """Подтверждение удаления заявки"""
     await state.finish()
@@ -13816,9 +17468,7 @@ async def confirm_delete_request(callback: types.CallbackQuery, state: FSMContex
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("confirm_delete_request:"), state="*"
-)
+@router.callback_query_handler(prefix="confirm_delete_request:", state="*")
 async def delete_request_final(callback: types.CallbackQuery, state: FSMContext):
     """Окончательное удаление заявки"""
     await state.finish()
@@ -14103,9 +17753,7 @@ async def delete_request_final(callback: types.CallbackQuery, state: FSMContext)
     await callback.answer("✅ Заявка удалена!", show_alert=True)
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("farmer_view_offers:"), state="*"
-)
+@router.callback_query_handler(prefix="farmer_view_offers:", state="*")
 async def farmer_view_offers(callback: types.CallbackQuery, state: FSMContext):
     """Просмотр откликов логистов по конкретной заявке фермера (через logistic_offers)."""
     await state.finish()
@@ -14200,9 +17848,7 @@ async def farmer_view_offers(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("farmer_contact_logist:"), state="*"
-)
+@router.callback_query_handler(prefix="farmer_contact_logist:", state="*")
 async def farmer_contact_logist(callback: types.CallbackQuery, state: FSMContext):
     """Контакты логиста по офферам на заявку фермера (через logistic_offers)."""
     await state.finish()
@@ -14308,7 +17954,7 @@ async def farmer_contact_logist(callback: types.CallbackQuery, state: FSMContext
 
 
 # ОБРАБОТЧИК КНОПКИ: СОЗДАТЬ ЗАЯВКУ (мини-клавиатура в подтверждении)
-@dp.callback_query_handler(text="farmer_confirm_request", state="*")
+@router.callback_query_handler(data="farmer_confirm_request", state="*")
 async def farmer_confirm_request_button(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -14379,7 +18025,7 @@ async def farmer_confirm_request_button(
 
 
 # Второй обработчик - оставьте как есть!
-@dp.callback_query_handler(text="farmer_cancel_request", state="*")
+@router.callback_query_handler(data="farmer_cancel_request", state="*")
 async def farmer_cancel_request_button(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -14398,7 +18044,7 @@ async def farmer_cancel_request_button(
 
 
 # ГЛАВНОЕ МЕНЮ ФЕРМЕРА (добавьте обработчик если его нет)
-@dp.callback_query_handler(text="farmer_main_menu", state="*")
+@router.callback_query_handler(data="farmer_main_menu", state="*")
 async def farmer_main_menu(callback: types.CallbackQuery, state: FSMContext):
     """Главное меню фермера"""
     await state.finish()
@@ -14409,9 +18055,7 @@ async def farmer_main_menu(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("logist_respond_farmer_request:"), state="*"
-)
+@router.callback_query_handler(prefix="logist_respond_farmer_request:", state="*")
 async def logist_respond_farmer_request(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -14448,9 +18092,7 @@ async def logist_respond_farmer_request(
 # ──────────────────────────────────────────────────────────────────────────
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("select_logistics_for_pull:"), state="*"
-)
+@router.callback_query_handler(prefix="select_logistics_for_pull:", state="*")
 async def show_logistics_for_pull(callback: types.CallbackQuery):
     """Показать список логистов для выбора под пул (портовая логика + карточки логистов)."""
     try:
@@ -14577,9 +18219,7 @@ async def show_logistics_for_pull(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_logistic_card:"), state="*"
-)
+@router.callback_query_handler(prefix="view_logistic_card:", state="*")
 async def view_logistic_card_for_selection(callback: types.CallbackQuery):
     """Просмотр карточки логиста при выборе логиста под пул."""
     try:
@@ -14716,9 +18356,7 @@ async def view_logistic_card_for_selection(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("confirm_select_logistic:"), state="*"
-)
+@router.callback_query_handler(prefix="confirm_select_logistic:", state="*")
 async def confirm_select_logistic(callback: types.CallbackQuery):
     """Подтвердить выбор логиста для пулла и отправить уведомления."""
     try:
@@ -14802,9 +18440,7 @@ async def confirm_select_logistic(callback: types.CallbackQuery):
 # ──────────────────────────────────────────────────────────────────────────
 # 3. ПРОСМОТР И ВЫБОР ЭКСПЕДИТОРА
 # ──────────────────────────────────────────────────────────────────────────
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("select_expeditor_for_pull:"), state="*"
-)
+@router.callback_query_handler(prefix="select_expeditor_for_pull:", state="*")
 async def show_expeditors_for_pull(callback: types.CallbackQuery):
     """Показать список экспедиторов для выбора под пул (по порту и статусу пулла)."""
     try:
@@ -14898,9 +18534,7 @@ async def show_expeditors_for_pull(callback: types.CallbackQuery):
 # ================== КАРТОЧКА ЭКСПЕДИТОРА ПОД ПУЛ ==================
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_expeditor_card:"), state="*"
-)
+@router.callback_query_handler(prefix="view_expeditor_card:", state="*")
 async def view_expeditor_card_for_selection(callback: types.CallbackQuery):
     """Просмотр карточки экспедитора и создание предложения по пуллу."""
     try:
@@ -14996,7 +18630,7 @@ async def view_expeditor_card_for_selection(callback: types.CallbackQuery):
 
 
 # ================== СОЗДАНИЕ ПРЕДЛОЖЕНИЯ ЭКСПЕДИТОРОМ ПО ПУЛЛУ ==================
-@dp.callback_query_handler(lambda c: c.data.startswith("exp_offer_start:"), state="*")
+@router.callback_query_handler(prefix="exp_offer_start:", state="*")
 async def exp_offer_start(callback: types.CallbackQuery, state: FSMContext):
     """Экспедитор начинает формировать предложение по пуллу."""
     await state.finish()
@@ -15043,7 +18677,7 @@ async def exp_offer_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.message_handler(state=ExpeditorOfferForPullStates.enter_terms)
+@router.message_handler(state=ExpeditorOfferForPullStates.enter_terms)
 async def exp_offer_enter_terms(message: types.Message, state: FSMContext):
     terms = message.text.strip()
     await state.update_data(terms=terms)
@@ -15055,7 +18689,7 @@ async def exp_offer_enter_terms(message: types.Message, state: FSMContext):
     await ExpeditorOfferForPullStates.enter_price.set()
 
 
-@dp.message_handler(state=ExpeditorOfferForPullStates.enter_price)
+@router.message_handler(state=ExpeditorOfferForPullStates.enter_price)
 async def exp_offer_enter_price(message: types.Message, state: FSMContext):
     try:
         price_text = message.text.replace(" ", "").replace(",", ".")
@@ -15188,9 +18822,7 @@ async def notify_exporter_about_expeditor_offer(pull: dict, offer: dict):
 # ================== ВИТРИНА ПРЕДЛОЖЕНИЙ ЭКСПЕДИТОРОВ ДЛЯ ЭКСПОРТЁРА ==================
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_expeditor_offers_for_pull:"), state="*"
-)
+@router.callback_query_handler(prefix="view_expeditor_offers_for_pull:", state="*")
 async def view_expeditor_offers_for_pull(callback: types.CallbackQuery):
     """Экспортёр смотрит все предложения экспедиторов по пуллу."""
     try:
@@ -15280,16 +18912,14 @@ async def view_expeditor_offers_for_pull(callback: types.CallbackQuery):
         )
 
     keyboard.add(
-        InlineKeyboardButton("⬅️ Назад к пуллу", callback_data=f"view_pull:{pull_id}")
+        InlineKeyboardButton("⬅️ Назад к пуллу", callback_data=VIEW_PULL_CB.pack(pull_id))
     )
 
     await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_expeditor_offer_for_pull:"), state="*"
-)
+@router.callback_query_handler(prefix="view_expeditor_offer_for_pull:", state="*")
 async def view_expeditor_offer_for_pull(callback: types.CallbackQuery):
     """Детали конкретного предложения экспедитора по пуллу."""
     try:
@@ -15377,7 +19007,7 @@ async def view_expeditor_offer_for_pull(callback: types.CallbackQuery):
     keyboard.add(
         InlineKeyboardButton(
             "⬅️ К пуллу",
-            callback_data=f"view_pull:{pull_id}",
+            callback_data=VIEW_PULL_CB.pack(pull_id),
         )
     )
 
@@ -15385,9 +19015,7 @@ async def view_expeditor_offer_for_pull(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("choose_expeditor_offer_for_pull:"), state="*"
-)
+@router.callback_query_handler(prefix="choose_expeditor_offer_for_pull:", state="*")
 async def choose_expeditor_offer_for_pull(callback: types.CallbackQuery):
     """Экспортёр выбирает конкретное предложение экспедитора по пуллу."""
     try:
@@ -15507,7 +19135,7 @@ async def choose_expeditor_offer_for_pull(callback: types.CallbackQuery):
     await callback.answer("✅ Экспедитор назначен")
 
 
-@dp.message_handler(state=SearchBatchesStatesGroup.enter_min_volume)
+@router.message_handler(state=SearchBatchesStatesGroup.enter_min_volume)
 async def search_min_volume(message: types.Message, state: FSMContext):
     """Ввод минимального объёма при поиске"""
     try:
@@ -15531,7 +19159,7 @@ async def search_min_volume(message: types.Message, state: FSMContext):
         await message.answer("❌ Некорректное значение. Введите число:")
 
 
-@dp.message_handler(state=SearchBatchesStatesGroup.enter_max_volume)
+@router.message_handler(state=SearchBatchesStatesGroup.enter_max_volume)
 async def search_max_volume(message: types.Message, state: FSMContext):
     """Ввод максимального объёма при поиске"""
     try:
@@ -15551,7 +19179,7 @@ async def search_max_volume(message: types.Message, state: FSMContext):
         await message.answer("❌ Некорректное значение. Введите число:")
 
 
-@dp.message_handler(state=SearchBatchesStatesGroup.enter_min_price)
+@router.message_handler(state=SearchBatchesStatesGroup.enter_min_price)
 async def search_min_price(message: types.Message, state: FSMContext):
     """Ввод минимальной цены при поиске"""
     try:
@@ -15569,7 +19197,8 @@ async def search_min_price(message: types.Message, state: FSMContext):
         await message.answer("❌ Некорректное значение. Введите число:")
 
 
-@dp.message_handler(state=SearchBatchesStatesGroup.enter_max_price)
+@router.message_handler(state=SearchBatchesStatesGroup.enter_max_price)
+@throttle("search")
 async def search_max_price(message: types.Message, state: FSMContext):
     """Завершение комплексного поиска"""
     try:
@@ -15599,10 +19228,10 @@ async def search_max_price(message: types.Message, state: FSMContext):
         await message.answer("❌ Некорректное значение. Введите число:")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("quality:"),
-    state=SearchBatchesStatesGroup.enter_quality_class,
+@router.callback_query_handler(
+    prefix="quality:", state=SearchBatchesStatesGroup.enter_quality_class
 )
+@throttle("search")
 async def search_by_quality(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора класса качества при поиске"""
     quality_class = callback.data.split(":", 1)[1]
@@ -15612,10 +19241,10 @@ async def search_by_quality(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("storage:"),
-    state=SearchBatchesStatesGroup.enter_storage_type,
+@router.callback_query_handler(
+    prefix="storage:", state=SearchBatchesStatesGroup.enter_storage_type
 )
+@throttle("search")
 async def search_by_storage(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора типа хранения при поиске"""
     storage_type = callback.data.split(":", 1)[1]
@@ -15709,7 +19338,7 @@ def matches_search_criteria(batch, search_params):
     return True
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("attach_files:"), state="*")
+@router.callback_query_handler(prefix="attach_files:", state="*")
 async def attach_files_start(callback: types.CallbackQuery, state: FSMContext):
     """Начало прикрепления файлов к партии"""
     batch_id = parse_callback_id(callback.data)
@@ -15743,7 +19372,7 @@ async def attach_files_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.message_handler(
+@router.message_handler(
     content_types=["photo", "document"], state=AttachFilesStatesGroup.upload_files
 )
 async def attach_files_upload(message: types.Message, state: FSMContext):
@@ -15779,8 +19408,7 @@ async def attach_files_upload(message: types.Message, state: FSMContext):
     if file_info:
         batch["files"].append(file_info)
         save_batches_to_pickle()
-        if gs and gs.spreadsheet:
-            gs.update_batch_in_sheets(batch)
+        sheets_outbox.upsert_batch(batch)
 
         await message.answer(
             f"✅ Файл добавлен ({len(batch['files'])} всего)\n"
@@ -15788,7 +19416,7 @@ async def attach_files_upload(message: types.Message, state: FSMContext):
         )
 
 
-@dp.message_handler(commands=["done"], state=AttachFilesStatesGroup.upload_files)
+@router.message_handler(commands=["done"], state=AttachFilesStatesGroup.upload_files)
 async def attach_files_done(message: types.Message, state: FSMContext):
     """Завершение прикрепления файлов"""
     data = await state.get_data()
@@ -15814,7 +19442,7 @@ async def attach_files_done(message: types.Message, state: FSMContext):
     await view_batch_details_direct(message, batch_id, user_id)
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("view_files:"), state="*")
+@router.callback_query_handler(prefix="view_files:", state="*")
 async def view_batch_files(callback: types.CallbackQuery):
     """Просмотр файлов партии"""
     batch_id = parse_callback_id(callback.data)
@@ -15863,7 +19491,7 @@ async def view_batch_files(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_pulls", state="*")
+@router.callback_query_handler(data="back_to_pulls", state="*")
 async def back_to_pulls(callback: types.CallbackQuery):
     """✅ Возврат к списку пулов (УНИВЕРСАЛЬНЫЙ для всех ролей)"""
 
@@ -15936,7 +19564,7 @@ async def back_to_pulls(callback: types.CallbackQuery):
                 # ДОБАВЛЯЕМ КНОПКУ
                 keyboard.add(
                     InlineKeyboardButton(
-                        button_text, callback_data=f"view_pull:{pull_id}"
+                        button_text, callback_data=VIEW_PULL_CB.pack(pull_id)
                     )
                 )
 
@@ -15993,7 +19621,7 @@ async def back_to_pulls(callback: types.CallbackQuery):
                 )
                 keyboard.add(
                     InlineKeyboardButton(
-                        button_text, callback_data=f"view_pull:{pull_id}"
+                        button_text, callback_data=VIEW_PULL_CB.pack(pull_id)
                     )
                 )
 
@@ -16033,8 +19661,8 @@ async def back_to_pulls(callback: types.CallbackQuery):
         )
 
 
-@dp.message_handler(commands=["stats"], state="*")
-@dp.message_handler(commands=["help"], state="*")
+@router.message_handler(commands=["stats"], state="*")
+@router.message_handler(commands=["help"], state="*")
 async def cmd_help(message: types.Message, state: FSMContext):
     """Справка по боту"""
     await state.finish()
@@ -16148,7 +19776,7 @@ async def cmd_help(message: types.Message, state: FSMContext):
     await message.answer(text, parse_mode="HTML")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_batch:"), state="*")
+@router.callback_query_handler(prefix="edit_batch:", state="*")
 async def start_edit_batch(callback: types.CallbackQuery, state: FSMContext):
     """Начало редактирования расширенной партии"""
     batch_id = parse_callback_id(callback.data)
@@ -16178,7 +19806,7 @@ async def start_edit_batch(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_field:"), state="*")
+@router.callback_query_handler(prefix="edit_field:", state="*")
 async def edit_batch_field_selected(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора поля для редактирования партии"""
     field = callback.data.split(":", 1)[1]
@@ -16235,9 +19863,7 @@ async def edit_batch_field_selected(callback: types.CallbackQuery, state: FSMCon
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("status:"), state=EditBatch.new_value
-)
+@router.callback_query_handler(prefix="status:", state=EditBatch.new_value)
 async def edit_batch_status_selected(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора статуса при редактировании партии"""
     new_status = callback.data.split(":", 1)[1]
@@ -16259,8 +19885,7 @@ async def edit_batch_status_selected(callback: types.CallbackQuery, state: FSMCo
     old_value = batch.get("status", "Не указан")
     batch["status"] = new_status
     save_batches_to_pickle()
-    if gs and gs.spreadsheet:
-        gs.update_batch_in_sheets(batch)
+    sheets_outbox.upsert_batch(batch)
 
     await state.finish()
     await callback.message.edit_text(
@@ -16274,9 +19899,7 @@ async def edit_batch_status_selected(callback: types.CallbackQuery, state: FSMCo
     await callback.answer("✅ Статус обновлён")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("quality:"), state=EditBatch.new_value
-)
+@router.callback_query_handler(prefix="quality:", state=EditBatch.new_value)
 async def edit_batch_quality_selected(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора класса качества при редактировании партии"""
     new_quality = callback.data.split(":", 1)[1]
@@ -16298,8 +19921,7 @@ async def edit_batch_quality_selected(callback: types.CallbackQuery, state: FSMC
     old_value = batch.get("quality_class", "Не указан")
     batch["quality_class"] = new_quality
     save_batches_to_pickle()
-    if gs and gs.spreadsheet:
-        gs.update_batch_in_sheets(batch)
+    sheets_outbox.upsert_batch(batch)
 
     await state.finish()
 
@@ -16314,9 +19936,7 @@ async def edit_batch_quality_selected(callback: types.CallbackQuery, state: FSMC
     await callback.answer("✅ Класс качества обновлён")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("storage:"), state=EditBatch.new_value
-)
+@router.callback_query_handler(prefix="storage:", state=EditBatch.new_value)
 async def edit_batch_storage_selected(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора типа хранения при редактировании партии"""
     new_storage = callback.data.split(":", 1)[1]
@@ -16338,8 +19958,7 @@ async def edit_batch_storage_selected(callback: types.CallbackQuery, state: FSMC
     old_value = batch.get("storage_type", "Не указан")
     batch["storage_type"] = new_storage
     save_batches_to_pickle()
-    if gs and gs.spreadsheet:
-        gs.update_batch_in_sheets(batch)
+    sheets_outbox.upsert_batch(batch)
 
     await state.finish()
 
@@ -16354,7 +19973,7 @@ async def edit_batch_storage_selected(callback: types.CallbackQuery, state: FSMC
     await callback.answer("✅ Тип хранения обновлён")
 
 
-@dp.message_handler(state=EditBatch.new_value)
+@router.message_handler(state=EditBatch.new_value)
 async def edit_batch_new_value(message: types.Message, state: FSMContext):
     """Обработка ввода нового значения для редактирования партии"""
     data = await state.get_data()
@@ -16418,8 +20037,7 @@ async def edit_batch_new_value(message: types.Message, state: FSMContext):
             old_value = batch.get(field, "Не указано")
             batch[field] = new_value
         save_batches_to_pickle()
-        if gs and gs.spreadsheet:
-            gs.update_batch_in_sheets(batch)
+        sheets_outbox.upsert_batch(batch)
 
         await state.finish()
         field_names_ru = {
@@ -16449,7 +20067,7 @@ async def edit_batch_new_value(message: types.Message, state: FSMContext):
         )
 
 
-@dp.callback_query_handler(lambda c: c.data == "edit_cancel", state="*")
+@router.callback_query_handler(data="edit_cancel", state="*")
 async def edit_cancel(callback: types.CallbackQuery, state: FSMContext):
     """Отмена редактирования"""
     await state.finish()
@@ -16457,7 +20075,7 @@ async def edit_cancel(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("delete_batch:"), state="*")
+@router.callback_query_handler(prefix="delete_batch:", state="*")
 async def delete_batch_start(callback: types.CallbackQuery, state: FSMContext):
     """Начало удаления партии"""
     batch_id = parse_callback_id(callback.data)
@@ -16495,9 +20113,7 @@ async def delete_batch_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("confirm_delete_batch:"), state="*"
-)
+@router.callback_query_handler(prefix="confirm_delete_batch:", state="*")
 async def delete_batch_confirmed(callback: types.CallbackQuery, state: FSMContext):
     """Подтверждение удаления партии - улучшенная версия"""
     await state.finish()
@@ -16556,7 +20172,7 @@ async def delete_batch_confirmed(callback: types.CallbackQuery, state: FSMContex
 
             # Пересчитываем current_volume
             new_volume = sum(b.get("volume", 0) for b in pull.get("batches", []))
-            pull["current_volume"] = new_volume
+            pull_fill.set_volume(pull.get("id", pull_id), pull, new_volume)
             logging.info(f"📉 Обновлен current_volume: {pull.get('current_volume')}")
 
             # Восстанавливаем статус, если пул больше не заполнен
@@ -16609,6 +20225,7 @@ async def delete_batch_confirmed(callback: types.CallbackQuery, state: FSMContex
                         f"🗑️ Удалено {old_len - new_len} участников с batch_id={batch_id} из pullparticipants[{key}]"
                     )
                     logging.info(f"   Осталось участников: {new_len}")
+        pull_fill.refresh(pull_id, all_pulls.get(pull_id))
 
     # Сохраняем данные, если пулы были изменены
     if removed_from_pulls:
@@ -16616,11 +20233,7 @@ async def delete_batch_confirmed(callback: types.CallbackQuery, state: FSMContex
         logging.info("✅ Пулы и участники сохранены")
 
     # Удаляем из Google Sheets, если интегрировано
-    if gs and hasattr(gs, "spreadsheet") and gs.spreadsheet:
-        try:
-            gs.delete_batch_from_sheets(batch_id)
-        except Exception as e:
-            logging.error(f"Ошибка Google Sheets: {e}")
+    sheets_outbox.delete_batch(batch_id)
 
     # Сообщаем пользователю об успешном удалении
     message = f"✅ Партия <b>#{batch_id}</b> удалена!"
@@ -16631,14 +20244,14 @@ async def delete_batch_confirmed(callback: types.CallbackQuery, state: FSMContex
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "cancel_delete_batch", state="*")
+@router.callback_query_handler(data="cancel_delete_batch", state="*")
 async def cancel_delete_batch(callback: types.CallbackQuery, state: FSMContext):
     """Отмена удаления партии и возврат к списку партий."""
     await state.finish()
     await back_to_my_batches(callback, state)
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("editfield_crop_"), state="*")
+@router.callback_query_handler(prefix="editfield_crop_", state="*")
 async def edit_crop_field(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик редактирования культуры"""
     await state.finish()
@@ -16691,7 +20304,7 @@ async def edit_crop_field(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("setcrop_"), state="*")
+@router.callback_query_handler(prefix="setcrop_", state="*")
 async def set_crop_value(callback: types.CallbackQuery, state: FSMContext):
     """Установка новой культуры"""
     await state.finish()
@@ -16738,7 +20351,7 @@ async def set_crop_value(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("✅ Культура обновлена!")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("editcancel_"), state="*")
+@router.callback_query_handler(prefix="editcancel_", state="*")
 async def cancel_edit_crop(callback: types.CallbackQuery, state: FSMContext):
     """Отмена редактирования культуры и возврат к карточке партии."""
     await state.finish()
@@ -16753,7 +20366,7 @@ async def cancel_edit_crop(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("✖️ Редактирование отменено")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("editpull_"), state="*")
+@router.callback_query_handler(prefix="editpull_", state="*")
 async def start_edit_pull(callback: types.CallbackQuery, state: FSMContext):
     """Начало редактирования пула"""
     try:
@@ -16796,7 +20409,7 @@ async def start_edit_pull(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_pull_field:"), state="*")
+@router.callback_query_handler(prefix="edit_pull_field:", state="*")
 async def edit_pull_field_selected(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора поля для редактирования пула"""
     field = callback.data.split(":", 1)[1]
@@ -16863,8 +20476,8 @@ async def edit_pull_field_selected(callback: types.CallbackQuery, state: FSMCont
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("culture:"), state=EditPullStatesGroup.edit_culture
+@router.callback_query_handler(
+    prefix="culture:", state=EditPullStatesGroup.edit_culture
 )
 async def edit_pull_culture(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора культуры при редактировании пула"""
@@ -16895,8 +20508,7 @@ async def edit_pull_culture(callback: types.CallbackQuery, state: FSMContext):
 
     save_pulls_to_pickle()
 
-    if gs and gs.spreadsheet:
-        gs.update_pull_in_sheets(pull)
+    sheets_outbox.upsert_pull(pull)
 
     await state.finish()
 
@@ -16911,9 +20523,7 @@ async def edit_pull_culture(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("✅ Культура обновлена")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("port:"), state=EditPullStatesGroup.edit_port
-)
+@router.callback_query_handler(prefix="port:", state=EditPullStatesGroup.edit_port)
 async def edit_pull_port(callback: types.CallbackQuery, state: FSMContext):
     """Обработка выбора порта при редактировании пула"""
     port_index = parse_callback_id(callback.data)
@@ -16971,8 +20581,7 @@ async def edit_pull_port(callback: types.CallbackQuery, state: FSMContext):
 
     save_pulls_to_pickle()
 
-    if gs and gs.spreadsheet:
-        gs.update_pull_in_sheets(pull)
+    sheets_outbox.upsert_pull(pull)
 
     await state.finish()
 
@@ -16987,37 +20596,37 @@ async def edit_pull_port(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("✅ Порт обновлён")
 
 
-@dp.message_handler(state=EditPullStatesGroup.edit_volume)
+@router.message_handler(state=EditPullStatesGroup.edit_volume)
 async def edit_pull_volume(message: types.Message, state: FSMContext):
     """Обработка ввода объёма при редактировании пула"""
     await edit_pull_numeric_field(message, state, "target_volume", "Объём")
 
 
-@dp.message_handler(state=EditPullStatesGroup.edit_price)
+@router.message_handler(state=EditPullStatesGroup.edit_price)
 async def edit_pull_price(message: types.Message, state: FSMContext):
     """Обработка ввода цены при редактировании пула"""
     await edit_pull_numeric_field(message, state, "price", "Цена")
 
 
-@dp.message_handler(state=EditPullStatesGroup.edit_moisture)
+@router.message_handler(state=EditPullStatesGroup.edit_moisture)
 async def edit_pull_moisture(message: types.Message, state: FSMContext):
     """Обработка ввода влажности при редактировании пула"""
     await edit_pull_numeric_field(message, state, "moisture", "Влажность", 0, 100)
 
 
-@dp.message_handler(state=EditPullStatesGroup.edit_nature)
+@router.message_handler(state=EditPullStatesGroup.edit_nature)
 async def edit_pull_nature(message: types.Message, state: FSMContext):
     """Обработка ввода натуры при редактировании пула"""
     await edit_pull_numeric_field(message, state, "nature", "Натура")
 
 
-@dp.message_handler(state=EditPullStatesGroup.edit_impurity)
+@router.message_handler(state=EditPullStatesGroup.edit_impurity)
 async def edit_pull_impurity(message: types.Message, state: FSMContext):
     """Обработка ввода сорности при редактировании пула"""
     await edit_pull_numeric_field(message, state, "impurity", "Сорность", 0, 100)
 
 
-@dp.message_handler(state=EditPullStatesGroup.edit_weed)
+@router.message_handler(state=EditPullStatesGroup.edit_weed)
 async def edit_pull_weed(message: types.Message, state: FSMContext):
     """Обработка ввода засорённости при редактировании пула"""
     await edit_pull_numeric_field(message, state, "weed", "Засорённость", 0, 100)
@@ -17065,11 +20674,13 @@ async def edit_pull_numeric_field(
 
         old_value = pull.get(field, 0)
         pull[field] = new_value
+        if field == "target_volume":
+            # Новый объём меняет процент заполнения и пороги
+            pull_fill.refresh(pull_id, pull)
 
         save_pulls_to_pickle()
 
-        if gs and gs.spreadsheet:
-            gs.update_pull_in_sheets(pull)
+        sheets_outbox.upsert_pull(pull)
 
         await state.finish()
 
@@ -17111,19 +20722,7 @@ async def debug_pull_deletion(pullid: int):
     # Проверка наличия в Google Sheets
     if gs and gs.spreadsheet:
         try:
-            worksheet = gs.spreadsheet.worksheet("Pulls")
-            all_values = worksheet.get_all_values()
-
-            found_in_sheets = False
-            for row in all_values[1:]:
-                if row and len(row) > 0:
-                    try:
-                        if int(row[0]) == pullid:
-                            found_in_sheets = True
-                            break
-                    except (ValueError, IndexError):
-                        continue
-
+            found_in_sheets = await find_sheet_row("Pulls", pullid) is not None
             logging.info(f"В Google Sheets: {found_in_sheets}")
         except Exception as e:
             logging.error(f"Ошибка проверки Google Sheets: {e}")
@@ -17168,17 +20767,10 @@ async def notify_logistic_pull_closed(pullid: int):
         )
 
         # Отправляем уведомления всем логистам
-        for logistic_id in logistics:
-            try:
-                await bot.send_message(logistic_id, message, parse_mode="HTML")
-                logging.info(
-                    f"Уведомление о закрытии пула {pullid} отправлено логисту {logistic_id}"
-                )
-            except Exception as e:
-                logging.error(f"Не удалось уведомить логиста {logistic_id}: {e}")
+        sent_count, _ = await notify_many(logistics, message, parse_mode="HTML")
 
         logging.info(
-            f"Уведомления о закрытии пула {pullid} отправлены {len(logistics)} логистам"
+            f"Уведомления о закрытии пула {pullid} отправлены {sent_count} логистам"
         )
 
     except Exception as e:
@@ -17186,7 +20778,7 @@ async def notify_logistic_pull_closed(pullid: int):
 
 
 # ==================== НАЧАЛО УДАЛЕНИЯ ПУЛА ====================
-@dp.callback_query_handler(lambda c: c.data.startswith("deletepull_"), state="*")
+@router.callback_query_handler(prefix="deletepull_", state="*")
 async def deletepullstart_callback(callback: types.CallbackQuery, state: FSMContext):
     """Запрос подтверждения удаления пула"""
     try:
@@ -17238,7 +20830,7 @@ async def deletepullstart_callback(callback: types.CallbackQuery, state: FSMCont
 
 
 # ==================== ПОДТВЕРЖДЕНИЕ УДАЛЕНИЯ ====================
-@dp.callback_query_handler(lambda c: c.data.startswith("confirmdeletepull_"), state="*")
+@router.callback_query_handler(prefix="confirmdeletepull_", state="*")
 async def deletepullconfirmed_callback(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -17320,6 +20912,8 @@ async def deletepullconfirmed_callback(
             f"🗑️ Удалено {participants_count} участников из pullparticipants[{str(pullid)}]"
         )
 
+    pull_fill.forget(pullid)
+
     # 3. ✅ ИСПРАВЛЕНО: Удаляем сам пул из pulls['pulls']
     all_pulls = pulls.get("pulls", {}) if isinstance(pulls, dict) else {}
     if pullid in all_pulls:
@@ -17354,45 +20948,25 @@ async def deletepullconfirmed_callback(
         save_batches_to_pickle()
 
     # ========== СИНХРОНИЗАЦИЯ С GOOGLE SHEETS ==========
-    if gs and gs.spreadsheet:
-        try:
-            worksheet = gs.spreadsheet.worksheet("Pulls")
-            all_values = worksheet.get_all_values()
-
-            rows_to_delete = []
-            for i, row in enumerate(all_values[1:], start=2):
-                if row and len(row) > 0:
-                    try:
-                        if int(row[0]) == pullid:
-                            rows_to_delete.append(i)
-                    except (ValueError, IndexError):
-                        continue
-
-            for row_num in reversed(rows_to_delete):
-                worksheet.delete_rows(row_num)
-
-            logging.info(f"Пул {pullid} удалён из Google Sheets")
-        except Exception as e:
-            logging.error(f"Ошибка удаления из Google Sheets: {e}")
+    sheets_outbox.delete_pull(pullid)
 
     # ========== УВЕДОМЛЕНИЯ ==========
 
-    # Уведомляем участников
+    # Уведомляем участников в фоне — экспортёр получает ответ сразу
     farmer_ids = pull.get("farmer_ids", [])
-    for farmer_id in farmer_ids:
-        try:
-            await bot.send_message(
-                farmer_id,
-                f"<b>🗑 Пул №{pullid} был удалён</b>\n\n"
-                "Экспортёр отменил пул:\n"
-                f"🌾 {pull_culture}\n"
-                f"📦 {pull_volume:.1f} т\n"
-                f"💰 ₽{pull_price:,.0f}/т\n\n"
-                'Ваша партия возвращена в статус "Активна"',
-                parse_mode="HTML",
-            )
-        except Exception as e:
-            logging.warning(f"⚠️ Уведомление фермеру {farmer_id}: {e}")
+    background_tasks.spawn(
+        "pull_deleted_notify",
+        notify_many(
+            farmer_ids,
+            f"<b>🗑 Пул №{pullid} был удалён</b>\n\n"
+            "Экспортёр отменил пул:\n"
+            f"🌾 {pull_culture}\n"
+            f"📦 {pull_volume:.1f} т\n"
+            f"💰 ₽{pull_price:,.0f}/т\n\n"
+            'Ваша партия возвращена в статус "Активна"',
+            parse_mode="HTML",
+        ),
+    )
 
     # ✅ ДОБАВЛЕНА ОДНА СТРОКА - создание клавиатуры
     keyboard = InlineKeyboardMarkup().add(
@@ -17420,7 +20994,7 @@ async def deletepullconfirmed_callback(
 
 
 # ==================== ОТМЕНА УДАЛЕНИЯ ====================
-@dp.callback_query_handler(lambda c: c.data == "canceldeletepull", state="*")
+@router.callback_query_handler(data="canceldeletepull", state="*")
 async def canceldeletepull_callback(callback: types.CallbackQuery, state: FSMContext):
     """✅ Отмена процесса удаления пула - ИСПРАВЛЕНО"""
 
@@ -17472,7 +21046,7 @@ async def canceldeletepull_callback(callback: types.CallbackQuery, state: FSMCon
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("close_pull:"), state="*")
+@router.callback_query_handler(prefix="close_pull:", state="*")
 async def close_pull_confirm(callback: types.CallbackQuery):
     """Подтверждение закрытия пула (НОВАЯ ФУНКЦИЯ)"""
     try:
@@ -17520,7 +21094,7 @@ async def close_pull_confirm(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("confirmclosepull_"), state="*")
+@router.callback_query_handler(prefix="confirmclosepull_", state="*")
 async def confirm_close_pull_callback(callback_query: types.CallbackQuery):
     """Совместимость: закрытие пула через единый обработчик статусов."""
     try:
@@ -17533,7 +21107,7 @@ async def confirm_close_pull_callback(callback_query: types.CallbackQuery):
     await confirm_pull_status(callback_query)
 
 
-@dp.callback_query_handler(lambda c: c.data == "cancel_delete_pull", state="*")
+@router.callback_query_handler(data="cancel_delete_pull", state="*")
 async def cancel_delete_pull(callback: types.CallbackQuery):
     """Отмена удаления пула"""
     await callback.message.edit_text("❌ Удаление отменено")
@@ -17543,7 +21117,7 @@ async def cancel_delete_pull(callback: types.CallbackQuery):
 # ================================
 # ОБРАБОТЧИК ЗАКРЫТИЯ ПУЛЛА
 # ================================
-@dp.callback_query_handler(lambda c: c.data == "get_partner_contacts", state="*")
+@router.callback_query_handler(data="get_partner_contacts", state="*")
 async def get_partner_contacts_handler(callback: types.CallbackQuery):
     """Получение контактов партнёра по сделке"""
     user_id = callback.from_user.id
@@ -17585,7 +21159,7 @@ async def get_partner_contacts_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("contact_partner:"), state="*")
+@router.callback_query_handler(prefix="contact_partner:", state="*")
 async def contact_partner_by_deal(callback: types.CallbackQuery):
     """Показать контакты участников конкретной сделки."""
     deal_id = parse_callback_id(callback.data)
@@ -17640,7 +21214,7 @@ async def contact_partner_by_deal(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("complete_deal:"), state="*")
+@router.callback_query_handler(prefix="complete_deal:", state="*")
 async def complete_deal(callback: types.CallbackQuery):
     """Завершение сделки"""
     deal_id = parse_callback_id(callback.data)
@@ -17687,9 +21261,7 @@ async def complete_deal(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("confirm_complete_deal:"), state="*"
-)
+@router.callback_query_handler(prefix="confirm_complete_deal:", state="*")
 async def confirm_complete_deal(callback: types.CallbackQuery):
     """Подтверждение завершения сделки"""
     deal_id = parse_callback_id(callback.data)
@@ -17731,7 +21303,7 @@ async def confirm_complete_deal(callback: types.CallbackQuery):
     await callback.answer("✅ Сделка завершена")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("cancel_deal:"), state="*")
+@router.callback_query_handler(prefix="cancel_deal:", state="*")
 async def cancel_deal(callback: types.CallbackQuery):
     """Отмена сделки"""
     deal_id = parse_callback_id(callback.data)
@@ -17773,9 +21345,7 @@ async def cancel_deal(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("confirm_cancel_deal:"), state="*"
-)
+@router.callback_query_handler(prefix="confirm_cancel_deal:", state="*")
 async def confirm_cancel_deal(callback: types.CallbackQuery):
     """Подтверждение отмены сделки"""
     deal_id = parse_callback_id(callback.data)
@@ -17812,8 +21382,8 @@ async def confirm_cancel_deal(callback: types.CallbackQuery):
     await callback.answer("✅ Сделка отменена")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data in ["cancel_complete_deal", "cancel_cancel_deal"], state="*"
+@router.callback_query_handler(
+    data=["cancel_complete_deal", "cancel_cancel_deal"], state="*"
 )
 async def cancel_deal_action(callback: types.CallbackQuery):
     """Отмена действия со сделкой"""
@@ -17836,26 +21406,14 @@ async def notify_deal_participants(deal_id: int, message: str):
         participants.append(deal["logistic_id"])
     if deal.get("expeditor_id"):
         participants.append(deal["expeditor_id"])
-    seen_participants = set()
-    for user_id in participants:
-        if user_id is None:
-            continue
-        participant_key = str(user_id)
-        if participant_key in seen_participants:
-            continue
-        seen_participants.add(participant_key)
-        try:
-            await bot.send_message(
-                user_id,
-                f"📋 <b>Уведомление по сделке #{deal_id}</b>\n\n{message}",
-                parse_mode="HTML",
-            )
-            await asyncio.sleep(0.1)  # Задержка между отправками
-        except Exception as e:
-            logging.error(f"❌ Ошибка уведомления пользователя {user_id}: {e}")
+    await notify_many(
+        participants,
+        f"📋 <b>Уведомление по сделке #{deal_id}</b>\n\n{message}",
+        parse_mode="HTML",
+    )
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("logistics:"), state="*")
+@router.callback_query_handler(prefix="logistics:", state="*")
 async def deal_logistics(callback: types.CallbackQuery):
     """Управление логистикой для сделки"""
     deal_id = parse_callback_id(callback.data)
@@ -17912,7 +21470,7 @@ async def deal_logistics(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("pullparticipants:"), state="*")
+@router.callback_query_handler(prefix="pullparticipants:", state="*")
 async def show_pullparticipants(callback: types.CallbackQuery):
     """Показать участников пула с ДЕТАЛЬНОЙ бизнес-информацией"""
     try:
@@ -18023,14 +21581,14 @@ async def show_pullparticipants(callback: types.CallbackQuery):
 
     keyboard = InlineKeyboardMarkup()
     keyboard.add(
-        InlineKeyboardButton("◀️ Назад к пулу", callback_data=f"view_pull:{pull_id}")
+        InlineKeyboardButton("◀️ Назад к пулу", callback_data=VIEW_PULL_CB.pack(pull_id))
     )
 
     await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("pull_logistics:"), state="*")
+@router.callback_query_handler(prefix="pull_logistics:", state="*")
 async def pull_logistics_menu(callback: types.CallbackQuery):
     """Меню логистики для пула"""
     try:
@@ -18113,14 +21671,14 @@ async def pull_logistics_menu(callback: types.CallbackQuery):
         ),
     )
     keyboard.add(
-        InlineKeyboardButton("◀️ Назад к пулу", callback_data=f"view_pull:{pull_id}")
+        InlineKeyboardButton("◀️ Назад к пулу", callback_data=VIEW_PULL_CB.pack(pull_id))
     )
 
     await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("create_shipping:"), state="*")
+@router.callback_query_handler(prefix="create_shipping:", state="*")
 async def create_shipping_from_pull(callback: types.CallbackQuery, state: FSMContext):
     """Создание заявки на логистику из пула"""
     try:
@@ -18193,7 +21751,7 @@ async def create_shipping_from_pull(callback: types.CallbackQuery, state: FSMCon
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "view_logistics_contacts", state="*")
+@router.callback_query_handler(data="view_logistics_contacts", state="*")
 async def view_logistics_contacts(callback: types.CallbackQuery):
     """Показать контакты логистов с реквизитами"""
     user_id = callback.from_user.id
@@ -18243,9 +21801,7 @@ async def view_logistics_contacts(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.message_handler(
-    lambda m: m.text in ["🚚 Моя карточка", "🚛 Моя карточка"], state="*"
-)
+@router.message_handler(text=["🚚 Моя карточка", "🚛 Моя карточка"], state="*")
 async def show_logistics_card(message: types.Message):
     """Показать карточку логиста/экспедитора"""
     user_id = message.from_user.id
@@ -18364,7 +21920,7 @@ async def show_logistics_card(message: types.Message):
     await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
 
 
-@dp.message_handler(lambda m: m.text == "🚚 Активные заявки", state="*")
+@router.message_handler(text="🚚 Активные заявки", state="*")
 async def show_active_requests(message: types.Message, state: FSMContext):
     """Показать активные заявки на доставку - ОБЪЕДИНЁННО для логиста/экспортёра/экспедитора"""
     await state.finish()
@@ -18785,9 +22341,7 @@ async def show_active_requests(message: types.Message, state: FSMContext):
         await message.answer(text, parse_mode="HTML")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("expeditor_respond_exporter_request:"), state="*"
-)
+@router.callback_query_handler(prefix="expeditor_respond_exporter_request:", state="*")
 async def expeditor_respond_exporter_request(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -18904,7 +22458,7 @@ async def expeditor_respond_exporter_request(
     await callback.answer()
 
 
-@dp.message_handler(state=ExpeditorOfferForRequestStates.enter_terms)
+@router.message_handler(state=ExpeditorOfferForRequestStates.enter_terms)
 async def exp_req_enter_terms(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     user_role = (get_user_by_id(user_id) or {}).get("role")
@@ -18926,7 +22480,7 @@ async def exp_req_enter_terms(message: types.Message, state: FSMContext):
     await ExpeditorOfferForRequestStates.enter_price.set()
 
 
-@dp.message_handler(state=ExpeditorOfferForRequestStates.enter_price)
+@router.message_handler(state=ExpeditorOfferForRequestStates.enter_price)
 async def exp_req_enter_price(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     user_role = (get_user_by_id(user_id) or {}).get("role")
@@ -19176,9 +22730,7 @@ async def notify_exporter_about_expeditor_request_offer(req: dict, offer: dict):
         )
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_expeditor_offers_for_request:"), state="*"
-)
+@router.callback_query_handler(prefix="view_expeditor_offers_for_request:", state="*")
 async def view_expeditor_offers_for_request(callback: types.CallbackQuery):
     """Владелец смотрит все предложения экспедиторов по заявке."""
     try:
@@ -19329,9 +22881,7 @@ async def view_expeditor_offers_for_request(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_expeditor_offer_for_request:"), state="*"
-)
+@router.callback_query_handler(prefix="view_expeditor_offer_for_request:", state="*")
 async def view_expeditor_offer_for_request(callback: types.CallbackQuery):
     """Детали оффера экспедитора по заявке."""
     try:
@@ -19481,9 +23031,7 @@ async def view_expeditor_offer_for_request(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_shipping_request:"), state="*"
-)
+@router.callback_query_handler(prefix="view_shipping_request:", state="*")
 async def view_shipping_request(callback: types.CallbackQuery, state: FSMContext):
     """Просмотр заявки на логистику (экспортёр, логист, экспедитор)."""
     await state.finish()
@@ -19635,9 +23183,7 @@ async def view_shipping_request(callback: types.CallbackQuery, state: FSMContext
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("logistic_respond_request:"), state="*"
-)
+@router.callback_query_handler(prefix="logistic_respond_request:", state="*")
 async def logistic_respond_exporter_request(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -19665,7 +23211,7 @@ async def logistic_respond_exporter_request(
     await make_offer_start(callback, state)
 
 
-@dp.message_handler(state=LogisticOfferForExporterRequestStates.enter_terms)
+@router.message_handler(state=LogisticOfferForExporterRequestStates.enter_terms)
 async def logistic_exporter_enter_terms(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     user_role = (get_user_by_id(user_id) or {}).get("role")
@@ -19684,7 +23230,7 @@ async def logistic_exporter_enter_terms(message: types.Message, state: FSMContex
     await LogisticOfferForExporterRequestStates.enter_price.set()
 
 
-@dp.message_handler(state=LogisticOfferForExporterRequestStates.enter_price)
+@router.message_handler(state=LogisticOfferForExporterRequestStates.enter_price)
 async def logistic_exporter_enter_price(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     user_role = (get_user_by_id(user_id) or {}).get("role")
@@ -19846,9 +23392,7 @@ async def notify_exporter_about_logistic_request_offer(req: dict, offer: dict):
     await bot.send_message(exporter_id, msg, reply_markup=kb, parse_mode="HTML")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_logistic_offers_for_request:"), state="*"
-)
+@router.callback_query_handler(prefix="view_logistic_offers_for_request:", state="*")
 async def view_logistic_offers_for_request(callback: types.CallbackQuery):
     """Экспортёр смотрит все предложения логистов по своей заявке."""
     try:
@@ -19914,6 +23458,24 @@ async def view_logistic_offers_for_request(callback: types.CallbackQuery):
     if hidden_count > 0:
         text += f"🗃 В архиве: <b>{hidden_count}</b>\n"
 
+    # Расчётная стоимость по тарифам карточек против предложенной цены
+    estimate = estimate_freight_for_request(req)
+    if estimate["distance_km"] is not None:
+        text += f"\n📐 Расстояние: ~{estimate['distance_km']:,.0f} км".replace(",", " ")
+    if estimate["median_per_ton"]:
+        text += (
+            f"\n📊 Рынок по карточкам: ~{estimate['median_per_ton']:,.0f} ₽/т".replace(",", " ")
+        )
+    text += "\n\n<b>Предложено / расчёт:</b>\n"
+    for offer in offers:
+        company = offer.get("company", "Логист")
+        price = safe_float(offer.get("price"))
+        estimated = get_estimated_per_ton(estimate, get_offer_logist_id(offer))
+        text += (
+            f"• {company}: {price:,.0f} ₽/т".replace(",", " ")
+            + f" • {format_estimate_vs_offer(price, estimated)}\n"
+        )
+
     kb = InlineKeyboardMarkup(row_width=1)
     for offer in offers:
         offer_id = offer.get("id")
@@ -19941,9 +23503,7 @@ async def view_logistic_offers_for_request(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_logistic_offer_for_request:"), state="*"
-)
+@router.callback_query_handler(prefix="view_logistic_offer_for_request:", state="*")
 async def view_logistic_offer_for_request(callback: types.CallbackQuery):
     try:
         raw_offer_id = callback.data.split(":", 1)[1]
@@ -20044,9 +23604,7 @@ async def view_logistic_offer_for_request(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("choose_logistic_offer_for_request:"), state="*"
-)
+@router.callback_query_handler(prefix="choose_logistic_offer_for_request:", state="*")
 async def choose_logistic_offer_for_request(callback: types.CallbackQuery):
     """Экспортёр выбирает логиста по заявке."""
     try:
@@ -20216,9 +23774,7 @@ async def choose_logistic_offer_for_request(callback: types.CallbackQuery):
     await callback.answer("✅ Логист назначен")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("choose_expeditor_offer_for_request:"), state="*"
-)
+@router.callback_query_handler(prefix="choose_expeditor_offer_for_request:", state="*")
 async def choose_expeditor_offer_for_request(callback: types.CallbackQuery):
     try:
         parts = callback.data.split(":")
@@ -20524,7 +24080,7 @@ async def choose_expeditor_offer_for_request(callback: types.CallbackQuery):
 # ═══════════════════════════════════════════════════════════════════════════
 # ЭКСПЕДИТОР: МОЯ КАРТОЧКА
 # ═══════════════════════════════════════════════════════════════════════════
-@dp.message_handler(lambda m: m.text == "💳 Моя карточка", state="*")
+@router.message_handler(text="💳 Моя карточка", state="*")
 async def show_expeditor_card(message: types.Message, state: FSMContext):
     """Экспедитор смотрит/редактирует свою карточку (новая модель expeditor_cards)."""
     await state.finish()
@@ -20599,7 +24155,7 @@ async def show_expeditor_card(message: types.Message, state: FSMContext):
 # ═══════════════════════════════════════════════════════════════════════════
 # УДАЛЕНИЕ КАРТОЧКИ
 # ═══════════════════════════════════════════════════════════════════════════
-@dp.callback_query_handler(lambda c: c.data == "delete_expeditor_card", state="*")
+@router.callback_query_handler(data="delete_expeditor_card", state="*")
 async def delete_expeditor_card(callback: types.CallbackQuery):
     """Удаление карточки экспедитора"""
     user_id = callback.from_user.id
@@ -20618,7 +24174,7 @@ async def delete_expeditor_card(callback: types.CallbackQuery):
         await callback.answer("❌ Карточка не найдена", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data == "expeditor_my_card", state="*")
+@router.callback_query_handler(data="expeditor_my_card", state="*")
 async def expeditor_my_card(callback: types.CallbackQuery, state: FSMContext):
     """Показать карточку экспедитора по кнопке '◀️ К карточке'."""
     await state.finish()
@@ -20689,7 +24245,7 @@ async def expeditor_my_card(callback: types.CallbackQuery, state: FSMContext):
 # ═══════════════════════════════════════════════════════════════════════════
 # ОТМЕНА СОЗДАНИЯ
 # ═══════════════════════════════════════════════════════════════════════════
-@dp.callback_query_handler(lambda c: c.data.startswith("view_request:"), state="*")
+@router.callback_query_handler(prefix="view_request:", state="*")
 async def view_request_details(callback: types.CallbackQuery, state: FSMContext):
     """Просмотр деталей заявки - универсальный для экспортёров и фермеров"""
     await state.finish()
@@ -21055,7 +24611,7 @@ def get_offer_status_display(status: str) -> str:
 # ═══════════════════════════════════════════════════════════════════════════
 # ЛОГИСТ: БАЗА ЭКСПЕДИТОРОВ
 # ═══════════════════════════════════════════════════════════════════════════
-@dp.message_handler(lambda m: m.text == "🚛 База экспедиторов", state="*")
+@router.message_handler(text="🚛 База экспедиторов", state="*")
 async def logist_view_expeditors(message: types.Message, state: FSMContext):
     """Логист просматривает базу экспедиторов"""
     await state.finish()
@@ -21117,7 +24673,7 @@ async def logist_view_expeditors(message: types.Message, state: FSMContext):
 # ═══════════════════════════════════════════════════════════════════════════
 
 
-@dp.message_handler(lambda m: m.text == "🚚 Доступные заявки", state="*")
+@router.message_handler(text="🚚 Доступные заявки", state="*")
 async def expeditor_view_available_requests(message: types.Message, state: FSMContext):
     """Экспедитор просматривает доступные заявки от логистов"""
     await state.finish()
@@ -21282,7 +24838,7 @@ async def expeditor_view_available_requests(message: types.Message, state: FSMCo
     await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("exp_view_req:"), state="*")
+@router.callback_query_handler(prefix="exp_view_req:", state="*")
 async def expeditor_view_request_details(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -21405,7 +24961,7 @@ async def expeditor_view_request_details(
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("exp_accept:"), state="*")
+@router.callback_query_handler(prefix="exp_accept:", state="*")
 async def expeditor_accept_request(callback: types.CallbackQuery, state: FSMContext):
     """Экспедитор принимает заявку"""
     try:
@@ -21583,7 +25139,7 @@ async def expeditor_accept_request(callback: types.CallbackQuery, state: FSMCont
     logging.info(f"✅ Экспедитор {expeditor_id} принял заявку {request_id}")
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_exp_requests", state="*")
+@router.callback_query_handler(data="back_to_exp_requests", state="*")
 async def back_to_exp_requests(callback: types.CallbackQuery, state: FSMContext):
     """Возврат к списку доступных заявок"""
     await state.finish()
@@ -21745,12 +25301,10 @@ async def back_to_exp_requests(callback: types.CallbackQuery, state: FSMContext)
     await callback.answer()
 
 
-@dp.message_handler(
-    lambda m: m.text == "🚛 Мои доставки"
-    and (
-        is_logistic_role((get_user_by_id(m.from_user.id) or {}).get("role"))
-        or is_expeditor_role((get_user_by_id(m.from_user.id) or {}).get("role"))
-    ),
+@router.message_handler(
+    lambda m: is_logistic_role((get_user_by_id(m.from_user.id) or {}).get("role"))
+    or is_expeditor_role((get_user_by_id(m.from_user.id) or {}).get("role")),
+    text="🚛 Мои доставки",
     state="*",
 )
 async def my_deliveries_handler(message: types.Message, state: FSMContext):
@@ -22015,7 +25569,7 @@ async def my_deliveries_handler(message: types.Message, state: FSMContext):
         )
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("exp_delivery:"), state="*")
+@router.callback_query_handler(prefix="exp_delivery:", state="*")
 async def expeditor_delivery_details(callback: types.CallbackQuery, state: FSMContext):
     """Детали активной доставки для экспедитора по deliveries/legacy shipping_requests."""
     await state.finish()
@@ -22247,7 +25801,7 @@ async def expeditor_delivery_details(callback: types.CallbackQuery, state: FSMCo
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("exp_complete:"), state="*")
+@router.callback_query_handler(prefix="exp_complete:", state="*")
 async def expeditor_complete_delivery(callback: types.CallbackQuery, state: FSMContext):
     """
     ✅ Завершение доставки экспедитором и сохранение завершённой сделки в Google Sheets.
@@ -22970,79 +26524,87 @@ async def expeditor_complete_delivery(callback: types.CallbackQuery, state: FSMC
     await callback.answer()
 
 
+def completed_deal_row(pull_id, request_id):
+    """Строка вкладки 'Завершенные сделки' для пула и заявки доставки (или None)."""
+    # 1. Находим пул
+    _, pull = find_pull_by_id(pull_id)
+
+    if not pull:
+        logging.error(f"❌ save_completed_deal_to_sheets: пул {pull_id} не найден")
+        return None
+
+    # 2. Находим заявку доставки
+    _, request = find_shipping_request_by_id(request_id)
+    if not request:
+        logging.error(
+            f"❌ save_completed_deal_to_sheets: заявка {request_id} не найдена"
+        )
+        return None
+
+    # 3. Достаём IDs участников
+    exporter_id = pull.get("exporter_id") or pull.get("creator_id")
+    farmer_id = request.get("farmer_id")
+    logist_id = get_assigned_logist_id(request)
+    expeditor_id = get_assigned_expeditor_id(request)
+
+    def uname(uid):
+        if not uid:
+            return ""
+        u = get_user_by_id(uid) or {}
+        return u.get("company_name") or u.get("name") or str(uid)
+
+    exporter_name = uname(exporter_id)
+    farmer_name = uname(farmer_id)
+    logist_name = uname(logist_id)
+    expeditor_name = uname(expeditor_id)
+
+    # 4. Бизнес‑поля сделки
+    culture = pull.get("culture", "")
+    port = pull.get("port", "")
+    doc_type = pull.get("doc_type", "")
+    documents = pull.get("documents", "")
+    pull_price = pull.get("price") or pull.get("price_per_ton") or 0
+    pull_volume = pull.get("target_volume") or 0
+
+    shipped_volume = request.get("volume") or request.get("shipped_volume") or 0
+    freight_price = request.get("price") or request.get("freight_price") or 0
+    status = request.get("status", "completed")
+    completed_at = request.get(
+        "completed_at", datetime.now().strftime("%d.%m.%Y %H:%M")
+    )
+
+    # 5. Строка для Google Sheets
+    row = [
+        completed_at,  # Дата завершения
+        int(pull_id),  # ID пула
+        int(request_id),  # ID заявки доставки
+        culture,  # Культура
+        port,  # Порт
+        doc_type,  # Тип поставки
+        documents,  # Документы
+        pull_volume,  # Объём пула, т
+        pull_price,  # Цена пула, ₽/т
+        shipped_volume,  # Отгруженный объём, т
+        freight_price,  # Ставка фрахта, ₽/т
+        status,  # Статус сделки
+        exporter_name,  # Экспортёр
+        farmer_name,  # Фермер
+        logist_name,  # Логист
+        expeditor_name,  # Экспедитор
+    ]
+    return row
+
+
 async def save_completed_deal_to_sheets(pull_id: int, request_id: int) -> bool:
     """
     Сохраняет завершённую сделку (пул + заявка на доставку) на вкладку
     'Завершенные сделки' в Google Sheets.
     """
     try:
-        # 1. Находим пул
-        _, pull = find_pull_by_id(pull_id)
-
-        if not pull:
-            logging.error(f"❌ save_completed_deal_to_sheets: пул {pull_id} не найден")
+        row = completed_deal_row(pull_id, request_id)
+        if row is None:
             return False
 
-        # 2. Находим заявку доставки
-        _, request = find_shipping_request_by_id(request_id)
-        if not request:
-            logging.error(
-                f"❌ save_completed_deal_to_sheets: заявка {request_id} не найдена"
-            )
-            return False
-
-        # 3. Достаём IDs участников
-        exporter_id = pull.get("exporter_id") or pull.get("creator_id")
-        farmer_id = request.get("farmer_id")
-        logist_id = get_assigned_logist_id(request)
-        expeditor_id = get_assigned_expeditor_id(request)
-
-        def uname(uid):
-            if not uid:
-                return ""
-            u = get_user_by_id(uid) or {}
-            return u.get("company_name") or u.get("name") or str(uid)
-
-        exporter_name = uname(exporter_id)
-        farmer_name = uname(farmer_id)
-        logist_name = uname(logist_id)
-        expeditor_name = uname(expeditor_id)
-
-        # 4. Бизнес‑поля сделки
-        culture = pull.get("culture", "")
-        port = pull.get("port", "")
-        doc_type = pull.get("doc_type", "")
-        documents = pull.get("documents", "")
-        pull_price = pull.get("price") or pull.get("price_per_ton") or 0
-        pull_volume = pull.get("target_volume") or 0
-
-        shipped_volume = request.get("volume") or request.get("shipped_volume") or 0
-        freight_price = request.get("price") or request.get("freight_price") or 0
-        status = request.get("status", "completed")
-        completed_at = request.get(
-            "completed_at", datetime.now().strftime("%d.%m.%Y %H:%M")
-        )
-
-        # 5. Строка для Google Sheets
-        row = [
-            completed_at,  # Дата завершения
-            int(pull_id),  # ID пула
-            int(request_id),  # ID заявки доставки
-            culture,  # Культура
-            port,  # Порт
-            doc_type,  # Тип поставки
-            documents,  # Документы
-            pull_volume,  # Объём пула, т
-            pull_price,  # Цена пула, ₽/т
-            shipped_volume,  # Отгруженный объём, т
-            freight_price,  # Ставка фрахта, ₽/т
-            status,  # Статус сделки
-            exporter_name,  # Экспортёр
-            farmer_name,  # Фермер
-            logist_name,  # Логист
-            expeditor_name,  # Экспедитор
-        ]
-
         # 6. Запись в Google Sheets
         if not gs or not getattr(gs, "spreadsheet", None):
             logging.error(
@@ -23050,13 +26612,17 @@ async def save_completed_deal_to_sheets(pull_id: int, request_id: int) -> bool:
             )
             return False
 
-        try:
-            ws = gs.spreadsheet.worksheet("Завершенные сделки")
-        except Exception:
-            logging.error("❌ Лист 'Завершенные сделки' не найден в Google Sheets")
+        if sheets_outbox.breaker.is_open:
+            # Google недоступен: не ждём таймаутов, сделку допишет сверка
+            logging.warning(
+                f"⚠️ save_completed_deal_to_sheets: Google API недоступен, сделка "
+                f"по пулу {pull_id} будет дописана при сверке"
+            )
             return False
 
-        ws.append_row(row, value_input_option="USER_ENTERED")
+        loop = asyncio.get_event_loop()
+        async with sheets_outbox.io_lock:
+            await loop.run_in_executor(None, gs.append_completed_deal, row)
         logging.info(
             f"✅ save_completed_deal_to_sheets: сделка по пулу {pull_id}, заявке {request_id} "
             "записана в 'Завершенные сделки'"
@@ -23074,7 +26640,7 @@ async def save_completed_deal_to_sheets(pull_id: int, request_id: int) -> bool:
 # ═══════════════════════════════════════════════════════════════════════════
 # ЭКСПЕДИТОР: ИСТОРИЯ ДОСТАВОК
 # ═══════════════════════════════════════════════════════════════════════════
-@dp.message_handler(lambda m: m.text == "✔️ История доставок", state="*")
+@router.message_handler(text="✔️ История доставок", state="*")
 async def expeditor_delivery_history(message: types.Message, state: FSMContext):
     """История завершённых доставок"""
     await state.finish()
@@ -23171,7 +26737,7 @@ async def expeditor_delivery_history(message: types.Message, state: FSMContext):
     await message.answer(text, parse_mode="HTML")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("view_expeditor:"), state="*")
+@router.callback_query_handler(prefix="view_expeditor:", state="*")
 async def logist_view_expeditor_card(callback: types.CallbackQuery, state: FSMContext):
     """Просмотр карточки экспедитора логистом"""
     await state.finish()
@@ -23276,7 +26842,7 @@ async def logist_view_expeditor_card(callback: types.CallbackQuery, state: FSMCo
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("send_message_to:"), state="*")
+@router.callback_query_handler(prefix="send_message_to:", state="*")
 async def send_message_to_expeditor(callback: types.CallbackQuery):
     """Показать контакты экспедитора, если нет username-кнопки."""
     user_id = callback.from_user.id
@@ -23306,7 +26872,7 @@ async def send_message_to_expeditor(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_expeditors", state="*")
+@router.callback_query_handler(data="back_to_expeditors", state="*")
 async def back_to_expeditors(callback: types.CallbackQuery, state: FSMContext):
     """Возврат к списку экспедиторов"""
     await state.finish()
@@ -23362,9 +26928,7 @@ async def back_to_expeditors(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_shipping_requests:"), state="*"
-)
+@router.callback_query_handler(prefix="view_shipping_requests:", state="*")
 async def view_shipping_requests_callback(callback: CallbackQuery):
     """Просмотр заявок на доставку для конкретного пула"""
     pull_id = parse_callback_id(callback.data)
@@ -23419,7 +26983,7 @@ async def view_shipping_requests_callback(callback: CallbackQuery):
         )
 
     keyboard.add(
-        InlineKeyboardButton("🔙 Назад к пулу", callback_data=f"view_pull:{pull_id}")
+        InlineKeyboardButton("🔙 Назад к пулу", callback_data=VIEW_PULL_CB.pack(pull_id))
     )
 
     await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
@@ -23431,9 +26995,7 @@ async def view_shipping_requests_callback(callback: CallbackQuery):
 # ═══════════════════════════════════════════════════════════════════════════
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_logist_request:"), state="*"
-)
+@router.callback_query_handler(prefix="view_logist_request:", state="*")
 async def view_logist_request_details(callback: CallbackQuery):
     """Legacy-совместимость: перенаправление на актуальный просмотр заявки."""
     try:
@@ -23454,7 +27016,7 @@ async def view_logist_request_details(callback: CallbackQuery):
     await view_shipping_request(callback, state=state)
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("select_logist:"), state="*")
+@router.callback_query_handler(prefix="select_logist:", state="*")
 async def select_logist_for_pull(callback: CallbackQuery):
     """Экспортёр выбирает логиста для перевозки"""
     try:
@@ -23638,67 +27200,267 @@ def edit_pull_fields_keyboard():
     return keyboard
 
 
-async def send_daily_stats():
-    """Ежедневная отправка статистики админу"""
+# ════════════════════════════════════════════════════════════════════
+# ТЯЖЁЛЫЕ ФОНОВЫЕ ЗАДАЧИ В ПУЛЕ ПРОЦЕССОВ
+# ════════════════════════════════════════════════════════════════════
+# Схема запуска: снимок хранилищ (на event loop, без await) ->
+# вычисление в ProcessPoolExecutor -> применение результатов на event loop.
+# Снимок состоит только из кортежей примитивов: он неизменяем, дёшево
+# сериализуется и не зависит от того, что хендлеры меняют во время расчёта.
+
+cpu_job_executor = None
+cpu_job_tasks = {}  # job_name -> asyncio.Task текущего запуска
+cpu_job_metrics = {}  # job_name -> счётчики и тайминги
+
+
+def get_cpu_job_executor():
+    """Ленивая инициализация пула процессов для тяжёлых задач."""
+    global cpu_job_executor
+    if cpu_job_executor is None:
+        mp_context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            # fork не переимпортирует main.py в воркере
+            mp_context = multiprocessing.get_context("fork")
+        cpu_job_executor = ProcessPoolExecutor(
+            max_workers=CONFIG.get("cpu_jobs_workers", 2), mp_context=mp_context
+        )
+        logging.info(
+            f"✅ Пул процессов для фоновых задач: {CONFIG.get('cpu_jobs_workers', 2)} воркер(а)"
+        )
+    return cpu_job_executor
+
+
+def shutdown_cpu_job_executor():
+    """Останавливает пул процессов, отменяя ещё не начатые задачи."""
+    global cpu_job_executor
+    if cpu_job_executor is None:
+        return
+    cpu_job_executor.shutdown(wait=False, cancel_futures=True)
+    cpu_job_executor = None
+
+
+def get_cpu_job_metrics(job_name: str) -> dict:
+    """Счётчики задачи (создаются при первом обращении)."""
+    return cpu_job_metrics.setdefault(
+        job_name,
+        {
+            "runs": 0,
+            "ok": 0,
+            "failed": 0,
+            "timeouts": 0,
+            "cancelled": 0,
+            "skipped": 0,
+            "last_status": None,
+            "last_started": None,
+            "last_ms": {},
+            "max_total_ms": 0.0,
+            "sum_total_ms": 0.0,
+        },
+    )
+
+
+async def run_cpu_job(job_name, snapshot_func, compute_func, apply_func, timeout=None):
+    """
+    Запускает тяжёлую задачу: snapshot_func() -> compute_func(*snapshot) в пуле
+    процессов -> await apply_func(result) на event loop.
+
+    Параллельный повторный запуск той же задачи пропускается. По таймауту
+    результат отбрасывается (воркер дорабатывает вхолостую), apply не вызывается.
+    """
+    metrics = get_cpu_job_metrics(job_name)
+    running = cpu_job_tasks.get(job_name)
+    if running is not None and not running.done():
+        metrics["skipped"] += 1
+        logging.warning(f"⏭ Задача {job_name} ещё выполняется, запуск пропущен")
+        return None
+
+    if timeout is None:
+        timeout = CONFIG.get("cpu_job_timeout", 120)
+
+    task = asyncio.ensure_future(
+        _execute_cpu_job(job_name, snapshot_func, compute_func, apply_func, timeout)
+    )
+    cpu_job_tasks[job_name] = task
     try:
-        total_users = len(users)
-        role_stats = defaultdict(int)
+        return await task
+    finally:
+        if cpu_job_tasks.get(job_name) is task:
+            cpu_job_tasks.pop(job_name, None)
 
-        # ✅ ПРАВИЛЬНО: итерируемся по user_data
-        for user in users.values():
-            if not isinstance(user, dict):
-                continue
-            role = user.get("role", "unknown")
-            role_stats[role] += 1
 
-        # ✅ ИСПРАВЛЕНО: правильный подсчёт партий
-        total_batches = count_all_batches()
+async def _execute_cpu_job(job_name, snapshot_func, compute_func, apply_func, timeout):
+    global cpu_job_executor
+    metrics = get_cpu_job_metrics(job_name)
+    metrics["runs"] += 1
+    metrics["last_started"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timings = {}
+    status = "failed"
+    started = time.perf_counter()
 
-        # ✅ ИСПРАВЛЕНО: правильный подсчёт активных партий
-        active_batches = sum(
-            1
-            for _, _, batch in iter_all_batches()
-            if status_in_group(
-                batch.get("status"),
-                {"active", "активна", "available", "доступна", "", "none"},
-            )
+    try:
+        stage = time.perf_counter()
+        snapshot = snapshot_func()
+        timings["snapshot"] = (time.perf_counter() - stage) * 1000
+
+        stage = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(get_cpu_job_executor(), compute_func, *snapshot)
+        result = await asyncio.wait_for(future, timeout)
+        timings["compute"] = (time.perf_counter() - stage) * 1000
+
+        stage = time.perf_counter()
+        applied = await apply_func(result)
+        timings["apply"] = (time.perf_counter() - stage) * 1000
+
+        status = "ok"
+        return applied
+
+    except asyncio.TimeoutError:
+        status = "timeout"
+        logging.error(f"⏱ Задача {job_name} превысила таймаут {timeout} с")
+        return None
+    except asyncio.CancelledError:
+        status = "cancelled"
+        logging.warning(f"⏹ Задача {job_name} отменена")
+        raise
+    except BrokenProcessPool as e:
+        # Пул умер (OOM, kill воркера) — пересоздадим при следующем запуске
+        logging.error(f"❌ Пул процессов сломан в задаче {job_name}: {e}")
+        cpu_job_executor = None
+        return None
+    except Exception as e:
+        logging.error(f"❌ Ошибка фоновой задачи {job_name}: {e}", exc_info=True)
+        return None
+    finally:
+        timings["total"] = (time.perf_counter() - started) * 1000
+        counter_key = {"ok": "ok", "timeout": "timeouts", "cancelled": "cancelled"}
+        metrics[counter_key.get(status, "failed")] += 1
+        metrics["last_status"] = status
+        metrics["last_ms"] = timings
+        metrics["sum_total_ms"] += timings["total"]
+        metrics["max_total_ms"] = max(metrics["max_total_ms"], timings["total"])
+        logging.info(
+            f"⚙️ {job_name}: {status}, "
+            + ", ".join(f"{k}={v:.1f} мс" for k, v in timings.items())
         )
 
-        all_pulls = pulls.get("pulls", pulls) if isinstance(pulls, dict) else {}
-        total_pulls = len(all_pulls)
-        open_pulls = len(
-            [
-                p
-                for p in all_pulls.values()
-                if isinstance(p, dict) and is_pull_open_status(p.get("status"))
-            ]
+
+def cancel_cpu_jobs():
+    """Отменяет все выполняющиеся тяжёлые задачи."""
+    cancelled = 0
+    for task in list(cpu_job_tasks.values()):
+        if not task.done():
+            task.cancel()
+            cancelled += 1
+    return cancelled
+
+
+def format_cpu_job_metrics() -> str:
+    """Блок статистики фоновых задач для админ-панели."""
+    if not cpu_job_metrics:
+        return ""
+    msg = "⚙️ <b>Фоновые задачи:</b>\n"
+    for job_name, m in sorted(cpu_job_metrics.items()):
+        done = m["ok"] + m["failed"] + m["timeouts"] + m["cancelled"]
+        avg_ms = m["sum_total_ms"] / done if done else 0
+        last_ms = m["last_ms"].get("total", 0)
+        msg += (
+            f"• {job_name}: {m['ok']}/{m['runs']} ок, "
+            f"ошибок {m['failed']}, таймаутов {m['timeouts']}; "
+            f"посл. {last_ms:.0f} мс, ср. {avg_ms:.0f} мс, макс. {m['max_total_ms']:.0f} мс\n"
         )
-        total_deals = len(deals)
-        active_deals = len(
-            [
-                d
-                for d in deals.values()
-                if d.get("status") in ["pending", "matched", "shipping"]
-            ]
+    return msg
+
+
+def snapshot_user_roles():
+    """Снимок ролей пользователей: ((user_id, role), ...)."""
+    return tuple(
+        (user_id, str(user.get("role") or ""))
+        for user_id, user in users.items()
+        if isinstance(user, dict)
+    )
+
+
+def snapshot_pull_rows():
+    """Снимок пулов: ((pull_id, culture, status), ...)."""
+    all_pulls = pulls.get("pulls", {}) if isinstance(pulls, dict) else {}
+    return tuple(
+        (pull_id, str(pull.get("culture") or ""), pull.get("status"))
+        for pull_id, pull in all_pulls.items()
+        if isinstance(pull, dict)
+    )
+
+
+def snapshot_batch_rows():
+    """Снимок партий: ((batch_id, farmer_id, culture, status, volume, price), ...)."""
+    return tuple(
+        (
+            batch_id,
+            farmer_id,
+            str(batch.get("culture") or ""),
+            str(batch.get("status") or ""),
+            batch.get("volume", 0),
+            batch.get("price"),
         )
+        for batch_id, farmer_id, batch in iter_all_batches()
+    )
+
 
-        text = "📊 <b>Ежедневная статистика Exportum</b>\n\n"
-        text += f"👥 Пользователей: {total_users}\n"
-        text += f"📦 Партий: {total_batches} (активных: {active_batches})\n"
-        text += f"🎯 Пулов: {total_pulls} (открытых: {open_pulls})\n"
-        text += f"📋 Сделок: {total_deals} (активных: {active_deals})\n"
-        text += f"🎯 Совпадений: {len(matches)}\n\n"
+def compute_daily_stats(user_roles, batch_rows, pull_rows, deal_statuses, matches_count):
+    """Текст ежедневной статистики по снимку (выполняется в пуле процессов)."""
+    role_stats = defaultdict(int)
+    for _, role in user_roles:
+        role_stats[role or "unknown"] += 1
 
-        text += "<b>Распределение по ролям:</b>\n"
-        for role, count in role_stats.items():
-            role_name = ROLES.get(role, role)
-            text += f"• {role_name}: {count}\n"
+    total_batches = len(batch_rows)
+    active_batches = sum(
+        1
+        for row in batch_rows
+        if status_in_group(
+            row[3], {"active", "активна", "available", "доступна", "", "none"}
+        )
+    )
+    total_pulls = len(pull_rows)
+    open_pulls = sum(1 for _, _, status in pull_rows if is_pull_open_status(status))
+    total_deals = len(deal_statuses)
+    active_deals = sum(
+        1 for status in deal_statuses if status in ["pending", "matched", "shipping"]
+    )
 
-        await bot.send_message(ADMIN_ID, text, parse_mode="HTML")
-        logging.info("✅ Ежедневная статистика отправлена админу")
+    text = "📊 <b>Ежедневная статистика Exportum</b>\n\n"
+    text += f"👥 Пользователей: {len(user_roles)}\n"
+    text += f"📦 Партий: {total_batches} (активных: {active_batches})\n"
+    text += f"🎯 Пулов: {total_pulls} (открытых: {open_pulls})\n"
+    text += f"📋 Сделок: {total_deals} (активных: {active_deals})\n"
+    text += f"🎯 Совпадений: {matches_count}\n\n"
 
-    except Exception as e:
-        logging.error(f"❌ Ошибка отправки ежедневной статистики: {e}")
+    text += "<b>Распределение по ролям:</b>\n"
+    for role, count in role_stats.items():
+        role_name = ROLES.get(role, role)
+        text += f"• {role_name}: {count}\n"
+    return text
+
+
+async def send_daily_stats():
+    """Ежедневная отправка статистики админу"""
+
+    def snapshot():
+        return (
+            snapshot_user_roles(),
+            snapshot_batch_rows(),
+            snapshot_pull_rows(),
+            tuple(d.get("status") for d in deals.values() if isinstance(d, dict)),
+            len(matches),
+        )
+
+    async def apply(text):
+        try:
+            await bot.send_message(ADMIN_ID, text, parse_mode="HTML")
+            logging.info("✅ Ежедневная статистика отправлена админу")
+        except Exception as e:
+            logging.error(f"❌ Ошибка отправки ежедневной статистики: {e}")
+
+    await run_cpu_job("send_daily_stats", snapshot, compute_daily_stats, apply)
 
 
 async def setup_scheduler():
@@ -23708,6 +27470,14 @@ async def setup_scheduler():
         scheduler.add_job(update_news_cache, "interval", hours=2)
         scheduler.add_job(auto_match_batches_and_pulls, "interval", minutes=30)
         scheduler.add_job(send_daily_stats, "cron", hour=9, minute=0)
+        scheduler.add_job(pull_reservations.purge_expired, "interval", minutes=5)
+        scheduler.add_job(reconcile_pull_fill, "interval", minutes=15)
+        scheduler.add_job(
+            reconcile_google_sheets,
+            "interval",
+            hours=CONFIG["sheets_reconcile_hours"],
+            next_run_time=datetime.now() + timedelta(minutes=5),
+        )
 
         scheduler.start()
         logging.info("✅ Планировщик задач настроен и запущен")
@@ -23729,7 +27499,7 @@ class LogisticStatesGroup(StatesGroup):
 
 
 # ==================== ОБРАБОТЧИКИ ДЛЯ ЛОГИСТОВ ====================
-@dp.message_handler(lambda m: m.text == "➕ Создать заявку на перевозку", state="*")
+@router.message_handler(text="➕ Создать заявку на перевозку", state="*")
 async def create_shipping_request_start(message: types.Message, state: FSMContext):
     """Начало создания заявки на перевозку"""
     user_id = message.from_user.id
@@ -23747,7 +27517,7 @@ async def create_shipping_request_start(message: types.Message, state: FSMContex
     await LogisticStatesGroup.route_from.set()
 
 
-@dp.message_handler(state=LogisticStatesGroup.route_from)
+@router.message_handler(state=LogisticStatesGroup.route_from)
 async def logistic_route_from(message: types.Message, state: FSMContext):
     """Обработка места погрузки"""
     route_from = message.text.strip()
@@ -23763,7 +27533,7 @@ async def logistic_route_from(message: types.Message, state: FSMContext):
     await LogisticStatesGroup.route_to.set()
 
 
-@dp.message_handler(state=LogisticStatesGroup.route_to)
+@router.message_handler(state=LogisticStatesGroup.route_to)
 async def logistic_route_to(message: types.Message, state: FSMContext):
     """Обработка места разгрузки"""
     route_to = message.text.strip()
@@ -23779,7 +27549,7 @@ async def logistic_route_to(message: types.Message, state: FSMContext):
     await LogisticStatesGroup.volume.set()
 
 
-@dp.message_handler(state=LogisticStatesGroup.volume)
+@router.message_handler(state=LogisticStatesGroup.volume)
 async def logistic_volume(message: types.Message, state: FSMContext):
     """Обработка объема"""
     try:
@@ -23803,7 +27573,7 @@ async def logistic_volume(message: types.Message, state: FSMContext):
         await message.answer("❌ Неверный формат. Укажите число (например: 1500)")
 
 
-@dp.message_handler(state=LogisticStatesGroup.desired_price)
+@router.message_handler(state=LogisticStatesGroup.desired_price)
 async def logistic_desired_price(message: types.Message, state: FSMContext):
     """Обработка ожидаемой цены за тонну"""
     try:
@@ -23827,7 +27597,7 @@ async def logistic_desired_price(message: types.Message, state: FSMContext):
         )
 
 
-@dp.message_handler(state=LogisticStatesGroup.price)
+@router.message_handler(state=LogisticStatesGroup.price)
 async def logistic_price(message: types.Message, state: FSMContext):
     """Обработка тарифа логиста"""
     try:
@@ -23848,7 +27618,7 @@ async def logistic_price(message: types.Message, state: FSMContext):
         await message.answer("❌ Неверный формат. Укажите число (например: 700)")
 
 
-@dp.message_handler(state=LogisticStatesGroup.vehicle_type)
+@router.message_handler(state=LogisticStatesGroup.vehicle_type)
 async def logistic_vehicle_type(message: types.Message, state: FSMContext):
     """Обработка типа транспорта"""
     vehicle_type = message.text.strip()
@@ -23864,8 +27634,8 @@ async def logistic_vehicle_type(message: types.Message, state: FSMContext):
     await LogisticStatesGroup.notes.set()
 
 
-@dp.message_handler(lambda m: m.text == "/skip", state=LogisticStatesGroup.notes)
-@dp.message_handler(state=LogisticStatesGroup.notes)
+@router.message_handler(text="/skip", state=LogisticStatesGroup.notes)
+@router.message_handler(state=LogisticStatesGroup.notes)
 async def logistic_notes(message: types.Message, state: FSMContext):
     """Завершение создания заявки логистом"""
     user_id = message.from_user.id
@@ -23974,7 +27744,7 @@ def get_status_name(status: str) -> str:
     return status_names.get(status, status)
 
 
-@dp.callback_query_handler(text="logistic_requests_list", state="*")
+@router.callback_query_handler(data="logistic_requests_list", state="*")
 async def show_logistic_requests_list(callback: types.CallbackQuery, state: FSMContext):
     """Список доступных заявок на доставку для логиста"""
     await state.finish()
@@ -24131,7 +27901,7 @@ async def show_logistic_requests_list(callback: types.CallbackQuery, state: FSMC
     await callback.answer()
 
 
-@dp.callback_query_handler(text="logist_main_menu", state="*")
+@router.callback_query_handler(data="logist_main_menu", state="*")
 async def logist_main_menu(callback: types.CallbackQuery, state: FSMContext):
     """Главное меню логиста"""
     await state.finish()
@@ -24150,7 +27920,7 @@ async def logist_main_menu(callback: types.CallbackQuery, state: FSMContext):
 # ============================================================================
 # ЛОГИСТ: FSM СОЗДАНИЯ ПРЕДЛОЖЕНИЯ
 # ============================================================================
-@dp.callback_query_handler(lambda c: c.data.startswith("make_offer:"), state="*")
+@router.callback_query_handler(prefix="make_offer:", state="*")
 async def make_offer_start(callback: types.CallbackQuery, state: FSMContext):
     """Начало создания предложения логистом"""
     await state.finish()
@@ -24301,8 +28071,8 @@ async def make_offer_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("vehicle_"), state=LogisticOfferStatesGroup.vehicle_type
+@router.callback_query_handler(
+    prefix="vehicle_", state=LogisticOfferStatesGroup.vehicle_type
 )
 async def offer_vehicle_selected(callback: types.CallbackQuery, state: FSMContext):
     """Выбор типа транспорта"""
@@ -24362,7 +28132,7 @@ async def offer_vehicle_selected(callback: types.CallbackQuery, state: FSMContex
     await callback.answer()
 
 
-@dp.message_handler(state=LogisticOfferStatesGroup.price)
+@router.message_handler(state=LogisticOfferStatesGroup.price)
 async def offer_price_entered(message: types.Message, state: FSMContext):
     """Ввод цены"""
     try:
@@ -24420,7 +28190,7 @@ async def offer_price_entered(message: types.Message, state: FSMContext):
     await LogisticOfferStatesGroup.delivery_date.set()
 
 
-@dp.message_handler(state=LogisticOfferStatesGroup.delivery_date)
+@router.message_handler(state=LogisticOfferStatesGroup.delivery_date)
 async def offer_date_entered(message: types.Message, state: FSMContext):
     """Ввод даты доставки"""
     date_str = message.text.strip()
@@ -24460,9 +28230,8 @@ async def offer_date_entered(message: types.Message, state: FSMContext):
         await message.answer("❌ Произошла ошибка. Попробуйте ещё раз.")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data == "skip_additional_info",
-    state=LogisticOfferStatesGroup.additional_info,
+@router.callback_query_handler(
+    data="skip_additional_info", state=LogisticOfferStatesGroup.additional_info
 )
 async def offer_skip_additional_info(callback: types.CallbackQuery, state: FSMContext):
     """Пропуск дополнительной информации"""
@@ -24473,7 +28242,7 @@ async def offer_skip_additional_info(callback: types.CallbackQuery, state: FSMCo
     await callback.answer()
 
 
-@dp.message_handler(state=LogisticOfferStatesGroup.additional_info)
+@router.message_handler(state=LogisticOfferStatesGroup.additional_info)
 async def offer_additional_info_entered(message: types.Message, state: FSMContext):
     """Ввод дополнительной информации"""
     additional_info = message.text.strip()
@@ -24585,8 +28354,8 @@ async def show_offer_confirmation(
     await LogisticOfferStatesGroup.confirm.set()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data == "confirm_offer", state=LogisticOfferStatesGroup.confirm
+@router.callback_query_handler(
+    data="confirm_offer", state=LogisticOfferStatesGroup.confirm
 )
 async def offer_confirmed(callback: types.CallbackQuery, state: FSMContext):
     """Подтверждение и создание предложения"""
@@ -24792,14 +28561,18 @@ async def offer_confirmed(callback: types.CallbackQuery, state: FSMContext):
                         )
                     )
 
-                await bot.send_message(
-                    receiver_id,
-                    receiver_text,
-                    reply_markup=receiver_keyboard,
-                    parse_mode="HTML",
+                # Отправка в фоне: логист получает ответ, не дожидаясь Telegram
+                background_tasks.spawn(
+                    "new_offer_notify",
+                    message_queue.send_message(
+                        receiver_id,
+                        receiver_text,
+                        reply_markup=receiver_keyboard,
+                        parse_mode="HTML",
+                    ),
                 )
                 logging.info(
-                    f"📧 Уведомление отправлено заказчику {receiver_id} по заявке #{request_id}"
+                    f"📧 Уведомление заказчику {receiver_id} по заявке #{request_id} поставлено в очередь"
                 )
             except Exception as e:
                 logging.error(
@@ -24831,9 +28604,9 @@ async def offer_confirmed(callback: types.CallbackQuery, state: FSMContext):
 # ============================================================================
 # ЛОГИСТ: УПРАВЛЕНИЕ ПРЕДЛОЖЕНИЯМИ
 # ============================================================================
-@dp.message_handler(
-    lambda m: m.text == "💼 Мои предложения"
-    and is_logistic_role((get_user_by_id(m.from_user.id) or {}).get("role")),
+@router.message_handler(
+    lambda m: is_logistic_role((get_user_by_id(m.from_user.id) or {}).get("role")),
+    text="💼 Мои предложения",
     state="*",
 )
 async def logistic_my_offers_text_button(message: types.Message, state: FSMContext):
@@ -24929,7 +28702,7 @@ async def logistic_my_offers_text_button(message: types.Message, state: FSMConte
         await message.answer("❌ Ошибка загрузки", parse_mode="HTML")
 
 
-@dp.callback_query_handler(lambda c: c.data == "my_offers")
+@router.callback_query_handler(data="my_offers")
 async def show_my_offers(callback: types.CallbackQuery, state: FSMContext):
     """Показать мои предложения"""
 
@@ -25030,7 +28803,7 @@ async def show_my_offers(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("❌ Ошибка загрузки", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("view_my_offer_"), state="*")
+@router.callback_query_handler(prefix="view_my_offer_", state="*")
 async def view_my_offer_details(callback: types.CallbackQuery, state: FSMContext):
     """Детальный просмотр своего предложения (экспортёр/фермер)"""
     await state.finish()
@@ -25219,7 +28992,7 @@ async def view_my_offer_details(callback: types.CallbackQuery, state: FSMContext
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("cancel_my_offer_"), state="*")
+@router.callback_query_handler(prefix="cancel_my_offer_", state="*")
 async def cancel_my_offer_confirm(callback: types.CallbackQuery, state: FSMContext):
     """Подтверждение отмены предложения"""
     await state.finish()
@@ -25273,9 +29046,7 @@ async def cancel_my_offer_confirm(callback: types.CallbackQuery, state: FSMConte
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("confirm_cancel_offer_"), state="*"
-)
+@router.callback_query_handler(prefix="confirm_cancel_offer_", state="*")
 async def cancel_my_offer_confirmed(callback: types.CallbackQuery, state: FSMContext):
     """Legacy-совместимость: перенаправление в основной обработчик отмены."""
     await state.finish()
@@ -25289,7 +29060,7 @@ async def cancel_my_offer_confirmed(callback: types.CallbackQuery, state: FSMCon
     await confirm_cancel_offer(callback)
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_offer_"), state="*")
+@router.callback_query_handler(prefix="edit_offer_", state="*")
 async def edit_offer_start(callback: types.CallbackQuery, state: FSMContext):
     """Начало редактирования предложения"""
     await state.finish()
@@ -25347,7 +29118,7 @@ class EditOfferStatesGroup(StatesGroup):
     value = State()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_price_"), state="*")
+@router.callback_query_handler(prefix="edit_price_", state="*")
 async def edit_offer_price(callback: types.CallbackQuery, state: FSMContext):
     """Редактирование цены"""
     await state.finish()
@@ -25392,7 +29163,7 @@ async def edit_offer_price(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.message_handler(state=EditOfferStatesGroup.value)
+@router.message_handler(state=EditOfferStatesGroup.value)
 async def edit_offer_value_entered(message: types.Message, state: FSMContext):
     """Сохранение изменённого значения (пока только цена)"""
     data = await state.get_data()
@@ -25591,8 +29362,12 @@ async def notify_logistic_offer_accepted(offer_id: int, exporter_id: int):
             InlineKeyboardButton("🚛 Мои доставки", callback_data="my_deliveries")
         )
 
-        await bot.send_message(
-            logist_id, text, reply_markup=keyboard, parse_mode="HTML"
+        await notification_digest.notify(
+            logist_id,
+            "offer_accepted",
+            f"Предложение #{offer_id} по заявке #{request_id} — {exporter_company}",
+            text,
+            keyboard,
         )
 
         logging.info(f"✅ Уведомление о принятии отправлено логисту {logist_id}")
@@ -25649,8 +29424,12 @@ async def notify_logistic_offer_rejected(
             InlineKeyboardButton("💼 Мои предложения", callback_data="my_offers")
         )
 
-        await bot.send_message(
-            logist_id, text, reply_markup=keyboard, parse_mode="HTML"
+        await notification_digest.notify(
+            logist_id,
+            "offer_rejected",
+            f"Предложение #{offer_id} по заявке #{request_id} — {exporter_company}",
+            text,
+            keyboard,
         )
 
         logging.info(f"❌ Уведомление об отклонении отправлено логисту {logist_id}")
@@ -25659,34 +29438,418 @@ async def notify_logistic_offer_rejected(
         logging.error(f"❌ Ошибка уведомления логиста об отклонении: {e}")
 
 
-async def notify_logistic_new_request(request_id: int):
-    """Уведомить всех логистов о новой заявке"""
-    try:
-        _, request = find_shipping_request_by_id(request_id)
-        if not request:
-            return
+# ═══════════════════════════════════════════════════════════════════════════
+# РАССТОЯНИЯ РЕГИОН × ПОРТ И ОЦЕНКА СТОИМОСТИ ПЕРЕВОЗКИ
+# ═══════════════════════════════════════════════════════════════════════════
+# Таблица расстояний поставляется файлом resources/region_port_distances.json
+# (регионы из region_keyboard × PORTS). Оценка считается сразу по всем
+# карточкам логистов массивами NumPy; массивы карточек кэшируются и
+# сбрасываются при сохранении logistics_cards.
+
+DEFAULT_TRUCK_PAYLOAD_T = 25.0
+DEFAULT_RAIL_PAYLOAD_T = 65.0
+
+distance_table = None  # {"regions", "ports", "km": np.ndarray, ...}
+freight_cards_cache = None  # {"source", "ids", "index", "price_per_km", ...}
+place_resolve_cache = BoundedCache("place_resolve_cache", 5000)
+
+
+def load_distance_table():
+    """Загружает таблицу расстояний (один раз за процесс)."""
+    global distance_table
+    if distance_table is not None:
+        return distance_table
+
+    try:
+        with open(REGION_PORT_DISTANCES_FILE, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        km = np.asarray(raw["km"], dtype=np.float64)
+        if km.shape != (len(raw["regions"]), len(raw["ports"])):
+            raise ValueError(f"размер матрицы {km.shape} не совпадает со списками")
+
+        region_keys = {}
+        region_names = []
+        for index, region in enumerate(raw["regions"]):
+            names = [region] + list(raw.get("aliases", {}).get(region, []))
+            region_names.append([_place_key(name) for name in names])
+            for key in region_names[-1]:
+                region_keys[key] = index
+
+        distance_table = {
+            "regions": raw["regions"],
+            "ports": raw["ports"],
+            "port_index": {p.lower(): i for i, p in enumerate(raw["ports"])},
+            "region_keys": region_keys,
+            "region_names": region_names,
+            "km": km,
+        }
+        logging.info(
+            f"✅ Таблица расстояний: {km.shape[0]} регионов × {km.shape[1]} портов"
+        )
+    except Exception as e:
+        logging.error(f"❌ Не удалось загрузить таблицу расстояний: {e}")
+        distance_table = {
+            "regions": [],
+            "ports": [],
+            "port_index": {},
+            "region_keys": {},
+            "region_names": [],
+            "km": np.zeros((0, 0)),
+        }
+    return distance_table
+
+
+PLACE_PREFIXES = {"г", "город"}
+PLACE_ABBREVIATIONS = {"обл": "область", "респ": "республика"}
+
+
+def _place_words(text) -> str:
+    """Слова топонима в нижнем регистре, «ё» -> «е», сокращения раскрыты."""
+    words = re.findall(r"[\w-]+", str(text or "").lower().replace("ё", "е"))
+    return " ".join(PLACE_ABBREVIATIONS.get(word, word) for word in words)
+
+
+def _place_key(place) -> str:
+    """Ключ топонима: название целиком («г. Ростов-на-Дону» -> «ростов-на-дону»)."""
+    words = _place_words(place).split()
+    if words and words[0] in PLACE_PREFIXES:
+        words = words[1:]
+    return " ".join(words)
+
+
+def resolve_region_index(place):
+    """
+    Индекс региона таблицы по свободному вводу: название региона или
+    алиас из region_port_distances.json целиком, либо одна из частей
+    ввода через запятую («Краснодарский край, ст. Каневская»).
+    """
+    region_keys = load_distance_table()["region_keys"]
+    for part in [place] + re.split(r"[,;/()]", str(place or "")):
+        key = _place_key(part)
+        if key in region_keys:
+            return region_keys[key]
+    return None
+
+
+def place_in_coverage(place, coverage: str) -> bool:
+    """
+    Упоминается ли место в зоне работы перевозчика (coverage — результат
+    _place_words). Для региона из таблицы подходит любое его название.
+    """
+    index = resolve_region_index(place)
+    if index is not None:
+        names = load_distance_table()["region_names"][index]
+    else:
+        names = [_place_key(place)]
+    return any(name and f" {name} " in f" {coverage} " for name in names)
+
+
+def resolve_port_index(place):
+    """Индекс порта по названию (точное совпадение или вхождение)."""
+    text = str(place or "").strip().lower()
+    if not text:
+        return None
+    table = load_distance_table()
+    if text in table["port_index"]:
+        return table["port_index"][text]
+    for port_name, index in table["port_index"].items():
+        if port_name in text:
+            return index
+    return None
+
+
+def get_route_distance_km(route_from, route_to):
+    """Расстояние регион -> порт, км; None если маршрут не в таблице."""
+    cache_key = (route_from, route_to)
+    if cache_key in place_resolve_cache:
+        return place_resolve_cache.get(cache_key)
+
+    region_index = resolve_region_index(route_from)
+    port_index = resolve_port_index(route_to)
+    distance = None
+    if region_index is not None and port_index is not None:
+        distance = float(load_distance_table()["km"][region_index, port_index])
+
+    place_resolve_cache[cache_key] = distance
+    return distance
+
+
+def get_request_distance_km(request: dict):
+    """Расстояние по заявке с учётом разных полей маршрута."""
+    route_from = (
+        request.get("route_from") or request.get("from_city") or request.get("farmer_region")
+    )
+    route_to = (
+        request.get("port_to")
+        or request.get("port")
+        or request.get("route_to")
+        or request.get("to_city")
+    )
+    return get_route_distance_km(route_from, route_to)
+
+
+def invalidate_freight_cards_cache():
+    """Сбрасывает массивы карточек (вызывается при сохранении карточек)."""
+    global freight_cards_cache
+    freight_cards_cache = None
+
+
+def get_freight_cards_arrays():
+    """Массивы тарифов по всем карточкам логистов (кэшируются)."""
+    global freight_cards_cache
+    if freight_cards_cache is not None and freight_cards_cache["source"] is logistics_cards:
+        return freight_cards_cache
+
+    ids = []
+    price_per_km = []
+    price_per_ton = []
+    payload = []
+    for card_key, card in logistics_cards.items():
+        if not isinstance(card, dict):
+            continue
+        ids.append(card.get("user_id", card_key))
+        price_per_km.append(safe_float(card.get("price_per_km")))
+        price_per_ton.append(safe_float(card.get("price_per_ton")))
+
+        capacity = parse_carrier_capacity(card.get("capacity"))
+        if not capacity:
+            vehicle = str(card.get("vehicle_type") or card.get("transport_type") or "")
+            capacity = (
+                DEFAULT_RAIL_PAYLOAD_T if "жд" in vehicle.lower() else DEFAULT_TRUCK_PAYLOAD_T
+            )
+        payload.append(capacity)
+
+    freight_cards_cache = {
+        "source": logistics_cards,
+        "ids": ids,
+        "index": {str(logist_id): i for i, logist_id in enumerate(ids)},
+        "price_per_km": np.asarray(price_per_km, dtype=np.float64),
+        "price_per_ton": np.asarray(price_per_ton, dtype=np.float64),
+        "payload": np.asarray(payload, dtype=np.float64),
+    }
+    return freight_cards_cache
+
+
+def estimate_freight_for_request(request: dict) -> dict:
+    """
+    Оценка стоимости перевозки по заявке сразу для всех карточек логистов.
+
+    Тариф за км считается за рейс одной машины/вагона, поэтому ₽/т =
+    price_per_km × расстояние / грузоподъёмность. Если маршрута нет в
+    таблице или у карточки нет цены за км — берётся price_per_ton.
+    Возвращает {"distance_km", "per_ton": ndarray, "total": ndarray,
+    "index": {logist_id -> позиция}, "median_per_ton"}.
+    """
+    arrays = get_freight_cards_arrays()
+    distance = get_request_distance_km(request)
+    volume = safe_float(request.get("volume"))
+
+    price_per_km = arrays["price_per_km"]
+    per_ton = arrays["price_per_ton"].copy()
+    if distance is not None and price_per_km.size:
+        by_km = price_per_km * distance / arrays["payload"]
+        per_ton = np.where(price_per_km > 0, by_km, per_ton)
+    per_ton[per_ton <= 0] = np.nan
+
+    valid = per_ton[~np.isnan(per_ton)]
+    return {
+        "distance_km": distance,
+        "per_ton": per_ton,
+        "total": per_ton * volume,
+        "index": arrays["index"],
+        "median_per_ton": float(np.median(valid)) if valid.size else None,
+    }
+
+
+def get_estimated_per_ton(estimate: dict, logist_id):
+    """Оценка ₽/т для конкретного логиста из результата estimate_freight_for_request."""
+    position = estimate["index"].get(str(logist_id))
+    if position is None:
+        return None
+    value = estimate["per_ton"][position]
+    return None if np.isnan(value) else float(value)
+
+
+def format_estimate_vs_offer(offered_per_ton, estimated_per_ton) -> str:
+    """Строка «расчёт / предложено» с отклонением в процентах."""
+    if not estimated_per_ton:
+        return "расчёт —"
+    delta = (safe_float(offered_per_ton) / estimated_per_ton - 1) * 100
+    return f"расчёт ~{estimated_per_ton:,.0f} ₽/т ({delta:+.0f}%)".replace(",", " ")
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# ПОДБОР ПЕРЕВОЗЧИКОВ ПОД ЗАЯВКУ (ВОЛНЫ УВЕДОМЛЕНИЙ)
+# ═══════════════════════════════════════════════════════════════════════════
+# Вместо рассылки всем логистам сразу карточки из logistics_cards
+# ранжируются под заявку, уведомление получают top-N. Если за
+# CONFIG["carrier_wave_delay_min"] никто не откликнулся — уходит следующая
+# волна, последняя волна охватывает всех оставшихся логистов (в т.ч. без
+# карточки). Состояние волн хранится в самой заявке (notified_logists,
+# carrier_wave).
+
+
+def parse_carrier_capacity(value) -> float:
+    """Грузоподъёмность из карточки: число или строка вида «25 т»."""
+    match = re.search(r"\d+(?:[.,]\d+)?", str(value or ""))
+    return float(match.group(0).replace(",", ".")) if match else 0.0
+
+
+def get_logist_rating(logist_id):
+    """Средний рейтинг логиста и число оценок из logistic_ratings."""
+    rating_data = logistic_ratings.get(logist_id) or logistic_ratings.get(str(logist_id))
+    if not rating_data and str(logist_id).isdigit():
+        rating_data = logistic_ratings.get(int(logist_id))
+    if not isinstance(rating_data, dict) or not rating_data.get("count"):
+        return None, 0
+    return rating_data["total_rating"] / rating_data["count"], rating_data["count"]
+
+
+def score_logistic_card(card: dict, request: dict, estimated_per_ton=None):
+    """
+    Оценка карточки логиста под заявку. None — карточка не подходит
+    (неактивна или минимальный объём больше объёма заявки).
+    estimated_per_ton — расчётный тариф по маршруту (estimate_freight_for_request).
+    """
+    if not isinstance(card, dict):
+        return None
+    if str(card.get("status") or "active").lower() not in {"active", "активна"}:
+        return None
+
+    volume = safe_float(request.get("volume"))
+    min_volume = safe_float(card.get("min_volume"))
+    if volume and min_volume and min_volume > volume:
+        return None
+
+    score = 0.0
+    coverage = _place_words(
+        " ".join(str(card.get(key) or "") for key in ("routes", "regions", "region"))
+    )
+
+    # Маршрут: откуда и куда (регион назначения / порт)
+    route_from = request.get("route_from") or request.get("from_city")
+    if place_in_coverage(route_from, coverage):
+        score += 3
+    if place_in_coverage(
+        request.get("route_to_region") or request.get("route_to"), coverage
+    ):
+        score += 2
+
+    # Порт
+    port = str(
+        request.get("port_to") or request.get("port") or request.get("route_to") or ""
+    ).strip().lower()
+    card_ports = {str(p).strip().lower() for p in card.get("ports") or []}
+    if port and port in card_ports:
+        score += 3
+
+    # Объём против грузоподъёмности
+    capacity = parse_carrier_capacity(card.get("capacity"))
+    if volume and capacity and volume <= capacity:
+        score += 1
+
+    # Тип транспорта
+    wanted_vehicle = str(
+        request.get("transport_type") or request.get("vehicle_type") or ""
+    ).strip().lower()
+    card_vehicle = str(
+        card.get("vehicle_type") or card.get("transport_type") or ""
+    ).strip().lower()
+    if wanted_vehicle and card_vehicle and wanted_vehicle not in {"не указано", "любой"}:
+        wanted_word = wanted_vehicle.split()[0]
+        score += 2 if wanted_word in card_vehicle else -1
+
+    # Цена за тонну против ожидаемой: 2 балла при цене не выше ожидаемой,
+    # 0 при +50%, -2 при +100% и дороже
+    desired_price = safe_float(request.get("desired_price") or request.get("price_rub"))
+    card_price = estimated_per_ton or safe_float(card.get("price_per_ton"))
+    if desired_price > 0 and card_price > 0:
+        overprice = max(card_price / desired_price - 1, 0)
+        score += 2 - 4 * min(overprice, 1)
+
+    # Рейтинг со сглаживанием к 3.0 (две «виртуальные» средние оценки)
+    avg_rating, count = get_logist_rating(card.get("user_id"))
+    if avg_rating is not None:
+        smoothed = (avg_rating * count + 3.0 * 2) / (count + 2)
+        score += smoothed - 3.0
+
+    return score
+
+
+def rank_carriers_for_request(request: dict, exclude=()):
+    """
+    Логисты по убыванию релевантности заявке: [(score, logist_id), ...].
+    Логисты без карточки или с неподходящей карточкой идут в конец со score=None.
+    """
+    excluded = {str(x) for x in exclude}
+    estimate = estimate_freight_for_request(request)
+    ranked = []
+    unranked = []
+    seen = set()
+
+    for uid, user in users.items():
+        if not isinstance(user, dict) or not is_logistic_role(user.get("role")):
+            continue
+        logist_id = int(uid) if str(uid).isdigit() else uid
+        key = str(logist_id)
+        if key in seen or key in excluded:
+            continue
+        seen.add(key)
+
+        card = logistics_cards.get(logist_id) or logistics_cards.get(key)
+        score = (
+            score_logistic_card(card, request, get_estimated_per_ton(estimate, logist_id))
+            if card
+            else None
+        )
+        if score is None:
+            unranked.append((None, logist_id))
+        else:
+            ranked.append((score, logist_id))
+
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return ranked + unranked
+
+
+def get_carrier_wave_request(kind: str, request_id):
+    """Заявка по типу источника: exporter / logistics / farmer."""
+    if kind == "exporter":
+        return find_shipping_request_by_id(request_id)[1]
+    if kind == "logistics":
+        return logistics_requests.get(request_id) or logistics_requests.get(
+            str(request_id)
+        )
+    if kind == "farmer":
+        return find_farmer_request_by_id(request_id)[1]
+    return None
+
+
+def save_carrier_wave_request(kind: str):
+    """Сохраняет хранилище заявок после обновления состояния волн."""
+    if kind == "exporter":
+        save_shipping_requests()
+    elif kind == "logistics":
+        save_logistics_requests_to_pickle()
+    elif kind == "farmer":
+        save_farmers_logistics()
+
+
+def carrier_request_has_responses(kind: str, request_id, request: dict) -> bool:
+    """Есть ли уже отклики логистов по заявке."""
+    if request.get("offers_count") or request.get("selected_offer_id"):
+        return True
+    if has_assigned_logist(request):
+        return True
+    return count_logistic_offers_for_request(request_id, source=kind) > 0
+
+
+def build_carrier_notification(kind: str, request_id, request: dict):
+    """Текст и клавиатура уведомления логиста о новой заявке."""
+    if kind == "exporter":
         pull_id = request.get("pull_id")
         all_pulls = pulls.get("pulls", {}) if isinstance(pulls, dict) else {}
         pull_info = all_pulls.get(pull_id) or all_pulls.get(str(pull_id), {})
 
-        # Получаем всех логистов (с нормализацией int/str ID)
-        logistics = []
-        seen_logist_ids = set()
-        for uid, user in users.items():
-            if not isinstance(user, dict):
-                continue
-            if not is_logistic_role(user.get("role")):
-                continue
-            normalized_uid = int(uid) if str(uid).isdigit() else uid
-            uid_key = str(normalized_uid)
-            if uid_key in seen_logist_ids:
-                continue
-            seen_logist_ids.add(uid_key)
-            logistics.append(normalized_uid)
-
-        if not logistics:
-            return
-
         text = "🔔 <b>НОВАЯ ЗАЯВКА НА ДОСТАВКУ!</b>\n\n"
         text += f"📦 Заявка #{request_id}\n"
         text += f"🌾 Культура: {pull_info.get('culture', 'Не указана')}\n"
@@ -25703,36 +29866,190 @@ async def notify_logistic_new_request(request_id: int):
         text += "\n<i>Торопитесь! Конкуренты уже смотрят эту заявку</i>"
 
         keyboard = InlineKeyboardMarkup()
-        keyboard.add(
-                InlineKeyboardButton(
-                    "👀 Посмотреть заявку",
-                    callback_data=f"view_shipping_request:{request_id}",
-                )
-            )
         keyboard.add(
             InlineKeyboardButton(
-                "📦 Все заявки", callback_data="logistic_requests_list"
+                "👀 Посмотреть заявку",
+                callback_data=f"view_shipping_request:{request_id}",
             )
         )
+        keyboard.add(
+            InlineKeyboardButton("📦 Все заявки", callback_data="logistic_requests_list")
+        )
+        return text, keyboard
 
-        # Отправляем уведомление каждому логисту
-        sent_count = 0
-        for logist_id in logistics:
+    if kind == "logistics":
+        desired_date = (
+            request.get("loading_date") or request.get("desired_date") or "Не указана"
+        )
+        volume = request.get("volume", 0) or 0
+        desired_price = request.get("desired_price", 0) or 0
+
+        text = (
+            f"✅ <b>Заявка на логистику #{request.get('id','-')}</b>\n\n"
+            f"📦 Пул: #{request.get('pull_id','-')}\n"
+            f"🌾 Культура: {request.get('culture', '—')}\n"
+            f"📊 Объём: {volume:.0f} т\n"
+            f"📍 Маршрут: {request.get('route_from', '—')} → {request.get('route_to', '—')}\n"
+            f"📅 Дата погрузки: {desired_date}\n"
+            f"💰 Ожидаемая цена: {desired_price:,.0f} ₽/т\n\n"
+            f"👤 Экспортёр: {request.get('exporter_name','-')}\n"
+            f"☎️ <code>{request.get('exporter_phone','-')}</code>\n"
+            f"📧 <code>{request.get('exporter_email','Не указан')}</code>\n\n"
+            "💼 Откликнитесь через меню <b>«Активные заявки»</b>."
+        )
+        return text, None
+
+    # farmer
+    text = (
+        "📬 <b>НОВАЯ ЗАЯВКА НА ДОСТАВКУ!</b>\n\n"
+        f"🌾 {request.get('culture')} • {request.get('volume')} т\n"
+        f"💰 Цена партии: {request.get('price_per_ton', 0):,} ₽/т\n"
+        f"💳 Ожидаемая цена доставки: {request.get('desired_price', 0):,} ₽/т\n\n"
+        f"📍 От: {request.get('farmer_region')}\n"
+        f"📍 Куда: {request.get('route_to_region')} ({request.get('port_to')})\n"
+        f"🚚 Транспорт: {request.get('transport_type')}\n"
+        f"👤 Фермер: {request.get('farmer_name', '')}\n"
+        f"☎️ {request.get('farmer_phone', '')}\n\n"
+        "Нажмите «ОТКЛИКНУТЬСЯ», если готовы везти."
+    )
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(
+        InlineKeyboardButton(
+            "✅ ОТКЛИКНУТЬСЯ",
+            callback_data=f"logist_respond_farmer_request:{request_id}",
+        ),
+        InlineKeyboardButton(
+            "📋 ДЕТАЛИ",
+            callback_data=f"view_request:farmer:{request_id}",
+        ),
+    )
+    return text, keyboard
+
+
+async def send_carrier_wave(kind: str, request_id) -> int:
+    """
+    Отправляет очередную волну уведомлений по заявке и планирует следующую.
+    Возвращает число уведомлённых в этой волне логистов.
+    """
+    request = get_carrier_wave_request(kind, request_id)
+    if not isinstance(request, dict):
+        return 0
+
+    wave = int(request.get("carrier_wave") or 0)
+    request["carrier_next_wave_at"] = None
+    if wave > 0 and (
+        not is_request_open_for_offers(request.get("status"))
+        or carrier_request_has_responses(kind, request_id, request)
+    ):
+        logging.info(f"🚚 Заявка {kind}#{request_id}: волны остановлены (есть отклик)")
+        save_carrier_wave_request(kind)
+        return 0
+
+    notified = list(request.get("notified_logists") or [])
+    candidates = rank_carriers_for_request(request, exclude=notified)
+    if not candidates:
+        save_carrier_wave_request(kind)
+        return 0
+
+    is_last_wave = wave + 1 >= CONFIG["carrier_max_waves"]
+    if is_last_wave:
+        recipients = candidates
+    else:
+        # Волны растут: N, 2N, ... и только из логистов с подходящей карточкой
+        wave_size = CONFIG["carrier_wave_size"] * (wave + 1)
+        recipients = [
+            item for item in candidates[:wave_size] if item[0] is not None
+        ] or candidates[:wave_size]
+
+    text, keyboard = build_carrier_notification(kind, request_id, request)
+    summary = (
+        f"#{request_id}: {request.get('culture') or request.get('cargo_type') or 'груз'}, "
+        f"{request.get('volume', '?')} т, "
+        f"{request.get('route_from') or request.get('region') or '?'} → "
+        f"{request.get('route_to') or request.get('port') or '?'}"
+    )
+    # Темп отправки задаёт очередь сообщений, сводки — режим получателя
+    recipient_ids = [
+        logist_id for _, logist_id in recipients if not is_user_blocked(logist_id)
+    ]
+    results = await asyncio.gather(
+        *(
+            notification_digest.notify(logist_id, "new_request", summary, text, keyboard)
+            for logist_id in recipient_ids
+        )
+    )
+    sent_count = sum(1 for delivered in results if delivered)
+    notified.extend(logist_id for _, logist_id in recipients)
+
+    request["notified_logists"] = notified
+    request["carrier_wave"] = wave + 1
+
+    remaining = len(candidates) - len(recipients)
+    if remaining > 0 and not is_last_wave:
+        run_date = datetime.now() + timedelta(
+            minutes=CONFIG["carrier_wave_delay_min"]
+        )
+        request["carrier_next_wave_at"] = run_date.strftime("%Y-%m-%d %H:%M:%S")
+        schedule_carrier_wave(kind, request_id, run_date)
+
+    save_carrier_wave_request(kind)
+    logging.info(
+        f"🔔 Заявка {kind}#{request_id}: волна {wave + 1}, "
+        f"уведомлено {sent_count} логистов, в резерве {remaining}"
+    )
+    return sent_count
+
+
+def schedule_carrier_wave(kind: str, request_id, run_date: datetime):
+    """Планирует следующую волну уведомлений через APScheduler."""
+    try:
+        scheduler.add_job(
+            send_carrier_wave,
+            "date",
+            run_date=run_date,
+            args=[kind, request_id],
+            id=f"carrier_wave:{kind}:{request_id}",
+            replace_existing=True,
+        )
+    except Exception as e:
+        logging.error(f"❌ Не удалось запланировать волну {kind}#{request_id}: {e}")
+
+
+def resume_carrier_waves() -> int:
+    """После рестарта восстанавливает запланированные волны из заявок."""
+    sources = {
+        "exporter": shipping_requests,
+        "logistics": logistics_requests,
+        "farmer": farmer_logistics_requests,
+    }
+    resumed = 0
+    for kind, storage in sources.items():
+        if not isinstance(storage, dict):
+            continue
+        for request_id, request in storage.items():
+            if not isinstance(request, dict) or not request.get("carrier_next_wave_at"):
+                continue
             try:
-                await bot.send_message(
-                    logist_id, text, reply_markup=keyboard, parse_mode="HTML"
+                run_date = datetime.strptime(
+                    request["carrier_next_wave_at"], "%Y-%m-%d %H:%M:%S"
                 )
-                sent_count += 1
-                await asyncio.sleep(0.1)  # Небольшая задержка между отправками
-            except Exception as e:
-                logging.error(f"Ошибка отправки логисту {logist_id}: {e}")
+            except ValueError:
+                continue
+            run_date = max(run_date, datetime.now() + timedelta(seconds=30))
+            schedule_carrier_wave(kind, request.get("id", request_id), run_date)
+            resumed += 1
+    if resumed:
+        logging.info(f"✅ Восстановлено волн уведомлений логистов: {resumed}")
+    return resumed
 
-        logging.info(
-            f"🔔 Уведомление о новой заявке #{request_id} отправлено {sent_count} логистам"
-        )
 
+async def notify_logistic_new_request(request_id: int):
+    """Уведомить подходящих логистов о новой заявке (волнами, см. send_carrier_wave)"""
+    try:
+        return await send_carrier_wave("exporter", request_id)
     except Exception as e:
         logging.error(f"❌ Ошибка массового уведомления логистов: {e}")
+        return 0
 
 
 async def notify_logistic_delivery_started(delivery_id: int):
@@ -25865,14 +30182,9 @@ async def notify_logistic_request_cancelled(request_id: int, reason: str = None)
         )
 
         # Уведомляем каждого логиста
-        for logist_id in related_logist_ids:
-            try:
-                await bot.send_message(
-                    logist_id, text, reply_markup=keyboard, parse_mode="HTML"
-                )
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                logging.error(f"Ошибка уведомления логиста {logist_id}: {e}")
+        await notify_many(
+            related_logist_ids, text, reply_markup=keyboard, parse_mode="HTML"
+        )
 
         logging.info(f"❌ Уведомления об отмене заявки #{request_id} отправлены")
 
@@ -25885,7 +30197,7 @@ async def notify_logistic_request_cancelled(request_id: int, reason: str = None)
 # ============================================================================
 
 
-@dp.callback_query_handler(lambda c: c.data == "my_deliveries", state="*")
+@router.callback_query_handler(data="my_deliveries", state="*")
 async def show_my_deliveries(callback: types.CallbackQuery, state: FSMContext):
     """Показать мои доставки"""
     await state.finish()
@@ -25999,7 +30311,7 @@ async def show_my_deliveries(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "logistic_statistics", state="*")
+@router.callback_query_handler(data="logistic_statistics", state="*")
 async def show_logistic_statistics(callback: types.CallbackQuery, state: FSMContext):
     """Показать статистику логиста"""
     await state.finish()
@@ -26155,7 +30467,7 @@ def load_shipping_requests():
 # ═══════════════════════════════════════════════════════════════════════════
 # СОЗДАНИЕ ЗАЯВКИ НА ЛОГИСТИКУ (ОБРАБОТЧИКИ)
 # ═══════════════════════════════════════════════════════════════════════════
-@dp.message_handler(state=ShippingRequestStatesGroup.route_from)
+@router.message_handler(state=ShippingRequestStatesGroup.route_from)
 async def shipping_route_from(message: types.Message, state: FSMContext):
     """Шаг 1: Пункт отправки"""
     route_from = message.text.strip()
@@ -26177,7 +30489,7 @@ async def shipping_route_from(message: types.Message, state: FSMContext):
 
 
 # ===== ШАГ 2: Пункт назначения =====
-@dp.message_handler(state=ShippingRequestStatesGroup.route_to)
+@router.message_handler(state=ShippingRequestStatesGroup.route_to)
 async def shipping_route_to(message: types.Message, state: FSMContext):
     """Шаг 2: Пункт назначения"""
     route_to = message.text.strip()
@@ -26213,7 +30525,7 @@ async def shipping_route_to(message: types.Message, state: FSMContext):
 
 
 # ===== ШАГ 3: Объём =====
-@dp.message_handler(state=ShippingRequestStatesGroup.volume)
+@router.message_handler(state=ShippingRequestStatesGroup.volume)
 async def shipping_volume(message: types.Message, state: FSMContext):
     """Шаг 3: Объём"""
     try:
@@ -26266,7 +30578,7 @@ async def shipping_volume(message: types.Message, state: FSMContext):
 
 
 # ===== ШАГ 4: Культура =====
-@dp.message_handler(state=ShippingRequestStatesGroup.culture)
+@router.message_handler(state=ShippingRequestStatesGroup.culture)
 async def shipping_culture(message: types.Message, state: FSMContext):
     """Шаг 4: Культура"""
     culture = message.text.strip()
@@ -26289,7 +30601,7 @@ async def shipping_culture(message: types.Message, state: FSMContext):
 
 
 # ===== ШАГ 5: Цена в рублях =====
-@dp.message_handler(state=ShippingRequestStatesGroup.price_rub)
+@router.message_handler(state=ShippingRequestStatesGroup.price_rub)
 async def shipping_price_rub(message: types.Message, state: FSMContext):
     """Шаг 5: Цена в рублях за тонну"""
 
@@ -26321,16 +30633,14 @@ async def shipping_price_rub(message: types.Message, state: FSMContext):
 
 
 # ===== ШАГ 6: Дата отправки =====
-@dp.message_handler(
-    lambda m: m.text == "/skip", state=ShippingRequestStatesGroup.desired_date
-)
+@router.message_handler(text="/skip", state=ShippingRequestStatesGroup.desired_date)
 async def shipping_desired_date_skip(message: types.Message, state: FSMContext):
     """Шаг 6: Пропуск даты"""
     await state.update_data(desired_date="Не указана")
     await shipping_final_confirmation(message, state)
 
 
-@dp.message_handler(state=ShippingRequestStatesGroup.desired_date)
+@router.message_handler(state=ShippingRequestStatesGroup.desired_date)
 async def shipping_desired_date(message: types.Message, state: FSMContext):
     """Шаг 6: Желаемая дата отправки"""
     desired_date = message.text.strip()
@@ -26756,12 +31066,32 @@ async def on_startup(dp):
     logging.info("=" * 70 + "\n")
     # ============================================================
 
+    # Конфликтующие и перекрытые маршруты видны сразу в логе старта
+    router.check_routes()
+
+    # После работы по webhook polling не получит апдейты, пока webhook стоит
+    if BOT_MODE != "webhook":
+        try:
+            await bot.delete_webhook()
+        except Exception as e:
+            logging.warning(f"⚠️ Не удалось снять webhook: {e}")
+
+    # Агрегаты наполнения пулов (объём/участники/пороги)
+    pull_fill.rebuild()
+    message_queue.start()
+    resume_broadcast_jobs()
+
+    # Google Sheets: подключение в потоке, изменения уходят фоновой очередью
+    await init_google_sheets()
+    sheets_outbox.start()
+
     # Настройка планировщика и обновление кэшей
     await setup_scheduler()
+    resume_carrier_waves()
 
     try:
-        await update_prices_cache()
-        await update_news_cache()
+        # Цены и новости — из файлов сразу, устаревшие обновятся в фоне
+        warm_market_caches()
         await schedule_weekly_reports()
         logging.info("✅ Данные обновлены при запуске")
     except Exception as e:
@@ -26820,7 +31150,7 @@ logging.info("   ✅ Интеграция с Google Sheets")
 logging.info("   ✅ Планировщик задач")
 
 
-@dp.message_handler(lambda m: m.text == "📦 Доступные партии", state="*")
+@router.message_handler(text="📦 Доступные партии", state="*")
 async def show_available_batches_exporter(message: types.Message, state: FSMContext):
     """Просмотр доступных партий для экспортера"""
     await state.finish()
@@ -26901,6 +31231,12 @@ async def on_shutdown(dp):
     """Завершение работы бота"""
     logging.info("⏹ Бот Exportum останавливается...")
 
+    # Тяжёлые фоновые задачи: отменяем и гасим пул процессов
+    cancelled_jobs = cancel_cpu_jobs()
+    if cancelled_jobs:
+        logging.info(f"⏹ Отменено фоновых задач: {cancelled_jobs}")
+    shutdown_cpu_job_executor()
+
     # ✅ СОХРАНЯЕМ ВСЕ ДАННЫЕ
     save_users_to_json()
     save_users_to_pickle()
@@ -26917,9 +31253,19 @@ async def on_shutdown(dp):
     # ✅ ДОБАВИТЬ ЭТУ СТРОКУ - СОХРАНЕНИЕ ЗАЯВОК:
     save_requests_to_file()
     save_farmers_logistics()
+    save_bounded_caches()
 
     logging.info("✅ Данные сохранены")
 
+    # Рассылки продолжатся после рестарта; фоновые уведомления, сводки
+    # и очередь досылаем сейчас
+    await stop_broadcast_tasks()
+    await background_tasks.drain()
+    await notification_digest.flush_all()
+    await message_queue.stop()
+    await sheets_outbox.stop()
+    await market_fetcher.close()
+
     await bot.close()
     await dp.storage.close()
     await dp.storage.wait_closed()
@@ -26928,9 +31274,9 @@ async def on_shutdown(dp):
 # ══════════════════════════════════════════════════════════════════════════
 # ПРОСМОТР ДЕТАЛЕЙ ДОСТАВКИ
 # ═══════════════════════════════════════════════════════════════════════════
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_delivery_")
-    and not c.data.startswith("view_delivery_by_request_"),
+@router.callback_query_handler(
+    lambda c: not c.data.startswith("view_delivery_by_request_"),
+    prefix="view_delivery_",
     state="*",
 )
 async def view_delivery_details(callback: types.CallbackQuery, state: FSMContext):
@@ -27118,32 +31464,39 @@ async def view_delivery_details(callback: types.CallbackQuery, state: FSMContext
         has_expeditor = bool(
             get_assigned_expeditor_id(delivery) or get_assigned_expeditor_id(request)
         )
-        status_ref = f"delivery_{delivery_id}"
         if not has_expeditor:
             if status in {"pending", "assigned", "new", "open", ""}:
                 keyboard.add(
                     InlineKeyboardButton(
                         "🚚 Начать доставку",
-                        callback_data=f"change_logist_status:{status_ref}:in_progress",
+                        callback_data=LOGIST_STATUS_CB.pack(
+                            "delivery", delivery_id, "in_progress"
+                        ),
                     )
                 )
                 keyboard.add(
                     InlineKeyboardButton(
                         "❌ Отменить доставку",
-                        callback_data=f"change_logist_status:{status_ref}:cancelled",
+                        callback_data=LOGIST_STATUS_CB.pack(
+                            "delivery", delivery_id, "cancelled"
+                        ),
                     )
                 )
             elif status == "in_progress":
                 keyboard.add(
                     InlineKeyboardButton(
                         "✅ Завершить доставку",
-                        callback_data=f"change_logist_status:{status_ref}:completed",
+                        callback_data=LOGIST_STATUS_CB.pack(
+                            "delivery", delivery_id, "completed"
+                        ),
                     )
                 )
                 keyboard.add(
                     InlineKeyboardButton(
                         "⏸ Вернуть в ожидание",
-                        callback_data=f"change_logist_status:{status_ref}:pending",
+                        callback_data=LOGIST_STATUS_CB.pack(
+                            "delivery", delivery_id, "pending"
+                        ),
                     )
                 )
 
@@ -27203,7 +31556,7 @@ async def view_delivery_details(callback: types.CallbackQuery, state: FSMContext
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("complete_delivery:"), state="*")
+@router.callback_query_handler(prefix="complete_delivery:", state="*")
 async def complete_delivery(callback: types.CallbackQuery):
     """Legacy-совместимость: завершение доставки через старый callback."""
     try:
@@ -27283,10 +31636,12 @@ async def complete_delivery(callback: types.CallbackQuery):
                 None,
             )
         if isinstance(linked_delivery, dict) and linked_delivery.get("id") is not None:
-            callback.data = (
-                f"change_logist_status:delivery_{linked_delivery.get('id')}:completed"
+            await change_logist_delivery_status(
+                callback,
+                LOGIST_STATUS_CB.payload(
+                    "delivery", linked_delivery.get("id"), "completed"
+                ),
             )
-            await change_logist_delivery_status(callback)
             return
 
     if not (
@@ -27575,17 +31930,16 @@ async def complete_delivery(callback: types.CallbackQuery):
     await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data in ["back_to_deliveries", "refresh_deliveries"], state="*"
+@router.callback_query_handler(
+    data=["back_to_deliveries", "refresh_deliveries"], state="*"
 )
 async def back_to_deliveries_handler(callback: types.CallbackQuery, state: FSMContext):
     """Вернуться к списку доставок"""
     await show_my_deliveries(callback, state)
 
 
-@dp.message_handler(
-    lambda m: m.text in ["💼 Мои логистических услуги", "💼 Мои логистических услуг"],
-    state="*",
+@router.message_handler(
+    text=["💼 Мои логистических услуги", "💼 Мои логистических услуг"], state="*"
 )
 async def logistics_services_stats_handler(message: types.Message, state: FSMContext):
     await state.finish()
@@ -27610,7 +31964,7 @@ async def logistics_services_stats_handler(message: types.Message, state: FSMCon
 # ═══════════════════════════════════════════════════════════════════════════════
 
 
-@dp.message_handler(lambda message: message.text == "📊 Новости и цены", state="*")
+@router.message_handler(text="📊 Новости и цены", state="*")
 async def show_news_and_prices(message: types.Message, state: FSMContext):
     """Отображение новостей и цен"""
     user_id = message.from_user.id
@@ -27632,12 +31986,12 @@ async def show_news_and_prices(message: types.Message, state: FSMContext):
     )
 
 
-@dp.callback_query_handler(lambda c: c.data == "show_prices", state="*")
+@router.callback_query_handler(data="show_prices", state="*")
 async def callback_show_prices(callback_query: types.CallbackQuery):
     """Показать цены"""
     await bot.answer_callback_query(callback_query.id)
     try:
-        await update_prices_cache()
+        await serve_market_cache("prices")
         message_text = format_prices_message()
 
         keyboard = InlineKeyboardMarkup()
@@ -27659,12 +32013,12 @@ async def callback_show_prices(callback_query: types.CallbackQuery):
         logging.error(f"Ошибка показа цен: {e}")
 
 
-@dp.callback_query_handler(lambda c: c.data == "show_news", state="*")
+@router.callback_query_handler(data="show_news", state="*")
 async def callback_show_news(callback_query: types.CallbackQuery):
     """Показать новости"""
     await bot.answer_callback_query(callback_query.id)
     try:
-        await update_news_cache()
+        await serve_market_cache("news")
         message_text = format_news_message()
 
         keyboard = InlineKeyboardMarkup()
@@ -27687,7 +32041,7 @@ async def callback_show_news(callback_query: types.CallbackQuery):
         logging.error(f"Ошибка показа новостей: {e}")
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_news_menu", state="*")
+@router.callback_query_handler(data="back_to_news_menu", state="*")
 async def callback_back_to_news_menu(callback_query: types.CallbackQuery):
     """Вернуться в меню новостей"""
     await bot.answer_callback_query(callback_query.id)
@@ -27776,7 +32130,7 @@ async def view_batch_details_direct(
     await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_my_batches", state="*")
+@router.callback_query_handler(data="back_to_my_batches", state="*")
 async def back_to_my_batches(callback: types.CallbackQuery, state: FSMContext):
     """Возврат к списку партий с фильтрацией по статусам"""
     await state.finish()
@@ -27884,7 +32238,7 @@ async def back_to_my_batches(callback: types.CallbackQuery, state: FSMContext):
 
 
 # Обработчик фильтрации партий по статусам
-@dp.callback_query_handler(lambda c: c.data.startswith("filter_batches:"), state="*")
+@router.callback_query_handler(prefix="filter_batches:", state="*")
 async def filter_batches(callback: types.CallbackQuery, state: FSMContext):
     """Фильтрация и показ партий по статусам"""
     await state.finish()
@@ -27955,7 +32309,7 @@ async def filter_batches(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(text="back_to_requests", state="*")
+@router.callback_query_handler(data="back_to_requests", state="*")
 async def back_to_requests(callback: types.CallbackQuery, state: FSMContext):
     """Вернуться к ПОЛНОМУ списку активных заявок (экспортёры + фермеры)"""
     await state.finish()
@@ -28134,7 +32488,7 @@ async def back_to_requests(callback: types.CallbackQuery, state: FSMContext):
             logging.error(f"Error sending new message: {e2}")
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_exporter_menu", state="*")
+@router.callback_query_handler(data="back_to_exporter_menu", state="*")
 async def back_to_exporter_menu(callback: types.CallbackQuery, state: FSMContext):
     """Возврат в меню экспортёра"""
     await state.finish()
@@ -28168,7 +32522,7 @@ async def back_to_exporter_menu(callback: types.CallbackQuery, state: FSMContext
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "advanced_batch_search", state="*")
+@router.callback_query_handler(data="advanced_batch_search", state="*")
 async def advanced_batch_search_handler(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -28186,7 +32540,7 @@ async def advanced_batch_search_handler(
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("contact_farmer_"), state="*")
+@router.callback_query_handler(prefix="contact_farmer_", state="*")
 async def contact_farmer_handler(callback: types.CallbackQuery, state: FSMContext):
     """Контакт с фермером"""
     try:
@@ -28236,7 +32590,7 @@ async def contact_farmer_handler(callback: types.CallbackQuery, state: FSMContex
         logging.error(f"Ошибка уведомления фермера: {e}")
 
 
-@dp.message_handler(lambda message: message.text == "🔍 Поиск", state="*")
+@router.message_handler(text="🔍 Поиск", state="*")
 async def start_search(message: types.Message, state: FSMContext):
     """Начать поиск партий"""
     user_id = message.from_user.id
@@ -28262,7 +32616,7 @@ async def start_search(message: types.Message, state: FSMContext):
     )
 
 
-@dp.callback_query_handler(lambda c: c.data == "search_by_culture")
+@router.callback_query_handler(data="search_by_culture")
 async def callback_search_by_culture(
     callback_query: types.CallbackQuery, state: FSMContext
 ):
@@ -28289,7 +32643,7 @@ async def callback_search_by_culture(
         pass
 
 
-@dp.callback_query_handler(lambda c: c.data == "search_by_region", state="*")
+@router.callback_query_handler(data="search_by_region", state="*")
 async def callback_search_by_region(callback_query: types.CallbackQuery):
     """Поиск по региону"""
     await bot.answer_callback_query(callback_query.id)
@@ -28307,9 +32661,7 @@ async def callback_search_by_region(callback_query: types.CallbackQuery):
         pass
 
 
-@dp.callback_query_handler(
-    lambda c: c.data in ["search_by_price", "search_by_volume"], state="*"
-)
+@router.callback_query_handler(data=["search_by_price", "search_by_volume"], state="*")
 async def callback_search_by_unavailable(callback_query: types.CallbackQuery):
     """Временный маршрут для неактивных фильтров поиска."""
     keyboard = InlineKeyboardMarkup(row_width=2)
@@ -28382,41 +32734,20 @@ async def publish_batch_to_channel(batch_data, farmer_name):
         logging.error(f"❌ Ошибка публикации партии в канал: {e}")
 
 
-async def generate_weekly_report():
-    """Генерация еженедельного отчета"""
-    try:
-        farmers_count = len([u for u in users.values() if u.get("role") == "farmer"])
-        exporters_count = len(
-            [u for u in users.values() if u.get("role") == "exporter"]
-        )
-        logistics_count = len(
-            [u for u in users.values() if is_logistic_role(u.get("role"))]
-        )
-        expeditors_count = len(
-            [
-                u
-                for u in users.values()
-                if is_expeditor_role(u.get("role"))
-            ]
-        )
-
-        total_batches = sum(1 for _ in iter_all_batches())
-        all_pulls = pulls.get("pulls", pulls) if isinstance(pulls, dict) else {}
-        total_pulls = len(all_pulls)
-        total_deals = len(deals)
-
-        total_batch_volume = 0
-        for _, _, batch in iter_all_batches():
-            total_batch_volume += batch.get("volume", 0)
-
-        prices = []
-        for _, _, batch in iter_all_batches():
-            if batch.get("price"):
-                prices.append(batch["price"])
+def compute_weekly_report(user_roles, batch_rows, total_pulls, total_deals, report_date):
+    """Текст еженедельного отчёта по снимку (выполняется в пуле процессов)."""
+    roles = [role for _, role in user_roles]
+    farmers_count = sum(1 for role in roles if role == "farmer")
+    exporters_count = sum(1 for role in roles if role == "exporter")
+    logistics_count = sum(1 for role in roles if is_logistic_role(role))
+    expeditors_count = sum(1 for role in roles if is_expeditor_role(role))
 
-        avg_price = sum(prices) / len(prices) if prices else 0
+    total_batches = len(batch_rows)
+    total_batch_volume = sum(row[4] or 0 for row in batch_rows)
+    prices = [row[5] for row in batch_rows if row[5]]
+    avg_price = sum(prices) / len(prices) if prices else 0
 
-        report_text = f"""📊 <b>ЕЖЕНЕДЕЛЬНЫЙ ОТЧЕТ</b>
+    return f"""📊 <b>ЕЖЕНЕДЕЛЬНЫЙ ОТЧЕТ</b>
 {'='*40}
 
 👥 <b>ПОЛЬЗОВАТЕЛИ:</b>
@@ -28424,7 +32755,7 @@ async def generate_weekly_report():
 • Экспортеры: {exporters_count}
 • Логисты: {logistics_count}
 • Экспедиторы: {expeditors_count}
-• <b>Всего: {len(users)}</b>
+• <b>Всего: {len(user_roles)}</b>
 
 📦 <b>ПАРТИИ:</b>
 • Всего партий: {total_batches}
@@ -28437,19 +32768,37 @@ async def generate_weekly_report():
 🤝 <b>СДЕЛКИ:</b>
 • Завершено сделок: {total_deals}
 
-📅 Дата отчета: {datetime.now().strftime('%d.%m.%Y %H:%M')}
+📅 Дата отчета: {report_date}
 """
 
-        await bot.send_message(ADMIN_ID, report_text, parse_mode="HTML")
 
+async def generate_weekly_report():
+    """Генерация еженедельного отчета"""
+
+    def snapshot():
+        all_pulls = pulls.get("pulls", pulls) if isinstance(pulls, dict) else {}
+        return (
+            snapshot_user_roles(),
+            snapshot_batch_rows(),
+            len(all_pulls),
+            len(deals),
+            datetime.now().strftime("%d.%m.%Y %H:%M"),
+        )
+
+    async def apply(report_text):
         try:
-            await bot.send_message(CHANNEL_ID, report_text, parse_mode="HTML")
+            await bot.send_message(ADMIN_ID, report_text, parse_mode="HTML")
+
+            try:
+                await bot.send_message(CHANNEL_ID, report_text, parse_mode="HTML")
+            except Exception as e:
+                logging.warning(f"Не удалось отправить weekly report в CHANNEL_ID: {e}")
+
+            logging.info("✅ Еженедельный отчет отправлен")
         except Exception as e:
-            logging.warning(f"Не удалось отправить weekly report в CHANNEL_ID: {e}")
+            logging.error(f"❌ Ошибка генерации отчета: {e}")
 
-        logging.info("✅ Еженедельный отчет отправлен")
-    except Exception as e:
-        logging.error(f"❌ Ошибка генерации отчета: {e}")
+    await run_cpu_job("generate_weekly_report", snapshot, compute_weekly_report, apply)
 
 
 async def schedule_weekly_reports():
@@ -28464,7 +32813,7 @@ async def schedule_weekly_reports():
 
 
 # ═══════════════════════════════════════════════════════════════════════════
-@dp.callback_query_handler(lambda c: c.data == "reload_data", state="*")
+@router.callback_query_handler(data="reload_data", state="*")
 async def reload_data_callback(callback: CallbackQuery, state: FSMContext):
     """Перезагрузка данных из файлов"""
     await state.finish()
@@ -28483,9 +32832,7 @@ async def reload_data_callback(callback: CallbackQuery, state: FSMContext):
 
 
 # === HANDLER: Присоединение партий к пуллу ===
-@dp.callback_query_handler(
-    lambda c: c.data and c.data.startswith("selectbatch_"), state="*"
-)
+@router.callback_query_handler(prefix="selectbatch_", state="*")
 async def process_batch_selection_for_pull(
     callback_query: CallbackQuery, state: FSMContext
 ):
@@ -28559,22 +32906,39 @@ async def process_batch_selection_for_pull(
             await callback_query.answer("⚠️ Уже добавлена", show_alert=True)
             return
 
-        pull["batches"].append(
-            {
-                "id": batch_id_int,
-                "farmer_id": batch.get("farmer_id"),
-                "culture": batch.get("culture"),
-                "volume": batch.get("volume"),
-                "price": batch.get("price"),
-                "moisture": batch.get("moisture", batch.get("humidity", 0)),
-                "impurity": batch.get("impurity", batch.get("impurities", 0)),
-                "quality_class": batch.get("quality_class", ""),
-                "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            }
+        reservation_id = await pull_reservations.reserve(
+            pull_id, batch.get("volume", 0), holder=user_id
         )
-        pull["batch_ids"].append(batch_id_int)
-        current_volume = pull.get("current_volume", 0)
-        pull["current_volume"] = current_volume + batch.get("volume", 0)
+        if reservation_id is None:
+            await callback_query.answer(
+                "❌ Недостаточно места в пулле", show_alert=True
+            )
+            return
+
+        def apply_add_batch(pull):
+            if any(same_id(bid, batch_id_int) for bid in pull["batch_ids"]):
+                return False
+            pull["batches"].append(
+                {
+                    "id": batch_id_int,
+                    "farmer_id": batch.get("farmer_id"),
+                    "culture": batch.get("culture"),
+                    "volume": batch.get("volume"),
+                    "price": batch.get("price"),
+                    "moisture": batch.get("moisture", batch.get("humidity", 0)),
+                    "impurity": batch.get("impurity", batch.get("impurities", 0)),
+                    "quality_class": batch.get("quality_class", ""),
+                    "joined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                }
+            )
+            pull["batch_ids"].append(batch_id_int)
+            pull_fill.add_volume(pull_id, pull, batch.get("volume", 0))
+            return True
+
+        confirmed, added = await pull_reservations.confirm(reservation_id, apply_add_batch)
+        if not confirmed or not added:
+            await callback_query.answer("⚠️ Уже добавлена или нет места", show_alert=True)
+            return
 
         save_pulls_to_pickle()
 
@@ -28582,11 +32946,7 @@ async def process_batch_selection_for_pull(
 
         logging.info(f"✅ Партия {batch_id} добавлена в пулл {pull_id}")
 
-        try:
-            if "gs" in globals() and hasattr(gs, "sync_pull_to_sheets"):
-                gs.sync_pull_to_sheets(pull_id, pull)
-        except Exception as e:
-            logging.debug(f"Синхронизация: {e}")
+        sheets_outbox.upsert_pull(pull)
 
     except Exception as e:
         logging.error(f"Ошибка: {e}")
@@ -28643,7 +33003,7 @@ async def safe_publish_to_channel(batch):
 # ═══════════════════════════════════════════════════════════════════════════
 # ОБРАБОТЧИКИ ОСНОВНЫХ КНОПОК МЕНЮ (ДОБАВЛЕНЫ)
 # ═══════════════════════════════════════════════════════════════════════════
-@dp.message_handler(lambda m: m.text == "📋 Мои пуллы", state="*")
+@router.message_handler(text="📋 Мои пуллы", state="*")
 async def show_my_pulls_farmer(message: types.Message, state: FSMContext):
     """Показать пуллы в которых участвует фермер"""
     user_id = message.from_user.id
@@ -28708,7 +33068,7 @@ async def show_my_pulls_farmer(message: types.Message, state: FSMContext):
     await message.answer(msg, parse_mode="Markdown")
 
 
-@dp.message_handler(lambda m: m.text == "➕ Создать партию", state="*")
+@router.message_handler(text="➕ Создать партию", state="*")
 async def create_batch_start(message: types.Message, state: FSMContext):
     """Начать создание партии"""
     user_id = message.from_user.id
@@ -28730,7 +33090,7 @@ async def create_batch_start(message: types.Message, state: FSMContext):
 # ═══════════════════════════════════════════════════════════════════════════
 
 
-@dp.message_handler(commands=["debug"], state="*")
+@router.message_handler(commands=["debug"], state="*")
 async def debug_account(message: types.Message):
     """Показать информацию о своём аккаунте для отладки"""
     user_id = message.from_user.id
@@ -28765,10 +33125,9 @@ async def debug_account(message: types.Message):
     # Проверяем Google Sheets
     try:  # ← ПРАВИЛЬНЫЙ ОТСТУП!
         if gs and gs.spreadsheet:
-            worksheet = gs.spreadsheet.worksheet("Users")
-            cell = worksheet.find(str(user_id))
-            if cell:
-                info.append(f"✅ Найден в Google Sheets (строка {cell.row})")
+            row_num = await find_sheet_row("Users", user_id)
+            if row_num:
+                info.append(f"✅ Найден в Google Sheets (строка {row_num})")
             else:
                 info.append("❌ Не найден в Google Sheets")
         else:
@@ -28783,9 +33142,7 @@ async def debug_account(message: types.Message):
 # СИСТЕМА ЛОГИСТИЧЕСКИХ ЗАЯВОК
 # ============================================================================
 # -------------------- ЭКСПОРТЁР: СОЗДАНИЕ ЗАЯВКИ --------------------
-@dp.message_handler(
-    lambda m: m.text == "🚚 Заявка на логистику", state="*"
-)  # ← ИСПРАВЛЕНО!
+@router.message_handler(text="🚚 Заявка на логистику", state="*")  # ← ИСПРАВЛЕНО!
 async def create_logistics_request_start(message: types.Message, state: FSMContext):
     """Создание заявки на логистику - с проверкой готовности пула"""
     await state.finish()
@@ -28906,9 +33263,7 @@ async def create_logistics_request_start(message: types.Message, state: FSMConte
     )
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("create_logistic_req:"), state="*"
-)
+@router.callback_query_handler(prefix="create_logistic_req:", state="*")
 async def select_pull_for_logistics(callback: types.CallbackQuery, state: FSMContext):
     """Выбор пула для заявки"""
     try:
@@ -28966,7 +33321,7 @@ async def select_pull_for_logistics(callback: types.CallbackQuery, state: FSMCon
     await callback.answer()
 
 
-@dp.message_handler(state=CreateLogisticRequestStatesGroup.route_from)
+@router.message_handler(state=CreateLogisticRequestStatesGroup.route_from)
 async def logistics_request_from(message: types.Message, state: FSMContext):
     """Место погрузки"""
     route_from = message.text.strip()
@@ -28986,7 +33341,7 @@ async def logistics_request_from(message: types.Message, state: FSMContext):
     await CreateLogisticRequestStatesGroup.loading_date.set()
 
 
-@dp.message_handler(state=CreateLogisticRequestStatesGroup.loading_date)
+@router.message_handler(state=CreateLogisticRequestStatesGroup.loading_date)
 async def logistics_request_date(message: types.Message, state: FSMContext):
     """Дата погрузки"""
     loading_date = message.text.strip()
@@ -29016,7 +33371,7 @@ async def logistics_request_date(message: types.Message, state: FSMContext):
     await CreateLogisticRequestStatesGroup.desired_price.set()
 
 
-@dp.message_handler(state=CreateLogisticRequestStatesGroup.desired_price)
+@router.message_handler(state=CreateLogisticRequestStatesGroup.desired_price)
 async def logistics_request_desired_price(message: types.Message, state: FSMContext):
     """Ожидаемая цена доставки"""
     try:
@@ -29042,10 +33397,8 @@ async def logistics_request_desired_price(message: types.Message, state: FSMCont
         )
 
 
-@dp.message_handler(
-    lambda m: m.text == "/skip", state=CreateLogisticRequestStatesGroup.notes
-)
-@dp.message_handler(state=CreateLogisticRequestStatesGroup.notes)
+@router.message_handler(text="/skip", state=CreateLogisticRequestStatesGroup.notes)
+@router.message_handler(state=CreateLogisticRequestStatesGroup.notes)
 async def logistics_request_finish(message: types.Message, state: FSMContext):
     """Завершение создания заявки"""
     global logistics_request_counter
@@ -29165,9 +33518,7 @@ async def logistics_request_finish(message: types.Message, state: FSMContext):
     )
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_logistics_req:"), state="*"
-)
+@router.callback_query_handler(prefix="view_logistics_req:", state="*")
 async def view_logistics_request_details(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -29486,7 +33837,7 @@ Email: <code>{req.get('exporter_email', 'Не указан')}</code>
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("respond_logistics:"), state="*")
+@router.callback_query_handler(prefix="respond_logistics:", state="*")
 async def respond_to_logistics_request(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -29551,7 +33902,7 @@ async def respond_to_logistics_request(
     await make_offer_start(callback, state)
 
 
-@dp.message_handler(state=LogisticOfferStates.price)
+@router.message_handler(state=LogisticOfferStates.price)
 async def logistics_offer_price(message: types.Message, state: FSMContext):
     """Цена за перевозку"""
     try:
@@ -29575,7 +33926,7 @@ async def logistics_offer_price(message: types.Message, state: FSMContext):
         await message.answer("❌ Некорректная цена. Введите положительное число.")
 
 
-@dp.message_handler(state=LogisticOfferStates.vehicle_type)
+@router.message_handler(state=LogisticOfferStates.vehicle_type)
 async def logistics_offer_vehicle(message: types.Message, state: FSMContext):
     """Тип транспорта"""
     vehicle_type = message.text.strip()
@@ -29592,7 +33943,7 @@ async def logistics_offer_vehicle(message: types.Message, state: FSMContext):
     await LogisticOfferStates.delivery_date.set()
 
 
-@dp.message_handler(state=LogisticOfferStates.delivery_date)
+@router.message_handler(state=LogisticOfferStates.delivery_date)
 async def logistics_offer_days(message: types.Message, state: FSMContext):
     """Срок доставки"""
     try:
@@ -29621,10 +33972,8 @@ async def logistics_offer_days(message: types.Message, state: FSMContext):
 # ============================================================================
 
 
-@dp.message_handler(
-    lambda m: m.text == "/skip", state=LogisticOfferStates.additional_info
-)
-@dp.message_handler(state=LogisticOfferStates.additional_info)
+@router.message_handler(text="/skip", state=LogisticOfferStates.additional_info)
+@router.message_handler(state=LogisticOfferStates.additional_info)
 async def logistics_offer_finish(message: types.Message, state: FSMContext):
     """Завершение отклика логиста"""
     global logistics_offer_counter
@@ -29737,53 +34086,11 @@ async def logistics_offer_finish(message: types.Message, state: FSMContext):
 # ============================================================================
 async def notify_logistics_about_new_request(request: dict):
     """Уведомление логистов о новой заявке на логистику от экспортёра."""
-    logistics_users = []
-    seen_logist_ids = set()
-    for uid, u in users.items():
-        if not isinstance(u, dict):
-            continue
-        if not is_logistic_role(u.get("role")):
-            continue
-        normalized_uid = int(uid) if str(uid).isdigit() else uid
-        uid_key = str(normalized_uid)
-        if uid_key in seen_logist_ids:
-            continue
-        seen_logist_ids.add(uid_key)
-        logistics_users.append(normalized_uid)
-
-    desired_date = (
-        request.get("loading_date")
-        or request.get("desired_date")
-        or "Не указана"
-    )
-    culture = request.get("culture", "—")
-    volume = request.get("volume", 0) or 0
-    route_from = request.get("route_from", "—")
-    route_to = request.get("route_to", "—")
-    desired_price = request.get("desired_price", 0) or 0
-
-    msg = (
-        f"✅ <b>Заявка на логистику #{request.get('id','-')}</b>\n\n"
-        f"📦 Пул: #{request.get('pull_id','-')}\n"
-        f"🌾 Культура: {culture}\n"
-        f"📊 Объём: {volume:.0f} т\n"
-        f"📍 Маршрут: {route_from} → {route_to}\n"
-        f"📅 Дата погрузки: {desired_date}\n"
-        f"💰 Ожидаемая цена: {desired_price:,.0f} ₽/т\n\n"
-        f"👤 Экспортёр: {request.get('exporter_name','-')}\n"
-        f"☎️ <code>{request.get('exporter_phone','-')}</code>\n"
-        f"📧 <code>{request.get('exporter_email','Не указан')}</code>\n\n"
-        "💼 Откликнитесь через меню <b>«Активные заявки»</b>."
-    )
-
-    for logist_id in logistics_users:
-        try:
-            await bot.send_message(logist_id, msg, parse_mode="HTML")
-            logging.info(
-                f"✅ Notified logist {logist_id} about request #{request.get('id','-')}"
-            )
-        except Exception as e:
-            logging.error(f"❌ Error notifying logist {logist_id}: {e}")
+    try:
+        return await send_carrier_wave("logistics", request.get("id"))
+    except Exception as e:
+        logging.error(f"❌ Error notifying logists about request #{request.get('id','-')}: {e}")
+        return 0
 
 
 async def notify_exporter_about_offer(request: dict, offer: dict):
@@ -29876,7 +34183,7 @@ async def notify_exporter_about_offer(request: dict, offer: dict):
 # ============================================================================
 # 🔙 НАВИГАЦИОННЫЕ ОБРАБОТЧИКИ
 # ===========================================================================
-@dp.callback_query_handler(lambda c: c.data == "back_to_logistics_requests", state="*")
+@router.callback_query_handler(data="back_to_logistics_requests", state="*")
 async def back_to_logistics_requests_handler(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -29890,7 +34197,7 @@ async def back_to_logistics_requests_handler(
     return
 
 
-@dp.callback_query_handler(lambda c: c.data == "noop", state="*")
+@router.callback_query_handler(data="noop", state="*")
 async def noop_handler(callback: types.CallbackQuery):
     """Пустой обработчик для кнопок без действия"""
     await callback.answer()
@@ -29899,7 +34206,7 @@ async def noop_handler(callback: types.CallbackQuery):
 # ====================================================================
 # ПОИСК ПО КУЛЬТУРЕ
 # ====================================================================
-@dp.message_handler(Text(equals="🔍 Поиск по культуре"), state="*")
+@router.message_handler(text="🔍 Поиск по культуре", state="*")
 async def start_search_by_culture(message: types.Message, state: FSMContext):
     """Начало поиска партий по культуре"""
 
@@ -29923,7 +34230,7 @@ if "expeditor_cards" not in globals():
     expeditor_cards = {}
 
 
-@dp.message_handler(Text(equals="📋 Моя карточка"), state="*")
+@router.message_handler(text="📋 Моя карточка", state="*")
 async def show_my_card_menu(message: types.Message, state: FSMContext):
     """Показать меню карточки логиста/экспедитора (унифицировано)."""
     await state.finish()
@@ -30037,7 +34344,7 @@ async def show_my_card_menu(message: types.Message, state: FSMContext):
 # ====================================================================
 
 
-@dp.callback_query_handler(lambda c: c.data == "create_logistic_card", state="*")
+@router.callback_query_handler(data="create_logistic_card", state="*")
 async def start_create_logistic_card(callback: types.CallbackQuery, state: FSMContext):
     """Старт создания карточки логиста."""
     await state.finish()
@@ -30051,7 +34358,7 @@ async def start_create_logistic_card(callback: types.CallbackQuery, state: FSMCo
     await callback.answer()
 
 
-@dp.message_handler(state=CreateLogisticCardStates.routes)
+@router.message_handler(state=CreateLogisticCardStates.routes)
 async def process_logistic_routes(message: types.Message, state: FSMContext):
     """Шаг 1 — маршруты."""
     await state.update_data(routes=message.text.strip())
@@ -30061,7 +34368,7 @@ async def process_logistic_routes(message: types.Message, state: FSMContext):
     await CreateLogisticCardStates.price_per_km.set()
 
 
-@dp.message_handler(state=CreateLogisticCardStates.price_per_km)
+@router.message_handler(state=CreateLogisticCardStates.price_per_km)
 async def process_price_per_km(message: types.Message, state: FSMContext):
     """Шаг 2 — цена за км."""
     try:
@@ -30075,7 +34382,7 @@ async def process_price_per_km(message: types.Message, state: FSMContext):
         await message.answer("❌ Введите число. Попробуйте снова:")
 
 
-@dp.message_handler(state=CreateLogisticCardStates.price_per_ton)
+@router.message_handler(state=CreateLogisticCardStates.price_per_ton)
 async def process_price_per_ton(message: types.Message, state: FSMContext):
     """Шаг 3 — цена за тонну."""
     try:
@@ -30090,7 +34397,7 @@ async def process_price_per_ton(message: types.Message, state: FSMContext):
         await message.answer("❌ Введите число. Попробуйте снова:")
 
 
-@dp.message_handler(state=CreateLogisticCardStates.min_volume)
+@router.message_handler(state=CreateLogisticCardStates.min_volume)
 async def process_min_volume(message: types.Message, state: FSMContext):
     """Шаг 4 — минимальный объем."""
     try:
@@ -30105,7 +34412,7 @@ async def process_min_volume(message: types.Message, state: FSMContext):
         await message.answer("❌ Введите число. Попробуйте снова:")
 
 
-@dp.message_handler(state=CreateLogisticCardStates.transport_type)
+@router.message_handler(state=CreateLogisticCardStates.transport_type)
 async def process_transport_type(message: types.Message, state: FSMContext):
     """Шаг 5 — тип транспорта."""
     await state.update_data(transport_type=message.text.strip())
@@ -30140,8 +34447,8 @@ async def process_transport_type(message: types.Message, state: FSMContext):
     await CreateLogisticCardStates.ports.set()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("selectport_"), state=CreateLogisticCardStates.ports
+@router.callback_query_handler(
+    prefix="selectport_", state=CreateLogisticCardStates.ports
 )
 async def toggle_port_selection(callback: types.CallbackQuery, state: FSMContext):
     """Выбор/снятие порта в списке портов логиста."""
@@ -30186,8 +34493,8 @@ async def toggle_port_selection(callback: types.CallbackQuery, state: FSMContext
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data == "ports_selected", state=CreateLogisticCardStates.ports
+@router.callback_query_handler(
+    data="ports_selected", state=CreateLogisticCardStates.ports
 )
 async def ports_selected(callback: types.CallbackQuery, state: FSMContext):
     """Подтверждение выбора портов."""
@@ -30208,7 +34515,7 @@ async def ports_selected(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.message_handler(state=CreateLogisticCardStates.additional_info)
+@router.message_handler(state=CreateLogisticCardStates.additional_info)
 async def save_logistic_card(message: types.Message, state: FSMContext):
     """Финальный шаг — сохранение карточки логиста в logistics_cards."""
     additional_raw = (message.text or "").strip()
@@ -30272,7 +34579,7 @@ async def save_logistic_card(message: types.Message, state: FSMContext):
 # ====================================================================
 # СОЗДАНИЕ КАРТОЧКИ ЭКСПЕДИТОРА (АНАЛОГИЧНО)
 # ====================================================================
-@dp.callback_query_handler(lambda c: c.data == "create_expeditor_card", state="*")
+@router.callback_query_handler(data="create_expeditor_card", state="*")
 async def start_create_expeditor_card(callback: types.CallbackQuery, state: FSMContext):
     """Старт создания карточки экспедитора (услуги + порты)."""
     await state.finish()
@@ -30296,7 +34603,7 @@ async def start_create_expeditor_card(callback: types.CallbackQuery, state: FSMC
     await callback.answer()
 
 
-@dp.message_handler(state=CreateExpeditorCardStates.services_text)
+@router.message_handler(state=CreateExpeditorCardStates.services_text)
 async def process_expeditor_services_text(message: types.Message, state: FSMContext):
     """Шаг 1 — спектр услуг экспедитора."""
     await state.update_data(services_text=message.text.strip())
@@ -30334,8 +34641,8 @@ async def process_expeditor_services_text(message: types.Message, state: FSMCont
     await CreateExpeditorCardStates.ports.set()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("selectexpport_"), state=CreateExpeditorCardStates.ports
+@router.callback_query_handler(
+    prefix="selectexpport_", state=CreateExpeditorCardStates.ports
 )
 async def toggle_expeditor_port(callback: types.CallbackQuery, state: FSMContext):
     """Выбор/снятие порта для карточки экспедитора."""
@@ -30387,9 +34694,8 @@ async def toggle_expeditor_port(callback: types.CallbackQuery, state: FSMContext
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data == "expeditor_ports_selected",
-    state=CreateExpeditorCardStates.ports,
+@router.callback_query_handler(
+    data="expeditor_ports_selected", state=CreateExpeditorCardStates.ports
 )
 async def expeditor_ports_selected(callback: types.CallbackQuery, state: FSMContext):
     """Подтверждение выбранных портов экспедитора."""
@@ -30411,7 +34717,7 @@ async def expeditor_ports_selected(callback: types.CallbackQuery, state: FSMCont
     await callback.answer()
 
 
-@dp.message_handler(state=CreateExpeditorCardStates.regions)
+@router.message_handler(state=CreateExpeditorCardStates.regions)
 async def process_expeditor_regions(message: types.Message, state: FSMContext):
     """Регионы работы."""
     await state.update_data(regions=message.text.strip())
@@ -30426,7 +34732,7 @@ async def process_expeditor_regions(message: types.Message, state: FSMContext):
     await CreateExpeditorCardStates.experience.set()
 
 
-@dp.message_handler(state=CreateExpeditorCardStates.experience)
+@router.message_handler(state=CreateExpeditorCardStates.experience)
 async def process_expeditor_experience(message: types.Message, state: FSMContext):
     """Опыт + доп.описание в одном шаге."""
     text = (message.text or "").strip()
@@ -30478,7 +34784,7 @@ async def process_expeditor_experience(message: types.Message, state: FSMContext
 # ====================================================================
 # ВЫБОР ЛОГИСТА ЭКСПОРТЁРОМ
 # ====================================================================
-@dp.callback_query_handler(lambda c: c.data.startswith("select_logistic_"))
+@router.callback_query_handler(prefix="select_logistic_")
 async def select_logistic_handler(callback: types.CallbackQuery):
     """Выбор логиста для сделки (legacy-сценарий после закрытия пула),
     с полными контактами логиста и экспортёра.
@@ -30587,9 +34893,9 @@ async def select_logistic_handler(callback: types.CallbackQuery):
 # ====================================================================
 # ВЫБОР ЭКСПЕДИТОРА ЭКСПОРТЁРОМ
 # ====================================================================
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("select_expeditor_")
-    and not c.data.startswith("select_expeditor_for_pull:")
+@router.callback_query_handler(
+    lambda c: not c.data.startswith("select_expeditor_for_pull:"),
+    prefix="select_expeditor_",
 )
 async def select_expeditor_handler(callback: types.CallbackQuery):
     """Выбор экспедитора для сделки (legacy-сценарий после закрытия пула),
@@ -30697,7 +35003,7 @@ async def select_expeditor_handler(callback: types.CallbackQuery):
 # ============================================================================
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_menu", state="*")
+@router.callback_query_handler(data="back_to_menu", state="*")
 async def back_to_menu_handler(callback: types.CallbackQuery, state: FSMContext):
     """Возврат в главное меню"""
     await state.finish()
@@ -30735,7 +35041,7 @@ async def back_to_menu_handler(callback: types.CallbackQuery, state: FSMContext)
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "cancel", state="*")
+@router.callback_query_handler(data="cancel", state="*")
 async def cancel_handler(callback: types.CallbackQuery, state: FSMContext):
     """Отмена текущего действия"""
     await state.finish()
@@ -30743,13 +35049,13 @@ async def cancel_handler(callback: types.CallbackQuery, state: FSMContext):
     await back_to_menu_handler(callback, state)
 
 
-@dp.callback_query_handler(lambda c: c.data == "cancel_action", state="*")
+@router.callback_query_handler(data="cancel_action", state="*")
 async def cancel_action_handler(callback: types.CallbackQuery, state: FSMContext):
     """Отмена действия"""
     await cancel_handler(callback, state)
 
 
-@dp.callback_query_handler(lambda c: c.data == "transport_type", state="*")
+@router.callback_query_handler(data="transport_type", state="*")
 async def transport_type_handler(callback: types.CallbackQuery):
     """Выбор типа транспорта"""
     keyboard = InlineKeyboardMarkup(row_width=2)
@@ -30765,7 +35071,7 @@ async def transport_type_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("transport_type:"), state="*")
+@router.callback_query_handler(prefix="transport_type:", state="*")
 async def transport_type_value_handler(callback: types.CallbackQuery):
     """Fallback для старых кнопок transport_type:*."""
     selected = callback.data.split(":", 1)[1]
@@ -30773,7 +35079,7 @@ async def transport_type_value_handler(callback: types.CallbackQuery):
     await callback.answer(f"Выбран транспорт: {labels.get(selected, selected)}", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("transport:"), state="*")
+@router.callback_query_handler(prefix="transport:", state="*")
 async def legacy_transport_selected(callback: types.CallbackQuery, state: FSMContext):
     """Fallback для устаревших кнопок выбора транспорта."""
     await state.finish()
@@ -30787,7 +35093,7 @@ async def legacy_transport_selected(callback: types.CallbackQuery, state: FSMCon
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("vehicle:"), state="*")
+@router.callback_query_handler(prefix="vehicle:", state="*")
 async def legacy_vehicle_selected(callback: types.CallbackQuery):
     """Fallback для устаревших vehicle-кнопок."""
     await callback.answer(
@@ -30796,7 +35102,7 @@ async def legacy_vehicle_selected(callback: types.CallbackQuery):
     )
 
 
-@dp.callback_query_handler(lambda c: c.data == "view_my_batches", state="*")
+@router.callback_query_handler(data="view_my_batches", state="*")
 async def view_my_batches_handler(callback: types.CallbackQuery):
     """Просмотр моих партий"""
     user_id = callback.from_user.id
@@ -30826,7 +35132,7 @@ async def view_my_batches_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "startsearch", state="*")
+@router.callback_query_handler(data="startsearch", state="*")
 async def startsearch_handler(callback: types.CallbackQuery):
     """Начать поиск"""
     keyboard = InlineKeyboardMarkup(row_width=2)
@@ -30843,12 +35149,353 @@ async def startsearch_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "broadcast_confirm", state="*")
+# ════════════════════════════════════════════════════════════════════
+# РАССЫЛКИ: ФОНОВЫЕ ЗАДАНИЯ С ПРОГРЕССОМ И ВОЗОБНОВЛЕНИЕМ
+# ════════════════════════════════════════════════════════════════════
+BROADCAST_CHUNK_SIZE = 50  # получателей между сохранениями прогресса
+BROADCAST_SEGMENT_ROLES = {
+    "farmer": "🌾 Фермеры",
+    "exporter": "📦 Экспортёры",
+    "logistic": "🚚 Логисты",
+    "expeditor": "🚛 Экспедиторы",
+}
+broadcast_jobs = {}  # job_id -> задание рассылки (см. create_broadcast_job)
+broadcast_tasks = {}  # job_id -> asyncio.Task
+
+
+def segment_role_key(role) -> str:
+    """Роль пользователя -> ключ сегмента рассылки."""
+    if is_logistic_role(role):
+        return "logistic"
+    if is_expeditor_role(role):
+        return "expeditor"
+    normalized = str(role or "").strip().lower()
+    return normalized if normalized in BROADCAST_SEGMENT_ROLES else "other"
+
+
+def group_users_by_segment() -> dict:
+    """
+    Пользователи по роли и региону: {"role": {key: [ids]},
+    "region": {name: [ids]}}. Один проход по users на шаг настройки
+    рассылки админом: кнопки сегментов и счётчики берутся из результата.
+    """
+    index = {"role": defaultdict(list), "region": defaultdict(list)}
+    for uid, user in users.items():
+        if not isinstance(user, dict):
+            continue
+        index["role"][segment_role_key(user.get("role"))].append(uid)
+        region = str(user.get("region") or "").strip()
+        if region:
+            index["region"][region].append(uid)
+    return index
+
+
+def is_user_blocked(user_id) -> bool:
+    user = get_user_by_id(user_id)
+    return isinstance(user, dict) and bool(user.get("bot_blocked"))
+
+
+def mark_user_blocked(user_id, blocked: bool = True, save: bool = True):
+    """
+    Отмечает, что пользователь заблокировал бота (или снимает отметку).
+    save=False — сохранит вызывающий (рассылка сохраняет users один раз).
+    """
+    user = get_user_by_id(user_id)
+    if not isinstance(user, dict) or bool(user.get("bot_blocked")) == blocked:
+        return
+    if blocked:
+        user["bot_blocked"] = True
+        user["bot_blocked_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        logging.info(f"🚫 Пользователь {user_id} недоступен — исключён из рассылок")
+    else:
+        user.pop("bot_blocked", None)
+        user.pop("bot_blocked_at", None)
+    if save:
+        save_users_to_json()
+        save_users_to_pickle()
+
+
+def save_broadcast_jobs():
+    """Сохраняет задания рассылок (с прогрессом по получателям) в JSON."""
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        tmp_path = BROADCASTS_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(broadcast_jobs, f, ensure_ascii=False)
+        os.replace(tmp_path, BROADCASTS_FILE)
+    except Exception as e:
+        logging.error(f"❌ Ошибка сохранения рассылок: {e}")
+
+
+def load_broadcast_jobs():
+    global broadcast_jobs
+    try:
+        if os.path.exists(BROADCASTS_FILE):
+            with open(BROADCASTS_FILE, "r", encoding="utf-8") as f:
+                broadcast_jobs = json.load(f)
+            logging.info(f"✅ Рассылки загружены: {len(broadcast_jobs)}")
+    except Exception as e:
+        logging.error(f"❌ Ошибка загрузки рассылок: {e}")
+        broadcast_jobs = {}
+
+
+def create_broadcast_job(text: str, recipients: list, segment_title: str, created_by) -> dict:
+    job_id = str(next_numeric_id(broadcast_jobs))
+    job = {
+        "id": job_id,
+        "text": text,
+        "segment": segment_title,
+        "recipients": list(recipients),
+        "results": {},  # str(user_id) -> sent / failed / blocked
+        "sent": 0,
+        "failed": 0,
+        "blocked": 0,
+        "status": "running",
+        "created_by": created_by,
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "finished_at": None,
+        "progress_chat_id": None,
+        "progress_message_id": None,
+    }
+    broadcast_jobs[job_id] = job
+    save_broadcast_jobs()
+    return job
+
+
+def format_broadcast_progress(job: dict) -> str:
+    total = len(job["recipients"])
+    done = len(job["results"])
+    status_titles = {
+        "running": "⏳ Идёт рассылка",
+        "done": "✅ Рассылка завершена",
+        "cancelled": "⏹ Рассылка остановлена",
+    }
+    msg = f"{status_titles.get(job['status'], job['status'])} #{job['id']}\n"
+    msg += f"👥 Сегмент: {job['segment']}\n"
+    msg += f"📊 Обработано: {done}/{total}\n"
+    msg += f"📤 Отправлено: {job['sent']}\n"
+    msg += f"❌ Ошибок: {job['failed']}\n"
+    msg += f"🚫 Заблокировали бота: {job['blocked']}"
+    return msg
+
+
+async def update_broadcast_progress(job: dict):
+    if not job.get("progress_chat_id") or not job.get("progress_message_id"):
+        return
+    keyboard = None
+    if job["status"] == "running":
+        keyboard = InlineKeyboardMarkup()
+        keyboard.add(
+            InlineKeyboardButton(
+                "⏹ Остановить", callback_data=f"broadcast_stop:{job['id']}"
+            )
+        )
+    try:
+        await bot.edit_message_text(
+            format_broadcast_progress(job),
+            chat_id=job["progress_chat_id"],
+            message_id=job["progress_message_id"],
+            reply_markup=keyboard,
+        )
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        logging.debug(f"Прогресс рассылки #{job['id']} не обновлён: {e}")
+
+
+async def run_broadcast_job(job_id: str):
+    """
+    Отправляет рассылку порциями через очередь сообщений. После каждой
+    порции результат по получателям сохраняется, поэтому после рестарта
+    задание продолжается с тех, кто ещё не обработан.
+    """
+    job = broadcast_jobs.get(job_id)
+    if not job:
+        return
+    text = f"📢 <b>Рассылка:</b>\n\n{job['text']}"
+    pending = [uid for uid in job["recipients"] if str(uid) not in job["results"]]
+    blocked_found = False
+
+    try:
+        for start in range(0, len(pending), BROADCAST_CHUNK_SIZE):
+            if job["status"] != "running":
+                break
+            chunk = []
+            for uid in pending[start : start + BROADCAST_CHUNK_SIZE]:
+                if is_user_blocked(uid):
+                    job["results"][str(uid)] = "blocked"
+                    job["blocked"] += 1
+                else:
+                    chunk.append(uid)
+
+            results = await asyncio.gather(
+                *(
+                    message_queue.send_message(
+                        uid, text, priority=PRIORITY_BROADCAST, parse_mode="HTML"
+                    )
+                    for uid in chunk
+                ),
+                return_exceptions=True,
+            )
+            for uid, result in zip(chunk, results):
+                if isinstance(result, OUTBOUND_UNREACHABLE_ERRORS):
+                    job["results"][str(uid)] = "blocked"
+                    job["blocked"] += 1
+                    mark_user_blocked(uid, save=False)
+                    blocked_found = True
+                elif isinstance(result, Exception):
+                    job["results"][str(uid)] = "failed"
+                    job["failed"] += 1
+                    logging.error(f"Ошибка отправки рассылки {uid}: {result}")
+                else:
+                    job["results"][str(uid)] = "sent"
+                    job["sent"] += 1
+
+            save_broadcast_jobs()
+            await update_broadcast_progress(job)
+
+        if job["status"] == "running":
+            job["status"] = "done"
+        job["finished_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        save_broadcast_jobs()
+        await update_broadcast_progress(job)
+        logging.info(
+            f"📢 Рассылка #{job_id} ({job['status']}): отправлено {job['sent']}, "
+            f"ошибок {job['failed']}, заблокировали {job['blocked']}"
+        )
+    except asyncio.CancelledError:
+        save_broadcast_jobs()  # остановка бота: продолжим после рестарта
+        raise
+    finally:
+        broadcast_tasks.pop(job_id, None)
+        if blocked_found:
+            save_users_to_json()
+            save_users_to_pickle()
+
+
+def start_broadcast_job(job_id: str):
+    if job_id in broadcast_tasks:
+        return
+    broadcast_tasks[job_id] = asyncio.get_event_loop().create_task(
+        run_broadcast_job(job_id)
+    )
+
+
+def resume_broadcast_jobs() -> int:
+    """После рестарта продолжает незавершённые рассылки."""
+    load_broadcast_jobs()
+    resumed = 0
+    for job_id, job in broadcast_jobs.items():
+        if job.get("status") == "running":
+            start_broadcast_job(job_id)
+            resumed += 1
+    if resumed:
+        logging.info(f"📢 Возобновлено рассылок: {resumed}")
+    return resumed
+
+
+async def stop_broadcast_tasks():
+    """Остановка бота: прерываем рассылки, прогресс уже сохранён."""
+    tasks = list(broadcast_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def broadcast_segment_keyboard(index: dict, regions: list) -> InlineKeyboardMarkup:
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        InlineKeyboardButton(
+            f"👥 Всем ({len(users)})", callback_data="broadcast_segment:all"
+        )
+    )
+    keyboard.add(
+        *[
+            InlineKeyboardButton(
+                f"{title} ({len(index['role'].get(role, []))})",
+                callback_data=f"broadcast_segment:role:{role}",
+            )
+            for role, title in BROADCAST_SEGMENT_ROLES.items()
+        ]
+    )
+    keyboard.add(
+        *[
+            InlineKeyboardButton(
+                f"📍 {region} ({len(index['region'][region])})",
+                callback_data=f"broadcast_segment:region:{i}",
+            )
+            for i, region in enumerate(regions)
+        ]
+    )
+    keyboard.add(InlineKeyboardButton("❌ Отменить", callback_data="broadcast_cancel"))
+    return keyboard
+
+
+@router.message_handler(state=Broadcast.message)
+async def broadcast_message_received(message: types.Message, state: FSMContext):
+    """Текст рассылки получен — выбор сегмента."""
+    if not is_admin_user(message.from_user.id):
+        await state.finish()
+        return
+
+    index = group_users_by_segment()
+    # Регионы в порядке убывания числа пользователей (в кнопки — по номеру)
+    regions = sorted(index["region"], key=lambda r: -len(index["region"][r]))[:10]
+    await state.update_data(broadcast_message=message.html_text, broadcast_regions=regions)
+
+    await message.answer(
+        "📢 <b>Кому отправить рассылку?</b>\n\n"
+        f"{message.html_text}",
+        reply_markup=broadcast_segment_keyboard(index, regions),
+        parse_mode="HTML",
+    )
+    await Broadcast.confirm.set()
+
+
+@router.callback_query_handler(prefix="broadcast_segment:", state=Broadcast.confirm)
+async def broadcast_segment_selected(callback: types.CallbackQuery, state: FSMContext):
+    """Сегмент выбран — подтверждение с числом получателей."""
+    if not is_admin_user(callback.from_user.id):
+        await callback.answer("🚫 Доступ запрещен", show_alert=True)
+        return
+
+    data = await state.get_data()
+    index = group_users_by_segment()
+    parts = callback.data.split(":")
+
+    if parts[1] == "role" and len(parts) == 3:
+        recipients = index["role"].get(parts[2], [])
+        segment_title = BROADCAST_SEGMENT_ROLES.get(parts[2], parts[2])
+    elif parts[1] == "region" and len(parts) == 3 and parts[2].isdigit():
+        regions = data.get("broadcast_regions") or []
+        region = regions[int(parts[2])] if int(parts[2]) < len(regions) else ""
+        recipients = index["region"].get(region, [])
+        segment_title = f"📍 {region}"
+    else:
+        recipients = list(users.keys())
+        segment_title = "👥 Все пользователи"
+
+    active = [uid for uid in recipients if not is_user_blocked(uid)]
+    await state.update_data(
+        broadcast_recipients=active, broadcast_segment=segment_title
+    )
+    await callback.message.edit_text(
+        f"📢 <b>Подтвердите рассылку</b>\n\n"
+        f"👥 Сегмент: {segment_title}\n"
+        f"📨 Получателей: {len(active)}"
+        f" (заблокировали бота: {len(recipients) - len(active)})\n\n"
+        f"{data.get('broadcast_message', '')}",
+        reply_markup=admin_broadcast_keyboard(),
+        parse_mode="HTML",
+    )
+    await callback.answer()
+
+
+@router.callback_query_handler(data="broadcast_confirm", state="*")
 async def broadcast_confirm_handler(callback: types.CallbackQuery, state: FSMContext):
     """Подтверждение рассылки"""
     user_id = callback.from_user.id
-    user_role = (get_user_by_id(user_id) or {}).get("role")
-    if user_id != ADMIN_ID and user_role != "admin":
+    if not is_admin_user(user_id):
         await callback.answer("🚫 Доступ запрещен", show_alert=True)
         return
 
@@ -30860,25 +35507,40 @@ async def broadcast_confirm_handler(callback: types.CallbackQuery, state: FSMCon
         await callback.answer()
         return
 
-    # Отправляем всем пользователям
-    sent = 0
-    failed = 0
-
-    for user_id in users.keys():
-        try:
-            await bot.send_message(
-                user_id, f"📢 <b>Рассылка:</b>\n\n{message_text}", parse_mode="HTML"
-            )
-            sent += 1
-        except Exception as e:
-            failed += 1
-            logging.error(f"Ошибка отправки рассылки {user_id}: {e}")
-
-    await callback.message.answer(
-        f"✅ Рассылка завершена\n📤 Отправлено: {sent}\n❌ Ошибок: {failed}"
+    recipients = data.get("broadcast_recipients")
+    if recipients is None:
+        recipients = [uid for uid in users.keys() if not is_user_blocked(uid)]
+    job = create_broadcast_job(
+        message_text,
+        recipients,
+        data.get("broadcast_segment", "👥 Все пользователи"),
+        user_id,
     )
     await state.finish()
-    await callback.answer()
+
+    # Прогресс обновляется в этом сообщении, рассылка идёт в фоне
+    progress_message = await callback.message.answer(format_broadcast_progress(job))
+    job["progress_chat_id"] = progress_message.chat.id
+    job["progress_message_id"] = progress_message.message_id
+    save_broadcast_jobs()
+    start_broadcast_job(job["id"])
+    await callback.answer("📢 Рассылка запущена")
+
+
+@router.callback_query_handler(prefix="broadcast_stop:", state="*")
+async def broadcast_stop_handler(callback: types.CallbackQuery):
+    """Остановка рассылки: уже отправленное остаётся, остальным не отправляем."""
+    if not is_admin_user(callback.from_user.id):
+        await callback.answer("🚫 Доступ запрещен", show_alert=True)
+        return
+
+    job = broadcast_jobs.get(callback.data.split(":", 1)[1])
+    if not job or job["status"] != "running":
+        await callback.answer("ℹ️ Рассылка уже завершена")
+        return
+    job["status"] = "cancelled"
+    save_broadcast_jobs()
+    await callback.answer("⏹ Рассылка будет остановлена")
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -30886,7 +35548,7 @@ async def broadcast_confirm_handler(callback: types.CallbackQuery, state: FSMCon
 # ═══════════════════════════════════════════════════════════════════════════
 
 
-@dp.callback_query_handler(lambda c: c.data == "__legacy_viewoffer_disabled__")
+@router.callback_query_handler(data="__legacy_viewoffer_disabled__")
 async def view_offer_details_legacy(callback: types.CallbackQuery):
     """Fallback для устаревшей кнопки просмотра предложения."""
     keyboard = InlineKeyboardMarkup()
@@ -30903,7 +35565,7 @@ async def view_offer_details_legacy(callback: types.CallbackQuery):
 # ═══════════════════════════════════════════════════════════════════════════
 # ЛОГИСТ: ПРОСМОТР ДЕТАЛЕЙ ПРЕДЛОЖЕНИЯ
 # ═══════════════════════════════════════════════════════════════════════════
-@dp.callback_query_handler(lambda c: c.data.startswith("viewoffer:"), state="*")
+@router.callback_query_handler(prefix="viewoffer:", state="*")
 async def view_offer_details_callback(callback: types.CallbackQuery, state: FSMContext):
     """Legacy-роут: перенаправляет на актуальный экран деталей своего предложения."""
     await state.finish()
@@ -30935,11 +35597,8 @@ async def view_offer_details_callback(callback: types.CallbackQuery, state: FSMC
     await view_my_offer_details(callback, state)
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("editprice:")
-    or c.data.startswith("edit_vehicle_")
-    or c.data.startswith("edit_info_"),
-    state="*",
+@router.callback_query_handler(
+    prefix=["editprice:", "edit_vehicle_", "edit_info_"], state="*"
 )
 async def legacy_offer_edit_handler(callback: types.CallbackQuery):
     """Fallback для устаревших кнопок редактирования предложения."""
@@ -30953,7 +35612,7 @@ async def legacy_offer_edit_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("deleteoffer:"), state="*")
+@router.callback_query_handler(prefix="deleteoffer:", state="*")
 async def legacy_offer_delete_handler(callback: types.CallbackQuery):
     """Мягкое удаление предложения по старому callback."""
     try:
@@ -30982,7 +35641,7 @@ async def legacy_offer_delete_handler(callback: types.CallbackQuery):
     await callback.answer("✅ Предложение отменено", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("view_delivery:"), state="*")
+@router.callback_query_handler(prefix="view_delivery:", state="*")
 async def legacy_view_delivery_handler(callback: types.CallbackQuery, state: FSMContext):
     """Совместимость: редирект старого view_delivery:<offer_id> на актуальный экран доставки."""
     await state.finish()
@@ -31115,7 +35774,7 @@ async def legacy_view_delivery_handler(callback: types.CallbackQuery, state: FSM
 # ═══════════════════════════════════════════════════════════════════════════
 
 
-@dp.callback_query_handler(lambda c: c.data == "cancel_offer", state="*")
+@router.callback_query_handler(data="cancel_offer", state="*")
 async def cancel_offer_flow(callback: types.CallbackQuery, state: FSMContext):
     """Отмена пошагового создания предложения логиста/экспедитора."""
     await state.finish()
@@ -31127,7 +35786,7 @@ async def cancel_offer_flow(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("Отменено")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("cancel_offer:"), state="*")
+@router.callback_query_handler(prefix="cancel_offer:", state="*")
 async def cancel_offer_handler(callback: types.CallbackQuery):
     """Отмена предложения логистом"""
     try:
@@ -31172,9 +35831,7 @@ async def cancel_offer_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("confirm_cancel_offer:"), state="*"
-)
+@router.callback_query_handler(prefix="confirm_cancel_offer:", state="*")
 async def confirm_cancel_offer(callback: types.CallbackQuery):
     """Подтверждение и финальная обработка отмены предложения"""
     try:
@@ -31339,7 +35996,7 @@ async def confirm_cancel_offer(callback: types.CallbackQuery):
 # ============================================================================
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_offers_list", state="*")
+@router.callback_query_handler(data="back_to_offers_list", state="*")
 async def back_to_offers_list(callback: types.CallbackQuery, state: FSMContext):
     """Вернуться к списку предложений логиста"""
     await state.finish()
@@ -31538,7 +36195,7 @@ async def back_to_offers_list(callback: types.CallbackQuery, state: FSMContext):
 # ============================================================================
 # ✏️ МЕНЮ РЕДАКТИРОВАНИЯ КАРТОЧКИ
 # ============================================================================
-@dp.callback_query_handler(lambda c: c.data == "edit_logistic_card", state="*")
+@router.callback_query_handler(data="edit_logistic_card", state="*")
 async def edit_logistic_card_menu(callback: types.CallbackQuery, state: FSMContext):
     """Меню редактирования карточки логиста"""
     await state.finish()
@@ -31579,7 +36236,7 @@ async def edit_logistic_card_menu(callback: types.CallbackQuery, state: FSMConte
 # ============================================================================
 # 🚛 РЕДАКТИРОВАНИЕ ТИПА ТРАНСПОРТА
 # ============================================================================
-@dp.callback_query_handler(lambda c: c.data == "edit_card_vehicle", state="*")
+@router.callback_query_handler(data="edit_card_vehicle", state="*")
 async def edit_card_vehicle(callback: types.CallbackQuery, state: FSMContext):
     """Изменить тип транспорта в карточке"""
     await state.finish()
@@ -31616,7 +36273,7 @@ async def edit_card_vehicle(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_vtype_"), state="*")
+@router.callback_query_handler(prefix="edit_vtype_", state="*")
 async def save_edit_vehicle(callback: types.CallbackQuery, state: FSMContext):
     """Сохранить выбранный тип транспорта и показать обновленную карточку"""
     await state.finish()
@@ -31670,7 +36327,7 @@ async def save_edit_vehicle(callback: types.CallbackQuery, state: FSMContext):
 # ============================================================================
 # 📦 РЕДАКТИРОВАНИЕ ГРУЗОПОДЪЁМНОСТИ
 # ============================================================================
-@dp.callback_query_handler(lambda c: c.data == "edit_card_capacity", state="*")
+@router.callback_query_handler(data="edit_card_capacity", state="*")
 async def edit_card_capacity(callback: types.CallbackQuery, state: FSMContext):
     """Начать редактирование грузоподъёмности"""
     await state.finish()
@@ -31703,7 +36360,7 @@ async def edit_card_capacity(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.message_handler(state=EditCardStates.capacity, content_types=["text"])
+@router.message_handler(state=EditCardStates.capacity, content_types=["text"])
 async def save_edit_capacity(message: types.Message, state: FSMContext):
     """Сохранить новую грузоподъёмность из текстового ввода"""
     user_id = message.from_user.id
@@ -31774,7 +36431,7 @@ async def save_edit_capacity(message: types.Message, state: FSMContext):
         )
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_cap_"), state="*")
+@router.callback_query_handler(prefix="edit_cap_", state="*")
 async def save_edit_capacity_preset(callback: types.CallbackQuery, state: FSMContext):
     """Сохранить грузоподъёмность из предустановленного диапазона."""
     await state.finish()
@@ -31818,7 +36475,7 @@ async def save_edit_capacity_preset(callback: types.CallbackQuery, state: FSMCon
 # ============================================================================
 # 📍 РЕДАКТИРОВАНИЕ РЕГИОНОВ
 # ============================================================================
-@dp.callback_query_handler(lambda c: c.data == "edit_card_regions", state="*")
+@router.callback_query_handler(data="edit_card_regions", state="*")
 async def edit_card_regions(callback: types.CallbackQuery, state: FSMContext):
     """Начать редактирование регионов доставки (доп. к портам)"""
     await state.finish()
@@ -31850,7 +36507,7 @@ async def edit_card_regions(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.message_handler(state=EditCardStates.regions, content_types=["text"])
+@router.message_handler(state=EditCardStates.regions, content_types=["text"])
 async def save_edit_regions(message: types.Message, state: FSMContext):
     """Сохранить новые регионы доставки"""
     user_id = message.from_user.id
@@ -31946,7 +36603,7 @@ async def save_edit_regions(message: types.Message, state: FSMContext):
 # ============================================================================
 # 💰 РЕДАКТИРОВАНИЕ ЦЕНЫ ЗА КМ
 # ============================================================================
-@dp.callback_query_handler(lambda c: c.data == "edit_card_price", state="*")
+@router.callback_query_handler(data="edit_card_price", state="*")
 async def edit_card_price(callback: types.CallbackQuery, state: FSMContext):
     """Начать редактирование цены за км"""
     await state.finish()
@@ -31980,7 +36637,7 @@ async def edit_card_price(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.message_handler(state=EditCardStates.price_per_km, content_types=["text"])
+@router.message_handler(state=EditCardStates.price_per_km, content_types=["text"])
 async def save_edit_price(message: types.Message, state: FSMContext):
     """Сохранить новую цену за км"""
     user_id = message.from_user.id
@@ -32069,7 +36726,7 @@ async def save_edit_price(message: types.Message, state: FSMContext):
 # ============================================================================
 # 📝 РЕДАКТИРОВАНИЕ ОПИСАНИЯ
 # ============================================================================
-@dp.callback_query_handler(lambda c: c.data == "edit_card_description", state="*")
+@router.callback_query_handler(data="edit_card_description", state="*")
 async def edit_card_description(callback: types.CallbackQuery, state: FSMContext):
     """Начать редактирование описания компании"""
     await state.finish()
@@ -32106,7 +36763,7 @@ async def edit_card_description(callback: types.CallbackQuery, state: FSMContext
     await callback.answer()
 
 
-@dp.message_handler(state=EditCardStates.description, content_types=["text"])
+@router.message_handler(state=EditCardStates.description, content_types=["text"])
 async def save_edit_description(message: types.Message, state: FSMContext):
     """Сохранить новое описание компании"""
     user_id = message.from_user.id
@@ -32293,7 +36950,7 @@ async def show_card_after_edit(message: types.Message, user_id: int):
 # ============================================================================
 # 🔙 ОБРАБОТЧИК ВОЗВРАТА К КАРТОЧКЕ
 # ============================================================================
-@dp.callback_query_handler(lambda c: c.data == "back_to_card", state="*")
+@router.callback_query_handler(data="back_to_card", state="*")
 async def back_to_card(callback: types.CallbackQuery, state: FSMContext):
     """Вернуться к карточке логиста"""
     user_id = callback.from_user.id
@@ -32311,7 +36968,7 @@ async def back_to_card(callback: types.CallbackQuery, state: FSMContext):
             logging.debug(f"Не удалось отправить callback.answer в back_to_card: {answer_error}")
 
 
-@dp.callback_query_handler(lambda c: c.data == "refresh_card", state="*")
+@router.callback_query_handler(data="refresh_card", state="*")
 async def refresh_logistic_card(callback: types.CallbackQuery, state: FSMContext):
     """Обновить экран карточки логиста."""
     await state.finish()
@@ -32319,7 +36976,7 @@ async def refresh_logistic_card(callback: types.CallbackQuery, state: FSMContext
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "delete_logistic_card", state="*")
+@router.callback_query_handler(data="delete_logistic_card", state="*")
 async def delete_logistic_card(callback: types.CallbackQuery, state: FSMContext):
     """Удаление карточки логиста."""
     await state.finish()
@@ -32346,7 +37003,7 @@ async def delete_logistic_card(callback: types.CallbackQuery, state: FSMContext)
 # ============================================================================
 # ========== ОБРАБОТЧИКИ ЭКСПЕДИТОРА ============================================
 # ============================================================================
-@dp.message_handler(lambda m: m.text == "📋 Создать предложение", state="*")
+@router.message_handler(text="📋 Создать предложение", state="*")
 async def expeditor_create_offer_handler(message: types.Message, state: FSMContext):
     """Начать создание предложения экспедитора"""
     await state.finish()
@@ -32364,8 +37021,8 @@ async def expeditor_create_offer_handler(message: types.Message, state: FSMConte
     )
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("service:"), state=ExpeditorOfferStates.service_type
+@router.callback_query_handler(
+    prefix="service:", state=ExpeditorOfferStates.service_type
 )
 async def set_service_type(callback: types.CallbackQuery, state: FSMContext):
     """Установить тип услуги"""
@@ -32403,7 +37060,7 @@ async def set_service_type(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.message_handler(state=ExpeditorOfferStates.ports)
+@router.message_handler(state=ExpeditorOfferStates.ports)
 async def set_expeditor_ports(message: types.Message, state: FSMContext):
     """Установить порты обслуживания"""
     user_role = (get_user_by_id(message.from_user.id) or {}).get("role")
@@ -32426,7 +37083,7 @@ async def set_expeditor_ports(message: types.Message, state: FSMContext):
     )
 
 
-@dp.message_handler(state=ExpeditorOfferStates.price)
+@router.message_handler(state=ExpeditorOfferStates.price)
 async def set_expeditor_price(message: types.Message, state: FSMContext):
     """Установить цену услуги"""
     user_role = (get_user_by_id(message.from_user.id) or {}).get("role")
@@ -32453,7 +37110,7 @@ async def set_expeditor_price(message: types.Message, state: FSMContext):
     )
 
 
-@dp.message_handler(state=ExpeditorOfferStates.terms)
+@router.message_handler(state=ExpeditorOfferStates.terms)
 async def set_expeditor_terms(message: types.Message, state: FSMContext):
     """Установить условия"""
     user_role = (get_user_by_id(message.from_user.id) or {}).get("role")
@@ -32486,8 +37143,8 @@ async def set_expeditor_terms(message: types.Message, state: FSMContext):
     await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data == "confirm_expeditor_offer", state=ExpeditorOfferStates.confirm
+@router.callback_query_handler(
+    data="confirm_expeditor_offer", state=ExpeditorOfferStates.confirm
 )
 async def confirm_expeditor_offer(callback: types.CallbackQuery, state: FSMContext):
     """Подтвердить создание предложения экспедитора"""
@@ -32547,10 +37204,10 @@ async def confirm_expeditor_offer(callback: types.CallbackQuery, state: FSMConte
     await callback.answer()
 
 
-@dp.message_handler(
-    lambda m: m.text == "💼 Мои предложения"
-    and (get_user_by_id(m.from_user.id) or {}).get("role")
+@router.message_handler(
+    lambda m: (get_user_by_id(m.from_user.id) or {}).get("role")
     and is_expeditor_role((get_user_by_id(m.from_user.id) or {}).get("role")),
+    text="💼 Мои предложения",
     state="*",
 )
 async def expeditor_my_offers_handler(message: types.Message, state: FSMContext):
@@ -32593,7 +37250,7 @@ async def expeditor_my_offers_handler(message: types.Message, state: FSMContext)
 # ============================================================================
 # ЭКСПОРТЁР: ПРОСМОТР ПРЕДЛОЖЕНИЙ ЛОГИСТОВ
 # ============================================================================
-@dp.callback_query_handler(lambda c: c.data.startswith("show_all_offers_"), state="*")
+@router.callback_query_handler(prefix="show_all_offers_", state="*")
 async def show_all_offers_redirect(callback: types.CallbackQuery, state: FSMContext):
     """Совместимость со старым callback show_all_offers_*."""
     await state.finish()
@@ -32608,9 +37265,7 @@ async def show_all_offers_redirect(callback: types.CallbackQuery, state: FSMCont
     await view_request_offers(callback, state)
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_request_offers_"), state="*"
-)
+@router.callback_query_handler(prefix="view_request_offers_", state="*")
 async def view_request_offers(callback: types.CallbackQuery, state: FSMContext):
     """Просмотр предложений логистов по заявке"""
     await state.finish()
@@ -32785,9 +37440,7 @@ async def view_request_offers(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_offer_details_"), state="*"
-)
+@router.callback_query_handler(prefix="view_offer_details_", state="*")
 async def view_offer_details_for_exporter(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -32976,7 +37629,7 @@ async def view_offer_details_for_exporter(
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("compare_offers_"), state="*")
+@router.callback_query_handler(prefix="compare_offers_", state="*")
 async def compare_offers(callback: types.CallbackQuery, state: FSMContext):
     """Сравнение предложений"""
     await state.finish()
@@ -33016,10 +37669,14 @@ async def compare_offers(callback: types.CallbackQuery, state: FSMContext):
     # Сортируем по цене
     offers.sort(key=lambda x: x[1].get("price", 999999))
 
+    estimate = estimate_freight_for_request(request)
+
     text = "⚖️ <b>СРАВНЕНИЕ ПРЕДЛОЖЕНИЙ</b>\n\n"
     text += f"📦 Заявка #{request_id}\n"
-    text += f"📊 Сравниваем {len(offers)} предложений\n\n"
-    text += "━━━━━━━━━━━━━━━━━━━━\n\n"
+    text += f"📊 Сравниваем {len(offers)} предложений\n"
+    if estimate["distance_km"] is not None:
+        text += f"📐 Расстояние: ~{estimate['distance_km']:,.0f} км\n"
+    text += "\n━━━━━━━━━━━━━━━━━━━━\n\n"
 
     # Показываем топ-3
     for i, (offer_id, offer) in enumerate(offers[:3], 1):
@@ -33031,6 +37688,8 @@ async def compare_offers(callback: types.CallbackQuery, state: FSMContext):
 
         text += f"{medal} <b>#{i} - {logist_name}</b>\n"
         text += f"💰 Цена: <b>{offer.get('price', 0):,.0f} ₽</b>\n"
+        estimated = get_estimated_per_ton(estimate, logist_id)
+        text += f"📐 {format_estimate_vs_offer(offer.get('price', 0), estimated)}\n"
         text += f"🚛 Транспорт: {offer.get('vehicle_type')}\n"
         text += f"📅 Дата: {offer.get('delivery_date')}\n"
 
@@ -33060,7 +37719,10 @@ async def compare_offers(callback: types.CallbackQuery, state: FSMContext):
     text += f"💵 Минимальная: <b>{min_price:,.0f} ₽</b>\n"
     text += f"💰 Средняя: <b>{avg_price:,.0f} ₽</b>\n"
     text += f"💸 Максимальная: <b>{max_price:,.0f} ₽</b>\n"
-    text += f"📈 Разброс: <b>{max_price - min_price:,.0f} ₽</b>\n\n"
+    text += f"📈 Разброс: <b>{max_price - min_price:,.0f} ₽</b>\n"
+    if estimate["median_per_ton"]:
+        text += f"📐 Расчёт по рынку: <b>~{estimate['median_per_ton']:,.0f} ₽/т</b>\n"
+    text += "\n"
 
     # Рекомендация
     best_offer_id, best_offer = offers[0]
@@ -33116,7 +37778,7 @@ class RejectOfferStatesGroup(StatesGroup):
     reason = State()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("accept_offer_"), state="*")
+@router.callback_query_handler(prefix="accept_offer_", state="*")
 async def accept_offer_start(callback: types.CallbackQuery, state: FSMContext):
     """Начало принятия предложения экспортёром"""
     await state.finish()
@@ -33268,7 +37930,7 @@ async def accept_offer_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("confirm_accept_"), state="*")
+@router.callback_query_handler(prefix="confirm_accept_", state="*")
 async def accept_offer_confirmed(callback: types.CallbackQuery, state: FSMContext):
     """Подтверждение принятия предложения"""
     await state.finish()
@@ -33492,12 +38154,13 @@ async def accept_offer_confirmed(callback: types.CallbackQuery, state: FSMContex
             # Уведомляем логистов
             other_logist_id = get_offer_logist_id(other_offer)
             if other_logist_id:
-                asyncio.create_task(
+                background_tasks.spawn(
+                    "offer_rejected_notify",
                     notify_logistic_offer_rejected(
                         other_offer_id,
                         request_customer_id,
                         "Принято другое предложение",
-                    )
+                    ),
                 )
 
     # Сохраняем данные
@@ -33513,8 +38176,9 @@ async def accept_offer_confirmed(callback: types.CallbackQuery, state: FSMContex
     # Уведомляем принятого логиста
     logist_id = get_offer_logist_id(offer)
     if logist_id:
-        asyncio.create_task(
-            notify_logistic_offer_accepted(offer_id, request_customer_id)
+        background_tasks.spawn(
+            "offer_accepted_notify",
+            notify_logistic_offer_accepted(offer_id, request_customer_id),
         )
 
     # Сообщение пользователю
@@ -33565,7 +38229,7 @@ async def accept_offer_confirmed(callback: types.CallbackQuery, state: FSMContex
     )
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("reject_offer_"), state="*")
+@router.callback_query_handler(prefix="reject_offer_", state="*")
 async def reject_offer_start(callback: types.CallbackQuery, state: FSMContext):
     """Начало отклонения предложения"""
     await state.finish()
@@ -33699,8 +38363,8 @@ async def reject_offer_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("reject_reason_"), state=RejectOfferStatesGroup.reason
+@router.callback_query_handler(
+    prefix="reject_reason_", state=RejectOfferStatesGroup.reason
 )
 async def reject_offer_reason_selected(
     callback: types.CallbackQuery, state: FSMContext
@@ -33751,7 +38415,7 @@ class CallbackProxy:
         return None
 
 
-@dp.message_handler(state=RejectOfferStatesGroup.reason)
+@router.message_handler(state=RejectOfferStatesGroup.reason)
 async def reject_offer_custom_reason(message: types.Message, state: FSMContext):
     """Ввод своей причины отклонения"""
     reason = message.text.strip()
@@ -33890,8 +38554,9 @@ async def reject_offer_execute(
     logist_id = get_offer_logist_id(offer)
     request_customer_id = request_owner_id or user_id
     if logist_id:
-        asyncio.create_task(
-            notify_logistic_offer_rejected(offer_id, request_customer_id, reason)
+        background_tasks.spawn(
+            "offer_rejected_notify",
+            notify_logistic_offer_rejected(offer_id, request_customer_id, reason),
         )
 
     # Сообщение
@@ -33944,7 +38609,7 @@ async def reject_offer_execute(
 # ============================================================================
 # ЭКСПОРТЁР: УПРАВЛЕНИЕ ЗАЯВКАМИ НА ДОСТАВКУ
 # ============================================================================
-@dp.callback_query_handler(lambda c: c.data == "my_shipping_requests", state="*")
+@router.callback_query_handler(data="my_shipping_requests", state="*")
 async def show_my_shipping_requests(callback: types.CallbackQuery, state: FSMContext):
     """Список заявок экспортёра на доставку"""
     await state.finish()
@@ -34105,7 +38770,7 @@ async def show_my_shipping_requests(callback: types.CallbackQuery, state: FSMCon
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("view_my_request_"), state="*")
+@router.callback_query_handler(prefix="view_my_request_", state="*")
 async def view_my_request_details(callback: types.CallbackQuery, state: FSMContext):
     """Детальный просмотр своей заявки"""
     await state.finish()
@@ -34253,7 +38918,7 @@ async def view_my_request_details(callback: types.CallbackQuery, state: FSMConte
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("cancel_request_"), state="*")
+@router.callback_query_handler(prefix="cancel_request_", state="*")
 async def cancel_request_confirm(callback: types.CallbackQuery, state: FSMContext):
     """Подтверждение отмены заявки"""
     await state.finish()
@@ -34319,9 +38984,7 @@ async def cancel_request_confirm(callback: types.CallbackQuery, state: FSMContex
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("confirm_cancel_request_"), state="*"
-)
+@router.callback_query_handler(prefix="confirm_cancel_request_", state="*")
 async def cancel_request_confirmed(callback: types.CallbackQuery, state: FSMContext):
     """Отмена заявки подтверждена"""
     await state.finish()
@@ -34575,8 +39238,9 @@ async def cancel_request_confirmed(callback: types.CallbackQuery, state: FSMCont
         cancelled_deals += 1
 
     if should_notify_logistics:
-        asyncio.create_task(
-            notify_logistic_request_cancelled(request_id, "Заказчик отменил заявку")
+        background_tasks.spawn(
+            "request_cancelled_notify",
+            notify_logistic_request_cancelled(request_id, "Заказчик отменил заявку"),
         )
     expeditor_id = get_assigned_expeditor_id(request)
     if expeditor_id:
@@ -34634,9 +39298,7 @@ async def cancel_request_confirmed(callback: types.CallbackQuery, state: FSMCont
 # ============================================================================
 # ЛОГИСТИЧЕСКАЯ ЗАЯВКА: ОТМЕНА ВЛАДЕЛЬЦЕМ
 # ============================================================================
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("cancel_logistics_request:"), state="*"
-)
+@router.callback_query_handler(prefix="cancel_logistics_request:", state="*")
 async def cancel_logistics_request_confirm(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -34708,9 +39370,7 @@ async def cancel_logistics_request_confirm(
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("confirm_cancel_logistics_request:"), state="*"
-)
+@router.callback_query_handler(prefix="confirm_cancel_logistics_request:", state="*")
 async def cancel_logistics_request_confirmed(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -34975,10 +39635,11 @@ async def cancel_logistics_request_confirmed(
         cancelled_deals += 1
 
     if should_notify_logistics:
-        asyncio.create_task(
+        background_tasks.spawn(
+            "request_cancelled_notify",
             notify_logistic_request_cancelled(
                 request_id, "Заказчик отменил логистическую заявку"
-            )
+            ),
         )
     expeditor_id = get_assigned_expeditor_id(request)
     if expeditor_id:
@@ -35047,7 +39708,7 @@ async def cancel_logistics_request_confirmed(
 # ============================================================================
 # ЭКСПОРТЁР: ПРОСМОТР ДОСТАВОК
 # ============================================================================
-@dp.callback_query_handler(lambda c: c.data == "exporter_deliveries", state="*")
+@router.callback_query_handler(data="exporter_deliveries", state="*")
 async def show_exporter_deliveries(callback: types.CallbackQuery, state: FSMContext):
     """Список доставок экспортёра"""
     await state.finish()
@@ -35161,9 +39822,7 @@ async def show_exporter_deliveries(callback: types.CallbackQuery, state: FSMCont
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_delivery_by_request_"), state="*"
-)
+@router.callback_query_handler(prefix="view_delivery_by_request_", state="*")
 async def view_delivery_by_request(callback: types.CallbackQuery, state: FSMContext):
     """Просмотр доставки по ID заявки (редирект на view_delivery_...)"""
     await state.finish()
@@ -35281,7 +39940,7 @@ class RateLogisticStatesGroup(StatesGroup):
     review = State()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("rate_logistic_"), state="*")
+@router.callback_query_handler(prefix="rate_logistic_", state="*")
 async def rate_logistic_start(callback: types.CallbackQuery, state: FSMContext):
     """Начало оценки логиста"""
     await state.finish()
@@ -35411,9 +40070,7 @@ async def rate_logistic_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("rate_"), state=RateLogisticStatesGroup.rating
-)
+@router.callback_query_handler(prefix="rate_", state=RateLogisticStatesGroup.rating)
 async def rate_logistic_rating_selected(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -35452,15 +40109,13 @@ async def rate_logistic_rating_selected(
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data == "skip_review", state=RateLogisticStatesGroup.review
-)
+@router.callback_query_handler(data="skip_review", state=RateLogisticStatesGroup.review)
 async def rate_logistic_skip_review(callback: types.CallbackQuery, state: FSMContext):
     """Пропустить отзыв"""
     await rate_logistic_save(callback, state, None)
 
 
-@dp.message_handler(state=RateLogisticStatesGroup.review)
+@router.message_handler(state=RateLogisticStatesGroup.review)
 async def rate_logistic_review_entered(message: types.Message, state: FSMContext):
     """Ввод отзыва"""
     review = message.text.strip()
@@ -35668,9 +40323,7 @@ async def rate_logistic_save(callback_or_fake, state: FSMContext, review: str =
     logging.info(f"⭐ Экспортёр {user_id} оценил логиста {logist_id} на {rating}/5")
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_logistic_profile_"), state="*"
-)
+@router.callback_query_handler(prefix="view_logistic_profile_", state="*")
 async def view_logistic_profile(callback: types.CallbackQuery, state: FSMContext):
     """Просмотр профиля и рейтинга логиста"""
     await state.finish()
@@ -35748,7 +40401,7 @@ async def view_logistic_profile(callback: types.CallbackQuery, state: FSMContext
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "edit_expeditor_card", state="*")
+@router.callback_query_handler(data="edit_expeditor_card", state="*")
 async def edit_expeditor_card_callback(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -35799,7 +40452,7 @@ async def edit_expeditor_card_callback(
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "edit_exp_services", state="*")
+@router.callback_query_handler(data="edit_exp_services", state="*")
 async def edit_exp_services(callback: types.CallbackQuery, state: FSMContext):
     await state.finish()
     await callback.message.edit_text(
@@ -35810,7 +40463,7 @@ async def edit_exp_services(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.message_handler(state=EditExpeditorCardStates.services_text)
+@router.message_handler(state=EditExpeditorCardStates.services_text)
 async def save_exp_services(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     card = expeditor_cards.get(user_id)
@@ -35825,7 +40478,7 @@ async def save_exp_services(message: types.Message, state: FSMContext):
     await message.answer("✅ Услуги обновлены.", parse_mode="HTML")
 
 
-@dp.callback_query_handler(lambda c: c.data == "edit_exp_regions", state="*")
+@router.callback_query_handler(data="edit_exp_regions", state="*")
 async def edit_exp_regions(callback: types.CallbackQuery, state: FSMContext):
     await state.finish()
     user_id = callback.from_user.id
@@ -35845,7 +40498,7 @@ async def edit_exp_regions(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.message_handler(state=EditExpeditorCardStates.regions)
+@router.message_handler(state=EditExpeditorCardStates.regions)
 async def save_exp_regions(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     card = expeditor_cards.get(user_id)
@@ -35860,7 +40513,7 @@ async def save_exp_regions(message: types.Message, state: FSMContext):
     await message.answer("✅ Регионы обновлены.", parse_mode="HTML")
 
 
-@dp.callback_query_handler(lambda c: c.data == "edit_exp_experience", state="*")
+@router.callback_query_handler(data="edit_exp_experience", state="*")
 async def edit_exp_experience(callback: types.CallbackQuery, state: FSMContext):
     await state.finish()
     user_id = callback.from_user.id
@@ -35880,7 +40533,7 @@ async def edit_exp_experience(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.message_handler(state=EditExpeditorCardStates.experience)
+@router.message_handler(state=EditExpeditorCardStates.experience)
 async def save_exp_experience(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     card = expeditor_cards.get(user_id)
@@ -35895,7 +40548,7 @@ async def save_exp_experience(message: types.Message, state: FSMContext):
     await message.answer("✅ Опыт обновлён.", parse_mode="HTML")
 
 
-@dp.callback_query_handler(lambda c: c.data == "edit_exp_description", state="*")
+@router.callback_query_handler(data="edit_exp_description", state="*")
 async def edit_exp_description(callback: types.CallbackQuery, state: FSMContext):
     await state.finish()
     user_id = callback.from_user.id
@@ -35915,7 +40568,7 @@ async def edit_exp_description(callback: types.CallbackQuery, state: FSMContext)
     await callback.answer()
 
 
-@dp.message_handler(state=EditExpeditorCardStates.description)
+@router.message_handler(state=EditExpeditorCardStates.description)
 async def save_exp_description(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     card = expeditor_cards.get(user_id)
@@ -35935,7 +40588,7 @@ async def save_exp_description(message: types.Message, state: FSMContext):
 # ============================================================================
 
 
-@dp.callback_query_handler(lambda c: c.data == "expeditor_my_offers", state="*")
+@router.callback_query_handler(data="expeditor_my_offers", state="*")
 async def show_expeditor_my_offers(callback: types.CallbackQuery, state: FSMContext):
     """Список предложений экспедитора"""
     await state.finish()
@@ -36068,7 +40721,7 @@ async def show_expeditor_my_offers(callback: types.CallbackQuery, state: FSMCont
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_expeditor_offer_"), state="*")
+@router.callback_query_handler(prefix="edit_expeditor_offer_", state="*")
 async def edit_expeditor_offer_legacy(callback: types.CallbackQuery, state: FSMContext):
     """Fallback для старой кнопки редактирования оффера экспедитора."""
     await state.finish()
@@ -36082,10 +40735,10 @@ async def edit_expeditor_offer_legacy(callback: types.CallbackQuery, state: FSMC
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_expeditor_offer_")
-    and not c.data.startswith("view_expeditor_offer_for_pull:")
+@router.callback_query_handler(
+    lambda c: not c.data.startswith("view_expeditor_offer_for_pull:")
     and not c.data.startswith("view_expeditor_offer_for_request:"),
+    prefix="view_expeditor_offer_",
     state="*",
 )
 async def view_expeditor_offer_details(
@@ -36179,9 +40832,7 @@ async def view_expeditor_offer_details(
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("cancel_expeditor_offer_"), state="*"
-)
+@router.callback_query_handler(prefix="cancel_expeditor_offer_", state="*")
 async def cancel_expeditor_offer(callback: types.CallbackQuery, state: FSMContext):
     """Отмена предложения экспедитора"""
     await state.finish()
@@ -36233,7 +40884,7 @@ async def cancel_expeditor_offer(callback: types.CallbackQuery, state: FSMContex
     logging.info(f"❌ Экспедитор {user_id} отменил предложение #{offer_id}")
 
 
-@dp.callback_query_handler(lambda c: c.data == "expeditor_available_pulls", state="*")
+@router.callback_query_handler(data="expeditor_available_pulls", state="*")
 async def show_expeditor_available_pulls(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -36357,9 +41008,7 @@ async def show_expeditor_available_pulls(
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("view_pull_for_expeditor_"), state="*"
-)
+@router.callback_query_handler(prefix="view_pull_for_expeditor_", state="*")
 async def view_pull_for_expeditor(callback: types.CallbackQuery, state: FSMContext):
     """Просмотр пула для экспедитора"""
     await state.finish()
@@ -36417,7 +41066,7 @@ async def view_pull_for_expeditor(callback: types.CallbackQuery, state: FSMConte
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "expeditor_statistics", state="*")
+@router.callback_query_handler(data="expeditor_statistics", state="*")
 async def show_expeditor_statistics(callback: types.CallbackQuery, state: FSMContext):
     """Статистика экспедитора"""
     await state.finish()
@@ -36520,11 +41169,12 @@ class DealView(StatesGroup):
     viewing_detail = State()
 
 
-deals_cache = {}
+deals_cache = BoundedCache("deals_cache", CONFIG["user_cache_size"], ttl=600)
 
 
 # ==========================@==================================================
-@dp.message_handler(lambda msg: msg.text in ["📋 Мои сделки"])
+@router.message_handler(text="📋 Мои сделки")
+@throttle("deals")
 async def show_user_deals(message: types.Message, state: FSMContext):
     """✅ ГЛАВНЫЙ ОБРАБОТЧИК - показывает ВСЕ статусы, кнопки ТОЛЬКО если > 0"""
     await state.finish()
@@ -36611,35 +41261,35 @@ async def show_user_deals(message: types.Message, state: FSMContext):
                 keyboard.add(
                     InlineKeyboardButton(
                         f"✅ Активные ({active})",
-                        callback_data="deals_status:farmer:active",
+                        callback_data=DEALS_FILTER_CB.pack("farmer", "active"),
                     )
                 )
             if reserved > 0:
                 keyboard.add(
                     InlineKeyboardButton(
                         f"🔒 Зарезервированные ({reserved})",
-                        callback_data="deals_status:farmer:reserved",
+                        callback_data=DEALS_FILTER_CB.pack("farmer", "reserved"),
                     )
                 )
             if sold > 0:
                 keyboard.add(
                     InlineKeyboardButton(
                         f"💰 Проданные ({sold})",
-                        callback_data="deals_status:farmer:sold",
+                        callback_data=DEALS_FILTER_CB.pack("farmer", "sold"),
                     )
                 )
             if canceled > 0:
                 keyboard.add(
                     InlineKeyboardButton(
                         f"❌ Снятые с продажи ({canceled})",
-                        callback_data="deals_status:farmer:canceled",
+                        callback_data=DEALS_FILTER_CB.pack("farmer", "canceled"),
                     )
                 )
             if matches > 0:
                 keyboard.add(
                     InlineKeyboardButton(
                         f"🎯 С совпадениями ({matches})",
-                        callback_data="deals_status:farmer:matches",
+                        callback_data=DEALS_FILTER_CB.pack("farmer", "matches"),
                     )
                 )
 
@@ -36744,35 +41394,35 @@ async def show_user_deals(message: types.Message, state: FSMContext):
                 keyboard.add(
                     InlineKeyboardButton(
                         f"✅ Активные ({active})",
-                        callback_data="deals_status:exporter:active",
+                        callback_data=DEALS_FILTER_CB.pack("exporter", "active"),
                     )
                 )
             if filled > 0:
                 keyboard.add(
                     InlineKeyboardButton(
                         f"🔒 Заполненные ({filled})",
-                        callback_data="deals_status:exporter:filled",
+                        callback_data=DEALS_FILTER_CB.pack("exporter", "filled"),
                     )
                 )
             if closed > 0:
                 keyboard.add(
                     InlineKeyboardButton(
                         f"💰 Закрытые ({closed})",
-                        callback_data="deals_status:exporter:closed",
+                        callback_data=DEALS_FILTER_CB.pack("exporter", "closed"),
                     )
                 )
             if cancelled > 0:
                 keyboard.add(
                     InlineKeyboardButton(
                         f"❌ Отмененные ({cancelled})",
-                        callback_data="deals_status:exporter:cancelled",
+                        callback_data=DEALS_FILTER_CB.pack("exporter", "cancelled"),
                     )
                 )
             if completed > 0:
                 keyboard.add(
                     InlineKeyboardButton(
                         f"🎯 Завершенные ({completed})",
-                        callback_data="deals_status:exporter:completed",
+                        callback_data=DEALS_FILTER_CB.pack("exporter", "completed"),
                     )
                 )
 
@@ -36860,21 +41510,21 @@ async def show_user_deals(message: types.Message, state: FSMContext):
                 keyboard.add(
                     InlineKeyboardButton(
                         f"⏳ Ожидающие ({pending})",
-                        callback_data="deals_status:logist:pending",
+                        callback_data=DEALS_FILTER_CB.pack("logist", "pending"),
                     )
                 )
             if in_progress > 0:
                 keyboard.add(
                     InlineKeyboardButton(
                         f"🚗 В пути ({in_progress})",
-                        callback_data="deals_status:logist:in_progress",
+                        callback_data=DEALS_FILTER_CB.pack("logist", "in_progress"),
                     )
                 )
             if completed > 0:
                 keyboard.add(
                     InlineKeyboardButton(
                         f"✅ Доставлено ({completed})",
-                        callback_data="deals_status:logist:completed",
+                        callback_data=DEALS_FILTER_CB.pack("logist", "completed"),
                     )
                 )
 
@@ -36986,21 +41636,21 @@ async def show_user_deals(message: types.Message, state: FSMContext):
                 keyboard.add(
                     InlineKeyboardButton(
                         f"🟢 Активные ({active})",
-                        callback_data="deals_status:expeditor:active",
+                        callback_data=DEALS_FILTER_CB.pack("expeditor", "active"),
                     )
                 )
             if in_progress > 0:
                 keyboard.add(
                     InlineKeyboardButton(
                         f"⏳ В пути ({in_progress})",
-                        callback_data="deals_status:expeditor:in_progress",
+                        callback_data=DEALS_FILTER_CB.pack("expeditor", "in_progress"),
                     )
                 )
             if delivered > 0:
                 keyboard.add(
                     InlineKeyboardButton(
                         f"✅ Доставлено ({delivered})",
-                        callback_data="deals_status:expeditor:completed",
+                        callback_data=DEALS_FILTER_CB.pack("expeditor", "completed"),
                     )
                 )
 
@@ -37022,24 +41672,12 @@ async def show_user_deals(message: types.Message, state: FSMContext):
         await message.answer(f"❌ Ошибка: {str(e)}")
 
 
-@dp.callback_query_handler(
-    lambda q: q.data == "main_menu"
-)
+@router.callback_query_handler(data="main_menu")
 async def back_to_main_overview_handler(
     callback: types.CallbackQuery, state: FSMContext = None
 ):
     """✅ Возврат в главное меню для ВСЕХ кнопок назад"""
     user_id = callback.from_user.id
-    current_time = time.time()
-    last_click = last_back_click.get(user_id, 0)
-
-    # ✅ ANTISPAM: игнорируем клики быстрее 0.5 секунды
-    if current_time - last_click < 0.5:
-        logging.info(f"⏱️ Защита от спама: {user_id} нажимает слишком быстро")
-        await callback.answer("⏱️ Подождите немного...", show_alert=False)
-        return
-
-    last_back_click[user_id] = current_time
     await callback.answer()
 
     try:
@@ -37101,7 +41739,7 @@ async def back_to_main_overview_handler(
             logging.debug(f"Recovery edit failed in back_to_main: {recovery_error}")
 
 
-@dp.callback_query_handler(lambda c: c.data == "my_deals", state="*")
+@router.callback_query_handler(data="my_deals", state="*")
 async def my_deals_callback(callback: types.CallbackQuery, state: FSMContext):
     """Открывает единый экран сделок/партий с актуальной бизнес-логикой."""
     await state.finish()
@@ -37116,7 +41754,7 @@ async def my_deals_callback(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "stats", state="*")
+@router.callback_query_handler(data="stats", state="*")
 async def stats_callback(callback: types.CallbackQuery, state: FSMContext):
     """Статистика: админская для ADMIN_ID, базовая личная для остальных."""
     await state.finish()
@@ -37196,7 +41834,7 @@ async def stats_callback(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "settings", state="*")
+@router.callback_query_handler(data="settings", state="*")
 async def settings_callback(callback: types.CallbackQuery, state: FSMContext):
     """Настройки профиля через существующие edit_profile callbacks."""
     await state.finish()
@@ -37210,22 +41848,66 @@ async def settings_callback(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
+@router.callback_query_handler(data="notify_mode", prefix="notify_mode:", state="*")
+async def notify_mode_callback(callback: types.CallbackQuery, state: FSMContext):
+    """Выбор режима уведомлений: сразу или сводкой."""
+    await state.finish()
+    user_id = callback.from_user.id
+    user = get_user_by_id(user_id)
+    if not user:
+        await callback.answer("❌ Профиль не найден", show_alert=True)
+        return
+
+    if ":" in callback.data:
+        mode = callback.data.split(":", 1)[1]
+        if mode in (NOTIFY_MODE_INSTANT, NOTIFY_MODE_DIGEST):
+            user["notify_mode"] = mode
+            save_users_to_json()
+            if mode == NOTIFY_MODE_INSTANT:
+                await notification_digest.flush(str(user_id))
+
+    mode = get_notify_mode(user_id)
+    window_min = max(CONFIG["notify_digest_window"] // 60, 1)
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    keyboard.add(
+        InlineKeyboardButton(
+            ("✅ " if mode == NOTIFY_MODE_INSTANT else "") + "⚡ Сразу",
+            callback_data=f"notify_mode:{NOTIFY_MODE_INSTANT}",
+        ),
+        InlineKeyboardButton(
+            ("✅ " if mode == NOTIFY_MODE_DIGEST else "") + "🗂 Сводкой",
+            callback_data=f"notify_mode:{NOTIFY_MODE_DIGEST}",
+        ),
+    )
+    keyboard.add(InlineKeyboardButton("◀️ Назад", callback_data="settings"))
+    await callback.message.edit_text(
+        "🔔 <b>Уведомления</b>\n\n"
+        "⚡ <b>Сразу</b> — каждое событие отдельным сообщением.\n"
+        f"🗂 <b>Сводкой</b> — события за {window_min} мин. одним сообщением "
+        "(совпадения, новые заявки, отклонённые предложения).\n\n"
+        "Принятие вашего предложения приходит сразу в любом режиме.",
+        reply_markup=keyboard,
+        parse_mode="HTML",
+    )
+    await callback.answer()
+
+
 # ============================================================================
 # ФИЛЬТР ПО СТАТУСУ
 # ============================================================================
-@dp.callback_query_handler(lambda q: q.data.startswith("deals_status:"))
-async def filter_deals_by_status(callback: types.CallbackQuery):
+@router.callback_query_handler(action=DEALS_FILTER_CB)
+@throttle("deals")
+async def filter_deals_by_status(callback: types.CallbackQuery, payload):
     """✅ Фильтрует сделки по статусам - ПОЛНОСТЬЮ ИСПРАВЛЕНО"""
     await callback.answer()
 
     try:
-        parts = callback.data.split(":")
-        if len(parts) < 3:
+        if not payload.role or not payload.status:
             await callback.answer("Некорректный формат фильтра", show_alert=True)
             return
 
-        requested_role = str(parts[1]).strip().lower()
-        status = parts[2]
+        requested_role = str(payload.role).strip().lower()
+        status = payload.status
         user_id = callback.from_user.id
         user = get_user_by_id(user_id) or {}
         user_role = str(user.get("role", "")).strip().lower()
@@ -37809,7 +42491,7 @@ async def filter_deals_by_status(callback: types.CallbackQuery):
 # ============================================================================
 # 🏠 ГЛАВНОЕ МЕНЮ - обработчик
 # ============================================================================
-@dp.callback_query_handler(lambda q: q.data == "__legacy_main_menu_disabled__")
+@router.callback_query_handler(data="__legacy_main_menu_disabled__")
 async def go_main_menu_legacy(callback: types.CallbackQuery):
     """Legacy-заглушка: принудительный возврат через актуальный обработчик."""
     await back_to_main_overview_handler(callback, state=None)
@@ -37983,7 +42665,8 @@ def get_expeditors_data(logistics_id=None):
 # ════════════════════════════════════════════════════════════════════════════════════
 # ГЛАВНАЯ ФУНКЦИЯ - ДЛЯ ВСЕХ РОЛЕЙ
 # ════════════════════════════════════════════════════════════════════════════════════
-@dp.callback_query_handler(lambda q: q.data.startswith("deal_detail:"))
+@router.callback_query_handler(prefix="deal_detail:")
+@throttle("deals")
 async def show_deal_detail(callback: types.CallbackQuery):
     """✅ ФИНАЛЬНЫЙ ОБРАБОТЧИК: Показывает партию/пул/логистику со ВСЕМИ УЧАСТНИКАМИ"""
     await callback.answer()
@@ -38542,10 +43225,8 @@ async def show_deal_detail(callback: types.CallbackQuery):
                         )
                         if expeditor_assigned:
                             text += "\nℹ️ Финальный статус доставки фиксирует экспедитор.\n"
-                        status_target_ref = (
-                            f"delivery_{deal_id}"
-                            if item_id_str.startswith("delivery_")
-                            else str(deal_id)
+                        status_source = (
+                            "delivery" if item_id_str.startswith("delivery_") else ""
                         )
                         if (not expeditor_assigned) and current_status in {
                             "pending",
@@ -38558,20 +43239,26 @@ async def show_deal_detail(callback: types.CallbackQuery):
                             keyboard.add(
                                 InlineKeyboardButton(
                                     "🚚 В работу",
-                                    callback_data=f"change_logist_status:{status_target_ref}:in_progress",
+                                    callback_data=LOGIST_STATUS_CB.pack(
+                                        status_source, deal_id, "in_progress"
+                                    ),
                                 )
                             )
                             keyboard.add(
                                 InlineKeyboardButton(
                                     "❌ Отменить",
-                                    callback_data=f"change_logist_status:{status_target_ref}:cancelled",
+                                    callback_data=LOGIST_STATUS_CB.pack(
+                                        status_source, deal_id, "cancelled"
+                                    ),
                                 )
                             )
                         elif (not expeditor_assigned) and current_status == "in_progress" and not is_admin:
                             keyboard.add(
                                 InlineKeyboardButton(
                                     "✅ Завершить",
-                                    callback_data=f"change_logist_status:{status_target_ref}:completed",
+                                    callback_data=LOGIST_STATUS_CB.pack(
+                                        status_source, deal_id, "completed"
+                                    ),
                                 )
                             )
             except (ValueError, TypeError):
@@ -38873,14 +43560,18 @@ async def show_deal_detail(callback: types.CallbackQuery):
                             keyboard.add(
                                 InlineKeyboardButton(
                                     "🚚 В путь",
-                                    callback_data=f"change_expeditor_status:{deal_id}:in_progress",
+                                    callback_data=EXPEDITOR_STATUS_CB.pack(
+                                        deal_id, "in_progress"
+                                    ),
                                 )
                             )
                         elif current_status == "in_progress" and not is_admin:
                             keyboard.add(
                                 InlineKeyboardButton(
                                     "✅ Доставлено",
-                                    callback_data=f"change_expeditor_status:{deal_id}:completed",
+                                    callback_data=EXPEDITOR_STATUS_CB.pack(
+                                        deal_id, "completed"
+                                    ),
                                 )
                             )
             except (ValueError, TypeError):
@@ -38891,7 +43582,7 @@ async def show_deal_detail(callback: types.CallbackQuery):
 
         keyboard.add(
             InlineKeyboardButton(
-                "⬅️ Назад", callback_data=f"deals_status:{role}:{original_status}"
+                "⬅️ Назад", callback_data=DEALS_FILTER_CB.pack(role, original_status)
             )
         )
 
@@ -38930,7 +43621,7 @@ async def show_deal_detail(callback: types.CallbackQuery):
 # ============================================================================
 # СМЕНА СТАТУСОВ: ФЕРМЕР
 # ============================================================================
-@dp.callback_query_handler(lambda q: q.data.startswith("change_farmer_status:"))
+@router.callback_query_handler(prefix="change_farmer_status:")
 async def change_farmer_batch_status(callback: types.CallbackQuery):
     """✅ Фермер меняет статус партии"""
     await callback.answer()
@@ -39010,7 +43701,7 @@ async def change_farmer_batch_status(callback: types.CallbackQuery):
 # ============================================================================
 
 
-@dp.callback_query_handler(lambda q: q.data.startswith("change_exporter_status:"))
+@router.callback_query_handler(prefix="change_exporter_status:")
 async def change_exporter_pool_status(callback: types.CallbackQuery):
     """Совместимость: перенаправление старого callback на единый обработчик статусов пула."""
     try:
@@ -39035,28 +43726,19 @@ async def change_exporter_pool_status(callback: types.CallbackQuery):
 # ============================================================================
 # СМЕНА СТАТУСОВ: ЛОГИСТ
 # ============================================================================
-@dp.callback_query_handler(lambda q: q.data.startswith("change_logist_status:"))
-async def change_logist_delivery_status(callback: types.CallbackQuery):
+@router.callback_query_handler(action=LOGIST_STATUS_CB)
+async def change_logist_delivery_status(callback: types.CallbackQuery, payload):
     """✅ Логист меняет статус доставки (deliveries + legacy shipping_requests)."""
     try:
-        parts = callback.data.split(":")
-        if len(parts) < 3:
+        if payload.delivery_id is None or not payload.status:
             await callback.answer("❌ Некорректные данные", show_alert=True)
             return
-        delivery_ref = parts[1]
-        new_status = parts[2]
+        new_status = payload.status
         user_id = callback.from_user.id
-
-        delivery_id_raw = delivery_ref
-        force_source = None
-        if str(delivery_ref).startswith("delivery_"):
-            delivery_id_raw = str(delivery_ref).split("_", 1)[1]
-            force_source = "deliveries"
-        elif str(delivery_ref).startswith("req_"):
-            delivery_id_raw = str(delivery_ref).split("_", 1)[1]
-            force_source = "shipping_requests"
-
-        delivery_id = int(delivery_id_raw) if str(delivery_id_raw).isdigit() else delivery_id_raw
+        force_source = {"delivery": "deliveries", "req": "shipping_requests"}.get(
+            payload.source
+        )
+        delivery_id = payload.delivery_id
         source = None
         delivery = None
 
@@ -39633,7 +44315,7 @@ async def change_logist_delivery_status(callback: types.CallbackQuery):
             save_expeditor_offers()
 
         logging.info(
-            f"✅ Логист {user_id}: доставка {delivery_id_raw} {old_status} → {new_status} ({source})"
+            f"✅ Логист {user_id}: доставка {delivery_id} {old_status} → {new_status} ({source})"
         )
 
         await callback.message.edit_text(
@@ -39654,21 +44336,16 @@ async def change_logist_delivery_status(callback: types.CallbackQuery):
 # ============================================================================
 
 
-@dp.callback_query_handler(lambda q: q.data.startswith("change_expeditor_status:"))
-async def change_expeditor_freight_status(callback: types.CallbackQuery):
+@router.callback_query_handler(action=EXPEDITOR_STATUS_CB)
+async def change_expeditor_freight_status(callback: types.CallbackQuery, payload):
     """✅ Экспедитор меняет статус маршрута + ЗАКРЫВАЕТ СДЕЛКИ"""
     try:
-        parts = callback.data.split(":")
-        if len(parts) < 3:
+        if payload.freight_id is None or not payload.status:
             await callback.answer("❌ Некорректные данные", show_alert=True)
             return
-        freight_id_raw = parts[1]
-        new_status = parts[2]
+        new_status = payload.status
         user_id = callback.from_user.id
-
-        freight_id = (
-            int(freight_id_raw) if str(freight_id_raw).isdigit() else freight_id_raw
-        )
+        freight_id = payload.freight_id
         _, freight = find_expeditor_offer_by_id(freight_id)
         if not freight or not same_id(freight.get("expeditor_id"), user_id):
             await callback.answer("❌ Маршрут не найден", show_alert=True)
@@ -39784,7 +44461,7 @@ async def change_expeditor_freight_status(callback: types.CallbackQuery):
         # ✅ ЕСЛИ СТАТУС "completed" - закрываем ТОЛЬКО связанные сущности
         if new_status == "completed":
             logging.info(
-                f"🎉 Экспедитор {user_id}: маршрут {freight_id_raw} доставлен - обновление связанных сущностей"
+                f"🎉 Экспедитор {user_id}: маршрут {freight_id} доставлен - обновление связанных сущностей"
             )
 
             now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -40632,7 +45309,7 @@ async def change_expeditor_freight_status(callback: types.CallbackQuery):
         save_expeditor_offers()
 
         logging.info(
-            f"✅ Экспедитор {user_id}: маршрут {freight_id_raw} {old_status} → {new_status}"
+            f"✅ Экспедитор {user_id}: маршрут {freight_id} {old_status} → {new_status}"
         )
         await callback.answer("✅ Статус обновлен")
 
@@ -40641,7 +45318,7 @@ async def change_expeditor_freight_status(callback: types.CallbackQuery):
         await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
 
 
-@dp.callback_query_handler(lambda q: q.data.startswith("change_pull_status:"))
+@router.callback_query_handler(prefix="change_pull_status:")
 async def change_pull_status(callback: types.CallbackQuery):
     """Показать меню смены статуса пула (урезанный список статусов)."""
     try:
@@ -40721,7 +45398,7 @@ async def change_pull_status(callback: types.CallbackQuery):
             )
 
         keyboard.add(
-            InlineKeyboardButton("🔙 Назад", callback_data=f"view_pull:{pull_id}")
+            InlineKeyboardButton("🔙 Назад", callback_data=VIEW_PULL_CB.pack(pull_id))
         )
 
         await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
@@ -40733,7 +45410,7 @@ async def change_pull_status(callback: types.CallbackQuery):
         await callback.answer(f"❌ Ошибка: {str(e)[:50]}", show_alert=True)
 
 
-@dp.callback_query_handler(lambda q: q.data.startswith("confirm_pull_status:"))
+@router.callback_query_handler(prefix="confirm_pull_status:")
 async def confirm_pull_status(callback: types.CallbackQuery):
     """Применить новый статус к пулу, уведомить ВСЕХ присоединившихся фермеров и ВСЕХ логистов"""
     try:
@@ -41157,7 +45834,7 @@ async def confirm_pull_status(callback: types.CallbackQuery):
         keyboard_notification = InlineKeyboardMarkup()
         keyboard_notification.add(
             InlineKeyboardButton(
-                "📊 Посмотреть пул", callback_data=f"view_pull:{pull_id}"
+                "📊 Посмотреть пул", callback_data=VIEW_PULL_CB.pack(pull_id)
             )
         )
 
@@ -41182,7 +45859,7 @@ async def confirm_pull_status(callback: types.CallbackQuery):
         keyboard = InlineKeyboardMarkup(row_width=1)
         keyboard.add(
             InlineKeyboardButton(
-                "📊 Назад к пулу", callback_data=f"view_pull:{pull_id}"
+                "📊 Назад к пулу", callback_data=VIEW_PULL_CB.pack(pull_id)
             )
         )
         keyboard.add(
@@ -41218,7 +45895,7 @@ async def confirm_pull_status(callback: types.CallbackQuery):
 # ============================================================================
 # CALLBACK ALIASES / FALLBACKS
 # ============================================================================
-@dp.callback_query_handler(lambda c: c.data == "create_pull", state="*")
+@router.callback_query_handler(data="create_pull", state="*")
 async def create_pull_alias(callback: types.CallbackQuery, state: FSMContext):
     """Alias для старой inline-кнопки создания пула."""
     await state.finish()
@@ -41238,7 +45915,7 @@ async def create_pull_alias(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "view_pools", state="*")
+@router.callback_query_handler(data="view_pools", state="*")
 async def view_pools_alias(callback: types.CallbackQuery, state: FSMContext):
     """Alias для inline-кнопки просмотра пулов фермером."""
     await state.finish()
@@ -41276,7 +45953,7 @@ async def view_pools_alias(callback: types.CallbackQuery, state: FSMContext):
         keyboard.add(
             InlineKeyboardButton(
                 f"🌾 {pull.get('culture', '?')} - {pull.get('target_volume', 0)}т ({progress:.0f}%)",
-                callback_data=f"view_pull:{pull_id}",
+                callback_data=VIEW_PULL_CB.pack(pull_id),
             )
         )
     keyboard.add(InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_main"))
@@ -41288,7 +45965,7 @@ async def view_pools_alias(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "broadcast_cancel", state="*")
+@router.callback_query_handler(data="broadcast_cancel", state="*")
 async def broadcast_cancel_alias(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     user_role = (get_user_by_id(user_id) or {}).get("role")
@@ -41301,18 +45978,18 @@ async def broadcast_cancel_alias(callback: types.CallbackQuery, state: FSMContex
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_offers", state="*")
+@router.callback_query_handler(data="back_to_offers", state="*")
 async def back_to_offers_alias(callback: types.CallbackQuery, state: FSMContext):
     """Совместимость со старым callback_data."""
     await back_to_offers_list(callback, state)
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_deals", state="*")
+@router.callback_query_handler(data="back_to_deals", state="*")
 async def back_to_deals_alias(callback: types.CallbackQuery, state: FSMContext):
     await my_deals_callback(callback, state)
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_pools", state="*")
+@router.callback_query_handler(data="back_to_pools", state="*")
 async def back_to_pools_alias(callback: types.CallbackQuery):
     await callback.message.edit_text(
         "📋 Вернитесь к списку пулов.",
@@ -41323,7 +46000,7 @@ async def back_to_pools_alias(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "expeditor_available_deals", state="*")
+@router.callback_query_handler(data="expeditor_available_deals", state="*")
 async def expeditor_available_deals_alias(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     role = (get_user_by_id(user_id) or {}).get("role")
@@ -41339,9 +46016,7 @@ async def expeditor_available_deals_alias(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(
-    lambda c: c.data.startswith("confirm:") or c.data.startswith("cancel:"), state="*"
-)
+@router.callback_query_handler(prefix=["confirm:", "cancel:"], state="*")
 async def legacy_confirm_cancel_alias(callback: types.CallbackQuery, state: FSMContext):
     action = callback.data.split(":", 1)[1].strip() if ":" in callback.data else ""
     if action != "confirm":
@@ -41352,7 +46027,7 @@ async def legacy_confirm_cancel_alias(callback: types.CallbackQuery, state: FSMC
     await back_to_main_handler(callback, state)
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_date_"), state="*")
+@router.callback_query_handler(prefix="edit_date_", state="*")
 async def legacy_edit_date_alias(callback: types.CallbackQuery):
     await callback.message.edit_text(
         "ℹ️ Изменение даты в этом экране больше не поддерживается.\n"
@@ -41364,12 +46039,12 @@ async def legacy_edit_date_alias(callback: types.CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "edit_profile", state="*")
+@router.callback_query_handler(data="edit_profile", state="*")
 async def edit_profile_alias(callback: types.CallbackQuery, state: FSMContext):
     await settings_callback(callback, state)
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_shipping_requests", state="*")
+@router.callback_query_handler(data="back_to_shipping_requests", state="*")
 async def back_to_shipping_requests_alias(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -41390,7 +46065,7 @@ async def back_to_shipping_requests_alias(
     await callback.answer("❌ Раздел недоступен", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data == "create_expeditor_offer", state="*")
+@router.callback_query_handler(data="create_expeditor_offer", state="*")
 async def create_expeditor_offer_alias(callback: types.CallbackQuery, state: FSMContext):
     """Alias для запуска создания предложения экспедитора из callback-кнопок."""
     await state.finish()
@@ -41409,7 +46084,7 @@ async def create_expeditor_offer_alias(callback: types.CallbackQuery, state: FSM
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "view_logistics_offers_btn", state="*")
+@router.callback_query_handler(data="view_logistics_offers_btn", state="*")
 async def view_logistics_offers_btn_alias(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -41423,7 +46098,7 @@ async def view_logistics_offers_btn_alias(
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "show_more_pulls_expeditor", state="*")
+@router.callback_query_handler(data="show_more_pulls_expeditor", state="*")
 async def show_more_pulls_expeditor_alias(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -41432,7 +46107,7 @@ async def show_more_pulls_expeditor_alias(
     await show_expeditor_available_pulls(callback, state)
 
 
-@dp.callback_query_handler(lambda c: c.data == "back_to_exp_deliveries", state="*")
+@router.callback_query_handler(data="back_to_exp_deliveries", state="*")
 async def back_to_exp_deliveries_alias(callback: types.CallbackQuery, state: FSMContext):
     """Возврат к списку доставок экспедитора/логиста."""
     await state.finish()
@@ -41589,7 +46264,7 @@ async def back_to_exp_deliveries_alias(callback: types.CallbackQuery, state: FSM
     await callback.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "delivery_history", state="*")
+@router.callback_query_handler(data="delivery_history", state="*")
 async def delivery_history_alias(callback: types.CallbackQuery, state: FSMContext):
     """История доставок через callback-кнопку."""
     await state.finish()
@@ -41726,14 +46401,13 @@ async def delivery_history_alias(callback: types.CallbackQuery, state: FSMContex
     await callback.answer("❌ Раздел недоступен", show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data == "back", state="*")
+@router.callback_query_handler(data="back", state="*")
 async def legacy_back_alias(callback: types.CallbackQuery, state: FSMContext):
     await back_to_main_handler(callback, state)
 
 
-@dp.callback_query_handler(
-    lambda c: c.data
-    in {
+@router.callback_query_handler(
+    data=[
         "vehicle:truck",
         "vehicle:train",
         "vehicle:ship",
@@ -41743,7 +46417,7 @@ async def legacy_back_alias(callback: types.CallbackQuery, state: FSMContext):
         "transport_type:truck",
         "transport_type:train",
         "transport_type:ship",
-    },
+    ],
     state="*",
 )
 async def legacy_transport_callback_alias(
@@ -41758,7 +46432,7 @@ async def legacy_transport_callback_alias(
     await back_to_main_handler(callback, state)
 
 
-@dp.callback_query_handler(state="*")
+@router.callback_query_handler(state="*")
 async def unknown_callback_fallback(callback: types.CallbackQuery, state: FSMContext):
     """Последний fallback: не даём callback-ам зависать без ответа."""
     await state.finish()
@@ -41775,10 +46449,171 @@ async def unknown_callback_fallback(callback: types.CallbackQuery, state: FSMCon
         logging.debug(f"Не удалось отрисовать unknown_callback_fallback: {e}")
 
 
+# ============================================================================
+# WEBHOOK-РЕЖИМ (альтернатива long polling)
+# ============================================================================
+class WebhookUpdateServer:
+    """
+    aiohttp-сервер для приёма апдейтов Telegram по webhook.
+
+    Запрос проверяется по секрету (X-Telegram-Bot-Api-Secret-Token), апдейт
+    запускается отдельной задачей, и Telegram сразу получает 200. Порядок
+    по пользователю и общий лимит параллельности обеспечивает UpdateScheduler,
+    поэтому апдейт идёт через dp.updates_handler (с middleware). Если в
+    обработке уже CONFIG["webhook_queue_size"] апдейтов или идёт остановка,
+    отвечаем 503 — Telegram повторит доставку позже. Webhook ставится без drop_pending_updates,
+    поэтому накопленные за время рестарта апдейты приходят заново.
+
+    Апдейт, на который уже ответили 200, Telegram не повторит: если при
+    остановке он не успел обработаться за CONFIG["webhook_drain_timeout"],
+    он отменяется и записывается в WEBHOOK_UNPROCESSED_FILE (и в лог) для
+    ручного разбора — автоматически он не переигрывается, потому что
+    обработчик мог успеть выполнить часть действий.
+    """
+
+    SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+    def __init__(self, dispatcher: Dispatcher):
+        self.dp = dispatcher
+        self._pending = {}  # задача апдейта в обработке -> апдейт (dict)
+        self._accepting = False
+        self.metrics = {
+            "received": 0,
+            "processed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "unauthorized": 0,
+        }
+
+    @property
+    def webhook_url(self) -> str:
+        return WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+            request.headers.get(self.SECRET_HEADER, ""), WEBHOOK_SECRET
+        ):
+            self.metrics["unauthorized"] += 1
+            return web.Response(status=401)
+        if not self._accepting:
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except Exception:
+            return web.Response(status=400)
+
+        if len(self._pending) >= CONFIG["webhook_queue_size"]:
+            self.metrics["rejected"] += 1
+            logging.warning(
+                "⚠️ Webhook: слишком много апдейтов в обработке, Telegram повторит"
+            )
+            return web.Response(status=503)
+        # Отдельная задача = свежий контекст: aiogram кэширует FSM-состояние
+        # и текущего пользователя в ContextVar'ах на время одного апдейта
+        task = asyncio.get_event_loop().create_task(self._process(data))
+        self._pending[task] = data
+        task.add_done_callback(lambda done: self._pending.pop(done, None))
+        self.metrics["received"] += 1
+        return web.Response(text="ok")
+
+    async def _process(self, data: dict):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        try:
+            await self.dp.updates_handler.notify(types.Update(**data))
+            self.metrics["processed"] += 1
+        except Exception as e:
+            self.metrics["failed"] += 1
+            logging.error(
+                f"❌ Webhook: ошибка обработки апдейта {data.get('update_id')}: {e}",
+                exc_info=True,
+            )
+
+    async def on_app_startup(self, app):
+        await on_startup(self.dp)
+        self._accepting = True
+        await self.dp.bot.set_webhook(
+            self.webhook_url,
+            secret_token=WEBHOOK_SECRET or None,
+            drop_pending_updates=False,
+            max_connections=CONFIG["webhook_max_connections"],
+        )
+        logging.info(f"🌐 Webhook установлен: {self.webhook_url}")
+
+    async def on_app_shutdown(self, app):
+        # Новые апдейты не принимаем (Telegram повторит их после рестарта),
+        # уже принятые дообрабатываем; не успевшие — сохраняем
+        self._accepting = False
+        if self._pending:
+            _, unfinished = await asyncio.wait(
+                set(self._pending), timeout=CONFIG["webhook_drain_timeout"]
+            )
+            if unfinished:
+                self.save_unprocessed([self._pending[task] for task in unfinished])
+                for task in unfinished:
+                    task.cancel()
+                await asyncio.gather(*unfinished, return_exceptions=True)
+        logging.info(f"🌐 Webhook остановлен: {self.metrics}")
+        await on_shutdown(self.dp)
+
+    @staticmethod
+    def save_unprocessed(updates: list):
+        """Дописывает прерванные апдейты в WEBHOOK_UNPROCESSED_FILE."""
+        update_ids = [update.get("update_id") for update in updates]
+        logging.warning(
+            f"⚠️ Webhook: не дообработано апдейтов: {len(updates)}, "
+            f"update_id: {update_ids} — сохранены в {WEBHOOK_UNPROCESSED_FILE}"
+        )
+        try:
+            os.makedirs(DATA_DIR, exist_ok=True)
+            stopped_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            with open(WEBHOOK_UNPROCESSED_FILE, "a", encoding="utf-8") as f:
+                for update in updates:
+                    record = {"stopped_at": stopped_at, "update": update}
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logging.error(f"❌ Webhook: не удалось сохранить прерванные апдейты: {e}")
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        app.on_startup.append(self.on_app_startup)
+        app.on_shutdown.append(self.on_app_shutdown)
+        return app
+
+    def run(self):
+        if not WEBHOOK_URL:
+            raise RuntimeError("WEBHOOK_URL is not set. Configure it in .env")
+        web.run_app(self.build_app(), host=WEBAPP_HOST, port=WEBAPP_PORT)
+
+
 # ============================================================================
 # ЗАПУСК БОТА
 # ============================================================================
 if __name__ == "__main__":
+    if "--bench-sheets" in sys.argv:
+        # Замер синхронизации с таблицей в памяти; бот не запускается
+        logging.getLogger().setLevel(logging.WARNING)
+        bench = benchmark_sheets_sync(
+            latency=(FAKE_SHEETS_LATENCY_MS or 20) / 1000,
+            error_rate=FAKE_SHEETS_ERROR_RATE,
+        )
+        print(format_sheets_benchmark(asyncio.run(bench)))
+        sys.exit(0)
+
+    if "--bench-parsers" in sys.argv:
+        # Замер разбора записанных страниц цен и новостей; бот не запускается
+        logging.getLogger().setLevel(logging.WARNING)
+        fixtures_dir = MARKET_FIXTURES_DIR or os.path.join(DATA_DIR, "market_fixtures")
+        if not os.path.exists(os.path.join(fixtures_dir, MARKET_FIXTURES_INDEX)):
+            print(
+                f"Нет записанных страниц в {fixtures_dir}: "
+                "запустите бота с MARKET_FIXTURES_DIR"
+            )
+            sys.exit(1)
+        print(format_market_parsers_benchmark(benchmark_market_parsers(fixtures_dir)))
+        sys.exit(0)
+
     logging.info("🚀 Запуск бота...")
     try:
         os.makedirs("data", exist_ok=True)
@@ -41786,6 +46621,9 @@ if __name__ == "__main__":
     except Exception as e:
         logging.error(f"❌ Ошибка создания директорий: {e}")
 
-    executor.start_polling(
-        dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown
-    )
+    if BOT_MODE == "webhook":
+        WebhookUpdateServer(dp).run()
+    else:
+        executor.start_polling(
+            dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown
+        )